@@ -1,10 +1,34 @@
 import httpx
 import asyncio
+import json
 
 # Configuration
-QUERY_ENDPOINT = "http://localhost:8000/query-ads"
+QUERY_ENDPOINT = "http://localhost:8000/query-ads/stream"
 HEADERS = {"Content-Type": "application/json"}
 
+async def render_stream(response: httpx.Response):
+    """Prints the NDJSON events of /query-ads/stream as they arrive."""
+    async for line in response.aiter_lines():
+        if not line:
+            continue
+        event = json.loads(line)
+        if event["type"] == "retrieval":
+            print(f"\nRetrieved {len(event['ads'])} ads:")
+            for ad in event["ads"]:
+                similarity = ad.get("similarity")
+                score = f"{similarity:.3f}" if similarity is not None else "n/a"
+                print(f"  - ad {ad.get('ad_id')} (similarity {score})")
+            print("\n--- Synthesized Answer ---")
+        elif event["type"] == "token":
+            print(event["text"], end="", flush=True)
+        elif event["type"] == "done":
+            timings = event.get("timings", {})
+            breakdown = ", ".join(f"{name.removesuffix('_ms')} {value:.0f} ms" for name, value in timings.items())
+            print(f"\n (Retrieved {event.get('retrieved_ads_count', 0)} ads for context; {breakdown})")
+            print("-" * 26)
+        elif event["type"] == "error":
+            print(f"\nError: {event.get('detail')}")
+
 async def main():
     print("--- AdGenesis Interactive Query Client ---")
     print("Type your question and press Enter. Type 'exit' to quit.")
@@ -27,14 +51,11 @@ async def main():
                 }
 
                 print("Sending query to the AdGenesis Engine...")
-                response = await client.post(QUERY_ENDPOINT, json=query_payload, headers=HEADERS)
-                response.raise_for_status()
-
-                query_result = response.json()
-                print("\n--- Synthesized Answer ---")
-                print(query_result.get("answer", "No answer provided."))
-                print(f" (Retrieved {query_result.get('retrieved_ads_count', 0)} ads for context)")
-                print("-" * 26)
+                async with client.stream("POST", QUERY_ENDPOINT, json=query_payload, headers=HEADERS) as response:
+                    if response.is_error:
+                        await response.aread()
+                    response.raise_for_status()
+                    await render_stream(response)
 
             except httpx.HTTPStatusError as e:
                 print(f"\nError: Could not query the API. Status code: {e.response.status_code}")
@@ -0,0 +1,108 @@
+"""
+Load-tests a DB-bound endpoint (`GET /ads/{id}/status`) at increasing
+concurrency and reports throughput and p50/p99 latency per level.
+
+Without `--url` the app runs in-process (httpx over ASGI, one event loop like a
+uvicorn worker) against two stand-ins for the database that charge `--db-ms`
+per query:
+  * blocking  sleeps synchronously, like the synchronous Supabase client called
+              from an `async def` endpoint did: every query stalls the loop,
+  * async     awaits, like the pooled asyncpg `Database` (with `--pool-size`
+              connections, so queries beyond it queue for a connection).
+With `--url` it load-tests a running server (and its real database) instead;
+pass an existing ad UUID with `--ad-id`.
+
+    python -m scripts.bench_api_load --concurrency 1,8,32,128 --requests 400 --db-ms 5
+    python -m scripts.bench_api_load --url http://localhost:8000 --ad-id <uuid>
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+import httpx
+
+from scripts.bench_vector_search import _percentile
+from src.dependencies import get_db
+from src.main import app
+
+
+class BlockingStandIn:
+    def __init__(self, db_s: float):
+        self._db_s = db_s
+
+    async def get_ad_status(self, ad_id: str) -> Optional[Dict[str, Any]]:
+        time.sleep(self._db_s)
+        return {"status": "ENRICHED", "error_log": None}
+
+
+class AsyncStandIn:
+    def __init__(self, db_s: float, pool_size: int):
+        self._db_s = db_s
+        self._pool_size = pool_size
+        self._connections: Optional[asyncio.Semaphore] = None
+
+    async def get_ad_status(self, ad_id: str) -> Optional[Dict[str, Any]]:
+        if self._connections is None:
+            self._connections = asyncio.Semaphore(self._pool_size)
+        async with self._connections:
+            await asyncio.sleep(self._db_s)
+        return {"status": "ENRICHED", "error_log": None}
+
+
+async def _load(client: httpx.AsyncClient, path: str, concurrency: int, requests: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    remaining = iter(range(requests))
+
+    async def worker() -> None:
+        for _ in remaining:
+            start = time.perf_counter()
+            response = await client.get(path)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {"rps": requests / elapsed, "p50": _percentile(latencies, 50), "p99": _percentile(latencies, 99)}
+
+
+def _report(label: str, concurrency: int, result: Dict[str, float]) -> None:
+    print(f"  {label:<9} c={concurrency:<4d} {result['rps']:9.1f} req/s   p50 {result['p50']:7.1f} ms   p99 {result['p99']:7.1f} ms")
+
+
+async def run(args) -> None:
+    levels = [int(level) for level in args.concurrency.split(",")]
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+            for concurrency in levels:
+                _report("server", concurrency, await _load(client, f"/ads/{args.ad_id}/status", concurrency, args.requests))
+        return
+
+    print(f"db={args.db_ms} ms per query, pool={args.pool_size}, {args.requests} requests per level")
+    stand_ins = {
+        "blocking": BlockingStandIn(args.db_ms / 1000),
+        "async": AsyncStandIn(args.db_ms / 1000, args.pool_size),
+    }
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        for concurrency in levels:
+            for label, stand_in in stand_ins.items():
+                app.dependency_overrides[get_db] = lambda stand_in=stand_in: stand_in
+                _report(label, concurrency, await _load(client, f"/ads/{uuid4()}/status", concurrency, args.requests))
+    app.dependency_overrides.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32,128", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=400, help="Requests per concurrency level")
+    parser.add_argument("--db-ms", type=float, default=5.0, help="Simulated query latency (in-process mode)")
+    parser.add_argument("--pool-size", type=int, default=10, help="Simulated pool size; matches DB_POOL_MAX_SIZE")
+    parser.add_argument("--url", help="Load-test a running server instead of the in-process app")
+    parser.add_argument("--ad-id", help="Ad UUID to query with --url")
+    args = parser.parse_args()
+    if args.url and not args.ad_id:
+        parser.error("--ad-id is required with --url")
+    asyncio.run(run(args))
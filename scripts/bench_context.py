@@ -0,0 +1,95 @@
+"""
+Benchmarks synthesis context size and latency: full `AdKnowledgeObject` JSON
+dumps (the previous retriever output) against the compact context builder.
+
+Search results are simulated from `test_dataset.json`: every ad gets canned
+analyses and a 768-float embedding, and is repeated `--reruns` times under new
+ad IDs and re-signed creative URLs, as re-launched ads appear in the Ad Library.
+Synthesis runs through the real response synthesizer on a fake LLM whose
+latency grows with prompt length.
+
+Usage:
+    python -m scripts.bench_context --k 10 --reruns 2 --budget 6000
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from src.context_builder import build_context_nodes, count_tokens
+from src.models import AdKnowledgeObject
+from src.query_engine import create_response_synthesizer
+from scripts.fake_models import PERSONA_RESPONSE, STRATEGIC_RESPONSE, VISUAL_RESPONSE, LatencyFakeLLM
+
+DATASET = Path(__file__).resolve().parent.parent / "test_dataset.json"
+
+
+def _search_results(k: int, reruns: int):
+    ads = json.loads(DATASET.read_text())
+    rows = []
+    for rerun in range(reruns):
+        for index, ad in enumerate(ads):
+            snapshot = json.loads(json.dumps(ad))
+            snapshot["ad_id"] = ad["ad_id"] + rerun
+            for creative in snapshot.get("creatives") or []:
+                if creative.get("original_url"):
+                    creative["original_url"] += f"&oe=rerun{rerun}"
+            rows.append({
+                "ad_id": snapshot["ad_id"],
+                "status": "ENRICHED",
+                "raw_data_snapshot": snapshot,
+                "strategic_analysis": json.loads(STRATEGIC_RESPONSE),
+                "visual_analysis": json.loads(VISUAL_RESPONSE),
+                "audience_persona": PERSONA_RESPONSE,
+                "vector_summary": [((index + i) % 97) / 97 for i in range(768)],
+                "similarity": 0.9 - 0.01 * len(rows),
+            })
+    return rows[:k]
+
+
+def _full_json_nodes(rows):
+    return [
+        NodeWithScore(node=TextNode(text=AdKnowledgeObject(**row).model_dump_json(indent=2), metadata={"source": "Supabase"}), score=1.0)
+        for row in rows
+    ]
+
+
+async def _synthesize(nodes, llm_latency_s: float, latency_per_1k_chars: float):
+    model = LatencyFakeLLM(latency_s=llm_latency_s, latency_per_1k_chars=latency_per_1k_chars)
+    synthesizer = create_response_synthesizer(model)
+    start = time.perf_counter()
+    await synthesizer.asynthesize("Which marketing angles dominate these ads?", nodes)
+    return time.perf_counter() - start, model.calls, model.input_chars
+
+
+def run(k: int, reruns: int, budget: int, llm_latency_s: float, latency_per_1k_chars: float) -> None:
+    rows = _search_results(k, reruns)
+
+    results = {}
+    for label, build in (
+        ("full JSON dumps", lambda: _full_json_nodes(rows)),
+        ("compact context", lambda: build_context_nodes(rows, token_budget=budget)),
+    ):
+        start = time.perf_counter()
+        nodes = build()
+        build_s = time.perf_counter() - start
+        tokens = sum(count_tokens(node.node.get_content()) for node in nodes)
+        synthesis_s, calls, input_chars = asyncio.run(_synthesize(nodes, llm_latency_s, latency_per_1k_chars))
+        results[label] = tokens
+        print(f"{label:<16}: {len(nodes):3d} nodes {tokens:8,d} context tokens, build {build_s * 1000:6.1f} ms, "
+              f"synthesis {synthesis_s * 1000:7.0f} ms in {calls} LLM call(s), {input_chars:,d} prompt chars")
+    print(f"context tokens reduced {results['full JSON dumps'] / results['compact context']:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--reruns", type=int, default=2, help="Copies of each dataset ad among the search results")
+    parser.add_argument("--budget", type=int, default=6000, help="Context token budget of the compact builder")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--latency-ms-per-1k-chars", type=float, default=15, help="Simulated prefill cost")
+    args = parser.parse_args()
+    run(args.k, args.reruns, args.budget, args.llm_latency_ms / 1000, args.latency_ms_per_1k_chars / 1000)
@@ -0,0 +1,72 @@
+"""
+Benchmarks the embedding service layer: model calls and wall time for a burst
+of concurrent queries (with repeats, as dashboards issue them) embedded
+directly versus through `EmbeddingService`, cold and warm.
+
+Usage:
+    python -m scripts.bench_embeddings --embed-latency-ms 100 --queries 200 --distinct 40
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from src.embeddings import EmbeddingService
+from src.llm_cache import SQLiteCacheStore
+from src.metrics import Metrics
+from scripts.fake_models import LatencyFakeEmbeddings
+
+
+async def _embed_all(embedding_model, queries):
+    return await asyncio.gather(*(embedding_model.aembed_query(query) for query in queries))
+
+
+def run(embed_latency_s: float, queries: int, distinct: int, window_ms: float) -> None:
+    texts = [f"Which ads use social proof for product line {i % distinct}?" for i in range(queries)]
+    loop = asyncio.new_event_loop()
+
+    direct = LatencyFakeEmbeddings(latency_s=embed_latency_s)
+    start = time.perf_counter()
+    loop.run_until_complete(_embed_all(direct, texts))
+    direct_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteCacheStore(Path(tmp) / "embeddings.sqlite3", max_entries=10_000, table="embedding_cache")
+        model = LatencyFakeEmbeddings(latency_s=embed_latency_s)
+        service = EmbeddingService(model, store=store, batch_window_ms=window_ms, metrics=Metrics())
+
+        start = time.perf_counter()
+        loop.run_until_complete(_embed_all(service, texts))
+        cold_s = time.perf_counter() - start
+        cold_calls = model.calls
+
+        start = time.perf_counter()
+        loop.run_until_complete(_embed_all(service, texts))
+        warm_s = time.perf_counter() - start
+        warm_calls = model.calls - cold_calls
+
+        restarted = EmbeddingService(model, store=store, batch_window_ms=window_ms, metrics=Metrics())
+        start = time.perf_counter()
+        loop.run_until_complete(_embed_all(restarted, texts))
+        restart_s = time.perf_counter() - start
+        restart_calls = model.calls - cold_calls - warm_calls
+        store.close()
+    loop.close()
+
+    print(f"{queries} concurrent queries, {distinct} distinct, embedding latency {embed_latency_s * 1000:.0f} ms")
+    print(f"  direct aembed_query           : {direct.calls:4d} calls {direct_s * 1000:8.1f} ms")
+    print(f"  service, cold                 : {cold_calls:4d} calls {cold_s * 1000:8.1f} ms")
+    print(f"  service, warm (LRU)           : {warm_calls:4d} calls {warm_s * 1000:8.1f} ms")
+    print(f"  new process, warm store       : {restart_calls:4d} calls {restart_s * 1000:8.1f} ms")
+    print(f"  calls saved over 3 passes     : {3 * direct.calls - model.calls}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--embed-latency-ms", type=float, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--distinct", type=int, default=40)
+    parser.add_argument("--window-ms", type=float, default=5)
+    args = parser.parse_args()
+    run(args.embed_latency_ms / 1000, args.queries, args.distinct, args.window_ms)
@@ -0,0 +1,70 @@
+"""
+Benchmarks per-ad enrichment wall time of the blocking pipeline (`enrich_ad`)
+against the async engine (`aenrich_ad`) in its default and fast modes, using
+fake chat/embedding models with injected latency.
+
+Usage:
+    python -m scripts.bench_enrichment_concurrency --llm-latency-ms 400 --embed-latency-ms 100 --ads 20
+"""
+import argparse
+import asyncio
+import time
+from uuid import uuid4
+
+from src.enrichment_pipeline import aenrich_ad, enrich_ad
+from src.models import AdKnowledgeObject
+from scripts.fake_models import LatencyFakeChatModel, LatencyFakeEmbeddings
+
+
+def _ad(i: int) -> AdKnowledgeObject:
+    return AdKnowledgeObject(
+        id=uuid4(),
+        ad_id=i,
+        raw_data_snapshot={
+            "ad_creative_url": f"https://example.com/creative/{i}.jpg",
+            "ad_body_text": "These feel like walking on a pillow but still look super cute.",
+            "targeting_data": {"age": "25-44"},
+        },
+    )
+
+
+def run(llm_latency_s: float, embed_latency_s: float, ads: int) -> None:
+    flash = LatencyFakeChatModel(latency_s=llm_latency_s)
+    pro = LatencyFakeChatModel(latency_s=llm_latency_s)
+    embeddings = LatencyFakeEmbeddings(latency_s=embed_latency_s)
+
+    start = time.perf_counter()
+    assert enrich_ad(_ad(0), flash, pro, embeddings, None).status == "ENRICHED"
+    blocking_s = time.perf_counter() - start
+
+    loop = asyncio.new_event_loop()
+    start = time.perf_counter()
+    assert loop.run_until_complete(aenrich_ad(_ad(0), flash, pro, embeddings, None)).status == "ENRICHED"
+    async_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert loop.run_until_complete(aenrich_ad(_ad(0), flash, pro, embeddings, None, fast_mode=True)).status == "ENRICHED"
+    fast_s = time.perf_counter() - start
+
+    async def enrich_many(fast_mode: bool):
+        return await asyncio.gather(*(aenrich_ad(_ad(i), flash, pro, embeddings, None, fast_mode=fast_mode) for i in range(ads)))
+
+    start = time.perf_counter()
+    loop.run_until_complete(enrich_many(fast_mode=True))
+    many_s = time.perf_counter() - start
+    loop.close()
+
+    print(f"LLM latency {llm_latency_s * 1000:.0f} ms, embedding latency {embed_latency_s * 1000:.0f} ms")
+    print(f"  enrich_ad (blocking)         : {blocking_s * 1000:8.0f} ms/ad")
+    print(f"  aenrich_ad (default)         : {async_s * 1000:8.0f} ms/ad")
+    print(f"  aenrich_ad (fast_mode)       : {fast_s * 1000:8.0f} ms/ad  ({blocking_s / fast_s:.1f}x faster)")
+    print(f"  {ads:>3} ads on one loop (fast)   : {many_s * 1000:8.0f} ms total")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency-ms", type=float, default=400)
+    parser.add_argument("--embed-latency-ms", type=float, default=100)
+    parser.add_argument("--ads", type=int, default=20)
+    args = parser.parse_args()
+    run(args.llm_latency_ms / 1000, args.embed_latency_ms / 1000, args.ads)
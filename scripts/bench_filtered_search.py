@@ -0,0 +1,169 @@
+"""
+Benchmarks filtered vector search on synthetic ads with skewed facet
+distributions (Zipf-distributed pages, a few dominant marketing angles and
+display formats).
+
+For each filter it compares:
+  * legacy      JSONB predicates + HNSW without iterative scan (the old RPC shape;
+                selective filters return fewer than k rows),
+  * prefilter   facet-column indexes, then exact ranking of the candidates,
+  * postfilter  HNSW with an iterative scan over the facet columns,
+and shows which strategy `match_ads_filtered`'s selectivity rule picks from the
+planner's estimate. Reports recall@k against exact search, how often all k rows
+came back, and p50/p95 latency.
+
+    python -m scripts.bench_filtered_search --dsn postgresql://... --rows 200000 --queries 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List
+
+import asyncpg
+import numpy as np
+
+from scripts.bench_vector_search import _connect, _percentile, _synthetic_vectors
+
+SCHEMA = "bench_vector"
+TABLE = f"{SCHEMA}.ads_facets"
+ANGLES = ["Social Proof", "Feature-Benefit", "Scarcity", "Pain-Agitate-Solution", "Urgency", "Authority", "Humor", "Nostalgia"]
+ANGLE_WEIGHTS = np.array([0.45, 0.25, 0.12, 0.08, 0.05, 0.03, 0.015, 0.005])
+FORMATS = ["VIDEO", "IMAGE", "DCO", "CAROUSEL"]
+FORMAT_WEIGHTS = np.array([0.6, 0.33, 0.05, 0.02])
+
+
+async def seed(conn: asyncpg.Connection, rows: int, pages: int, centroids: np.ndarray, rng: np.random.Generator) -> None:
+    await conn.execute(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}")
+    await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    await conn.execute(
+        f"CREATE TABLE {TABLE} (id BIGINT PRIMARY KEY, status TEXT NOT NULL, raw_data_snapshot JSONB NOT NULL,"
+        f" strategic_analysis JSONB NOT NULL, vector_summary VECTOR({centroids.shape[1]}) NOT NULL,"
+        " marketing_angle TEXT GENERATED ALWAYS AS (strategic_analysis->>'marketing_angle') STORED,"
+        " page_name TEXT GENERATED ALWAYS AS (raw_data_snapshot->>'page_name') STORED,"
+        " ad_display_format TEXT GENERATED ALWAYS AS (raw_data_snapshot->>'ad_display_format') STORED)"
+    )
+    batch_size = 20_000
+    for start in range(0, rows, batch_size):
+        count = min(batch_size, rows - start)
+        vectors = _synthetic_vectors(rng, count, centroids)
+        page_ids = np.minimum(rng.zipf(1.3, count), pages)
+        angles = rng.choice(ANGLES, count, p=ANGLE_WEIGHTS / ANGLE_WEIGHTS.sum())
+        formats = rng.choice(FORMATS, count, p=FORMAT_WEIGHTS / FORMAT_WEIGHTS.sum())
+        records = [
+            (
+                start + i, "ENRICHED",
+                json.dumps({"page_name": f"page-{page_ids[i]}", "ad_display_format": str(formats[i])}),
+                json.dumps({"marketing_angle": str(angles[i])}),
+                vectors[i].tolist(),
+            )
+            for i in range(count)
+        ]
+        await conn.copy_records_to_table(
+            "ads_facets", schema_name=SCHEMA, records=records,
+            columns=["id", "status", "raw_data_snapshot", "strategic_analysis", "vector_summary"],
+        )
+        print(f"  seeded {start + count:>9,d} / {rows:,d}", end="\r", flush=True)
+    print()
+    await conn.execute("SET maintenance_work_mem = '2GB'")
+    await conn.execute(
+        f"CREATE INDEX ON {TABLE} USING hnsw (vector_summary vector_cosine_ops)"
+        " WITH (m = 16, ef_construction = 64) WHERE status = 'ENRICHED'"
+    )
+    for column in ("marketing_angle", "page_name", "ad_display_format"):
+        await conn.execute(f"CREATE INDEX ON {TABLE} ({column}) WHERE status = 'ENRICHED'")
+    await conn.execute(
+        f"CREATE STATISTICS IF NOT EXISTS {SCHEMA}.ads_facets_stats (dependencies, mcv)"
+        f" ON marketing_angle, page_name, ad_display_format FROM {TABLE}"
+    )
+    await conn.execute(f"ANALYZE {TABLE}")
+
+
+def _where(filters: Dict[str, str], legacy: bool) -> str:
+    clauses = ["status = 'ENRICHED'"]
+    for column, value in filters.items():
+        if legacy:
+            source = "strategic_analysis" if column == "marketing_angle" else "raw_data_snapshot"
+            clauses.append(f"{source}->>'{column}' = '{value}'")
+        else:
+            clauses.append(f"{column} = '{value}'")
+    return " AND ".join(clauses)
+
+
+async def _estimate_rows(conn: asyncpg.Connection, where: str) -> float:
+    plan = json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {TABLE} WHERE {where}"))
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+async def _search(conn: asyncpg.Connection, query: List[float], k: int, where: str, settings: dict):
+    async with conn.transaction():
+        for name, value in settings.items():
+            await conn.execute("SELECT set_config($1, $2, true)", name, str(value))
+        start = time.perf_counter()
+        rows = await conn.fetch(f"SELECT id FROM {TABLE} WHERE {where} ORDER BY vector_summary <=> $1 LIMIT $2", query, k)
+        return [row["id"] for row in rows], time.perf_counter() - start
+
+
+async def run(args) -> None:
+    rng = np.random.default_rng(11)
+    conn = await _connect(args.dsn)
+    centroids = np.random.default_rng(args.dimensions).normal(size=(256, args.dimensions)).astype(np.float32)
+    if not args.reuse:
+        print(f"Seeding {args.rows:,d} ads with skewed facets into {TABLE} ...")
+        await seed(conn, args.rows, args.pages, centroids, rng)
+    total = await conn.fetchval(f"SELECT count(*) FROM {TABLE} WHERE status = 'ENRICHED'")
+    queries = [vector.tolist() for vector in _synthetic_vectors(rng, args.queries, centroids)]
+
+    filters = {
+        "head page": {"page_name": "page-1"},
+        "tail page": {"page_name": "page-500"},
+        "common angle": {"marketing_angle": "Social Proof"},
+        "rare angle + format": {"marketing_angle": "Nostalgia", "ad_display_format": "DCO"},
+        "common angle + format": {"marketing_angle": "Feature-Benefit", "ad_display_format": "VIDEO"},
+    }
+    hnsw = {"hnsw.ef_search": args.ef_search}
+    modes = {
+        "legacy": (True, {**hnsw, "hnsw.iterative_scan": "off"}),
+        "prefilter": (False, {"enable_indexscan": "off"}),
+        "postfilter": (False, {**hnsw, "hnsw.iterative_scan": "relaxed_order", "hnsw.max_scan_tuples": args.max_scan_tuples}),
+    }
+    for label, facet_filter in filters.items():
+        where = _where(facet_filter, legacy=False)
+        actual = await conn.fetchval(f"SELECT count(*) FROM {TABLE} WHERE {where}")
+        estimated = await _estimate_rows(conn, where)
+        picked = "prefilter" if estimated <= args.prefilter_max_rows or estimated / total <= args.prefilter_selectivity else "postfilter"
+        print(f"\n{label}: {actual:,d} rows ({actual / total:.2%}), estimated {estimated:,.0f} -> {picked}")
+
+        exact = [set((await _search(conn, query, args.k, where, {"enable_indexscan": "off"}))[0]) for query in queries]
+        print(f"  {'mode':<12} {'recall':>7} {'full k':>7} {'p50 ms':>8} {'p95 ms':>8}")
+        for mode, (legacy, settings) in modes.items():
+            recalls, full, latencies = [], 0, []
+            for query, truth in zip(queries, exact):
+                ids, elapsed = await _search(conn, query, args.k, _where(facet_filter, legacy), settings)
+                recalls.append(len(truth & set(ids)) / max(len(truth), 1))
+                full += len(ids) >= min(args.k, actual)
+                latencies.append(elapsed)
+            marker = " *" if mode == picked else ""
+            print(f"  {mode:<12} {np.mean(recalls):>7.3f} {full / len(queries):>7.2f} "
+                  f"{_percentile(latencies, 50):>8.1f} {_percentile(latencies, 95):>8.1f}{marker}")
+    await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dsn", default=os.environ.get("DATABASE_URL"), help="Postgres connection string (default: $DATABASE_URL)")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--pages", type=int, default=5_000)
+    parser.add_argument("--dimensions", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--ef-search", type=int, default=100)
+    parser.add_argument("--max-scan-tuples", type=int, default=20_000)
+    parser.add_argument("--prefilter-selectivity", type=float, default=0.02, help="Same default as match_ads_filtered")
+    parser.add_argument("--prefilter-max-rows", type=int, default=20_000, help="Same default as match_ads_filtered")
+    parser.add_argument("--reuse", action="store_true", help="Benchmark the existing seed instead of re-seeding")
+    args = parser.parse_args()
+    if not args.dsn:
+        parser.error("--dsn or DATABASE_URL is required")
+    asyncio.run(run(args))
@@ -0,0 +1,94 @@
+"""
+Benchmarks bulk ingestion (`/ingest-ads:batch`) against the single-ad path (`/ingest-ad`).
+
+Runs entirely locally: Postgres is replaced by an in-memory stand-in for `Database`
+that charges a fixed round-trip latency per insert statement (plus a small per-row
+cost), and Celery publishes to its in-memory broker transport.
+
+Usage:
+    python -m scripts.bench_ingest --ads 2000 --db-rtt-ms 5 --chunk-size 500
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Dict, List
+from uuid import uuid4
+
+from fastapi.testclient import TestClient
+
+from src.celery_app import celery_app
+from src.config import Settings
+from src.dependencies import get_db, get_settings
+from src.main import app
+
+
+class StandInPostgres:
+    """Minimal stand-in for the insert methods of `src.db.Database`."""
+
+    def __init__(self, rtt_ms: float, row_cost_us: float):
+        self.rtt_s = rtt_ms / 1000
+        self.row_cost_s = row_cost_us / 1_000_000
+        self.rows: List[Dict[str, Any]] = []
+        self.round_trips = 0
+
+    async def insert_ads(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        self.round_trips += 1
+        await asyncio.sleep(self.rtt_s + self.row_cost_s * len(rows))
+        inserted = [{**row, "id": uuid4()} for row in rows]
+        self.rows.extend(inserted)
+        return inserted
+
+    async def insert_ad(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        return (await self.insert_ads([row]))[0]
+
+
+def _payload(i: int) -> Dict[str, Any]:
+    return {
+        "ad_id": 1_000_000 + i,
+        "raw_data_snapshot": {"page_name": "Bench Co.", "ad_body_text": f"Benchmark ad {i}"},
+        "ad_creative_url": f"https://example.com/creative/{i}.jpg",
+    }
+
+
+def run(ads: int, rtt_ms: float, row_cost_us: float, chunk_size: int) -> None:
+    # Route Celery to the in-memory broker so publishes are real kombu publishes.
+    celery_app.conf.broker_url = "memory://"
+    celery_app.conf.result_backend = "cache+memory://"
+
+    settings = Settings(INGEST_INSERT_CHUNK_SIZE=chunk_size, INGEST_BATCH_MAX_ITEMS=max(ads, 1))
+    app.dependency_overrides[get_settings] = lambda: settings
+    client = TestClient(app)
+    payloads = [_payload(i) for i in range(ads)]
+
+    db = StandInPostgres(rtt_ms, row_cost_us)
+    app.dependency_overrides[get_db] = lambda: db
+    start = time.perf_counter()
+    for payload in payloads:
+        client.post("/ingest-ad", json=payload).raise_for_status()
+    single_s = time.perf_counter() - start
+    single_round_trips = db.round_trips
+
+    db = StandInPostgres(rtt_ms, row_cost_us)
+    app.dependency_overrides[get_db] = lambda: db
+    start = time.perf_counter()
+    response = client.post("/ingest-ads:batch", json=payloads)
+    response.raise_for_status()
+    batch_s = time.perf_counter() - start
+    assert response.json()["accepted"] == ads
+
+    app.dependency_overrides.clear()
+
+    print(f"ads={ads} db_rtt={rtt_ms}ms chunk_size={chunk_size}")
+    print(f"  /ingest-ad        : {ads / single_s:10.1f} ads/s  ({single_round_trips} DB round trips, {single_s:.2f}s)")
+    print(f"  /ingest-ads:batch : {ads / batch_s:10.1f} ads/s  ({db.round_trips} DB round trips, {batch_s:.2f}s)")
+    print(f"  speedup           : {single_s / batch_s:10.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ads", type=int, default=2000)
+    parser.add_argument("--db-rtt-ms", type=float, default=5.0, help="Simulated Postgres/PostgREST round-trip latency")
+    parser.add_argument("--row-cost-us", type=float, default=20.0, help="Simulated per-row insert cost")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    args = parser.parse_args()
+    run(args.ads, args.db_rtt_ms, args.row_cost_us, args.chunk_size)
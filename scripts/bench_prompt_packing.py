@@ -0,0 +1,127 @@
+"""
+Fake-model harness for prompt packing.
+
+A fake chat model answers the single-ad and packed strategic and persona
+prompts and counts calls and tokens (estimated at 4 characters per token). For
+each pack size, `--ads` ads run both stages concurrently through a
+`PromptPacker`; `--drop-rate` of the packed items are left out of the answers
+to exercise the single-ad fallback. Pack size 1 is the unpacked pipeline.
+
+    python -m scripts.bench_prompt_packing --ads 64 --pack-sizes 1 2 4 8 16 --drop-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from src.logger import logger
+from src.metrics import Metrics
+from src.models import StrategicAnalysis, VisualAnalysis
+from src.prompt_packing import PromptPacker
+
+ANALYSIS = {
+    "marketing_angle": "Feature-Benefit",
+    "emotional_appeal": "Convenience",
+    "cta_analysis": "Direct and specific; 'Shop now' matches the limited-time offer.",
+    "key_claims": ["Free shipping on all orders", "30-day returns"],
+    "confidence_score": 0.82,
+}
+PERSONA = "Busy urban professionals aged 25-40 who value convenience and shop on mobile."
+VISUAL = VisualAnalysis(
+    visual_style="product-focused", key_visual_elements=["running shoe", "city street"],
+    color_palette="bright & contrasting", overall_impression="Energetic product shot with a clear offer banner.",
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class CountingChatModel(BaseChatModel):
+    """Answers strategic and persona prompts, packed or not, and counts calls and tokens."""
+
+    drop_rate: float = 0.0
+    seed: int = 0
+    calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "counting-fake"
+
+    def _answer(self, prompt: str) -> str:
+        persona = "persona" in prompt.lower().split("\n", 2)[1]
+        ad_ids = re.findall(r"--- Ad ID: (\S+) ---", prompt)
+        if not ad_ids:
+            return PERSONA if persona else json.dumps(ANALYSIS)
+        rng = random.Random(f"{self.seed}:{prompt}")
+        items = [
+            {"ad_id": ad_id, "audience_persona": PERSONA} if persona else {"ad_id": ad_id, **ANALYSIS}
+            for ad_id in ad_ids if rng.random() >= self.drop_rate
+        ]
+        return json.dumps({"items": items})
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        prompt = messages[-1].content
+        answer = self._answer(prompt)
+        self.calls += 1
+        self.input_tokens += estimate_tokens(prompt)
+        self.output_tokens += estimate_tokens(answer)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=answer))])
+
+
+def _raw_ad(i: int) -> Dict[str, Any]:
+    return {
+        "ad_creative_url": f"https://cdn.example.com/creatives/{i}.jpg",
+        "ad_copy": f"Ad {i}: Free shipping on all orders and 30-day returns. Shop now before the offer ends!",
+        "page_name": f"Brand {i % 7}",
+        "targeting_data": {"age_min": 25, "age_max": 40, "interests": ["running", "fitness"]},
+    }
+
+
+async def _enrich(packer: PromptPacker, ad_id: str, raw: Dict[str, Any]) -> None:
+    strategic = await packer.strategic_analysis(ad_id, raw, raw["targeting_data"], VISUAL)
+    await packer.audience_persona(ad_id, raw, strategic, VISUAL)
+
+
+async def simulate(ads: int, pack_size: int, drop_rate: float, seed: int = 0) -> Dict[str, float]:
+    """Runs both stages for `ads` concurrent ads; returns calls and tokens per ad and the fallback count."""
+    llm = CountingChatModel(drop_rate=drop_rate, seed=seed)
+    metrics = Metrics()
+    packer = PromptPacker(llm, pack_size=pack_size, window_ms=5, metrics=metrics)
+    await asyncio.gather(*(_enrich(packer, f"ad-{i}", _raw_ad(i)) for i in range(ads)))
+    counters = metrics.snapshot()
+    return {
+        "calls_per_ad": llm.calls / ads,
+        "input_tokens_per_ad": llm.input_tokens / ads,
+        "output_tokens_per_ad": llm.output_tokens / ads,
+        "fallbacks": sum(value for name, value in counters.items() if name.endswith(".fallbacks")),
+    }
+
+
+async def run(args) -> None:
+    logger.disable("src")
+    print(f"{args.ads} ads, strategic + persona stages, {args.drop_rate:.0%} of packed items dropped")
+    print(f"  {'pack':>4}  {'calls/ad':>8}  {'in tok/ad':>9}  {'out tok/ad':>10}  {'fallbacks':>9}")
+    for pack_size in args.pack_sizes:
+        result = await simulate(args.ads, pack_size, args.drop_rate)
+        print(
+            f"  {pack_size:>4}  {result['calls_per_ad']:8.2f}  {result['input_tokens_per_ad']:9.0f}"
+            f"  {result['output_tokens_per_ad']:10.0f}  {result['fallbacks']:9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ads", type=int, default=64)
+    parser.add_argument("--pack-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--drop-rate", type=float, default=0.05, help="Share of packed items the fake model leaves out")
+    args = parser.parse_args()
+    asyncio.run(run(args))
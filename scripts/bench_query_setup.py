@@ -0,0 +1,82 @@
+"""
+Microbenchmark of the per-request setup work done by `/query-ads` before any
+network call is made.
+
+"before" rebuilds everything per request, as the endpoint used to: parse `.env`,
+create the Gemini Pro and embedding clients, the response synthesizer, the
+retriever and the query engine. "after" resolves the clients from the
+process-wide registry and only builds the per-query retriever and query engine.
+
+Usage:
+    python -m scripts.bench_query_setup --iterations 200
+"""
+import argparse
+import statistics
+import time
+from typing import Callable, List
+
+from llama_index.core.query_engine import RetrieverQueryEngine
+
+from src.config import Settings
+from src.dependencies import (
+    create_embedding_model_client,
+    create_gemini_pro_client,
+    get_client_registry,
+    get_settings,
+)
+from src.query_engine import SupabaseHybridRetriever, create_response_synthesizer
+
+
+def _synthesizer_available() -> bool:
+    try:
+        create_response_synthesizer(get_client_registry().gemini_pro)
+        return True
+    except Exception as e:
+        print(f"Note: response synthesizer cannot be built in this environment ({e!r}); excluded from both paths.")
+        return False
+
+
+def setup_before(with_synthesizer: bool) -> None:
+    settings = Settings()
+    gemini_pro = create_gemini_pro_client(settings)
+    embedding_model = create_embedding_model_client(settings)
+    retriever = SupabaseHybridRetriever(db=None, embedding_model=embedding_model, k=5)
+    if with_synthesizer:
+        RetrieverQueryEngine(retriever=retriever, response_synthesizer=create_response_synthesizer(gemini_pro))
+
+
+def setup_after(with_synthesizer: bool) -> None:
+    registry = get_client_registry()
+    get_settings()
+    retriever = SupabaseHybridRetriever(db=None, embedding_model=registry.embedding_model, k=5)
+    if with_synthesizer:
+        RetrieverQueryEngine(retriever=retriever, response_synthesizer=registry.response_synthesizer())
+
+
+def _measure(fn: Callable[[], None], iterations: int) -> List[float]:
+    fn()  # Warm-up (imports, first registry population)
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def _report(label: str, samples: List[float]) -> None:
+    p95 = statistics.quantiles(samples, n=20)[18]
+    print(f"  {label:<7}: mean {statistics.mean(samples):8.3f} ms   p95 {p95:8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    with_synthesizer = _synthesizer_available()
+    before = _measure(lambda: setup_before(with_synthesizer), args.iterations)
+    after = _measure(lambda: setup_after(with_synthesizer), args.iterations)
+    print(f"Per-request setup overhead over {args.iterations} iterations:")
+    _report("before", before)
+    _report("after", after)
+    print(f"  speedup: {statistics.mean(before) / statistics.mean(after):.1f}x")
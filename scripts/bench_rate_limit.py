@@ -0,0 +1,137 @@
+"""
+Simulated-quota harness for the per-model rate limiter.
+
+A fake Gemini endpoint enforces a quota of `--quota-rps` requests per second
+(a server-side token bucket with one second of burst) and answers requests
+beyond it with RESOURCE_EXHAUSTED. `--processes` worker processes, each with
+`--callers` concurrent callers, call it for `--duration` seconds in three setups:
+  * unlimited   callers retry a 429 after a fixed delay, like the Celery task
+                with `default_retry_delay` did,
+  * per-process every process has its own limiter that assumes the whole quota
+                (RATE_LIMIT_BACKEND=memory): only AIMD and backoff hold it back,
+  * shared      the processes share one token bucket (RATE_LIMIT_BACKEND=redis).
+Reports sustained successful throughput as a share of the quota and the number
+of 429 responses (each one a wasted request and, without the limiter, a worker
+slot spent waiting to retry).
+
+    python -m scripts.bench_rate_limit --quota-rps 50 --processes 4 --callers 32 --duration 5
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, List
+
+from src.logger import logger
+from src.metrics import Metrics
+from src.rate_limiter import AdaptiveConcurrency, LocalTokenBucket, ModelRateLimiter
+
+
+class ResourceExhausted(Exception):
+    """Named like `google.api_core.exceptions.ResourceExhausted`."""
+    code = 429
+
+
+class SimulatedQuotaAPI:
+    """Endpoint with a token-bucket quota of `quota_rps` and `latency_s` per request."""
+
+    def __init__(self, quota_rps: float, latency_s: float, burst_s: float = 1.0):
+        self._quota_rps = quota_rps
+        self._capacity = quota_rps * burst_s
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._latency_s = latency_s
+        self.succeeded = 0
+        self.rejected = 0
+
+    def _admit(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._quota_rps)
+        self._updated = now
+        if self._tokens < 1:
+            return False # Rejected requests do not use up quota.
+        self._tokens -= 1
+        return True
+
+    async def call(self) -> str:
+        await asyncio.sleep(self._latency_s / 2)
+        if not self._admit():
+            self.rejected += 1
+            raise ResourceExhausted("429 RESOURCE_EXHAUSTED: quota exceeded")
+        await asyncio.sleep(self._latency_s / 2)
+        self.succeeded += 1
+        return "ok"
+
+
+async def _unlimited_caller(api: SimulatedQuotaAPI, deadline: float, retry_delay_s: float) -> None:
+    while time.monotonic() < deadline:
+        try:
+            await api.call()
+        except ResourceExhausted:
+            await asyncio.sleep(retry_delay_s)
+
+
+async def _limited_caller(api: SimulatedQuotaAPI, limiter: ModelRateLimiter, deadline: float) -> None:
+    while time.monotonic() < deadline:
+        try:
+            await limiter.arun(api.call)
+        except ResourceExhausted:
+            pass # Out of retries; a real caller would be retried by Celery.
+
+
+def _limiters(mode: str, processes: int, quota_rps: float, concurrency: int) -> List[ModelRateLimiter]:
+    shared = LocalTokenBucket(quota_rps, quota_rps * 0.2)
+    return [
+        ModelRateLimiter(
+            "simulated-model",
+            shared if mode == "shared" else LocalTokenBucket(quota_rps, quota_rps * 0.2),
+            AdaptiveConcurrency(concurrency, maximum=64, decrease_cooldown_s=0.2),
+            max_retries=4,
+            backoff_base_s=0.05,
+            backoff_max_s=1.0,
+            metrics=Metrics(),
+        )
+        for _ in range(processes)
+    ]
+
+
+async def simulate(mode: str, quota_rps: float, processes: int, callers: int, duration_s: float,
+                   latency_s: float = 0.05, retry_delay_s: float = 1.0, concurrency: int = 8) -> Dict[str, float]:
+    """Runs one setup against a fresh simulated quota; returns throughput and 429 counts."""
+    api = SimulatedQuotaAPI(quota_rps, latency_s)
+    deadline = time.monotonic() + duration_s
+    if mode == "unlimited":
+        workers = [_unlimited_caller(api, deadline, retry_delay_s) for _ in range(processes * callers)]
+    else:
+        workers = [
+            _limited_caller(api, limiter, deadline)
+            for limiter in _limiters(mode, processes, quota_rps, concurrency)
+            for _ in range(callers)
+        ]
+    start = time.monotonic()
+    await asyncio.gather(*workers)
+    elapsed = time.monotonic() - start
+    # Slightly above 1 is possible: the server bucket starts with one second of burst.
+    return {
+        "rps": api.succeeded / elapsed,
+        "quota_share": api.succeeded / elapsed / quota_rps,
+        "rejected": api.rejected,
+    }
+
+
+async def run(args) -> None:
+    logger.disable("src") # One warning per AIMD decrease would drown the results.
+    print(f"quota {args.quota_rps:.0f} req/s, {args.processes} processes x {args.callers} callers, {args.duration:.0f} s")
+    for mode in ("unlimited", "per-process", "shared"):
+        result = await simulate(mode, args.quota_rps, args.processes, args.callers, args.duration, args.latency_ms / 1000)
+        print(f"  {mode:<12} {result['rps']:7.1f} req/s ({result['quota_share']:5.1%} of quota)  {result['rejected']:6d} x 429")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quota-rps", type=float, default=50)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--callers", type=int, default=32, help="Concurrent callers per process")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args))
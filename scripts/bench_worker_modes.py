@@ -0,0 +1,84 @@
+"""
+Benchmarks enrichment throughput per Celery worker process: the prefork pool
+(one task at a time per child process) against the threads pool (many tasks
+per process over the shared worker loop, bounded by WORKER_MAX_IN_FLIGHT).
+
+Runs the real `enrichment_task` body against latency-injected fake models and
+a fake database, so only the execution model differs between the runs.
+
+Usage:
+    python -m scripts.bench_worker_modes --llm-latency-ms 400 --db-latency-ms 5 --ads 64 --threads 32
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import patch
+from uuid import uuid4
+
+from src.dependencies import get_settings
+from src.tasks import enrichment_task
+from scripts.fake_models import LatencyFakeChatModel, LatencyFakeEmbeddings
+
+
+class LatencyFakeDatabase:
+    """The `Database` calls of `enrichment_task`, each costing `latency_s`."""
+
+    def __init__(self, latency_s: float):
+        self.latency_s = latency_s
+
+    async def claim_ad(self, ad_id, owner, lease_seconds):
+        await asyncio.sleep(self.latency_s)
+        return True, {
+            "id": ad_id,
+            "ad_id": 1,
+            "status": "ENRICHING",
+            "raw_data_snapshot": {
+                "ad_creative_url": f"https://example.com/creative/{ad_id}.jpg",
+                "ad_body_text": "These feel like walking on a pillow but still look super cute.",
+            },
+        }
+
+    async def _write(self, *args, **kwargs):
+        await asyncio.sleep(self.latency_s)
+        return True
+
+    save_stage = save_enrichment = heartbeat = update_ad = _write
+
+
+def _ads_per_minute(ads: int, threads: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda _: enrichment_task.run(ad_id=str(uuid4())), range(ads)))
+    return ads / (time.perf_counter() - start) * 60
+
+
+def run(llm_latency_s: float, db_latency_s: float, ads: int, threads: int, max_in_flight: int) -> None:
+    settings = get_settings().model_copy(update={"WORKER_MAX_IN_FLIGHT": max_in_flight, "CREATIVE_FETCH_ENABLED": False})
+    clients = SimpleNamespace(enrichment_cache=None, creative_fetcher=None)
+    with patch.multiple(
+        enrichment_task,
+        _settings=settings,
+        _db=LatencyFakeDatabase(db_latency_s),
+        _gemini_flash_client=LatencyFakeChatModel(latency_s=llm_latency_s),
+        _gemini_pro_client=LatencyFakeChatModel(latency_s=llm_latency_s),
+        _embedding_model_instance=LatencyFakeEmbeddings(latency_s=llm_latency_s / 4),
+    ), patch("src.tasks._client_registry", return_value=clients), patch("src.tasks.get_settings", return_value=settings):
+        prefork = _ads_per_minute(max(ads // 8, 4), threads=1)
+        threaded = _ads_per_minute(ads, threads=threads)
+
+    print(f"LLM latency {llm_latency_s * 1000:.0f} ms, DB latency {db_latency_s * 1000:.0f} ms")
+    label = f"threads ({threads} threads, {max_in_flight} in flight)"
+    print(f"  {'prefork (1 task per process)':<40}: {prefork:8.0f} ads/min per process")
+    print(f"  {label:<40}: {threaded:8.0f} ads/min per process  ({threaded / prefork:.1f}x)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency-ms", type=float, default=400)
+    parser.add_argument("--db-latency-ms", type=float, default=5)
+    parser.add_argument("--ads", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--max-in-flight", type=int, default=32)
+    args = parser.parse_args()
+    run(args.llm_latency_ms / 1000, args.db_latency_ms / 1000, args.ads, args.threads, args.max_in_flight)
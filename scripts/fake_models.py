@@ -0,0 +1,143 @@
+"""
+Latency-injected fake Gemini chat and embedding models for the local benchmarks.
+
+The chat model answers each enrichment prompt with a valid canned response
+(chosen by looking at the prompt), so the real prompt templates and output
+parsers run unchanged while every call costs `latency_s` of wall time.
+`LatencyFakeLLM` stands in for the synthesis model on the LlamaIndex side.
+"""
+import asyncio
+import time
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from llama_index.core.llms import CompletionResponse, CompletionResponseGen, CustomLLM, LLMMetadata
+
+from src.models import StrategicAnalysis, VisualAnalysis
+
+VISUAL_RESPONSE = VisualAnalysis(
+    visual_style="user-generated content",
+    key_visual_elements=["product close-up", "text overlay"],
+    color_palette="warm tones",
+    overall_impression="Authentic and approachable.",
+).model_dump_json()
+
+STRATEGIC_RESPONSE = StrategicAnalysis(
+    marketing_angle="Social Proof",
+    emotional_appeal="Comfort",
+    cta_analysis="Clear 'Shop now' CTA.",
+    key_claims=["feels like walking on a pillow"],
+    confidence_score=0.9,
+).model_dump_json()
+
+PERSONA_RESPONSE = "Style-conscious women aged 25-44 who value comfort."
+
+
+class LatencyFakeChatModel(BaseChatModel):
+    """Chat model that sleeps `latency_s` per call and answers with a canned enrichment response."""
+
+    latency_s: float = 0.2
+    calls: int = 0
+    input_chars: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "latency-fake-chat-model"
+
+    def _respond(self, messages: List[BaseMessage]) -> ChatResult:
+        prompt = "\n".join(str(message.content) for message in messages)
+        self.calls += 1
+        self.input_chars += len(prompt)
+        if "Audience Persona:" in prompt:
+            content = PERSONA_RESPONSE
+        elif "strategic analysis" in prompt:
+            content = STRATEGIC_RESPONSE
+        else:
+            content = VISUAL_RESPONSE
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self.latency_s)
+        return self._respond(messages)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self.latency_s)
+        return self._respond(messages)
+
+
+class LatencyFakeEmbeddings(Embeddings):
+    """Embedding model that sleeps `latency_s` per request and returns deterministic vectors."""
+
+    def __init__(self, latency_s: float = 0.1, dimensions: int = 768):
+        self.latency_s = latency_s
+        self.dimensions = dimensions
+        self.calls = 0
+
+    def _vector(self, text: str) -> List[float]:
+        seed = sum(text.encode()) % 997
+        return [((seed + i) % 97) / 97 for i in range(self.dimensions)]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        time.sleep(self.latency_s)
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.calls += 1
+        await asyncio.sleep(self.latency_s)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+class LatencyFakeLLM(CustomLLM):
+    """
+    LlamaIndex LLM that sleeps `latency_s` plus `latency_per_1k_chars` per 1,000
+    prompt characters (a stand-in for prefill cost) and returns a fixed answer.
+    """
+
+    latency_s: float = 0.3
+    latency_per_1k_chars: float = 0.015
+    context_window: int = 1_000_000
+    calls: int = 0
+    input_chars: int = 0
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=self.context_window, num_output=1024, model_name="latency-fake-llm")
+
+    def _latency(self, prompt: str) -> float:
+        self.calls += 1
+        self.input_chars += len(prompt)
+        return self.latency_s + self.latency_per_1k_chars * len(prompt) / 1000
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        time.sleep(self._latency(prompt))
+        return CompletionResponse(text="Social Proof dominates the retrieved ads.")
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        await asyncio.sleep(self._latency(prompt))
+        return CompletionResponse(text="Social Proof dominates the retrieved ads.")
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        yield self.complete(prompt, formatted=formatted, **kwargs)
@@ -0,0 +1,304 @@
+"""
+Batch mode for enrichment backfills: runs the LLM stages of many PENDING ads
+as Gemini Batch API jobs instead of one online request per ad and stage.
+
+Batch jobs are billed at a discount and draw on a separate quota, at the cost
+of latency (a job may take up to a day). A run:
+  1. leases up to `BATCH_ENRICHMENT_MAX_ADS` PENDING ads (heartbeating the
+     leases while jobs run);
+  2. renders the visual analysis prompt of every ad with the same templates and
+     inputs as the online pipeline, skipping stages already checkpointed or
+     cached, and submits the prompts as one JSONL batch job;
+  3. polls the job, parses its output with the pipeline's output parsers and
+     checkpoints the stage for all ads in one statement;
+  4. repeats 2-3 for the strategic analysis (which consumes the visual
+     results) and the audience persona, then embeds the strategy summaries
+     through the shared embedding service;
+  5. writes the outcome of every ad in one statement.
+Ads whose job failed or expired go back to PENDING with their checkpoints;
+ads with an unparseable or missing answer are marked FAILED.
+
+    python -m src.batch_enrichment [--max-ads 10000] [--poll-interval 60]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.prompts import BasePromptTemplate
+
+from src.db import Database
+from src.enrichment_pipeline import (
+    STRATEGIC_ANALYSIS_SCHEMA,
+    VISUAL_ANALYSIS_SCHEMA,
+    audience_persona_inputs,
+    audience_persona_prompt,
+    build_summary_text,
+    strategic_analysis_inputs,
+    strategic_analysis_parser,
+    strategic_analysis_prompt,
+    visual_analysis_inputs,
+    visual_analysis_parser,
+    visual_analysis_prompt,
+)
+from src.leases import LeaseHeartbeat, lease_owner_id
+from src.llm_cache import EnrichmentCache, model_name
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+from src.models import AdKnowledgeObject, StrategicAnalysis, VisualAnalysis
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+SUCCEEDED_STATES = frozenset({"JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"})
+TERMINAL_STATES = SUCCEEDED_STATES | {"JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+
+def batch_request(key: str, prompt_text: str, temperature: Optional[float], schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """One line of a Gemini batch input file; `schema` are `json_schema_kwargs` for a JSON stage."""
+    request: Dict[str, Any] = {"contents": [{"role": "user", "parts": [{"text": prompt_text}]}]}
+    generation_config = dict(schema or {})
+    if temperature is not None:
+        generation_config["temperature"] = temperature
+    if generation_config:
+        request["generation_config"] = generation_config
+    return {"key": key, "request": request}
+
+def response_text(line: Dict[str, Any]) -> str:
+    """The text of one line of a Gemini batch output file; raises if the request failed."""
+    if line.get("error"):
+        raise ValueError(f"Batch request failed: {line['error']}")
+    candidates = (line.get("response") or {}).get("candidates") or []
+    if not candidates:
+        raise ValueError("Batch response has no candidates")
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+
+class GeminiBatchClient:
+    """Submits JSONL batch jobs through the Files and Batches APIs of `google.genai`."""
+
+    def __init__(self, client: Any):
+        self._client = client
+
+    async def submit(self, model: str, requests: List[Dict[str, Any]], display_name: str) -> str:
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as handle:
+            for request in requests:
+                handle.write(json.dumps(request, default=str) + "\n")
+        try:
+            uploaded = await self._client.aio.files.upload(
+                file=handle.name, config={"display_name": display_name, "mime_type": "jsonl"}
+            )
+        finally:
+            os.unlink(handle.name)
+        job = await self._client.aio.batches.create(model=model, src=uploaded.name, config={"display_name": display_name})
+        return job.name
+
+    async def poll(self, job_name: str) -> Tuple[str, Optional[str]]:
+        job = await self._client.aio.batches.get(name=job_name)
+        state = job.state.name if hasattr(job.state, "name") else str(job.state)
+        return state, str(job.error) if job.error else None
+
+    async def results(self, job_name: str) -> List[Dict[str, Any]]:
+        job = await self._client.aio.batches.get(name=job_name)
+        content = await self._client.aio.files.download(file=job.dest.file_name)
+        return [json.loads(line) for line in content.decode().splitlines() if line.strip()]
+
+
+class BatchEnrichmentRunner:
+    def __init__(
+        self,
+        db: Database,
+        batch_client: Any,
+        gemini_flash: "ChatGoogleGenerativeAI",
+        gemini_pro: "ChatGoogleGenerativeAI",
+        embedding_model: Embeddings,
+        cache: Optional[EnrichmentCache] = None,
+        lease_seconds: float = 300,
+        heartbeat_interval: float = 60,
+        poll_interval: float = 60,
+        metrics: Optional[Metrics] = None,
+    ):
+        self._db = db
+        self._batch_client = batch_client
+        self._gemini_flash = gemini_flash
+        self._gemini_pro = gemini_pro
+        self._embedding_model = embedding_model
+        self._cache = cache
+        self._lease_seconds = lease_seconds
+        self._heartbeat_interval = heartbeat_interval
+        self._poll_interval = poll_interval
+        self._metrics = metrics or get_metrics()
+        self.owner = lease_owner_id()
+
+    async def _wait(self, job_name: str) -> Tuple[str, Optional[str]]:
+        while True:
+            state, error = await self._batch_client.poll(job_name)
+            if state in TERMINAL_STATES:
+                return state, error
+            await asyncio.sleep(self._poll_interval)
+
+    async def _run_stage(
+        self,
+        stage: str,
+        prompt: BasePromptTemplate,
+        llm: "ChatGoogleGenerativeAI",
+        inputs_for: Callable[[AdKnowledgeObject], Dict[str, Any]],
+        parse: Callable[[str], Any],
+        output_type: type,
+        schema: Optional[Dict[str, Any]],
+        ads: Dict[str, AdKnowledgeObject],
+        outcomes: Dict[str, Tuple[str, str]],
+    ) -> None:
+        """Runs `stage` for every ad without an outcome yet as one batch job, then checkpoints it."""
+        completed: Dict[str, Any] = {}
+        requests: List[Dict[str, Any]] = []
+        cache_keys: Dict[str, str] = {}
+        for ad_id, ad in ads.items():
+            if ad_id in outcomes or (ad.stage_status.get(stage) == "DONE" and getattr(ad, stage) is not None):
+                continue
+            inputs = inputs_for(ad)
+            if self._cache is not None:
+                cache_keys[ad_id], cached = self._cache.lookup(stage, prompt, llm, inputs, output_type)
+                if cached is not None:
+                    completed[ad_id] = cached
+                    continue
+            requests.append(batch_request(ad_id, prompt.format(**inputs), getattr(llm, "temperature", None), schema))
+
+        if requests:
+            job_name = await self._batch_client.submit(model_name(llm), requests, display_name=f"enrichment-{stage}")
+            logger.info(f"Submitted batch job {job_name} with {len(requests)} {stage} requests.")
+            self._metrics.incr("batch_enrichment.requests", len(requests))
+            state, error = await self._wait(job_name)
+            if state not in SUCCEEDED_STATES:
+                logger.error(f"Batch job {job_name} ended in {state}: {error}")
+                for request in requests:
+                    outcomes[request["key"]] = ("PENDING", f"Batch job for {stage} ended in {state}")
+            else:
+                answered = set()
+                for line in await self._batch_client.results(job_name):
+                    ad_id = line.get("key")
+                    if ad_id not in ads:
+                        continue
+                    answered.add(ad_id)
+                    try:
+                        completed[ad_id] = parse(response_text(line))
+                    except Exception as e:
+                        outcomes[ad_id] = ("FAILED", f"{stage}: {e}")
+                        continue
+                    if ad_id in cache_keys:
+                        self._cache.store(stage, cache_keys[ad_id], completed[ad_id])
+                for request in requests:
+                    if request["key"] not in answered:
+                        outcomes[request["key"]] = ("FAILED", f"{stage}: no result in batch output")
+
+        for ad_id, result in completed.items():
+            setattr(ads[ad_id], stage, result)
+            ads[ad_id].stage_status[stage] = "DONE"
+        await self._db.save_stages(stage, completed, owner=self.owner)
+
+    async def _embed(self, ads: Dict[str, AdKnowledgeObject], outcomes: Dict[str, Tuple[str, str]]) -> None:
+        pending = [
+            ad_id for ad_id, ad in ads.items()
+            if ad_id not in outcomes and not (ad.stage_status.get("vector_summary") == "DONE" and ad.vector_summary is not None)
+        ]
+        if not pending:
+            return
+        texts = [build_summary_text(ads[ad_id].strategic_analysis, ads[ad_id].audience_persona) for ad_id in pending]
+        try:
+            vectors = await self._embedding_model.aembed_documents(texts)
+        except Exception as e:
+            logger.error(f"Embedding {len(texts)} strategy summaries failed: {e}")
+            for ad_id in pending:
+                outcomes[ad_id] = ("PENDING", f"vector_summary: {e}")
+            return
+        completed = dict(zip(pending, vectors))
+        for ad_id, vector in completed.items():
+            ads[ad_id].vector_summary = vector
+            ads[ad_id].stage_status["vector_summary"] = "DONE"
+        await self._db.save_stages("vector_summary", completed, owner=self.owner)
+
+    async def enrich(self, ads: Dict[str, AdKnowledgeObject]) -> Dict[str, int]:
+        """Enriches leased `ads` (by ID) stage by stage and writes their outcomes; returns counts per status."""
+        outcomes: Dict[str, Tuple[str, str]] = {}
+        for ad_id, ad in ads.items():
+            if not ad.raw_data_snapshot.get("ad_creative_url"):
+                outcomes[ad_id] = ("FAILED", "Ad creative URL not found in raw_data_snapshot.")
+
+        await self._run_stage(
+            "visual_analysis", visual_analysis_prompt, self._gemini_flash,
+            lambda ad: visual_analysis_inputs(ad.raw_data_snapshot["ad_creative_url"]),
+            visual_analysis_parser.parse, VisualAnalysis, VISUAL_ANALYSIS_SCHEMA, ads, outcomes,
+        )
+        await self._run_stage(
+            "strategic_analysis", strategic_analysis_prompt, self._gemini_pro,
+            lambda ad: strategic_analysis_inputs(ad.raw_data_snapshot, ad.raw_data_snapshot.get("targeting_data", {}), ad.visual_analysis),
+            strategic_analysis_parser.parse, StrategicAnalysis, STRATEGIC_ANALYSIS_SCHEMA, ads, outcomes,
+        )
+        await self._run_stage(
+            "audience_persona", audience_persona_prompt, self._gemini_pro,
+            lambda ad: audience_persona_inputs(ad.raw_data_snapshot, ad.strategic_analysis, ad.visual_analysis),
+            lambda text: text.strip(), str, None, ads, outcomes,
+        )
+        await self._embed(ads, outcomes)
+
+        enriched_at = datetime.now()
+        rows = []
+        for ad_id in ads:
+            status, error_log = outcomes.get(ad_id, ("ENRICHED", None))
+            rows.append({"id": ad_id, "status": status, "enriched_at": enriched_at if status == "ENRICHED" else None, "error_log": error_log})
+        await self._db.finish_enrichments(rows, owner=self.owner)
+
+        counts: Dict[str, int] = {}
+        for row in rows:
+            counts[row["status"]] = counts.get(row["status"], 0) + 1
+        for status, count in counts.items():
+            self._metrics.incr(f"batch_enrichment.{status.lower()}", count)
+        return counts
+
+    async def run(self, max_ads: int) -> Dict[str, int]:
+        """Leases up to `max_ads` PENDING ads and enriches them through batch jobs."""
+        rows = await self._db.claim_pending_ads(max_ads, self._lease_seconds, self.owner)
+        if not rows:
+            logger.info("No PENDING ads to enrich.")
+            return {}
+        ads = {str(row["id"]): AdKnowledgeObject(**row) for row in rows}
+        logger.info(f"Batch enrichment of {len(ads)} ads started ({self.owner}).")
+        async with LeaseHeartbeat(self._db, self.owner, self._lease_seconds, self._heartbeat_interval, ads, metrics=self._metrics):
+            counts = await self.enrich(ads)
+        logger.info(f"Batch enrichment finished: {counts}")
+        return counts
+
+
+async def main(max_ads: Optional[int] = None, poll_interval: Optional[float] = None) -> None:
+    from src.dependencies import get_client_registry
+
+    clients = get_client_registry()
+    settings = clients.settings
+    runner = BatchEnrichmentRunner(
+        db=clients.db,
+        batch_client=GeminiBatchClient(clients.gemini_flash_chat_model.client),
+        gemini_flash=clients.gemini_flash_chat_model,
+        gemini_pro=clients.gemini_pro_chat_model,
+        embedding_model=clients.embedding_model,
+        cache=clients.enrichment_cache,
+        lease_seconds=settings.ENRICHMENT_LEASE_SECONDS,
+        heartbeat_interval=settings.ENRICHMENT_HEARTBEAT_SECONDS,
+        poll_interval=poll_interval or settings.BATCH_ENRICHMENT_POLL_INTERVAL_SECONDS,
+    )
+    try:
+        await runner.run(max_ads or settings.BATCH_ENRICHMENT_MAX_ADS)
+    finally:
+        await clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enrich PENDING ads through Gemini batch jobs.")
+    parser.add_argument("--max-ads", type=int, help="PENDING ads per run (default: BATCH_ENRICHMENT_MAX_ADS)")
+    parser.add_argument("--poll-interval", type=float, help="Seconds between job status checks (default: BATCH_ENRICHMENT_POLL_INTERVAL_SECONDS)")
+    args = parser.parse_args()
+    asyncio.run(main(args.max_ads, args.poll_interval))
@@ -1,6 +1,6 @@
 from celery import Celery, Task
-from src.config import Settings
-from src.dependencies import get_settings
+from celery.signals import worker_init
+from src.config import get_settings
 from src.logger import logger
 
 settings = get_settings()
@@ -17,3 +17,21 @@ from src.tasks import BaseTaskWithClients
 celery_app.Task = BaseTaskWithClients  # Assign our custom task class
 
 celery_app.config_from_object('src.celeryconfig')
+
+celery_app.conf.beat_schedule = {
+    "sweep-expired-enrichment-leases": {
+        "task": "src.tasks.sweep_expired_leases_task",
+        "schedule": settings.LEASE_SWEEP_INTERVAL_SECONDS,
+    },
+}
+
+
+@worker_init.connect
+def preload_model_clients(**kwargs) -> None:
+    """
+    Imports the model client libraries, which the task modules only import on
+    first use, in the worker's main process before the pool starts: prefork
+    children then inherit them rather than each importing them on its first
+    task (and again after every recycle).
+    """
+    import src.rate_limited_clients
@@ -1,35 +1,48 @@
 from kombu import Exchange, Queue
 
+# Priority lanes, most urgent first. Each lane is its own queue consumed by its
+# own worker pool (`python -m src.lanes <lane>`, see src/lanes.py), so a
+# backfill queued in `bulk` never delays an analyst's single-ad ingest in
+# `realtime`, and retries of failing ads do not hold up first attempts.
+REALTIME_QUEUE = 'realtime'
+RETRY_QUEUE = 'retry'
+BULK_QUEUE = 'bulk'
+LANES = (REALTIME_QUEUE, RETRY_QUEUE, BULK_QUEUE)
+
 # Define the Dead Letter Exchange
 dead_letter_exchange = Exchange('dead_letter_exchange', type='direct')
 
-# Define the Dead Letter Queue
+# Define the Dead Letter Queue. Tasks that exhausted their retries are
+# published here explicitly (src/dead_letters.py): broker-side dead-lettering
+# (`x-dead-letter-exchange`) only exists on RabbitMQ, not on Redis. No worker
+# consumes it; `python -m src.dead_letters` replays it.
 dead_letter_queue = Queue(
     'dead_letter_queue',
     dead_letter_exchange,
     routing_key='dead_letter'
 )
 
-# Define the main tasks queue with dead letter configuration
+# One queue per lane. `x-max-priority` turns on message priorities on
+# RabbitMQ; Redis emulates them with one list per priority step (see
+# broker_transport_options).
 tasks_exchange = Exchange('tasks', type='direct')
-tasks_queue = Queue(
-    'tasks',
-    tasks_exchange,
-    routing_key='tasks',
-    queue_arguments={
-        'x-dead-letter-exchange': 'dead_letter_exchange',
-        'x-dead-letter-routing-key': 'dead_letter'
-    }
+lane_queues = tuple(
+    Queue(lane, tasks_exchange, routing_key=lane, queue_arguments={'x-max-priority': 10})
+    for lane in LANES
 )
 
-task_queues = (tasks_queue, dead_letter_queue)
-task_default_queue = 'tasks'
+task_queues = (*lane_queues, dead_letter_queue)
+task_default_queue = BULK_QUEUE
 task_default_exchange = 'tasks'
-task_default_routing_key = 'tasks'
+task_default_routing_key = BULK_QUEUE
+task_default_priority = 0
+task_routes = {
+    'src.tasks.sweep_expired_leases_task': {'queue': RETRY_QUEUE},
+}
 task_acks_late = True
 task_reject_on_worker_lost = True
-worker_prefetch_multiplier = 1
-worker_max_tasks_per_child = 100
+worker_prefetch_multiplier = 1 # Lane workers override it per lane (CELERY_<LANE>_PREFETCH)
+worker_max_tasks_per_child = 100 # Prefork only; a recycled child rebuilds only the clients its tasks use
 
 # Recommended Redis settings for production
 broker_transport_options = {
@@ -37,6 +50,11 @@ broker_transport_options = {
     'retry_on_timeout': True,
     'socket_connect_timeout': 30,
     'socket_keepalive': True,
+    # Message priorities 0-9 (one Redis list per step), and a worker that
+    # consumes several lanes drains them in the order it lists them.
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
 }
 
 result_backend_transport_options = {
@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -14,6 +15,14 @@ class Settings(BaseSettings):
     SUPABASE_URL: str
     SUPABASE_KEY: str
     SUPABASE_CONNECTION_STRING: str
+    # Pooled direct connections (src/db.py). With Supabase's transaction pooler
+    # (port 6543) prepared statements cannot be kept: set DB_STATEMENT_CACHE_SIZE=0.
+    DB_POOL_MIN_SIZE: int = 2
+    DB_POOL_MAX_SIZE: int = 10 # Per process; keep (API + worker processes) x max below the server's connection limit
+    DB_ACQUIRE_TIMEOUT_SECONDS: float = 5 # Wait for a free pooled connection before failing the request
+    DB_COMMAND_TIMEOUT_SECONDS: float = 15
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    DB_MAX_INACTIVE_CONNECTION_LIFETIME_SECONDS: float = 300
 
     # Google AI
     GOOGLE_API_KEY: str
@@ -22,11 +31,105 @@ class Settings(BaseSettings):
 
     # Embedding Model
     EMBEDDING_MODEL: str = "gemini-embedding-001" # Google embedding model
+    EMBEDDING_CACHE_BACKEND: str = "sqlite" # "sqlite", "redis" (shares REDIS_URL) or "none"
+    EMBEDDING_CACHE_PATH: str = ".cache/embedding_cache.sqlite3"
+    EMBEDDING_CACHE_TTL_SECONDS: int = 30 * 24 * 3600
+    EMBEDDING_CACHE_MAX_ENTRIES: int = 500_000 # LRU bound for the SQLite backend
+    EMBEDDING_LRU_SIZE: int = 4096 # In-process vectors kept per process
+    EMBEDDING_BATCH_WINDOW_MS: float = 5 # How long concurrent embed requests wait to share a call
+    EMBEDDING_MAX_BATCH_SIZE: int = 100 # Texts per embedding API call
+
+    # Vector search (match_ads_ann)
+    VECTOR_SEARCH_EF_SEARCH: int = 100 # HNSW candidate list size; higher trades latency for recall
+    VECTOR_SEARCH_ITERATIVE_SCAN: str = "relaxed_order" # "off", "strict_order" or "relaxed_order" (pgvector >= 0.8)
+    QUERY_CONTEXT_TOKEN_BUDGET: int = 6000 # Upper bound for the ad context of one synthesis prompt
+    QUERY_MIN_SIMILARITY: Optional[float] = None # Default cosine similarity below which matches are dropped
+    QUERY_SCORE_GAP: Optional[float] = None # Default adaptive-k gap: stop at the first larger similarity drop
+
+    # Semantic answer cache (per API process)
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: float = 0.95 # Cosine similarity at which two queries share an answer
+    ANSWER_CACHE_MAX_ENTRIES: int = 1000
+    ANSWER_CACHE_TTL_SECONDS: int = 24 * 3600
 
     # Celery
     REDIS_URL: str = "redis://localhost:6379/0"
+    # Worker execution: "prefork" runs one enrichment at a time per child process; "threads"
+    # runs CELERY_<LANE>_CONCURRENCY tasks per process over one shared event loop and client set
+    CELERY_WORKER_POOL: str = "prefork"
+    WORKER_MAX_IN_FLIGHT: int = 32 # Enrichments awaited at once per worker process; further tasks wait for a slot
+    # Priority lanes (src/celeryconfig.py): worker pool per lane, started with `python -m src.lanes <lane>`
+    CELERY_REALTIME_CONCURRENCY: int = 4 # Keep idle capacity so single-ad ingests start at once
+    CELERY_REALTIME_PREFETCH: int = 1
+    CELERY_RETRY_CONCURRENCY: int = 2
+    CELERY_RETRY_PREFETCH: int = 1
+    CELERY_BULK_CONCURRENCY: int = 8
+    CELERY_BULK_PREFETCH: int = 4 # Backfills tolerate prefetching; the lane is isolated from realtime
+    DLQ_REPLAY_BATCH_SIZE: int = 100 # Dead-lettered tasks re-driven per batch by `python -m src.dead_letters`
+    DLQ_REPLAY_RATE_PER_SECOND: float = 10 # Upper bound for re-driven tasks per second
+
+    # Enrichment
+    ENRICHMENT_FAST_MODE: bool = False # Overlap independent LLM stages at some cost in grounding (see aenrich_ad)
+    ENRICHMENT_PACK_SIZE: int = 1 # Ads per strategic/persona LLM call in the queue worker (see src/prompt_packing.py); 1 disables packing
+    ENRICHMENT_PACK_WINDOW_MS: float = 50 # How long a packed call waits for more ads
+    ENRICHMENT_CACHE_BACKEND: str = "sqlite" # "sqlite", "redis" (shares REDIS_URL) or "none"
+    ENRICHMENT_CACHE_PATH: str = ".cache/enrichment_cache.sqlite3"
+    ENRICHMENT_CACHE_TTL_SECONDS: int = 30 * 24 * 3600
+    ENRICHMENT_CACHE_MAX_ENTRIES: int = 200_000 # LRU bound for the SQLite backend
+    ENRICHMENT_LEASE_SECONDS: float = 300 # After this without a heartbeat, an ad still ENRICHING is considered orphaned
+    ENRICHMENT_HEARTBEAT_SECONDS: float = 60 # How often a worker extends the leases it holds
+    LEASE_SWEEP_INTERVAL_SECONDS: float = 60 # Celery beat period of the expired-lease sweeper
+    LEASE_SWEEP_BATCH_SIZE: int = 500 # Ads reclaimed per UPDATE by the sweeper
+
+    # Creative fetching for multimodal visual analysis (see src/creatives.py)
+    CREATIVE_FETCH_ENABLED: bool = True # Off: the visual model only sees the creative URL
+    CREATIVE_CACHE_DIR: str = ".cache/creatives" # Content-addressed blobs and keyframes
+    CREATIVE_MAX_BYTES: int = 50 * 1024 * 1024 # Larger creatives are analyzed from their URL alone
+    CREATIVE_SPOOL_BYTES: int = 8 * 1024 * 1024 # Downloads beyond this spill from memory to disk
+    CREATIVE_MAX_FRAMES: int = 4 # Keyframes extracted per video (needs ffmpeg)
+    CREATIVE_FRAME_WIDTH: int = 768
+    CREATIVE_FETCH_TIMEOUT_SECONDS: float = 30
+    CREATIVE_FETCH_MAX_CONNECTIONS: int = 32 # Pooled connections per event loop
+
+    # Queue worker mode (python -m src.queue_worker): claims PENDING ads from Postgres
+    QUEUE_WORKER_CONCURRENCY: int = 16 # Ads enriched concurrently per process
+    QUEUE_WORKER_BATCH_SIZE: int = 16 # Upper bound for the ads claimed per statement
+    QUEUE_WORKER_POLL_INTERVAL_SECONDS: float = 2 # Idle wait when no ad is PENDING
+    QUEUE_WORKER_RECLAIM_INTERVAL_SECONDS: float = 60 # Also sweeps expired leases, for deployments without Celery beat
+
+    # Batch mode (python -m src.batch_enrichment): backfills through the Gemini Batch API
+    BATCH_ENRICHMENT_MAX_ADS: int = 10_000 # PENDING ads claimed per run (one batch job per LLM stage)
+    BATCH_ENRICHMENT_POLL_INTERVAL_SECONDS: float = 60
+
+    # Gemini rate limiting: one token bucket per model name (see src/rate_limiter.py)
+    RATE_LIMIT_BACKEND: str = "redis" # "redis" (quota shared by API and workers via REDIS_URL), "memory" (per process) or "none"
+    GEMINI_FLASH_RPM: float = 1000 # Requests per minute; clients sharing a model name get the lowest quota
+    GEMINI_PRO_RPM: float = 1000
+    EMBEDDING_RPM: float = 1500 # Batched embedding requests per minute
+    RATE_LIMIT_BURST_SECONDS: float = 1 # Bucket capacity, in seconds of quota
+    MODEL_CONCURRENCY_INITIAL: int = 8 # AIMD concurrency limit per model and process: start ...
+    MODEL_CONCURRENCY_MAX: int = 64 # ... and upper bound
+    RATE_LIMIT_MAX_RETRIES: int = 4 # In-process retries of a call rejected with 429 / RESOURCE_EXHAUSTED
+    RATE_LIMIT_BACKOFF_BASE_SECONDS: float = 1
+    RATE_LIMIT_BACKOFF_MAX_SECONDS: float = 30
+    TASK_RETRY_BACKOFF_BASE_SECONDS: float = 30 # Jittered exponential countdown of enrichment task retries
+    TASK_RETRY_BACKOFF_MAX_SECONDS: float = 600
+
+    # Metrics
+    METRICS_BACKEND: str = "memory" # "memory" (per process) or "redis" (aggregated across API and workers)
+
+    # Bulk ingestion
+    INGEST_BATCH_MAX_ITEMS: int = 5000 # Upper bound for a single /ingest-ads:batch request
+    INGEST_INSERT_CHUNK_SIZE: int = 500 # Rows per multi-row insert (and per Celery group)
+    DEDUP_ENABLED: bool = True # Link near-duplicate ads to an earlier ad's enrichment instead of enriching them
+    DEDUP_MAX_HAMMING_DISTANCE: int = 6 # Max differing bits between the 64-bit copy SimHashes of a duplicate and its source
 
     # Logging
     LOG_LEVEL: str = "INFO"
     LOG_JSON_FORMAT: bool = False
     LOG_FILE: Optional[str] = "logs/app.log"
+
+@lru_cache
+def get_settings() -> Settings:
+    """Returns the process-wide settings, parsing `.env` only once."""
+    return Settings()
@@ -0,0 +1,149 @@
+import hashlib
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.utils import get_tokenizer
+
+from src.llm_cache import normalize_creative_url
+
+# Upper bound for a single ad's copy in the context; long copy is mostly hashtags.
+MAX_BODY_CHARS = 600
+
+def count_tokens(text: str) -> int:
+    """Token count with the tokenizer LlamaIndex uses for prompt budgeting."""
+    return len(get_tokenizer()(text))
+
+def _domain(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
+    host = urlsplit(url).hostname or ""
+    return host.removeprefix("www.") or None
+
+def _truncate(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + " ..."
+
+def _join(values: Any) -> Optional[str]:
+    if isinstance(values, (list, tuple)):
+        return ", ".join(str(value) for value in values if value) or None
+    return str(values) if values else None
+
+def _creative_group_key(row: Dict[str, Any]) -> str:
+    """
+    Identifies an ad's creative and copy independently of its `ad_id` and of
+    the signed, expiring parameters of its creative URLs, so re-runs of the
+    same creative collapse into one context entry.
+    """
+    snapshot = row.get("raw_data_snapshot") or {}
+    urls = [creative.get("original_url") for creative in snapshot.get("creatives") or [] if creative.get("original_url")]
+    if snapshot.get("ad_creative_url"):
+        urls.append(snapshot["ad_creative_url"])
+    body = " ".join(str(snapshot.get("ad_body_text") or "").split())
+    if not body and not urls:
+        # Nothing to compare: never merge such ads with each other.
+        return f"ad:{row.get('id') or row.get('ad_id')}"
+    payload = "\x00".join([body] + sorted(normalize_creative_url(url) for url in urls))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def compact_ad_context(row: Dict[str, Any], duplicate_ad_ids: Optional[List[Any]] = None) -> str:
+    """
+    Renders the decision-relevant fields of an enriched ad row as a few lines of
+    text. The embedding, raw URLs (only the landing page's domain is kept) and
+    raw targeting payloads are left out.
+    """
+    snapshot = row.get("raw_data_snapshot") or {}
+    strategic = row.get("strategic_analysis") or {}
+    visual = row.get("visual_analysis") or {}
+
+    header = " | ".join(part for part in [
+        f"Ad {row.get('ad_id')}",
+        snapshot.get("page_name"),
+        snapshot.get("ad_display_format"),
+        _join(snapshot.get("publisher_platform")),
+        "active" if snapshot.get("is_active") else ("inactive" if "is_active" in snapshot else None),
+        " to ".join(str(date)[:10] for date in (snapshot.get("start_date"), snapshot.get("end_date")) if date) or None,
+    ] if part)
+    lines = [header]
+    if duplicate_ad_ids:
+        lines.append(f"Also ran as: {', '.join(str(ad_id) for ad_id in duplicate_ad_ids)}")
+    if snapshot.get("ad_body_text"):
+        lines.append(f"Copy: {_truncate(snapshot['ad_body_text'], MAX_BODY_CHARS)}")
+    domain = _domain(snapshot.get("landing_page_url"))
+    cta = " ".join(part for part in [snapshot.get("cta_text"), f"({domain})" if domain else None] if part)
+    if cta:
+        lines.append(f"CTA: {cta}")
+    if strategic:
+        lines.append(
+            f"Strategy: angle={strategic.get('marketing_angle')}; appeal={strategic.get('emotional_appeal')};"
+            f" claims={_join(strategic.get('key_claims')) or 'none'}; CTA analysis: {strategic.get('cta_analysis')}"
+        )
+    if visual:
+        lines.append(
+            f"Visual: style={visual.get('visual_style')}; elements={_join(visual.get('key_visual_elements')) or 'none'};"
+            f" palette={visual.get('color_palette')}; impression: {visual.get('overall_impression')}"
+        )
+    if row.get("audience_persona"):
+        lines.append(f"Audience: {row['audience_persona']}")
+    return "\n".join(lines)
+
+def select_by_similarity(
+    rows: List[Dict[str, Any]],
+    min_similarity: Optional[float] = None,
+    score_gap: Optional[float] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Cuts search results (best first) down to the relevant ones: rows below
+    `min_similarity` are dropped, and with `score_gap` (adaptive k) the results
+    end at the first drop in similarity larger than the gap. The best row is
+    always subject to `min_similarity`, never to the gap.
+    """
+    selected = []
+    for row in rows:
+        similarity = row.get("similarity")
+        if similarity is None:
+            selected.append(row)
+            continue
+        if min_similarity is not None and similarity < min_similarity:
+            continue
+        previous = selected[-1].get("similarity") if selected else None
+        if score_gap is not None and previous is not None and previous - similarity > score_gap:
+            break
+        selected.append(row)
+    return selected
+
+def build_context_nodes(rows: List[Dict[str, Any]], token_budget: Optional[int] = None) -> List[NodeWithScore]:
+    """
+    Turns search results (best first) into compact context nodes.
+
+    Rows sharing a creative fingerprint are merged into the best-scoring one,
+    which lists the other `ad_id`s. Nodes are then kept in order until
+    `token_budget` (if any) would be exceeded; the best node is always kept.
+    """
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        groups.setdefault(_creative_group_key(row), []).append(row)
+
+    nodes = []
+    used_tokens = 0
+    for best, *duplicates in groups.values():
+        text = compact_ad_context(best, [row.get("ad_id") for row in duplicates])
+        tokens = count_tokens(text)
+        if token_budget is not None and nodes and used_tokens + tokens > token_budget:
+            break
+        used_tokens += tokens
+        metadata = {
+            "source": "Supabase",
+            "ad_id": best.get("ad_id"),
+            "similarity": best.get("similarity"),
+            "duplicate_ad_ids": [row.get("ad_id") for row in duplicates],
+        }
+        node = TextNode(
+            text=text,
+            metadata=metadata,
+            # Identifiers for clients, not context for the LLM.
+            excluded_llm_metadata_keys=list(metadata),
+            excluded_embed_metadata_keys=list(metadata),
+        )
+        nodes.append(NodeWithScore(node=node, score=best.get("similarity")))
+    return nodes
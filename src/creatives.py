@@ -0,0 +1,255 @@
+"""
+Creative fetching for multimodal visual analysis.
+
+`CreativeFetcher` turns an ad creative URL into the images the visual model
+is shown:
+  * downloads stream through a pooled `httpx.AsyncClient` (one per event loop)
+    into a spooled temporary file, hashing as they go, and are aborted once
+    they exceed `CREATIVE_MAX_BYTES`;
+  * images are kept as they are; videos are reduced to up to
+    `CREATIVE_MAX_FRAMES` keyframes by `ffmpeg`, scaled to at most
+    `CREATIVE_FRAME_WIDTH` pixels wide (without `ffmpeg` on the PATH, videos
+    yield no frames and are analyzed from their URL alone);
+  * results live in a local blob cache keyed by the SHA-256 of the content, so
+    identical creatives (the same file behind different fbcdn URLs) are
+    processed once, plus a URL index so a URL seen before is not downloaded
+    again. Concurrent fetches of one URL share a single download.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+import weakref
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import httpx
+
+from src.config import Settings
+from src.llm_cache import normalize_creative_url
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+
+CHUNK_SIZE = 256 * 1024
+
+
+class CreativeTooLarge(Exception):
+    """The creative exceeds the download size cap."""
+
+
+class Creative:
+    """A fetched creative: its content hash, MIME type and the image files shown to the model."""
+
+    def __init__(self, url: str, content_hash: str, mime_type: str, images: List[Path]):
+        self.url = url
+        self.content_hash = content_hash
+        self.mime_type = mime_type
+        self.images = images
+
+    def content_blocks(self) -> List[Dict[str, Any]]:
+        """The images as LangChain multimodal message content (base64 data URLs)."""
+        blocks = []
+        for image in self.images:
+            mime_type = mimetypes.guess_type(image.name)[0] or "image/jpeg"
+            data = base64.b64encode(image.read_bytes()).decode()
+            blocks.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{data}"}})
+        return blocks
+
+
+class CreativeFetcher:
+    def __init__(
+        self,
+        cache_dir: Union[str, Path],
+        max_bytes: int = 50 * 1024 * 1024,
+        spool_bytes: int = 8 * 1024 * 1024,
+        max_frames: int = 4,
+        frame_width: int = 768,
+        timeout_s: float = 30,
+        max_connections: int = 32,
+        ffmpeg: Optional[str] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        self._cache_dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._spool_bytes = spool_bytes
+        self._max_frames = max_frames
+        self._frame_width = frame_width
+        self._timeout_s = timeout_s
+        self._max_connections = max_connections
+        self._ffmpeg = ffmpeg or shutil.which("ffmpeg")
+        self._transport = transport
+        self._metrics = metrics or get_metrics()
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._in_flight: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Future]]" = weakref.WeakKeyDictionary()
+        if self._ffmpeg is None:
+            logger.warning("ffmpeg not found; video creatives will be analyzed without keyframes.")
+
+    # --- Blob cache ---
+
+    def _blob_dir(self, content_hash: str) -> Path:
+        return self._cache_dir / "blobs" / content_hash[:2] / content_hash
+
+    def _url_index(self, url: str) -> Path:
+        return self._cache_dir / "urls" / f"{hashlib.sha256(normalize_creative_url(url).encode()).hexdigest()}.json"
+
+    def _load(self, url: str, content_hash: str) -> Optional[Creative]:
+        manifest = self._blob_dir(content_hash) / "manifest.json"
+        try:
+            entry = json.loads(manifest.read_text())
+        except (OSError, ValueError):
+            return None
+        images = [self._blob_dir(content_hash) / name for name in entry["images"]]
+        if not all(image.exists() for image in images):
+            return None
+        return Creative(url, content_hash, entry["mime_type"], images)
+
+    def _save(self, blob_dir: Path, mime_type: str, images: List[Path]) -> None:
+        # Written last and atomically: a blob without a manifest is incomplete.
+        manifest = blob_dir / "manifest.json"
+        partial = manifest.with_suffix(".tmp")
+        partial.write_text(json.dumps({"mime_type": mime_type, "images": [image.name for image in images]}))
+        os.replace(partial, manifest)
+
+    def _remember_url(self, url: str, content_hash: str) -> None:
+        index = self._url_index(url)
+        index.parent.mkdir(parents=True, exist_ok=True)
+        partial = index.with_suffix(f".{os.getpid()}.tmp")
+        partial.write_text(json.dumps({"content_hash": content_hash, "fetched_at": time.time()}))
+        os.replace(partial, index)
+
+    # --- Fetching ---
+
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self._timeout_s,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self._max_connections, max_keepalive_connections=self._max_connections),
+                transport=self._transport,
+            )
+            self._clients[loop] = client
+        return client
+
+    async def _download(self, url: str, spool: Any) -> Tuple[str, str]:
+        """Streams `url` into `spool`; returns its SHA-256 and MIME type."""
+        digest = hashlib.sha256()
+        size = 0
+        async with self._client().stream("GET", url) as response:
+            response.raise_for_status()
+            declared = int(response.headers.get("content-length") or 0)
+            if declared > self._max_bytes:
+                raise CreativeTooLarge(f"{url} is {declared} bytes (limit {self._max_bytes})")
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                size += len(chunk)
+                if size > self._max_bytes:
+                    raise CreativeTooLarge(f"{url} exceeds {self._max_bytes} bytes")
+                digest.update(chunk)
+                spool.write(chunk)
+            mime_type = response.headers.get("content-type", "").split(";")[0].strip()
+        self._metrics.incr("creatives.downloaded_bytes", size)
+        return digest.hexdigest(), mime_type or mimetypes.guess_type(url)[0] or "application/octet-stream"
+
+    async def _extract_keyframes(self, source: Path, blob_dir: Path) -> List[Path]:
+        if self._ffmpeg is None:
+            return []
+        process = await asyncio.create_subprocess_exec(
+            self._ffmpeg, "-v", "error", "-i", str(source),
+            "-vf", f"select='eq(pict_type,I)',scale='min({self._frame_width},iw)':-2",
+            "-vsync", "vfr", "-frames:v", str(self._max_frames), "-q:v", "3",
+            str(blob_dir / "frame_%02d.jpg"),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            logger.warning(f"Keyframe extraction failed for {source.name}: {stderr.decode(errors='replace')[-500:]}")
+            return []
+        return sorted(blob_dir.glob("frame_*.jpg"))
+
+    async def _process(self, url: str, spool: Any, content_hash: str, mime_type: str) -> Creative:
+        blob_dir = self._blob_dir(content_hash)
+        blob_dir.mkdir(parents=True, exist_ok=True)
+        spool.seek(0)
+        if mime_type.startswith("image/"):
+            image = blob_dir / f"image{mimetypes.guess_extension(mime_type) or '.jpg'}"
+            with open(image, "wb") as handle:
+                shutil.copyfileobj(spool, handle)
+            images = [image]
+        elif mime_type.startswith("video/"):
+            # ffmpeg needs a seekable file for MP4s whose index is at the end.
+            with tempfile.NamedTemporaryFile(dir=blob_dir, suffix=".video") as source:
+                shutil.copyfileobj(spool, source)
+                source.flush()
+                images = await self._extract_keyframes(Path(source.name), blob_dir)
+            self._metrics.incr("creatives.videos")
+        else:
+            logger.warning(f"Creative {url} has unsupported content type {mime_type}.")
+            images = []
+        self._save(blob_dir, mime_type, images)
+        return Creative(url, content_hash, mime_type, images)
+
+    async def _fetch(self, url: str) -> Creative:
+        try:
+            content_hash = json.loads(self._url_index(url).read_text())["content_hash"]
+        except (OSError, ValueError, KeyError):
+            content_hash = None
+        if content_hash is not None:
+            creative = self._load(url, content_hash)
+            if creative is not None:
+                self._metrics.incr("creatives.url_hits")
+                return creative
+
+        with tempfile.SpooledTemporaryFile(max_size=self._spool_bytes) as spool:
+            content_hash, mime_type = await self._download(url, spool)
+            self._metrics.incr("creatives.downloads")
+            creative = self._load(url, content_hash)
+            if creative is not None:
+                self._metrics.incr("creatives.content_hits") # Same file behind another URL
+            else:
+                creative = await self._process(url, spool, content_hash, mime_type)
+        self._remember_url(url, content_hash)
+        return creative
+
+    async def fetch(self, url: str) -> Creative:
+        """Returns the creative behind `url`, downloading and processing it unless cached."""
+        loop = asyncio.get_running_loop()
+        in_flight = self._in_flight.setdefault(loop, {})
+        key = normalize_creative_url(url)
+        future = in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(url))
+            in_flight[key] = future
+            future.add_done_callback(lambda _: in_flight.pop(key, None))
+        else:
+            self._metrics.incr("creatives.coalesced")
+        # Shielded: the download may be shared with other callers of the same URL.
+        return await asyncio.shield(future)
+
+    async def aclose(self) -> None:
+        """Closes the HTTP client of the running loop (clients of other loops are dropped)."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        self._clients = weakref.WeakKeyDictionary()
+        if client is not None:
+            await client.aclose()
+
+
+def create_creative_fetcher(settings: Settings) -> Optional[CreativeFetcher]:
+    """The creative fetcher, or None when `CREATIVE_FETCH_ENABLED` is off (URL-only visual analysis)."""
+    if not settings.CREATIVE_FETCH_ENABLED:
+        return None
+    return CreativeFetcher(
+        settings.CREATIVE_CACHE_DIR,
+        max_bytes=settings.CREATIVE_MAX_BYTES,
+        spool_bytes=settings.CREATIVE_SPOOL_BYTES,
+        max_frames=settings.CREATIVE_MAX_FRAMES,
+        frame_width=settings.CREATIVE_FRAME_WIDTH,
+        timeout_s=settings.CREATIVE_FETCH_TIMEOUT_SECONDS,
+        max_connections=settings.CREATIVE_FETCH_MAX_CONNECTIONS,
+    )
@@ -0,0 +1,502 @@
+import asyncio
+import json
+import struct
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+import asyncpg
+from pydantic import BaseModel
+
+from src.config import Settings
+from src.logger import logger
+
+# Column types of `public.ads` that the application writes, for casts in bulk inserts.
+AD_COLUMN_TYPES = {
+    "id": "uuid",
+    "ad_id": "bigint",
+    "raw_data_snapshot": "jsonb",
+    "status": "text",
+    "enriched_at": "timestamptz",
+    "error_log": "text",
+    "strategic_analysis": "jsonb",
+    "visual_analysis": "jsonb",
+    "audience_persona": "text",
+    "vector_summary": "vector",
+    "lease_owner": "text",
+    "lease_expires_at": "timestamptz",
+    "heartbeat_at": "timestamptz",
+    "stage_status": "jsonb",
+    "copy_simhash": "bigint",
+    "creative_fingerprint": "text",
+    "derived_from": "uuid",
+}
+
+# Result columns of the enrichment stages, in pipeline order.
+STAGE_COLUMNS = ("visual_analysis", "strategic_analysis", "audience_persona", "vector_summary")
+
+# Claims an ad for owner $2 under a lease of $3 seconds and returns it in one
+# statement. An ad can be claimed when it is PENDING, when $2 already holds it
+# (a retry of the same task) or when its lease expired. Otherwise the second
+# branch returns it unchanged (as of the statement's snapshot) so the caller can
+# tell "taken" from "missing" without another query.
+CLAIM_AD_SQL = """
+WITH claimed AS (
+    UPDATE public.ads
+    SET status = 'ENRICHING', lease_owner = $2, lease_expires_at = now() + make_interval(secs => $3), heartbeat_at = now()
+    WHERE id = $1 AND (
+        status = 'PENDING'
+        OR (status = 'ENRICHING' AND (lease_owner = $2 OR lease_expires_at < now()))
+    )
+    RETURNING *
+)
+SELECT true AS claimed, claimed.* FROM claimed
+UNION ALL
+SELECT false AS claimed, ads.* FROM public.ads WHERE id = $1 AND NOT EXISTS (SELECT 1 FROM claimed)
+"""
+
+# Fixed text, so each pooled connection prepares it once and then only binds
+# and executes it (with DB_STATEMENT_CACHE_SIZE > 0). With an owner ($9), the
+# write is fenced: it only lands while $9 still holds the lease (or after the
+# sweeper put the ad back to PENDING and nobody claimed it yet).
+SAVE_ENRICHMENT_SQL = """
+UPDATE public.ads SET
+    status = $2, enriched_at = $3, error_log = $4, strategic_analysis = $5,
+    visual_analysis = $6, audience_persona = $7, vector_summary = $8,
+    stage_status = CASE WHEN $2 = 'ENRICHED' THEN '{}'::jsonb ELSE stage_status END,
+    lease_owner = NULL, lease_expires_at = NULL
+WHERE id = $1 AND ($9::text IS NULL OR lease_owner = $9 OR status = 'PENDING')
+"""
+
+# Checkpoints one completed stage: its result column and its DONE mark, fenced
+# by the lease owner ($3) like SAVE_ENRICHMENT_SQL. One fixed statement per stage.
+SAVE_STAGE_SQL = {
+    stage: f"""
+UPDATE public.ads SET {stage} = $2, stage_status = stage_status || jsonb_build_object('{stage}', 'DONE')
+WHERE id = $1 AND ($3::text IS NULL OR lease_owner = $3)
+"""
+    for stage in STAGE_COLUMNS
+}
+
+# Bulk variant of SAVE_STAGE_SQL: checkpoints one stage for many ads.
+SAVE_STAGES_SQL = {
+    stage: f"""
+UPDATE public.ads SET {stage} = r.value, stage_status = ads.stage_status || jsonb_build_object('{stage}', 'DONE')
+FROM unnest($1::uuid[], $2::{AD_COLUMN_TYPES[stage]}[]) AS r(id, value)
+WHERE ads.id = r.id AND ($3::text IS NULL OR ads.lease_owner = $3)
+"""
+    for stage in STAGE_COLUMNS
+}
+
+# Records the outcome of many enrichments whose stage results were already
+# checkpointed, and releases their leases. An outcome of PENDING hands the ad
+# back for a later attempt.
+FINISH_ENRICHMENTS_SQL = """
+UPDATE public.ads SET
+    status = r.status, enriched_at = r.enriched_at, error_log = r.error_log,
+    stage_status = CASE WHEN r.status = 'ENRICHED' THEN '{}'::jsonb ELSE ads.stage_status END,
+    lease_owner = NULL, lease_expires_at = NULL
+FROM unnest($1::uuid[], $2::text[], $3::timestamptz[], $4::text[]) AS r(id, status, enriched_at, error_log)
+WHERE ads.id = r.id AND ($5::text IS NULL OR ads.lease_owner = $5)
+"""
+
+# Extends the leases owner $2 still holds on the ads $1.
+HEARTBEAT_SQL = """
+UPDATE public.ads SET heartbeat_at = now(), lease_expires_at = now() + make_interval(secs => $3)
+WHERE id = ANY($1::uuid[]) AND status = 'ENRICHING' AND lease_owner = $2
+"""
+
+# Claims up to $1 PENDING ads (oldest first) for owner $3 under a lease of $2 seconds.
+# Derived ads are skipped: they take their source ad's results (src/dedup.py).
+# SKIP LOCKED makes concurrent claimers skip each other's rows instead of
+# waiting on them, so no ad is handed to two workers.
+CLAIM_PENDING_ADS_SQL = """
+UPDATE public.ads AS ads
+SET status = 'ENRICHING', lease_owner = $3, lease_expires_at = now() + make_interval(secs => $2), heartbeat_at = now()
+FROM (
+    SELECT id FROM public.ads
+    WHERE status = 'PENDING' AND derived_from IS NULL
+    ORDER BY created_at
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+) AS batch
+WHERE ads.id = batch.id
+RETURNING ads.*
+"""
+
+# Puts up to $1 ENRICHING ads whose lease expired back to PENDING.
+RECLAIM_EXPIRED_LEASES_SQL = """
+UPDATE public.ads SET status = 'PENDING', lease_owner = NULL, lease_expires_at = NULL
+WHERE id IN (
+    SELECT id FROM public.ads
+    WHERE status = 'ENRICHING' AND lease_expires_at < now()
+    LIMIT $1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id
+"""
+
+# Source ads (not derived, not FAILED) that carry one of the creative
+# fingerprints $1, ENRICHED ones first so a duplicate is linked to a finished
+# enrichment when there is one.
+DEDUP_SOURCES_SQL = """
+SELECT id, creative_fingerprint, copy_simhash, status FROM public.ads
+WHERE creative_fingerprint = ANY($1::text[]) AND derived_from IS NULL AND status <> 'FAILED'
+ORDER BY status = 'ENRICHED' DESC, created_at
+"""
+
+# Copies the enrichment of ENRICHED source ads to the PENDING ads $1 derived
+# from them. Derived ads whose source is still in flight are left to the
+# `ads_propagate_to_derived` trigger.
+COPY_FROM_SOURCES_SQL = """
+UPDATE public.ads AS ads SET
+    status = 'ENRICHED', enriched_at = now(), error_log = NULL,
+    visual_analysis = source.visual_analysis, strategic_analysis = source.strategic_analysis,
+    audience_persona = source.audience_persona, vector_summary = source.vector_summary
+FROM public.ads AS source
+WHERE ads.id = ANY($1::uuid[]) AND ads.status = 'PENDING'
+    AND source.id = ads.derived_from AND source.status = 'ENRICHED'
+RETURNING ads.id
+"""
+
+# Puts the FAILED ads among $1 back to PENDING for another attempt. Their stage
+# checkpoints are kept, so completed stages are not repeated.
+REQUEUE_FAILED_ADS_SQL = """
+UPDATE public.ads SET status = 'PENDING', error_log = NULL, lease_owner = NULL, lease_expires_at = NULL
+WHERE id = ANY($1::uuid[]) AND status = 'FAILED'
+RETURNING id
+"""
+
+# Named parameters of the `match_ads_filtered` function.
+MATCH_ADS_FILTERED_PARAMS = (
+    "query_embedding", "match_count", "filter_criteria", "ef_search", "iterative_scan",
+    "max_scan_tuples", "prefilter_selectivity", "prefilter_max_rows", "include_vector",
+)
+
+def encode_vector(vector: Sequence[float]) -> bytes:
+    # pgvector binary format: dimensions, unused, then big-endian float4s.
+    return struct.pack(f">HH{len(vector)}f", len(vector), 0, *vector)
+
+def decode_vector(data: bytes) -> List[float]:
+    dimensions, _ = struct.unpack_from(">HH", data)
+    return list(struct.unpack_from(f">{dimensions}f", data, 4))
+
+def _as_uuid(value: Any) -> Optional[UUID]:
+    try:
+        return value if isinstance(value, UUID) else UUID(str(value))
+    except ValueError:
+        return None
+
+class Database:
+    """
+    Async access to the `ads` table and its search functions over a pool of
+    direct connections to `SUPABASE_CONNECTION_STRING`.
+
+    The pool is opened on first use. asyncpg connections belong to the event
+    loop they were opened on, so when used from another loop (e.g. a Celery
+    worker's loop after the API's) the old pool is dropped and a new one opened.
+    """
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int = 2,
+        max_size: int = 10,
+        acquire_timeout: float = 5.0,
+        command_timeout: float = 15.0,
+        statement_cache_size: int = 100,
+        max_inactive_connection_lifetime: float = 300.0,
+    ):
+        self._dsn = dsn
+        self._min_size = min_size
+        self._max_size = max_size
+        self._acquire_timeout = acquire_timeout
+        self._command_timeout = command_timeout
+        self._statement_cache_size = statement_cache_size
+        self._max_inactive_connection_lifetime = max_inactive_connection_lifetime
+        self._pool: Optional[asyncpg.Pool] = None
+        self._pool_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def _init_connection(self, conn: asyncpg.Connection) -> None:
+        for name in ("json", "jsonb"):
+            await conn.set_type_codec(name, schema="pg_catalog", encoder=partial(json.dumps, default=str), decoder=json.loads)
+        # Supabase may install pgvector into `extensions` rather than `public`.
+        vector_schema = await conn.fetchval("SELECT typnamespace::regnamespace::text FROM pg_type WHERE typname = 'vector'")
+        if vector_schema:
+            await conn.set_type_codec("vector", schema=vector_schema, encoder=encode_vector, decoder=decode_vector, format="binary")
+
+    async def pool(self) -> asyncpg.Pool:
+        """Returns the pool of the running event loop, opening it on first use."""
+        loop = asyncio.get_running_loop()
+        if self._pool is not None and self._pool_loop is loop:
+            return self._pool
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock, self._lock_loop = asyncio.Lock(), loop
+        async with self._lock:
+            if self._pool is not None and self._pool_loop is not loop:
+                logger.warning("Database pool used from a new event loop; reopening it.")
+                self._pool.terminate()
+                self._pool = None
+            if self._pool is None:
+                self._pool = await asyncpg.create_pool(
+                    self._dsn,
+                    min_size=self._min_size,
+                    max_size=self._max_size,
+                    command_timeout=self._command_timeout,
+                    statement_cache_size=self._statement_cache_size,
+                    max_inactive_connection_lifetime=self._max_inactive_connection_lifetime,
+                    init=self._init_connection,
+                )
+                self._pool_loop = loop
+        return self._pool
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[asyncpg.Connection]:
+        """Borrows a pooled connection, waiting at most `acquire_timeout` for one."""
+        pool = await self.pool()
+        async with pool.acquire(timeout=self._acquire_timeout) as conn:
+            yield conn
+
+    async def close(self) -> None:
+        if self._pool is None:
+            return
+        pool, self._pool = self._pool, None
+        if self._pool_loop is asyncio.get_running_loop():
+            await pool.close()
+        else:
+            pool.terminate()
+
+    # --- ads ---
+
+    async def insert_ads(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Inserts `rows` (which must all set the same columns) with one statement
+        and returns the stored rows in insertion order.
+        """
+        if not rows:
+            return []
+        columns = list(rows[0])
+        unknown = set(columns) - set(AD_COLUMN_TYPES)
+        if unknown:
+            raise ValueError(f"Unknown ads columns: {sorted(unknown)}")
+        if any(set(row) != set(columns) for row in rows):
+            raise ValueError("All rows of a bulk insert must set the same columns")
+        arrays = ", ".join(f"${i}::{AD_COLUMN_TYPES[column]}[]" for i, column in enumerate(columns, start=1))
+        query = f"INSERT INTO public.ads ({', '.join(columns)}) SELECT * FROM unnest({arrays}) RETURNING *"
+        async with self.connection() as conn:
+            records = await conn.fetch(query, *[[row[column] for row in rows] for column in columns])
+        return [dict(record) for record in records]
+
+    async def insert_ad(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        return (await self.insert_ads([row]))[0]
+
+    async def get_ad(self, ad_id: Any) -> Optional[Dict[str, Any]]:
+        ad_uuid = _as_uuid(ad_id)
+        if ad_uuid is None:
+            return None
+        async with self.connection() as conn:
+            record = await conn.fetchrow("SELECT * FROM public.ads WHERE id = $1", ad_uuid)
+        return dict(record) if record else None
+
+    async def get_ad_status(self, ad_id: Any) -> Optional[Dict[str, Any]]:
+        ad_uuid = _as_uuid(ad_id)
+        if ad_uuid is None:
+            return None
+        async with self.connection() as conn:
+            record = await conn.fetchrow("SELECT status, error_log, derived_from FROM public.ads WHERE id = $1", ad_uuid)
+        return dict(record) if record else None
+
+    async def transition_status(self, ad_id: Any, from_status: str, to_status: str) -> bool:
+        """Moves the ad from `from_status` to `to_status`; False if it was not in `from_status`."""
+        async with self.connection() as conn:
+            result = await conn.execute(
+                "UPDATE public.ads SET status = $3 WHERE id = $1 AND status = $2", _as_uuid(ad_id), from_status, to_status
+            )
+        return result != "UPDATE 0"
+
+    async def claim_ad(self, ad_id: Any, owner: str, lease_seconds: float) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """
+        Leases the ad to `owner` (moving it to ENRICHING) and returns `(True, row)`.
+        Returns `(False, row)` with its current status if it is held by another
+        owner or not waiting for enrichment, and `(False, None)` if there is no such ad.
+        """
+        ad_uuid = _as_uuid(ad_id)
+        if ad_uuid is None:
+            return False, None
+        async with self.connection() as conn:
+            record = await conn.fetchrow(CLAIM_AD_SQL, ad_uuid, owner, float(lease_seconds))
+        if record is None:
+            return False, None
+        row = dict(record)
+        return row.pop("claimed"), row
+
+    async def save_enrichment(self, ad_id: Any, fields: Dict[str, Any], owner: Optional[str] = None) -> bool:
+        """
+        Writes the outcome of an enrichment (all enrichment columns) with one
+        prepared statement and releases the lease. With `owner`, returns False
+        without writing if the lease has passed to someone else.
+        """
+        # `execute` with arguments goes through the connection's statement cache;
+        # an explicit `prepare()` would bypass it and cost a round trip per call.
+        async with self.connection() as conn:
+            result = await conn.execute(
+                SAVE_ENRICHMENT_SQL,
+                _as_uuid(ad_id),
+                fields.get("status"),
+                fields.get("enriched_at"),
+                fields.get("error_log"),
+                fields.get("strategic_analysis"),
+                fields.get("visual_analysis"),
+                fields.get("audience_persona"),
+                fields.get("vector_summary"),
+                owner,
+            )
+        return result != "UPDATE 0"
+
+    async def save_stage(self, ad_id: Any, stage: str, value: Any, owner: Optional[str] = None) -> bool:
+        """
+        Checkpoints the result of one enrichment stage so that a retry can skip
+        it. With `owner`, returns False without writing if the lease has passed
+        to someone else.
+        """
+        if stage not in SAVE_STAGE_SQL:
+            raise ValueError(f"Unknown enrichment stage: {stage}")
+        if isinstance(value, BaseModel):
+            value = value.model_dump(mode="json")
+        async with self.connection() as conn:
+            result = await conn.execute(SAVE_STAGE_SQL[stage], _as_uuid(ad_id), value, owner)
+        return result != "UPDATE 0"
+
+    async def save_stages(self, stage: str, results: Dict[Any, Any], owner: Optional[str] = None) -> int:
+        """Checkpoints one stage for many ads (`{ad_id: result}`) in one statement; returns the rows written."""
+        if stage not in SAVE_STAGES_SQL:
+            raise ValueError(f"Unknown enrichment stage: {stage}")
+        if not results:
+            return 0
+        ad_ids = [_as_uuid(ad_id) for ad_id in results]
+        values = [value.model_dump(mode="json") if isinstance(value, BaseModel) else value for value in results.values()]
+        async with self.connection() as conn:
+            result = await conn.execute(SAVE_STAGES_SQL[stage], ad_ids, values, owner)
+        return int(result.split()[-1])
+
+    async def finish_enrichments(self, outcomes: Sequence[Dict[str, Any]], owner: Optional[str] = None) -> int:
+        """
+        Writes `status`, `enriched_at` and `error_log` of many ads (dicts with
+        an `id`) in one statement and releases their leases; returns the rows written.
+        """
+        if not outcomes:
+            return 0
+        async with self.connection() as conn:
+            result = await conn.execute(
+                FINISH_ENRICHMENTS_SQL,
+                [_as_uuid(outcome["id"]) for outcome in outcomes],
+                [outcome["status"] for outcome in outcomes],
+                [outcome.get("enriched_at") for outcome in outcomes],
+                [outcome.get("error_log") for outcome in outcomes],
+                owner,
+            )
+        return int(result.split()[-1])
+
+    async def heartbeat(self, ad_ids: Sequence[Any], owner: str, lease_seconds: float) -> int:
+        """Extends the leases `owner` holds on `ad_ids`; returns how many it still holds."""
+        if not ad_ids:
+            return 0
+        async with self.connection() as conn:
+            result = await conn.execute(HEARTBEAT_SQL, [_as_uuid(ad_id) for ad_id in ad_ids], owner, float(lease_seconds))
+        return int(result.split()[-1])
+
+    async def claim_pending_ads(self, limit: int, lease_seconds: float, owner: str) -> List[Dict[str, Any]]:
+        """Leases up to `limit` PENDING ads to `owner` for `lease_seconds` and returns them (now ENRICHING)."""
+        if limit <= 0:
+            return []
+        async with self.connection() as conn:
+            records = await conn.fetch(CLAIM_PENDING_ADS_SQL, limit, float(lease_seconds), owner)
+        return [dict(record) for record in records]
+
+    async def reclaim_expired_leases(self, limit: int = 1000, before_commit: Optional[Callable[[List[str]], Any]] = None) -> List[str]:
+        """
+        Returns up to `limit` ENRICHING ads with an expired lease to PENDING;
+        returns their ids. `before_commit(ad_ids)` runs inside the transaction
+        (e.g. to re-dispatch them): if it raises, the ads stay ENRICHING for
+        the next sweep. A task claiming one of them meanwhile waits on its row lock.
+        """
+        async with self.connection() as conn:
+            async with conn.transaction():
+                ad_ids = [str(record["id"]) for record in await conn.fetch(RECLAIM_EXPIRED_LEASES_SQL, limit)]
+                if ad_ids and before_commit is not None:
+                    before_commit(ad_ids)
+        return ad_ids
+
+    async def requeue_failed_ads(self, ad_ids: Sequence[Any], before_commit: Optional[Callable[[List[str]], Any]] = None) -> List[str]:
+        """
+        Puts the FAILED ads among `ad_ids` back to PENDING; returns their ids,
+        in the order given. `before_commit(requeued_ids)` runs inside the
+        transaction (e.g. to dispatch them): if it raises, the ads stay FAILED.
+        """
+        ad_uuids = [ad_uuid for ad_uuid in map(_as_uuid, ad_ids) if ad_uuid is not None]
+        if not ad_uuids:
+            return []
+        async with self.connection() as conn:
+            async with conn.transaction():
+                records = await conn.fetch(REQUEUE_FAILED_ADS_SQL, ad_uuids)
+                requeued = {str(record["id"]) for record in records}
+                requeued_ids = [str(ad_uuid) for ad_uuid in ad_uuids if str(ad_uuid) in requeued]
+                if requeued_ids and before_commit is not None:
+                    before_commit(requeued_ids)
+        return requeued_ids
+
+    async def find_dedup_sources(self, creative_fingerprints: Sequence[str]) -> List[Dict[str, Any]]:
+        """Source ads carrying any of `creative_fingerprints`, ENRICHED ones first."""
+        if not creative_fingerprints:
+            return []
+        async with self.connection() as conn:
+            records = await conn.fetch(DEDUP_SOURCES_SQL, list(creative_fingerprints))
+        return [dict(record) for record in records]
+
+    async def copy_enrichment_from_sources(self, ad_ids: Sequence[Any]) -> List[str]:
+        """Gives derived ads whose source is ENRICHED a copy of its results; returns the ids copied to."""
+        if not ad_ids:
+            return []
+        async with self.connection() as conn:
+            records = await conn.fetch(COPY_FROM_SOURCES_SQL, [_as_uuid(ad_id) for ad_id in ad_ids])
+        return [str(record["id"]) for record in records]
+
+    async def update_ad(self, ad_id: Any, fields: Dict[str, Any]) -> None:
+        fields = {column: value for column, value in fields.items() if column in AD_COLUMN_TYPES and column != "id"}
+        if not fields:
+            return
+        assignments = ", ".join(f"{column} = ${i}" for i, column in enumerate(fields, start=2))
+        async with self.connection() as conn:
+            await conn.execute(f"UPDATE public.ads SET {assignments} WHERE id = $1", _as_uuid(ad_id), *fields.values())
+
+    # --- search ---
+
+    async def match_ads_filtered(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Calls `match_ads_filtered` with the given named parameters; unset ones keep their defaults."""
+        unknown = set(params) - set(MATCH_ADS_FILTERED_PARAMS)
+        if unknown:
+            raise ValueError(f"Unknown match_ads_filtered parameters: {sorted(unknown)}")
+        names = [name for name in MATCH_ADS_FILTERED_PARAMS if name in params]
+        arguments = ", ".join(f"{name} => ${i}" for i, name in enumerate(names, start=1))
+        async with self.connection() as conn:
+            records = await conn.fetch(f"SELECT * FROM public.match_ads_filtered({arguments})", *[params[name] for name in names])
+        return [dict(record) for record in records]
+
+    async def latest_enriched_at(self, filter_criteria: Optional[Dict[str, Any]]) -> Optional[str]:
+        """Newest `enriched_at` among the ads matching `filter_criteria`, as an ISO 8601 string."""
+        async with self.connection() as conn:
+            value = await conn.fetchval("SELECT public.latest_enriched_at($1)", filter_criteria or {})
+        return value.isoformat() if value else None
+
+def create_database(settings: Settings) -> Database:
+    return Database(
+        settings.SUPABASE_CONNECTION_STRING,
+        min_size=settings.DB_POOL_MIN_SIZE,
+        max_size=settings.DB_POOL_MAX_SIZE,
+        acquire_timeout=settings.DB_ACQUIRE_TIMEOUT_SECONDS,
+        command_timeout=settings.DB_COMMAND_TIMEOUT_SECONDS,
+        statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+        max_inactive_connection_lifetime=settings.DB_MAX_INACTIVE_CONNECTION_LIFETIME_SECONDS,
+    )
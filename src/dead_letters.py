@@ -0,0 +1,154 @@
+"""
+Dead-lettered enrichment tasks.
+
+An enrichment task that exhausted its retries marks its ad FAILED and
+publishes an entry to `dead_letter_queue` (src/celeryconfig.py):
+
+    {"task": "src.tasks.enrichment_task", "kwargs": {"ad_id": ..., "force_refresh": ...},
+     "error": "...", "dead_lettered_at": <unix time>}
+
+Nothing consumes that queue. Once the cause is fixed (a quota raised, a
+prompt repaired), the replay command re-drives the entries through the
+`retry` lane in rate-limited batches:
+
+    python -m src.dead_letters [--limit N] [--batch-size N] [--rate PER_SECOND]
+
+A replay puts each FAILED ad back to PENDING (its stage checkpoints are
+kept, so completed stages are not repeated) before dispatching it again.
+Entries whose ad is no longer FAILED are dropped.
+"""
+import argparse
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from kombu import Connection
+
+from src.celeryconfig import RETRY_QUEUE, dead_letter_exchange, dead_letter_queue
+from src.db import Database
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+
+
+class DeadLetterQueue:
+    """Publishes entries to, and takes entries from, the dead-letter queue over `connection`."""
+
+    def __init__(self, connection: Connection):
+        self._connection = connection
+        self._queue = None
+
+    def publish(self, task: str, kwargs: Dict[str, Any], error: str) -> None:
+        entry = {"task": task, "kwargs": kwargs, "error": error, "dead_lettered_at": time.time()}
+        with self._connection.Producer(serializer="json") as producer:
+            producer.publish(
+                entry, exchange=dead_letter_exchange, routing_key=dead_letter_queue.routing_key,
+                declare=[dead_letter_queue], retry=True, retry_policy={"max_retries": 3},
+            )
+        get_metrics().incr("dead_letters.published")
+
+    def take(self, limit: int) -> List[Any]:
+        """Up to `limit` entries (kombu messages); each must be acked or requeued."""
+        if self._queue is None:
+            self._queue = self._connection.SimpleQueue(dead_letter_queue)
+        messages = []
+        while len(messages) < limit:
+            try:
+                messages.append(self._queue.get(block=False))
+            except self._queue.Empty:
+                break
+        return messages
+
+    def close(self) -> None:
+        if self._queue is not None:
+            self._queue.close()
+        self._connection.release()
+
+
+async def replay_dead_letters(
+    dead_letters: DeadLetterQueue,
+    db: Database,
+    dispatch: Callable[[List[str], Sequence[bool]], Any],
+    batch_size: int = 100,
+    rate_per_second: float = 10,
+    limit: Optional[int] = None,
+    sleep: Callable[[float], Awaitable[None]] = asyncio.sleep,
+    metrics: Optional[Metrics] = None,
+) -> Dict[str, int]:
+    """
+    Re-drives up to `limit` dead-lettered enrichments, `batch_size` at a time
+    and at most `rate_per_second` on average: each batch's FAILED ads are
+    passed to `dispatch(ad_ids, force_refresh)` and go back to PENDING. A
+    batch whose dispatch fails stays FAILED and goes back to the dead-letter
+    queue. Returns the numbers of replayed and dropped entries.
+    """
+    metrics = metrics or get_metrics()
+    counts = {"replayed": 0, "dropped": 0}
+    while limit is None or sum(counts.values()) < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sum(counts.values()))
+        messages = dead_letters.take(size)
+        if not messages:
+            break
+        started = time.monotonic()
+        kwargs_by_ad = {str(message.payload["kwargs"]["ad_id"]): message.payload["kwargs"] for message in messages}
+        try:
+            # Dispatched before the move back to PENDING commits: a batch whose
+            # dispatch fails stays FAILED, so its entries replay next time.
+            requeued = await db.requeue_failed_ads(
+                list(kwargs_by_ad),
+                before_commit=lambda ad_ids: dispatch(ad_ids, [bool(kwargs_by_ad[ad_id].get("force_refresh")) for ad_id in ad_ids]),
+            )
+        except Exception:
+            for message in messages:
+                message.requeue()
+            raise
+        for message in messages:
+            message.ack()
+        counts["replayed"] += len(requeued)
+        counts["dropped"] += len(messages) - len(requeued)
+        metrics.incr("dead_letters.replayed", len(requeued))
+        logger.info(f"Replayed {len(requeued)} dead-lettered ads ({len(messages) - len(requeued)} no longer FAILED).")
+        await sleep(max(len(messages) / rate_per_second - (time.monotonic() - started), 0))
+    return counts
+
+
+def dead_letter_stats(metrics: Metrics) -> Dict[str, float]:
+    """Dead-lettered and replayed task counts."""
+    counters = metrics.snapshot()
+    return {
+        "dead_lettered": counters.get("dead_letters.published", 0),
+        "replayed": counters.get("dead_letters.replayed", 0),
+    }
+
+
+async def main(limit: Optional[int] = None, batch_size: Optional[int] = None, rate: Optional[float] = None) -> None:
+    from src.celery_app import celery_app
+    from src.dependencies import get_client_registry
+    from src.tasks import dispatch_enrichment_batch
+
+    clients = get_client_registry()
+    settings = clients.settings
+    dead_letters = DeadLetterQueue(celery_app.connection_for_read())
+
+    def dispatch(ad_ids: List[str], force_refresh: Sequence[bool]) -> List[str]:
+        return dispatch_enrichment_batch(ad_ids, force_refresh=force_refresh, lanes=[RETRY_QUEUE] * len(ad_ids))
+
+    try:
+        counts = await replay_dead_letters(
+            dead_letters, clients.db, dispatch,
+            batch_size=batch_size or settings.DLQ_REPLAY_BATCH_SIZE,
+            rate_per_second=rate or settings.DLQ_REPLAY_RATE_PER_SECOND,
+            limit=limit,
+        )
+        logger.info(f"Dead-letter replay finished: {counts}")
+    finally:
+        dead_letters.close()
+        await clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-drive dead-lettered enrichment tasks through the retry lane.")
+    parser.add_argument("--limit", type=int, help="Entries to replay (default: all)")
+    parser.add_argument("--batch-size", type=int, help="Entries per batch (default: DLQ_REPLAY_BATCH_SIZE)")
+    parser.add_argument("--rate", type=float, help="Entries per second (default: DLQ_REPLAY_RATE_PER_SECOND)")
+    args = parser.parse_args()
+    asyncio.run(main(args.limit, args.batch_size, args.rate))
@@ -0,0 +1,153 @@
+"""
+Near-duplicate ad detection at ingestion.
+
+Advertisers run the same creative with lightly edited copy many times over. Each
+ingested ad is fingerprinted with
+  * `copy_simhash`: a 64-bit SimHash of its normalized copy (the words of
+    the body, caption and CTA), so edits of a few words flip only a few bits;
+  * `creative_fingerprint`: a SHA-256 of its normalized creative URL (fbcdn
+    URLs are reduced to their path, see `normalize_creative_url`).
+
+An ad with the creative fingerprint of a source ad (one that is not itself
+derived) and a SimHash within `DEDUP_MAX_HAMMING_DISTANCE` bits of the
+source's is stored with `derived_from` pointing at the source and is not
+enqueued for enrichment. It takes a copy of the source's results: at once if
+the source is ENRICHED, otherwise when it becomes ENRICHED (see
+supabase/migrations/20250908000000_ads_dedup_fingerprints.sql). Duplicates
+within one ingested chunk are linked to the first ad of their group.
+
+Metrics: dedup.checked (ads looked up), dedup.duplicates (ads linked to a
+source) and dedup.copied (duplicates whose source was already ENRICHED).
+"""
+import hashlib
+import re
+import unicodedata
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+from src.db import Database
+from src.llm_cache import normalize_creative_url
+from src.metrics import Metrics, get_metrics
+
+# Copy fields of the raw snapshot that make up an ad's text.
+COPY_FIELDS = ("ad_body_text", "ad_caption", "cta_text")
+
+SIMHASH_BITS = 64
+
+_URL = re.compile(r"https?://\S+|www\.\S+")
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_copy(text: str) -> str:
+    """Case-folded copy without URLs, punctuation or repeated whitespace."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(_NON_WORD.sub(" ", _URL.sub(" ", text)).split())
+
+
+def ad_copy(raw_data_snapshot: Dict[str, Any]) -> str:
+    return " ".join(str(raw_data_snapshot.get(field) or "") for field in COPY_FIELDS)
+
+
+def simhash(text: str) -> int:
+    """
+    64-bit SimHash over the words of the normalized `text`, as a signed integer
+    (the range of a Postgres BIGINT). Words rather than shingles: ad copy is
+    short, and replacing one word of a short copy already changes most of its
+    shingles. Empty copy hashes to 0.
+    """
+    weights = [0] * SIMHASH_BITS
+    for word in normalize_copy(text).split():
+        value = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    value = sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+    return value - (1 << SIMHASH_BITS) if value >= 1 << (SIMHASH_BITS - 1) else value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << SIMHASH_BITS) - 1)).count("1")
+
+
+def creative_fingerprint(raw_data_snapshot: Dict[str, Any]) -> Optional[str]:
+    """SHA-256 of the normalized creative URL, or None for an ad without one."""
+    url = raw_data_snapshot.get("ad_creative_url")
+    if not url:
+        return None
+    return hashlib.sha256(normalize_creative_url(url).encode()).hexdigest()
+
+
+def _find_source(candidates: Sequence[Dict[str, Any]], fingerprint: str, copy_hash: int, max_distance: int) -> Optional[Dict[str, Any]]:
+    for candidate in candidates:
+        if (
+            candidate["creative_fingerprint"] == fingerprint
+            and candidate["copy_simhash"] is not None
+            and hamming_distance(candidate["copy_simhash"], copy_hash) <= max_distance
+        ):
+            return candidate
+    return None
+
+
+async def link_duplicates(
+    rows: List[Dict[str, Any]],
+    db: Database,
+    max_distance: int,
+    skip: Sequence[bool] = (),
+    metrics: Optional[Metrics] = None,
+) -> None:
+    """
+    Fingerprints the ad rows about to be inserted and links near-duplicates to
+    their source: sets `id`, `copy_simhash`, `creative_fingerprint` and
+    `derived_from` (None for ads that need their own enrichment) on every row.
+    Rows flagged in `skip` (e.g. forced refreshes) are fingerprinted but never
+    linked.
+    """
+    metrics = metrics or get_metrics()
+    flags = list(skip) or [False] * len(rows)
+    for row in rows:
+        row["id"] = row.get("id") or uuid.uuid4()
+        row["copy_simhash"] = simhash(ad_copy(row["raw_data_snapshot"]))
+        row["creative_fingerprint"] = creative_fingerprint(row["raw_data_snapshot"])
+        row["derived_from"] = None
+
+    fingerprints = sorted({row["creative_fingerprint"] for row in rows if row["creative_fingerprint"]})
+    sources = await db.find_dedup_sources(fingerprints)
+    duplicates = 0
+    for row, skipped in zip(rows, flags):
+        if row["creative_fingerprint"] is None:
+            continue
+        source = None
+        if not skipped:
+            metrics.incr("dedup.checked")
+            source = _find_source(sources, row["creative_fingerprint"], row["copy_simhash"], max_distance)
+        if source is None:
+            sources.append({**row, "status": "PENDING"}) # A source for the rest of the chunk
+        else:
+            row["derived_from"] = source["id"]
+            duplicates += 1
+    if duplicates:
+        metrics.incr("dedup.duplicates", duplicates)
+
+
+async def copy_from_sources(rows: Sequence[Dict[str, Any]], db: Database, metrics: Optional[Metrics] = None) -> List[str]:
+    """
+    After the insert: gives the derived rows whose source is already ENRICHED
+    a copy of its results. Returns the ids copied to.
+    """
+    derived = [row["id"] for row in rows if row.get("derived_from") is not None]
+    copied = await db.copy_enrichment_from_sources(derived)
+    if copied:
+        (metrics or get_metrics()).incr("dedup.copied", len(copied))
+    return copied
+
+
+def dedup_stats(metrics: Metrics) -> Dict[str, Optional[float]]:
+    """Ads checked, linked to a source and the resulting dedup ratio."""
+    counters = metrics.snapshot()
+    checked = counters.get("dedup.checked", 0)
+    duplicates = counters.get("dedup.duplicates", 0)
+    return {
+        "checked": checked,
+        "duplicates": duplicates,
+        "copied_at_ingestion": counters.get("dedup.copied", 0),
+        "dedup_ratio": duplicates / checked if checked else None,
+    }
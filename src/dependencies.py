@@ -1,22 +1,198 @@
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
 from fastapi import Depends
-from supabase import Client
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-import google.generativeai as genai
-from llama_index.llms.langchain import LangChainLLM
-from src.config import Settings
-from src.supabase_client import get_supabase_client as get_actual_supabase_client # Rename to avoid conflict
+from src.config import Settings, get_settings
+from src.creatives import CreativeFetcher, create_creative_fetcher
+from src.db import Database, create_database
+from src.embeddings import EmbeddingService, create_embedding_service
+from src.llm_cache import EnrichmentCache, create_enrichment_cache
+from src.rate_limiter import (
+    ModelRateLimiter,
+    create_rate_limited_chat_model,
+    create_rate_limited_embeddings,
+    create_rate_limiter,
+)
+
+# The client libraries (Supabase, LangChain, LlamaIndex) take seconds to import
+# between them: they are imported by the factories below, on first use, so that
+# importing this module (and thus starting the API or a worker) stays cheap.
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+    from llama_index.core.response_synthesizers import BaseSynthesizer
+    from llama_index.llms.langchain import LangChainLLM
+    from supabase import Client
+    from src.query_engine import SemanticAnswerCache
+
+def create_gemini_flash_chat_model(settings: Settings, limiter: Optional[ModelRateLimiter] = None) -> "ChatGoogleGenerativeAI":
+    return create_rate_limited_chat_model(limiter, model=settings.GEMINI_FLASH_MODEL, temperature=0.1, google_api_key=settings.GOOGLE_API_KEY)
+
+def create_gemini_pro_chat_model(settings: Settings, limiter: Optional[ModelRateLimiter] = None) -> "ChatGoogleGenerativeAI":
+    return create_rate_limited_chat_model(limiter, model=settings.GEMINI_PRO_MODEL, temperature=0.2, google_api_key=settings.GOOGLE_API_KEY)
+
+def create_gemini_flash_client(settings: Settings) -> "LangChainLLM":
+    from llama_index.llms.langchain import LangChainLLM
+    return LangChainLLM(create_gemini_flash_chat_model(settings))
+
+def create_gemini_pro_client(settings: Settings) -> "LangChainLLM":
+    from llama_index.llms.langchain import LangChainLLM
+    return LangChainLLM(create_gemini_pro_chat_model(settings))
+
+def create_embedding_model_client(settings: Settings, limiter: Optional[ModelRateLimiter] = None) -> "GoogleGenerativeAIEmbeddings":
+    return create_rate_limited_embeddings(limiter, model=settings.EMBEDDING_MODEL, google_api_key=settings.GOOGLE_API_KEY)
+
+
+class ClientRegistry:
+    """
+    Holds the expensive, reusable clients of a process.
+
+    Each client is built on first access and then shared by every request (or
+    task) in the process. `aclose()` releases the underlying connections and is
+    called from the FastAPI lifespan on shutdown.
+    """
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.RLock() # Factories may resolve other clients.
+
+    def _get_or_create(self, name: str, factory: Callable[[], Any]) -> Any:
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = factory()
+                    self._clients[name] = client
+        return client
+
+    @property
+    def supabase(self) -> "Client":
+        def create():
+            from supabase import create_client
+            return create_client(self.settings.SUPABASE_URL, self.settings.SUPABASE_KEY)
+        return self._get_or_create("supabase", create)
+
+    @property
+    def db(self) -> Database:
+        """Pooled async Postgres access; the pool itself is opened on first use."""
+        return self._get_or_create("db", lambda: create_database(self.settings))
+
+    def rate_limiter(self, model: str) -> Optional[ModelRateLimiter]:
+        """The limiter of `model`, shared by every client of the process that calls it."""
+        return self._get_or_create(f"rate_limiter:{model}", lambda: create_rate_limiter(self.settings, model))
+
+    @property
+    def gemini_flash_chat_model(self) -> "ChatGoogleGenerativeAI":
+        return self._get_or_create(
+            "gemini_flash_chat_model",
+            lambda: create_gemini_flash_chat_model(self.settings, self.rate_limiter(self.settings.GEMINI_FLASH_MODEL)),
+        )
+
+    @property
+    def gemini_pro_chat_model(self) -> "ChatGoogleGenerativeAI":
+        return self._get_or_create(
+            "gemini_pro_chat_model",
+            lambda: create_gemini_pro_chat_model(self.settings, self.rate_limiter(self.settings.GEMINI_PRO_MODEL)),
+        )
+
+    @property
+    def gemini_pro(self) -> "LangChainLLM":
+        """Gemini Pro wrapped for LlamaIndex; shares the underlying LangChain chat model."""
+        def create():
+            from llama_index.llms.langchain import LangChainLLM
+            return LangChainLLM(self.gemini_pro_chat_model)
+        return self._get_or_create("gemini_pro", create)
+
+    def response_synthesizer(self, streaming: bool = False) -> "BaseSynthesizer":
+        """The (streaming) response synthesizer over `gemini_pro`; it holds no per-query state, so queries share it."""
+        def create():
+            from src.query_engine import create_response_synthesizer
+            return create_response_synthesizer(self.gemini_pro, streaming=streaming)
+        return self._get_or_create(f"response_synthesizer:{streaming}", create)
+
+    @property
+    def embedding_client(self) -> "GoogleGenerativeAIEmbeddings":
+        return self._get_or_create(
+            "embedding_client",
+            lambda: create_embedding_model_client(self.settings, self.rate_limiter(self.settings.EMBEDDING_MODEL)),
+        )
+
+    @property
+    def embedding_model(self) -> EmbeddingService:
+        """The embedding client behind the shared vector cache and micro-batcher."""
+        return self._get_or_create("embedding_model", lambda: create_embedding_service(self.embedding_client, self.settings))
+
+    @property
+    def enrichment_cache(self) -> Optional[EnrichmentCache]:
+        """The enrichment LLM output cache, or None when `ENRICHMENT_CACHE_BACKEND` is `none`."""
+        return self._get_or_create("enrichment_cache", lambda: create_enrichment_cache(self.settings))
+
+    @property
+    def creative_fetcher(self) -> Optional[CreativeFetcher]:
+        """Downloads creatives for multimodal visual analysis, or None when `CREATIVE_FETCH_ENABLED` is off."""
+        return self._get_or_create("creative_fetcher", lambda: create_creative_fetcher(self.settings))
+
+    @property
+    def answer_cache(self) -> Optional["SemanticAnswerCache"]:
+        """The semantic answer cache of `/query-ads`, or None when `ANSWER_CACHE_ENABLED` is off."""
+        def create():
+            if not self.settings.ANSWER_CACHE_ENABLED:
+                return None
+            # Imported here so that Celery workers do not load the query engine.
+            from src.query_engine import SemanticAnswerCache
+            return SemanticAnswerCache(
+                threshold=self.settings.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+                max_entries=self.settings.ANSWER_CACHE_MAX_ENTRIES,
+                ttl_seconds=self.settings.ANSWER_CACHE_TTL_SECONDS,
+            )
+        return self._get_or_create("answer_cache", create)
+
+    async def aclose(self) -> None:
+        """Closes every client that has been built and forgets it."""
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for name, client in clients.items():
+            try:
+                if name == "gemini_pro" or name.startswith("response_synthesizer:"):
+                    continue # Closed through the chat model they wrap.
+                if isinstance(client, Database):
+                    await client.close()
+                elif isinstance(client, CreativeFetcher):
+                    await client.aclose()
+                else:
+                    _close_client(client)
+            except Exception as e:
+                # Shutdown must not be interrupted by a client that is already gone.
+                from src.logger import logger
+                logger.warning(f"Failed to close client {name}: {e}")
+
+def _close_client(client: Any) -> None:
+    underlying = getattr(client, "client", None) # google.genai.Client of the LangChain wrappers
+    if underlying is not None and callable(getattr(underlying, "close", None)):
+        underlying.close()
+    elif callable(getattr(client, "close", None)):
+        client.close()
+    postgrest_session = getattr(getattr(client, "postgrest", None), "session", None)
+    if postgrest_session is not None:
+        postgrest_session.close()
+
+@lru_cache
+def get_client_registry() -> ClientRegistry:
+    """Returns the process-wide client registry."""
+    return ClientRegistry(get_settings())
 
-def get_settings() -> Settings:
-    return Settings()
+def get_supabase() -> "Client": # Renamed to get_supabase for FastAPI Depends consistency
+    return get_client_registry().supabase
 
-def get_supabase() -> Client: # Renamed to get_supabase for FastAPI Depends consistency
-    return get_actual_supabase_client()
+def get_db(registry: ClientRegistry = Depends(get_client_registry)) -> Database:
+    return registry.db
 
-def create_gemini_flash_client(settings: Settings) -> LangChainLLM:
-    return LangChainLLM(ChatGoogleGenerativeAI(model=settings.GEMINI_FLASH_MODEL, temperature=0.1, google_api_key=settings.GOOGLE_API_KEY))
+def get_gemini_pro(registry: ClientRegistry = Depends(get_client_registry)) -> "LangChainLLM":
+    return registry.gemini_pro
 
-def create_gemini_pro_client(settings: Settings) -> LangChainLLM:
-    return LangChainLLM(ChatGoogleGenerativeAI(model=settings.GEMINI_PRO_MODEL, temperature=0.2, google_api_key=settings.GOOGLE_API_KEY))
+def get_embedding_model(registry: ClientRegistry = Depends(get_client_registry)) -> EmbeddingService:
+    return registry.embedding_model
 
-def create_embedding_model_client(settings: Settings) -> GoogleGenerativeAIEmbeddings:
-    return GoogleGenerativeAIEmbeddings(model=settings.EMBEDDING_MODEL, google_api_key=settings.GOOGLE_API_KEY)
+def get_answer_cache(registry: ClientRegistry = Depends(get_client_registry)) -> Optional["SemanticAnswerCache"]:
+    return registry.answer_cache
@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import inspect
+import threading
+import weakref
+from array import array
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from src.config import Settings
+from src.llm_cache import create_cache_store, model_name
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+
+QUERY_TASK_TYPE = "RETRIEVAL_QUERY"
+DOCUMENT_TASK_TYPE = "RETRIEVAL_DOCUMENT"
+
+def encode_vector(vector: List[float]) -> bytes:
+    """Packs a vector as a compact float32 blob (3 KB for 768 dimensions)."""
+    return array("f", vector).tobytes()
+
+def decode_vector(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class _MicroBatcher:
+    """
+    Coalesces the embed requests issued on one event loop within `window_s` into
+    a single batched call per task type. Concurrent requests for the same text
+    share one future.
+    """
+    def __init__(
+        self,
+        embed: Callable[[str, List[str]], Awaitable[List[List[float]]]],
+        window_s: float,
+        max_batch_size: int,
+        metrics: Metrics,
+    ):
+        self._embed = embed
+        self._window_s = window_s
+        self._max_batch_size = max_batch_size
+        self._metrics = metrics
+        self._pending: Dict[str, Dict[str, asyncio.Future]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    def submit(self, task_type: str, text: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        pending = self._pending.setdefault(task_type, {})
+        future = pending.get(text)
+        if future is not None:
+            self._metrics.incr("embedding.coalesced")
+            return future
+        future = loop.create_future()
+        pending[text] = future
+        if len(pending) >= self._max_batch_size:
+            self._flush(task_type)
+        elif task_type not in self._timers:
+            self._timers[task_type] = loop.call_later(self._window_s, self._flush, task_type)
+        return future
+
+    def _flush(self, task_type: str) -> None:
+        timer = self._timers.pop(task_type, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(task_type, None)
+        if batch:
+            asyncio.get_running_loop().create_task(self._run(task_type, batch))
+
+    async def _run(self, task_type: str, batch: Dict[str, asyncio.Future]) -> None:
+        texts = list(batch)
+        try:
+            vectors = await self._embed(task_type, texts)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, vector in zip(texts, vectors):
+            if not batch[text].done():
+                batch[text].set_result(vector)
+
+
+class EmbeddingService(Embeddings):
+    """
+    Caching, batching front for an embedding model, usable wherever a LangChain
+    `Embeddings` is expected.
+
+    Lookups go through a bounded in-process LRU, then a shared persistent store
+    keyed by (model, task type, text hash) that holds float32 blobs. Async misses
+    are coalesced by a per-loop micro-batcher into `aembed_documents` calls.
+    Queries and documents keep their own task types, so batching does not change
+    the vectors the model returns.
+    """
+    def __init__(
+        self,
+        embedding_model: Embeddings,
+        store: Optional[Any] = None,
+        ttl_seconds: int = 30 * 24 * 3600,
+        lru_size: int = 4096,
+        batch_window_ms: float = 5.0,
+        max_batch_size: int = 100,
+        metrics: Optional[Metrics] = None,
+    ):
+        self._embedding_model = embedding_model
+        self._model_name = model_name(embedding_model)
+        self._store = store
+        self._ttl_seconds = ttl_seconds
+        self._lru_size = lru_size
+        self._lru: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lru_lock = threading.Lock()
+        self._batch_window_s = batch_window_ms / 1000
+        self._max_batch_size = max_batch_size
+        self._metrics = metrics or get_metrics()
+        self._batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _MicroBatcher]" = weakref.WeakKeyDictionary()
+        self._supports_task_type = "task_type" in inspect.signature(embedding_model.embed_documents).parameters
+
+    @property
+    def embedding_model(self) -> Embeddings:
+        return self._embedding_model
+
+    # --- Cache ---
+
+    def _key(self, task_type: str, text: str) -> str:
+        return hashlib.sha256(f"{self._model_name}\x00{task_type}\x00{text}".encode()).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        with self._lru_lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                self._metrics.incr("embedding.lru_hits")
+                return vector
+        blob = None
+        if self._store is not None:
+            try:
+                blob = self._store.get(key)
+            except Exception as e:
+                # A cache outage costs a model call, not the embedding.
+                logger.warning(f"Embedding cache lookup failed: {e}")
+        if blob is None:
+            self._metrics.incr("embedding.misses")
+            return None
+        self._metrics.incr("embedding.store_hits")
+        vector = decode_vector(blob)
+        self._remember_in_lru(key, vector)
+        return vector
+
+    def _remember_in_lru(self, key: str, vector: List[float]) -> None:
+        with self._lru_lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self._lru_size:
+                self._lru.popitem(last=False)
+
+    def _remember(self, key: str, vector: List[float]) -> List[float]:
+        blob = encode_vector(vector)
+        # Serve the float32-rounded vector from the start so hits and misses agree.
+        vector = decode_vector(blob)
+        self._remember_in_lru(key, vector)
+        if self._store is not None:
+            try:
+                self._store.set(key, blob, self._ttl_seconds)
+            except Exception as e:
+                logger.warning(f"Embedding cache write failed: {e}")
+        return vector
+
+    # --- Model calls ---
+
+    def _model_kwargs(self, task_type: str) -> Dict[str, Any]:
+        return {"task_type": task_type} if self._supports_task_type else {}
+
+    def _embed_sync(self, texts: List[str], task_type: str) -> List[List[float]]:
+        results: List[Optional[List[float]]] = []
+        missing: Dict[str, List[int]] = {}
+        for index, text in enumerate(texts):
+            vector = self._lookup(self._key(task_type, text))
+            results.append(vector)
+            if vector is None:
+                missing.setdefault(text, []).append(index)
+
+        misses = list(missing)
+        for start in range(0, len(misses), self._max_batch_size):
+            batch = misses[start:start + self._max_batch_size]
+            self._metrics.incr("embedding.api_calls")
+            self._metrics.incr("embedding.api_texts", len(batch))
+            vectors = self._embedding_model.embed_documents(batch, **self._model_kwargs(task_type))
+            for text, vector in zip(batch, vectors):
+                vector = self._remember(self._key(task_type, text), vector)
+                for index in missing[text]:
+                    results[index] = vector
+        return results
+
+    async def _aembed_batch(self, task_type: str, texts: List[str]) -> List[List[float]]:
+        self._metrics.incr("embedding.api_calls")
+        self._metrics.incr("embedding.api_texts", len(texts))
+        vectors = await self._embedding_model.aembed_documents(texts, **self._model_kwargs(task_type))
+        return [self._remember(self._key(task_type, text), vector) for text, vector in zip(texts, vectors)]
+
+    async def _aembed(self, text: str, task_type: str) -> List[float]:
+        vector = self._lookup(self._key(task_type, text))
+        if vector is not None:
+            return vector
+        loop = asyncio.get_running_loop()
+        batcher = self._batchers.get(loop)
+        if batcher is None:
+            batcher = _MicroBatcher(self._aembed_batch, self._batch_window_s, self._max_batch_size, self._metrics)
+            self._batchers[loop] = batcher
+        # Shielded: the future may be shared with other callers of the same text.
+        return await asyncio.shield(batcher.submit(task_type, text))
+
+    # --- Embeddings interface ---
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed_sync(texts, DOCUMENT_TASK_TYPE)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_sync([text], QUERY_TASK_TYPE)[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*(self._aembed(text, DOCUMENT_TASK_TYPE) for text in texts)))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self._aembed(text, QUERY_TASK_TYPE)
+
+    def close(self) -> None:
+        """Closes the persistent store; the wrapped model is owned by the caller."""
+        if self._store is not None:
+            self._store.close()
+
+def embedding_stats(metrics: Metrics) -> Dict[str, Optional[float]]:
+    """Request, hit and model-call counts of the embedding service."""
+    counters = metrics.snapshot()
+    lru_hits = counters.get("embedding.lru_hits", 0)
+    store_hits = counters.get("embedding.store_hits", 0)
+    coalesced = counters.get("embedding.coalesced", 0)
+    misses = counters.get("embedding.misses", 0)
+    requests = lru_hits + store_hits + misses
+    api_calls = counters.get("embedding.api_calls", 0)
+    return {
+        "requests": requests,
+        "lru_hits": lru_hits,
+        "store_hits": store_hits,
+        "coalesced": coalesced,
+        "api_calls": api_calls,
+        "calls_saved": requests - api_calls,
+        "hit_rate": (lru_hits + store_hits) / requests if requests else None,
+    }
+
+def create_embedding_service(embedding_model: Embeddings, settings: Settings) -> EmbeddingService:
+    store = create_cache_store(
+        settings.EMBEDDING_CACHE_BACKEND, settings, settings.EMBEDDING_CACHE_PATH,
+        settings.EMBEDDING_CACHE_MAX_ENTRIES, namespace="embedding_cache",
+    )
+    return EmbeddingService(
+        embedding_model,
+        store=store,
+        ttl_seconds=settings.EMBEDDING_CACHE_TTL_SECONDS,
+        lru_size=settings.EMBEDDING_LRU_SIZE,
+        batch_window_ms=settings.EMBEDDING_BATCH_WINDOW_MS,
+        max_batch_size=settings.EMBEDDING_MAX_BATCH_SIZE,
+    )
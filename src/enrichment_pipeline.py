@@ -1,26 +1,41 @@
+import asyncio
 import os
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional
 from uuid import UUID
 
-import google.generativeai as genai
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import HumanMessage
 from langchain_core.prompts import PromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from langchain_core.runnables import RunnableLambda
 from pydantic import BaseModel, Field
-from supabase import Client
 
 from src.config import Settings
 from src.models import AdKnowledgeObject, StrategicAnalysis, VisualAnalysis
 from src.logger import logger
 from src.dependencies import get_settings
+from src.llm_cache import EnrichmentCache
+from src.metrics import get_metrics
+from src.rate_limiter import is_rate_limit_error
+from src.structured_output import StageOutputParser, json_schema_kwargs
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from supabase import Client
+    from src.creatives import Creative, CreativeFetcher
+    from src.prompt_packing import PromptPacker
 
 # Configure Google AI (This will be moved into the functions that use it)
 # genai.configure(api_key=settings.GOOGLE_API_KEY)
 
-# --- Pydantic Output Parsers ---
-strategic_analysis_parser = PydanticOutputParser(pydantic_object=StrategicAnalysis)
-visual_analysis_parser = PydanticOutputParser(pydantic_object=VisualAnalysis)
+# --- Output Parsers ---
+# The JSON stages get their schema through the model's native JSON-schema mode
+# (bind the `*_SCHEMA` arguments), not as format instructions in the prompt.
+strategic_analysis_parser = StageOutputParser(stage="strategic_analysis", pydantic_object=StrategicAnalysis)
+visual_analysis_parser = StageOutputParser(stage="visual_analysis", pydantic_object=VisualAnalysis)
+audience_persona_parser = StageOutputParser(stage="audience_persona")
+STRATEGIC_ANALYSIS_SCHEMA = json_schema_kwargs(StrategicAnalysis)
+VISUAL_ANALYSIS_SCHEMA = json_schema_kwargs(VisualAnalysis)
 
 
 # --- Prompt Templates ---
@@ -29,15 +44,10 @@ You are an expert marketing analyst. Your task is to analyze an ad creative and
 Focus on the visual style, key elements, and overall impression.
 
 Ad Creative URL: {ad_creative_url}
-
-{format_instructions}
-
-Provide your analysis in the specified JSON format.
 """
 visual_analysis_prompt = PromptTemplate(
     template=VISUAL_ANALYSIS_PROMPT_TEMPLATE,
     input_variables=["ad_creative_url"],
-    partial_variables={"format_instructions": visual_analysis_parser.get_format_instructions()},
 )
 
 STRATEGIC_ANALYSIS_PROMPT_TEMPLATE = """
@@ -48,15 +58,10 @@ Extract the core marketing angle, emotional appeal, call-to-action effectiveness
 Raw Ad Data: {raw_ad_data}
 Targeting Data: {targeting_data}
 Visual Analysis: {visual_analysis}
-
-{format_instructions}
-
-Provide your analysis in the specified JSON format.
 """
 strategic_analysis_prompt = PromptTemplate(
     template=STRATEGIC_ANALYSIS_PROMPT_TEMPLATE,
     input_variables=["raw_ad_data", "targeting_data", "visual_analysis"],
-    partial_variables={"format_instructions": strategic_analysis_parser.get_format_instructions()},
 )
 
 AUDIENCE_PERSONA_PROMPT_TEMPLATE = """
@@ -73,48 +78,82 @@ audience_persona_prompt = PromptTemplate(
     input_variables=["raw_ad_data", "strategic_analysis", "visual_analysis"],
 )
 
-# --- Enrichment Pipeline Functions ---
+# --- Prompt Inputs ---
+# Shared by the chains below and by batch mode (src/batch_enrichment.py), so
+# both render identical prompts and share cache entries.
 
-def perform_visual_analysis(ad_creative_url: str, gemini_flash: ChatGoogleGenerativeAI) -> VisualAnalysis:
-    """Performs visual analysis using Gemini 1.5 Flash and PydanticOutputParser for safe parsing."""
-    chain = visual_analysis_prompt | gemini_flash | visual_analysis_parser
-    response = chain.invoke({"ad_creative_url": ad_creative_url})
-    return response
+TEXT_ONLY_VISUAL_ANALYSIS = "Not available; analyze the ad from its copy and targeting data only."
+CREATIVE_ATTACHED = "\nThe creative is attached (for a video, its keyframes in order)."
 
-def perform_strategic_analysis(raw_ad_data: Dict[str, Any], targeting_data: Dict[str, Any], visual_analysis: VisualAnalysis, gemini_pro: ChatGoogleGenerativeAI) -> StrategicAnalysis:
-    """Performs deep strategic analysis using Gemini 1.5 Pro."""
-    chain = strategic_analysis_prompt | gemini_pro | strategic_analysis_parser
-    response = chain.invoke({
+def visual_analysis_inputs(ad_creative_url: str) -> Dict[str, Any]:
+    return {"ad_creative_url": ad_creative_url}
+
+def strategic_analysis_inputs(raw_ad_data: Dict[str, Any], targeting_data: Dict[str, Any], visual_analysis: Optional[VisualAnalysis]) -> Dict[str, Any]:
+    return {
         "raw_ad_data": raw_ad_data,
         "targeting_data": targeting_data,
-        "visual_analysis": visual_analysis.model_dump()
-    })
-    return response
+        "visual_analysis": visual_analysis.model_dump() if visual_analysis else TEXT_ONLY_VISUAL_ANALYSIS,
+    }
 
-def generate_audience_persona(raw_ad_data: Dict[str, Any], strategic_analysis: StrategicAnalysis, visual_analysis: VisualAnalysis, gemini_pro: ChatGoogleGenerativeAI) -> str:
-    """Generates a concise audience persona using Gemini 1.5 Pro."""
-    chain = audience_persona_prompt | gemini_pro
-    response = chain.invoke({
+def audience_persona_inputs(raw_ad_data: Dict[str, Any], strategic_analysis: StrategicAnalysis, visual_analysis: VisualAnalysis) -> Dict[str, Any]:
+    return {
         "raw_ad_data": raw_ad_data,
         "strategic_analysis": strategic_analysis.model_dump_json(), # Pass as JSON string
         "visual_analysis": visual_analysis.model_dump()
-    })
-    return response.content.strip()
+    }
+
+# --- Enrichment Pipeline Functions ---
+
+def perform_visual_analysis(ad_creative_url: str, gemini_flash: "ChatGoogleGenerativeAI", cache: Optional[EnrichmentCache] = None) -> VisualAnalysis:
+    """Performs visual analysis using Gemini 1.5 Flash in JSON-schema mode, with a repairing parser."""
+    chain = visual_analysis_prompt | gemini_flash.bind(**VISUAL_ANALYSIS_SCHEMA) | visual_analysis_parser
+    inputs = visual_analysis_inputs(ad_creative_url)
+    if cache is not None:
+        return cache.invoke("visual_analysis", chain, visual_analysis_prompt, gemini_flash, inputs, VisualAnalysis)
+    response = chain.invoke(inputs)
+    return response
+
+def perform_strategic_analysis(raw_ad_data: Dict[str, Any], targeting_data: Dict[str, Any], visual_analysis: VisualAnalysis, gemini_pro: "ChatGoogleGenerativeAI", cache: Optional[EnrichmentCache] = None) -> StrategicAnalysis:
+    """Performs deep strategic analysis using Gemini 1.5 Pro."""
+    chain = strategic_analysis_prompt | gemini_pro.bind(**STRATEGIC_ANALYSIS_SCHEMA) | strategic_analysis_parser
+    inputs = strategic_analysis_inputs(raw_ad_data, targeting_data, visual_analysis)
+    if cache is not None:
+        return cache.invoke("strategic_analysis", chain, strategic_analysis_prompt, gemini_pro, inputs, StrategicAnalysis)
+    response = chain.invoke(inputs)
+    return response
+
+def generate_audience_persona(raw_ad_data: Dict[str, Any], strategic_analysis: StrategicAnalysis, visual_analysis: VisualAnalysis, gemini_pro: "ChatGoogleGenerativeAI", cache: Optional[EnrichmentCache] = None) -> str:
+    """Generates a concise audience persona using Gemini 1.5 Pro."""
+    chain = audience_persona_prompt | gemini_pro | audience_persona_parser
+    inputs = audience_persona_inputs(raw_ad_data, strategic_analysis, visual_analysis)
+    if cache is not None:
+        return cache.invoke("audience_persona", chain, audience_persona_prompt, gemini_pro, inputs, str).strip()
+    response = chain.invoke(inputs)
+    return response.strip()
 
-def generate_vector_summary(text: str, embedding_model: GoogleGenerativeAIEmbeddings) -> List[float]:
+def generate_vector_summary(text: str, embedding_model: Embeddings) -> List[float]:
     """Generates a vector embedding for the ad's core strategy."""
     embeddings = embedding_model.embed_query(text)
     return embeddings
 
+def build_summary_text(strategic_analysis: StrategicAnalysis, audience_persona: Optional[str] = None) -> str:
+    """Builds the natural-language strategy summary that is embedded into `vector_summary`."""
+    summary_text = f"Marketing Angle: {strategic_analysis.marketing_angle}. Emotional Appeal: {strategic_analysis.emotional_appeal}. CTA: {strategic_analysis.cta_analysis}."
+    if audience_persona is not None:
+        summary_text += f" Audience: {audience_persona}"
+    return summary_text
+
 def enrich_ad(
     ad_data: AdKnowledgeObject,
-    gemini_flash: ChatGoogleGenerativeAI,
-    gemini_pro: ChatGoogleGenerativeAI,
-    embedding_model: GoogleGenerativeAIEmbeddings,
-    supabase: Client,
+    gemini_flash: "ChatGoogleGenerativeAI",
+    gemini_pro: "ChatGoogleGenerativeAI",
+    embedding_model: Embeddings,
+    supabase: Optional["Client"] = None,
+    cache: Optional[EnrichmentCache] = None,
 ) -> AdKnowledgeObject:
     """
     Orchestrates the ad enrichment process.
+    LLM stage outputs are served from `cache` when an equivalent ad was already analyzed.
     """
     ad_data.status = "ENRICHING"
     # Update status in DB (optional, for real-time tracking)
@@ -127,25 +166,25 @@ def enrich_ad(
         if not ad_creative_url:
             raise ValueError("Ad creative URL not found in raw_data_snapshot.")
         
-        visual_analysis = perform_visual_analysis(ad_creative_url, gemini_flash)
+        visual_analysis = perform_visual_analysis(ad_creative_url, gemini_flash, cache=cache)
         ad_data.visual_analysis = visual_analysis
 
         # 2. Slow Pass: Strategic Analysis
         # Assuming raw_data_snapshot contains 'targeting_data'
         targeting_data = ad_data.raw_data_snapshot.get("targeting_data", {})
         strategic_analysis = perform_strategic_analysis(
-            ad_data.raw_data_snapshot, targeting_data, visual_analysis, gemini_pro
+            ad_data.raw_data_snapshot, targeting_data, visual_analysis, gemini_pro, cache=cache
         )
         ad_data.strategic_analysis = strategic_analysis
 
         # 3. Generate Audience Persona
         audience_persona = generate_audience_persona(
-            ad_data.raw_data_snapshot, strategic_analysis, visual_analysis, gemini_pro
+            ad_data.raw_data_snapshot, strategic_analysis, visual_analysis, gemini_pro, cache=cache
         )
         ad_data.audience_persona = audience_persona
 
         # 4. Generate Vector Summary
-        summary_text = f"Marketing Angle: {strategic_analysis.marketing_angle}. Emotional Appeal: {strategic_analysis.emotional_appeal}. CTA: {strategic_analysis.cta_analysis}. Audience: {audience_persona}"
+        summary_text = build_summary_text(strategic_analysis, audience_persona)
         vector_summary = generate_vector_summary(summary_text, embedding_model)
         ad_data.vector_summary = vector_summary
 
@@ -159,4 +198,184 @@ def enrich_ad(
 
     return ad_data
 
+# --- Async Enrichment Engine ---
+
+# Called with (stage, result) as soon as a stage completes, e.g. `Database.save_stage`.
+StageCheckpoint = Callable[[str, Any], Awaitable[Any]]
+
+async def _fetch_creative(ad_creative_url: str, fetcher: Optional["CreativeFetcher"]) -> Optional["Creative"]:
+    if fetcher is None:
+        return None
+    try:
+        return await fetcher.fetch(ad_creative_url)
+    except Exception as e:
+        # Too large, gone or unreachable: still worth an analysis from the URL and copy.
+        logger.warning(f"Could not fetch creative {ad_creative_url}, analyzing its URL only: {e}")
+        get_metrics().incr("creatives.fetch_failed")
+        return None
+
+async def aperform_visual_analysis(
+    ad_creative_url: str,
+    gemini_flash: "ChatGoogleGenerativeAI",
+    cache: Optional[EnrichmentCache] = None,
+    fetcher: Optional["CreativeFetcher"] = None,
+) -> VisualAnalysis:
+    """
+    Async variant of `perform_visual_analysis`. With a `fetcher`, the model is
+    shown the creative itself (the image, or keyframes of a video) next to the
+    prompt; creatives that cannot be fetched are analyzed from their URL.
+    """
+    creative = await _fetch_creative(ad_creative_url, fetcher)
+    if creative is None or not creative.images:
+        chain = visual_analysis_prompt | gemini_flash.bind(**VISUAL_ANALYSIS_SCHEMA) | visual_analysis_parser
+        inputs = visual_analysis_inputs(ad_creative_url)
+    else:
+        def multimodal_message(inputs: Dict[str, Any]) -> List[HumanMessage]:
+            text = visual_analysis_prompt.format(ad_creative_url=inputs["ad_creative_url"])
+            return [HumanMessage(content=[{"type": "text", "text": text + CREATIVE_ATTACHED}, *creative.content_blocks()])]
+
+        chain = RunnableLambda(multimodal_message) | gemini_flash.bind(**VISUAL_ANALYSIS_SCHEMA) | visual_analysis_parser
+        # Keyed by content too: the same URL may serve a different creative later.
+        inputs = {**visual_analysis_inputs(ad_creative_url), "creative_sha256": creative.content_hash}
+    if cache is not None:
+        return await cache.ainvoke("visual_analysis", chain, visual_analysis_prompt, gemini_flash, inputs, VisualAnalysis)
+    return await chain.ainvoke(inputs)
+
+async def aperform_strategic_analysis(raw_ad_data: Dict[str, Any], targeting_data: Dict[str, Any], visual_analysis: Optional[VisualAnalysis], gemini_pro: "ChatGoogleGenerativeAI", cache: Optional[EnrichmentCache] = None) -> StrategicAnalysis:
+    """
+    Async variant of `perform_strategic_analysis`.
+    With `visual_analysis=None` it runs a text-only pass that does not wait for the visual stage.
+    """
+    chain = strategic_analysis_prompt | gemini_pro.bind(**STRATEGIC_ANALYSIS_SCHEMA) | strategic_analysis_parser
+    inputs = strategic_analysis_inputs(raw_ad_data, targeting_data, visual_analysis)
+    if cache is not None:
+        return await cache.ainvoke("strategic_analysis", chain, strategic_analysis_prompt, gemini_pro, inputs, StrategicAnalysis)
+    return await chain.ainvoke(inputs)
+
+async def agenerate_audience_persona(raw_ad_data: Dict[str, Any], strategic_analysis: StrategicAnalysis, visual_analysis: VisualAnalysis, gemini_pro: "ChatGoogleGenerativeAI", cache: Optional[EnrichmentCache] = None) -> str:
+    """Async variant of `generate_audience_persona`."""
+    chain = audience_persona_prompt | gemini_pro | audience_persona_parser
+    inputs = audience_persona_inputs(raw_ad_data, strategic_analysis, visual_analysis)
+    if cache is not None:
+        return (await cache.ainvoke("audience_persona", chain, audience_persona_prompt, gemini_pro, inputs, str)).strip()
+    return (await chain.ainvoke(inputs)).strip()
+
+async def agenerate_vector_summary(text: str, embedding_model: Embeddings) -> List[float]:
+    """Async variant of `generate_vector_summary`."""
+    return await embedding_model.aembed_query(text)
+
+async def _run_stage(ad_data: AdKnowledgeObject, stage: str, run: Callable[[], Awaitable[Any]], checkpoint: Optional[StageCheckpoint]) -> Any:
+    """
+    Runs one enrichment stage unless a previous attempt already completed it,
+    records its status on `ad_data` and checkpoints its result.
+    """
+    if ad_data.stage_status.get(stage) == "DONE" and getattr(ad_data, stage) is not None:
+        get_metrics().incr("enrichment.stages_resumed")
+        return getattr(ad_data, stage)
+    try:
+        result = await run()
+    except Exception:
+        ad_data.stage_status[stage] = "FAILED"
+        raise
+    setattr(ad_data, stage, result)
+    ad_data.stage_status[stage] = "DONE"
+    if checkpoint is not None:
+        await checkpoint(stage, result)
+    return result
+
+async def aenrich_ad(
+    ad_data: AdKnowledgeObject,
+    gemini_flash: "ChatGoogleGenerativeAI",
+    gemini_pro: "ChatGoogleGenerativeAI",
+    embedding_model: Embeddings,
+    supabase: Optional["Client"] = None,
+    fast_mode: bool = False,
+    cache: Optional[EnrichmentCache] = None,
+    checkpoint: Optional[StageCheckpoint] = None,
+    packer: Optional["PromptPacker"] = None,
+    fetcher: Optional["CreativeFetcher"] = None,
+) -> AdKnowledgeObject:
+    """
+    Async counterpart of `enrich_ad`, built on `ainvoke`/`aembed_query`.
+
+    The default mode keeps the data dependencies of `enrich_ad` (visual ->
+    strategic -> persona -> embedding) but never blocks the event loop, so one
+    loop can enrich many ads concurrently.
+
+    `fast_mode` trades some grounding for latency and needs two LLM round trips
+    of wall time instead of four:
+      1. the strategic pass runs text-only, concurrently with visual analysis;
+      2. the persona is generated concurrently with the embedding of the
+         strategy summary, which therefore does not include the persona.
+
+    LLM stage outputs are served from `cache` when an equivalent ad was already analyzed.
+    Rate-limit errors are raised instead of failing the ad.
+
+    Stages marked `DONE` in `ad_data.stage_status` (by an earlier attempt) are
+    not run again. Every stage that completes is passed to `checkpoint`; a
+    stage that raises is marked `FAILED`.
+
+    With a `packer`, the strategic and persona stages are analyzed together
+    with those of other ads enriched concurrently (see `src.prompt_packing`).
+    With a `fetcher`, visual analysis sees the creative (see `src.creatives`).
+    """
+    ad_data.status = "ENRICHING"
+
+    try:
+        ad_creative_url = ad_data.raw_data_snapshot.get("ad_creative_url")
+        if not ad_creative_url:
+            raise ValueError("Ad creative URL not found in raw_data_snapshot.")
+        targeting_data = ad_data.raw_data_snapshot.get("targeting_data", {})
+
+        def stage(name: str, run: Callable[[], Awaitable[Any]]) -> Awaitable[Any]:
+            return _run_stage(ad_data, name, run, checkpoint)
+
+        def strategic(visual_analysis: Optional[VisualAnalysis]) -> Awaitable[StrategicAnalysis]:
+            if packer is not None:
+                return packer.strategic_analysis(str(ad_data.id or ad_data.ad_id), ad_data.raw_data_snapshot, targeting_data, visual_analysis)
+            return aperform_strategic_analysis(ad_data.raw_data_snapshot, targeting_data, visual_analysis, gemini_pro, cache=cache)
+
+        def persona() -> Awaitable[str]:
+            if packer is not None:
+                return packer.audience_persona(
+                    str(ad_data.id or ad_data.ad_id), ad_data.raw_data_snapshot, ad_data.strategic_analysis, ad_data.visual_analysis
+                )
+            return agenerate_audience_persona(
+                ad_data.raw_data_snapshot, ad_data.strategic_analysis, ad_data.visual_analysis, gemini_pro, cache=cache
+            )
+
+        visual = lambda: aperform_visual_analysis(ad_creative_url, gemini_flash, cache=cache, fetcher=fetcher)
+        if fast_mode:
+            await asyncio.gather(
+                stage("visual_analysis", visual),
+                stage("strategic_analysis", lambda: strategic(None)),
+            )
+            await asyncio.gather(
+                stage("audience_persona", persona),
+                stage("vector_summary", lambda: agenerate_vector_summary(
+                    build_summary_text(ad_data.strategic_analysis), embedding_model
+                )),
+            )
+        else:
+            await stage("visual_analysis", visual)
+            await stage("strategic_analysis", lambda: strategic(ad_data.visual_analysis))
+            await stage("audience_persona", persona)
+            await stage("vector_summary", lambda: agenerate_vector_summary(
+                build_summary_text(ad_data.strategic_analysis, ad_data.audience_persona), embedding_model
+            ))
+
+        ad_data.status = "ENRICHED"
+        ad_data.enriched_at = datetime.now()
+
+    except Exception as e:
+        if is_rate_limit_error(e):
+            # Still over quota after the limiter's own retries: a transient
+            # condition for the caller to retry later, not a verdict on the ad.
+            raise
+        ad_data.status = "FAILED"
+        ad_data.error_log = str(e)
+        logger.error(f"Enrichment failed for ad {ad_data.ad_id}: {e}")
+
+    return ad_data
+
 # The main function is now removed as it was for testing purposes and will be replaced by a proper test suite.
@@ -0,0 +1,74 @@
+"""
+Celery priority lanes.
+
+Enrichment tasks are routed to one of three queues (src/celeryconfig.py):
+  * `realtime`: single-ad ingests from analysts (`/ingest-ad`);
+  * `bulk`: bulk ingests and backfills (`/ingest-ads:batch`, `/ingest-ads:stream`);
+  * `retry`: task retries, re-queued orphans and dead-letter replays.
+An ingest request can pick its lane with `priority`.
+
+Each lane runs its own worker pool with its own concurrency and prefetch
+(`CELERY_<LANE>_CONCURRENCY`, `CELERY_<LANE>_PREFETCH`), using the
+`CELERY_WORKER_POOL` execution pool (with `threads`, the concurrency is the
+number of enrichments one process runs at once):
+
+    python -m src.lanes realtime
+    python -m src.lanes bulk
+
+Messages also carry a broker priority, so a single worker consuming several
+lanes (`-Q realtime,retry,bulk`, e.g. in development) still serves the more
+urgent ones first.
+"""
+import argparse
+import os
+from typing import Any, Dict, List, Optional, Sequence
+
+from src.celeryconfig import BULK_QUEUE, LANES, REALTIME_QUEUE, RETRY_QUEUE
+from src.config import Settings
+
+# Message priority per lane, 0 (lowest) to 9 (highest).
+LANE_PRIORITY = {REALTIME_QUEUE: 9, RETRY_QUEUE: 5, BULK_QUEUE: 0}
+
+
+def broker_priority(priority: int, broker_url: str) -> int:
+    """
+    The message priority to send for `priority` (9 most urgent): AMQP serves
+    higher values first, while the Redis transport serves 0 first.
+    """
+    return 9 - priority if broker_url.startswith(("redis://", "rediss://", "redis+socket://")) else priority
+
+
+def lane_options(lane: str, broker_url: str) -> Dict[str, Any]:
+    """`apply_async` options that route a task to `lane`."""
+    if lane not in LANE_PRIORITY:
+        raise ValueError(f"Unknown lane {lane!r}; expected one of {', '.join(LANES)}")
+    return {"queue": lane, "priority": broker_priority(LANE_PRIORITY[lane], broker_url)}
+
+
+def worker_argv(lane: str, settings: Settings, extra: Sequence[str] = ()) -> List[str]:
+    """The `celery worker` command line of the pool that consumes `lane`."""
+    if lane not in LANE_PRIORITY:
+        raise ValueError(f"Unknown lane {lane!r}; expected one of {', '.join(LANES)}")
+    return [
+        "celery", "-A", "src.celery_app", "worker",
+        "--queues", lane,
+        "--hostname", f"{lane}@%h",
+        "--pool", settings.CELERY_WORKER_POOL,
+        "--concurrency", str(getattr(settings, f"CELERY_{lane.upper()}_CONCURRENCY")),
+        "--prefetch-multiplier", str(getattr(settings, f"CELERY_{lane.upper()}_PREFETCH")),
+        *extra,
+    ]
+
+
+def main(lane: str, extra: Optional[Sequence[str]] = None) -> None:
+    from src.dependencies import get_settings
+
+    argv = worker_argv(lane, get_settings(), extra or ())
+    os.execvp(argv[0], argv)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start the Celery worker pool of one priority lane.")
+    parser.add_argument("lane", choices=LANES)
+    args, extra = parser.parse_known_args()
+    main(args.lane, extra)
@@ -0,0 +1,128 @@
+"""
+Enrichment leases: who is enriching an ad, and until when.
+
+Claiming an ad (see `Database.claim_ad` and `Database.claim_pending_ads`) moves
+it to ENRICHING under a lease: `lease_owner` names the claimant and
+`lease_expires_at` says when the claim lapses. The owner extends the lease with
+heartbeats while the pipeline runs, so the lease only runs out when its worker
+died or hung. The sweeper puts ads whose lease ran out back to PENDING and
+re-queues them.
+
+A Celery task leases an ad under its task ID, which stays the same across
+retries and redeliveries, so a retry takes its own ad back immediately instead
+of skipping it as taken.
+"""
+import asyncio
+import os
+import socket
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from src.db import Database
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+
+
+def lease_owner_id(task_id: Optional[str] = None) -> str:
+    """The lease owner for a Celery task (its task ID) or, without one, for this process."""
+    if task_id:
+        return f"task:{task_id}"
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class LeaseHeartbeat:
+    """
+    Extends the leases `owner` holds on `ad_ids` every `interval` seconds while
+    the context is open. `ad_ids` may change while it runs (ads that finish are
+    discarded, new claims added).
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        owner: str,
+        lease_seconds: float,
+        interval: float,
+        ad_ids: Iterable[Any] = (),
+        metrics: Optional[Metrics] = None,
+    ):
+        self._db = db
+        self._owner = owner
+        self._lease_seconds = lease_seconds
+        self._interval = interval
+        self._metrics = metrics or get_metrics()
+        self._task: Optional[asyncio.Task] = None
+        self.ad_ids: Set[Any] = set(ad_ids)
+
+    async def beat(self) -> int:
+        """Extends the leases once; returns how many are still held."""
+        ad_ids = list(self.ad_ids)
+        if not ad_ids:
+            return 0
+        held = await self._db.heartbeat(ad_ids, self._owner, self._lease_seconds)
+        if held < len(ad_ids):
+            # Expired and taken over (or finished) elsewhere; the fenced save will not land.
+            logger.warning(f"Lease owner {self._owner} lost {len(ad_ids) - held} of {len(ad_ids)} leases.")
+            self._metrics.incr("leases.lost", len(ad_ids) - held)
+        return held
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self.beat()
+            except Exception as e:
+                # A missed beat only shortens the lease; the next one may succeed.
+                logger.warning(f"Lease heartbeat of {self._owner} failed: {e}")
+
+    async def __aenter__(self) -> "LeaseHeartbeat":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+async def sweep_expired_leases(
+    db: Database,
+    requeue: Optional[Callable[[List[str]], Any]] = None,
+    batch_size: int = 500,
+    metrics: Optional[Metrics] = None,
+) -> int:
+    """
+    Puts ENRICHING ads whose lease expired back to PENDING, `batch_size` rows
+    per statement, and passes each batch of IDs to `requeue` (e.g.
+    `dispatch_enrichment_batch`) before the statement commits, so a batch
+    whose requeue fails stays ENRICHING for the next sweep instead of being
+    left PENDING with no task. Returns the number of ads reclaimed.
+    """
+    metrics = metrics or get_metrics()
+    total = 0
+    while True:
+        ad_ids = await db.reclaim_expired_leases(batch_size, before_commit=requeue)
+        if ad_ids:
+            total += len(ad_ids)
+            metrics.incr("leases.reclaimed", len(ad_ids))
+            if requeue is not None:
+                metrics.incr("leases.requeued", len(ad_ids))
+        if len(ad_ids) < batch_size:
+            break
+    if total:
+        logger.warning(f"Reclaimed {total} ads whose enrichment lease expired.")
+    return total
+
+
+def lease_stats(metrics: Metrics) -> Dict[str, float]:
+    """Reclaimed, re-queued and lost lease counts."""
+    counters = metrics.snapshot()
+    return {
+        "reclaimed": counters.get("leases.reclaimed", 0),
+        "requeued": counters.get("leases.requeued", 0),
+        "lost": counters.get("leases.lost", 0),
+        "stale_writes": counters.get("leases.stale_writes", 0),
+    }
@@ -0,0 +1,248 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Type, Union
+from urllib.parse import urlsplit, urlunsplit
+
+import redis
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable
+from pydantic import BaseModel
+
+from src.config import Settings
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+
+# Snapshot fields that differ between re-runs of the same creative and copy but
+# do not change what the model is asked to analyze.
+VOLATILE_INPUT_KEYS = frozenset({"ad_id", "ad_library_url", "advertiser_page_id", "start_date", "end_date", "is_active"})
+
+def normalize_creative_url(url: str) -> str:
+    """
+    Normalizes a creative URL for cache keys.
+
+    fbcdn URLs carry signed, expiring query parameters (`_nc_*`, `oh`, `oe`,
+    `efg`, ...) and are served from many edge hosts, so only their path
+    identifies the object. Other URLs only lose their fragment.
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    if host == "fbcdn.net" or host.endswith(".fbcdn.net"):
+        return f"fbcdn:{parts.path}"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+
+def normalize_inputs(value: Any) -> Any:
+    """Recursively normalizes prompt inputs so that equivalent inputs serialize identically."""
+    if isinstance(value, BaseModel):
+        return normalize_inputs(value.model_dump(mode="json"))
+    if isinstance(value, dict):
+        return {str(key): normalize_inputs(item) for key, item in value.items() if key not in VOLATILE_INPUT_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [normalize_inputs(item) for item in value]
+    if isinstance(value, str):
+        value = " ".join(value.split())
+        if value.startswith(("http://", "https://")):
+            return normalize_creative_url(value)
+    return value
+
+def template_version(prompt: BasePromptTemplate) -> str:
+    """Fingerprint of a prompt template including its partials; changes whenever the prompt does."""
+    template = getattr(prompt, "template", None) or repr(prompt)
+    partials = json.dumps(prompt.partial_variables, sort_keys=True, default=str)
+    return hashlib.sha256(f"{template}\x00{partials}".encode()).hexdigest()[:16]
+
+def model_name(llm: Any) -> str:
+    return getattr(llm, "model", None) or getattr(llm, "model_name", None) or type(llm).__name__
+
+
+# --- Stores ---
+
+CacheValue = Union[str, bytes]
+
+class SQLiteCacheStore:
+    """Single-file cache store with TTL expiry and LRU eviction beyond `max_entries`."""
+    def __init__(self, path: Union[str, Path], max_entries: int, table: str = "llm_cache"):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._max_entries = max_entries
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # No declared value type: text and blob values are stored as given.
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " key TEXT PRIMARY KEY, value NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_last_access ON {table} (last_access)")
+
+    def get(self, key: str) -> Optional[CacheValue]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(f"SELECT value, expires_at FROM {self._table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+                return None
+            self._conn.execute(f"UPDATE {self._table} SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: CacheValue, ttl_seconds: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self._table} (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl_seconds, now),
+            )
+            # Drop expired entries first, then the least recently used ones over the limit.
+            self._conn.execute(f"DELETE FROM {self._table} WHERE expires_at <= ?", (now,))
+            self._conn.execute(
+                f"DELETE FROM {self._table} WHERE key IN ("
+                f" SELECT key FROM {self._table} ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,),
+            )
+
+    def close(self) -> None:
+        self._conn.close()
+
+class RedisCacheStore:
+    """
+    Redis-backed store shared by all workers. Entries expire via key TTLs; LRU
+    eviction is left to the server's `maxmemory-policy allkeys-lru`.
+    Values come back as bytes.
+    """
+    def __init__(self, redis_url: str, prefix: str = "adgenesis:llm_cache:"):
+        self._redis = redis.Redis.from_url(redis_url)
+        self._prefix = prefix
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._redis.get(self._prefix + key)
+
+    def set(self, key: str, value: CacheValue, ttl_seconds: int) -> None:
+        self._redis.set(self._prefix + key, value, ex=ttl_seconds)
+
+    def close(self) -> None:
+        self._redis.close()
+
+def create_cache_store(backend: str, settings: Settings, sqlite_path: str, max_entries: int, namespace: str) -> Optional[Any]:
+    """
+    Builds a cache store for `backend` (`sqlite`, `redis` or `none`). `namespace`
+    names the SQLite table and the Redis key prefix.
+    """
+    backend = backend.lower()
+    if backend == "none":
+        return None
+    if backend == "redis":
+        return RedisCacheStore(settings.REDIS_URL, prefix=f"adgenesis:{namespace}:")
+    if backend == "sqlite":
+        return SQLiteCacheStore(sqlite_path, max_entries, table=namespace)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+# --- Cache ---
+
+class EnrichmentCache:
+    """
+    Content-addressed cache in front of the enrichment chains.
+
+    Keys hash the stage name, the prompt template fingerprint, the model name and
+    the normalized prompt inputs, so re-runs of the same creative and copy under a
+    different `ad_id` reuse the stored output. Hits and misses are counted per stage.
+    """
+    def __init__(self, store: Any, ttl_seconds: int, metrics: Optional[Metrics] = None, read: bool = True):
+        self._store = store
+        self._ttl_seconds = ttl_seconds
+        self._metrics = metrics or get_metrics()
+        self._read = read
+
+    def bypass(self) -> "EnrichmentCache":
+        """Returns a view that skips lookups but still stores fresh outputs, for forced re-enrichment."""
+        return EnrichmentCache(self._store, self._ttl_seconds, self._metrics, read=False)
+
+    def make_key(self, stage: str, prompt: BasePromptTemplate, llm: Any, inputs: Dict[str, Any]) -> str:
+        payload = {
+            "stage": stage,
+            "template_version": template_version(prompt),
+            "model": model_name(llm),
+            "inputs": normalize_inputs(inputs),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str).encode()).hexdigest()
+
+    def _lookup(self, stage: str, key: str, output_type: Type) -> Any:
+        if not self._read:
+            self._metrics.incr(f"enrichment_cache.{stage}.bypassed")
+            return None
+        try:
+            cached = self._store.get(key)
+        except Exception as e:
+            logger.warning(f"Enrichment cache lookup failed for stage {stage}: {e}")
+            cached = None
+        if cached is None:
+            self._metrics.incr(f"enrichment_cache.{stage}.misses")
+            return None
+        self._metrics.incr(f"enrichment_cache.{stage}.hits")
+        return output_type.model_validate_json(cached) if issubclass(output_type, BaseModel) else json.loads(cached)
+
+    def _store_output(self, stage: str, key: str, output: Any) -> None:
+        value = output.model_dump_json() if isinstance(output, BaseModel) else json.dumps(output)
+        try:
+            self._store.set(key, value, self._ttl_seconds)
+        except Exception as e:
+            logger.warning(f"Enrichment cache write failed for stage {stage}: {e}")
+
+    def lookup(self, stage: str, prompt: BasePromptTemplate, llm: Any, inputs: Dict[str, Any], output_type: Type) -> Tuple[str, Any]:
+        """Returns the cache key for `inputs` and the cached output, or None on a miss (see `store`)."""
+        key = self.make_key(stage, prompt, llm, inputs)
+        return key, self._lookup(stage, key, output_type)
+
+    def store(self, stage: str, key: str, output: Any) -> None:
+        """Stores an output computed outside `invoke` (e.g. by a batch job) under its `lookup` key."""
+        self._store_output(stage, key, output)
+
+    def invoke(self, stage: str, chain: Runnable, prompt: BasePromptTemplate, llm: Any, inputs: Dict[str, Any], output_type: Type) -> Any:
+        """Returns the cached output of `chain` for `inputs`, invoking and storing it on a miss."""
+        key, cached = self.lookup(stage, prompt, llm, inputs, output_type)
+        if cached is not None:
+            return cached
+        output = chain.invoke(inputs)
+        self._store_output(stage, key, output)
+        return output
+
+    async def ainvoke(self, stage: str, chain: Runnable, prompt: BasePromptTemplate, llm: Any, inputs: Dict[str, Any], output_type: Type) -> Any:
+        """Async variant of `invoke`. Store access is local/sub-millisecond and stays synchronous."""
+        key, cached = self.lookup(stage, prompt, llm, inputs, output_type)
+        if cached is not None:
+            return cached
+        output = await chain.ainvoke(inputs)
+        self._store_output(stage, key, output)
+        return output
+
+    def close(self) -> None:
+        self._store.close()
+
+def enrichment_cache_stats(metrics: Metrics) -> Dict[str, Dict[str, Optional[float]]]:
+    """Hit/miss counts and hit rate per enrichment stage."""
+    counters = metrics.snapshot()
+    stages = {name.split(".")[1] for name in counters if name.startswith("enrichment_cache.")}
+    stats = {}
+    for stage in sorted(stages):
+        hits = counters.get(f"enrichment_cache.{stage}.hits", 0)
+        misses = counters.get(f"enrichment_cache.{stage}.misses", 0)
+        stats[stage] = {
+            "hits": hits,
+            "misses": misses,
+            "bypassed": counters.get(f"enrichment_cache.{stage}.bypassed", 0),
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+        }
+    return stats
+
+def create_enrichment_cache(settings: Settings) -> Optional[EnrichmentCache]:
+    """Builds the cache configured by `ENRICHMENT_CACHE_BACKEND` (`sqlite`, `redis` or `none`)."""
+    store = create_cache_store(
+        settings.ENRICHMENT_CACHE_BACKEND, settings, settings.ENRICHMENT_CACHE_PATH,
+        settings.ENRICHMENT_CACHE_MAX_ENTRIES, namespace="llm_cache",
+    )
+    return EnrichmentCache(store, settings.ENRICHMENT_CACHE_TTL_SECONDS) if store is not None else None
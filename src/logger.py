@@ -1,6 +1,6 @@
 import sys
 from loguru import logger
-from src.config import Settings
+from src.config import Settings, get_settings
 
 def configure_logging(settings: Settings):
     """
@@ -52,8 +52,7 @@ def configure_logging(settings: Settings):
             diagnose=False,      # Do not leak sensitive data in production
         )
 
-# Instantiate settings and configure logging on import
-settings = Settings()
-configure_logging(settings)
+# Configure logging on import, from the process-wide settings
+configure_logging(get_settings())
 
 __all__ = ["logger"]
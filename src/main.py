@@ -1,24 +1,70 @@
 import asyncio
+import importlib
+import json
 import traceback
-from typing import List, Optional
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Literal, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException, Depends, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from supabase import Client
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from fastapi import FastAPI, HTTPException, Depends, Request, Body
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 
 from src.models import AdKnowledgeObject
-from src.query_engine import synthesize_answer
-from src.dependencies import get_supabase, get_settings, create_gemini_pro_client, create_embedding_model_client
+from src.dependencies import (
+    get_db,
+    get_settings,
+    get_client_registry,
+    get_gemini_pro,
+    get_embedding_model,
+    get_answer_cache,
+    ClientRegistry,
+)
 from src.logger import logger
-from src.tasks import enrichment_task
+from src.tasks import dispatch_enrichment, dispatch_enrichment_batch
+from src.celeryconfig import BULK_QUEUE, REALTIME_QUEUE
 from src.config import Settings
+from src.db import Database
+from src.dead_letters import dead_letter_stats
+from src.dedup import copy_from_sources, dedup_stats, link_duplicates
+from src.embeddings import EmbeddingService, embedding_stats
+from src.llm_cache import enrichment_cache_stats
+from src.metrics import get_metrics
+from src.leases import lease_stats
+from src.prompt_packing import prompt_packing_stats
+from src.structured_output import structured_output_stats
+
+# The query engine imports LlamaIndex, which alone takes seconds: it is loaded
+# in the background once the app has started (and by the first query, if that
+# comes sooner) instead of at import, so the API is up and ingesting at once.
+if TYPE_CHECKING:
+    from llama_index.llms.langchain import LangChainLLM
+    from src.query_engine import SemanticAnswerCache
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Shares one client registry across all requests of the process and closes
+    its clients on shutdown.
+    """
+    clients = get_client_registry()
+    query_engine_loaded = asyncio.create_task(asyncio.to_thread(importlib.import_module, "src.query_engine"))
+    try:
+        yield
+    finally:
+        try:
+            await query_engine_loaded
+        except Exception as e:
+            # The first query re-raises it; shutdown still has clients to close.
+            logger.warning(f"Background import of the query engine failed: {e}")
+        await clients.aclose()
+        logger.info("Shutting down logger.")
+        logger.remove()
 
 app = FastAPI(
     title="AdGenesis Intelligence Engine",
     description="API for ingesting, enriching, and querying competitor ad intelligence.",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 @app.middleware("http")
@@ -37,24 +83,63 @@ class IngestAdRequest(BaseModel):
     ad_id: int
     raw_data_snapshot: dict
     ad_creative_url: str
+    force_refresh: bool = False # Re-run every LLM stage even if equivalent outputs are cached
+    # Celery lane (src/lanes.py); defaults to `realtime` for /ingest-ad and `bulk` for the bulk endpoints
+    priority: Optional[Literal["realtime", "bulk"]] = None
 
 class IngestAdResponse(BaseModel):
     message: str
     ad_id: str
-    task_id: str
+    task_id: Optional[str] = None # None for a near-duplicate, which takes its source ad's enrichment
+    derived_from: Optional[str] = None
+
+class BatchIngestItemResult(BaseModel):
+    index: int
+    status: str # `accepted`, `invalid` or `failed`
+    source_ad_id: Optional[int] = None
+    ad_id: Optional[str] = None
+    task_id: Optional[str] = None
+    derived_from: Optional[str] = None # Source ad whose enrichment a near-duplicate takes
+    error: Optional[str] = None
+
+class BatchIngestResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[BatchIngestItemResult]
 
 class QueryRequest(BaseModel):
     query: str
     filter_criteria: Optional[dict] = None
     k: int = 5
+    # Cut-offs that let synthesis run over fewer than `k` ads; unset falls back to the settings.
+    min_similarity: Optional[float] = Field(default=None, ge=-1, le=1)
+    score_gap: Optional[float] = Field(default=None, ge=0)
+    # Re-rank the retrieved ads with the LLM and keep the best `rerank_top_n`.
+    rerank: Optional[Literal["llm"]] = None
+    rerank_top_n: Optional[int] = Field(default=None, ge=1)
+
+def _retrieval_kwargs(request: QueryRequest, settings: Settings, gemini_pro: "LangChainLLM") -> Dict[str, Any]:
+    """Retrieval tuning shared by /query-ads and /query-ads/stream."""
+    from src.query_engine import build_node_postprocessors
+
+    return {
+        "ef_search": settings.VECTOR_SEARCH_EF_SEARCH,
+        "iterative_scan": settings.VECTOR_SEARCH_ITERATIVE_SCAN,
+        "context_token_budget": settings.QUERY_CONTEXT_TOKEN_BUDGET,
+        "min_similarity": request.min_similarity if request.min_similarity is not None else settings.QUERY_MIN_SIMILARITY,
+        "score_gap": request.score_gap if request.score_gap is not None else settings.QUERY_SCORE_GAP,
+        "node_postprocessors": build_node_postprocessors(request.rerank, gemini_pro, top_n=request.rerank_top_n),
+    }
 
 @app.post("/ingest-ad", response_model=IngestAdResponse, status_code=202)
 async def ingest_and_enrich_ad(
     request: IngestAdRequest,
-    supabase: Client = Depends(get_supabase),
+    db: Database = Depends(get_db),
+    settings: Settings = Depends(get_settings),
 ):
     """
     Ingests a new raw ad and schedules it for background enrichment using Celery.
+    A near-duplicate of an existing ad is linked to it instead.
     """
     request.raw_data_snapshot["ad_creative_url"] = request.ad_creative_url
 
@@ -64,52 +149,307 @@ async def ingest_and_enrich_ad(
         status="PENDING"
     )
 
-    response = supabase.from_("ads").insert(ad_to_ingest.model_dump(exclude_none=True)).execute()
-    
-    if not response.data:
-        raise HTTPException(status_code=500, detail=f"Failed to ingest ad: {response.error}")
+    try:
+        row = ad_to_ingest.model_dump(exclude_none=True)
+        if settings.DEDUP_ENABLED:
+            await link_duplicates([row], db, settings.DEDUP_MAX_HAMMING_DISTANCE, skip=[request.force_refresh])
+        inserted_ad = AdKnowledgeObject(**await db.insert_ad(row))
+    except Exception as e:
+        logger.error(f"Failed to ingest ad {request.ad_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to ingest ad: {e}")
+
+    if inserted_ad.derived_from is not None:
+        try:
+            await copy_from_sources([inserted_ad.model_dump()], db)
+            return IngestAdResponse(
+                message="Ad is a near-duplicate; it takes the enrichment of its source ad.",
+                ad_id=str(inserted_ad.id),
+                derived_from=str(inserted_ad.derived_from),
+            )
+        except Exception as e:
+            # Still PENDING: enrich it like any other ad rather than leave it waiting.
+            logger.warning(f"Copying enrichment to near-duplicate ad {inserted_ad.id} failed, enriching it individually: {e}")
 
-    inserted_ad = AdKnowledgeObject(**response.data[0])
-    
     # Dispatch the enrichment task to Celery with only the ad's ID
-    task = enrichment_task.delay(ad_id=str(inserted_ad.id))
+    task_id = dispatch_enrichment(str(inserted_ad.id), force_refresh=request.force_refresh, lane=request.priority or REALTIME_QUEUE)
 
     return IngestAdResponse(
         message="Ad accepted for enrichment.",
         ad_id=str(inserted_ad.id),
-        task_id=task.id
+        task_id=task_id
     )
 
+def _validate_ingest_item(index: int, item: Any) -> Tuple[Optional[IngestAdRequest], Optional[BatchIngestItemResult]]:
+    """Validates one bulk item, returning either the request or an `invalid` result."""
+    try:
+        return IngestAdRequest.model_validate(item), None
+    except ValidationError as e:
+        source_ad_id = item.get("ad_id") if isinstance(item, dict) and isinstance(item.get("ad_id"), int) else None
+        return None, BatchIngestItemResult(index=index, status="invalid", source_ad_id=source_ad_id, error=str(e))
+
+async def _ingest_chunk(chunk: List[Tuple[int, IngestAdRequest]], db: Database, settings: Settings) -> List[BatchIngestItemResult]:
+    """
+    Inserts a chunk of validated ads with one multi-row insert and dispatches
+    their enrichment as one Celery group. Near-duplicates are linked to their
+    source ad instead of being dispatched.
+    """
+    rows = []
+    for _, request in chunk:
+        request.raw_data_snapshot["ad_creative_url"] = request.ad_creative_url
+        rows.append(AdKnowledgeObject(
+            ad_id=request.ad_id,
+            raw_data_snapshot=request.raw_data_snapshot,
+            status="PENDING"
+        ).model_dump(exclude_none=True))
+
+    try:
+        if settings.DEDUP_ENABLED:
+            await link_duplicates(rows, db, settings.DEDUP_MAX_HAMMING_DISTANCE, skip=[request.force_refresh for _, request in chunk])
+        inserted = await db.insert_ads(rows)
+        if len(inserted) != len(rows):
+            raise RuntimeError(f"Insert returned {len(inserted)} rows for {len(rows)} ads")
+    except Exception as e:
+        logger.error(f"Bulk insert of {len(rows)} ads failed: {e}")
+        return [
+            BatchIngestItemResult(index=index, status="failed", source_ad_id=request.ad_id, error=f"Failed to ingest ad: {e}")
+            for index, request in chunk
+        ]
+
+    # INSERT ... SELECT FROM unnest(...) RETURNING yields the rows in insertion order.
+    inserted_ids = [str(row["id"]) for row in inserted]
+    derived_from = [str(row["derived_from"]) if row.get("derived_from") else None for row in inserted]
+    if any(derived_from):
+        try:
+            await copy_from_sources(inserted, db)
+        except Exception as e:
+            # Still PENDING: enrich them like any other ad rather than leave them waiting.
+            logger.warning(f"Copying enrichment to near-duplicate ads failed, enriching them individually: {e}")
+            derived_from = [None] * len(inserted)
+
+    dispatched = [position for position, source in enumerate(derived_from) if source is None]
+    try:
+        task_ids = dispatch_enrichment_batch(
+            [inserted_ids[position] for position in dispatched],
+            force_refresh=[chunk[position][1].force_refresh for position in dispatched],
+            lanes=[chunk[position][1].priority or BULK_QUEUE for position in dispatched],
+        )
+    except Exception as e:
+        # The rows are stored as PENDING, so they can be re-dispatched later.
+        logger.error(f"Failed to dispatch enrichment for {len(dispatched)} ads: {e}")
+        return [
+            BatchIngestItemResult(index=index, status="accepted", source_ad_id=request.ad_id, ad_id=ad_id, derived_from=source)
+            if source else
+            BatchIngestItemResult(index=index, status="failed", source_ad_id=request.ad_id, ad_id=ad_id, error=f"Failed to dispatch enrichment: {e}")
+            for (index, request), ad_id, source in zip(chunk, inserted_ids, derived_from)
+        ]
+    task_id_of = dict(zip(dispatched, task_ids))
+
+    return [
+        BatchIngestItemResult(
+            index=index, status="accepted", source_ad_id=request.ad_id, ad_id=ad_id,
+            task_id=task_id_of.get(position), derived_from=source,
+        )
+        for position, ((index, request), ad_id, source) in enumerate(zip(chunk, inserted_ids, derived_from))
+    ]
+
+@app.post("/ingest-ads:batch", response_model=BatchIngestResponse, status_code=202)
+async def ingest_and_enrich_ads_batch(
+    items: List[Dict[str, Any]] = Body(...),
+    db: Database = Depends(get_db),
+    settings: Settings = Depends(get_settings),
+):
+    """
+    Ingests many raw ads at once. Items are validated individually, inserted in
+    chunked multi-row inserts and scheduled for enrichment as Celery groups.
+    Returns one result per item, in request order.
+    """
+    if len(items) > settings.INGEST_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {len(items)} ads exceeds the limit of {settings.INGEST_BATCH_MAX_ITEMS}.",
+        )
+
+    results: List[BatchIngestItemResult] = []
+    chunk: List[Tuple[int, IngestAdRequest]] = []
+    for index, item in enumerate(items):
+        request, invalid = _validate_ingest_item(index, item)
+        if invalid:
+            results.append(invalid)
+            continue
+        chunk.append((index, request))
+        if len(chunk) >= settings.INGEST_INSERT_CHUNK_SIZE:
+            results.extend(await _ingest_chunk(chunk, db, settings))
+            chunk = []
+    if chunk:
+        results.extend(await _ingest_chunk(chunk, db, settings))
+
+    results.sort(key=lambda result: result.index)
+    accepted = sum(1 for result in results if result.status == "accepted")
+    return BatchIngestResponse(accepted=accepted, rejected=len(results) - accepted, results=results)
+
+async def _iter_ndjson(request: Request) -> AsyncIterator[Tuple[int, Any]]:
+    """Yields `(line_number, parsed_item)` for each non-empty line of an NDJSON request body."""
+    buffer = b""
+    index = 0
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield index, _parse_ndjson_line(line)
+                index += 1
+    if buffer.strip():
+        yield index, _parse_ndjson_line(buffer)
+
+def _parse_ndjson_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return e
+
+class _DuplexStreamingResponse(StreamingResponse):
+    """
+    A `StreamingResponse` whose body is produced while the request body is
+    still being read. The body iterator must be the only reader of the
+    request, so the response does not listen for the client disconnecting
+    (reading the request raises `ClientDisconnect` instead).
+    """
+    async def __call__(self, scope, receive, send) -> None:
+        await self.stream_response(send)
+
+@app.post("/ingest-ads:stream")
+async def ingest_and_enrich_ads_stream(
+    request: Request,
+    db: Database = Depends(get_db),
+    settings: Settings = Depends(get_settings),
+):
+    """
+    Streaming variant of `/ingest-ads:batch` for arbitrarily large pulls.
+    Reads one ad per NDJSON line and inserts/dispatches each chunk as soon as it
+    has been received, so the body is never held in memory as a whole.
+    Streams back one NDJSON result line per input line, each chunk's as soon
+    as it has been inserted; clients should read the response while sending.
+    """
+    async def results() -> AsyncIterator[str]:
+        chunk: List[Tuple[int, IngestAdRequest]] = []
+        async for index, item in _iter_ndjson(request):
+            if isinstance(item, json.JSONDecodeError):
+                yield BatchIngestItemResult(index=index, status="invalid", error=f"Invalid JSON: {item}").model_dump_json(exclude_none=True) + "\n"
+                continue
+            ingest_request, invalid = _validate_ingest_item(index, item)
+            if invalid:
+                yield invalid.model_dump_json(exclude_none=True) + "\n"
+                continue
+            chunk.append((index, ingest_request))
+            if len(chunk) >= settings.INGEST_INSERT_CHUNK_SIZE:
+                yield "".join(result.model_dump_json(exclude_none=True) + "\n" for result in await _ingest_chunk(chunk, db, settings))
+                chunk = []
+        if chunk:
+            yield "".join(result.model_dump_json(exclude_none=True) + "\n" for result in await _ingest_chunk(chunk, db, settings))
+
+    return _DuplexStreamingResponse(results(), media_type="application/x-ndjson")
+
 @app.post("/query-ads")
 async def query_ad_intelligence(
     request: QueryRequest,
-    supabase: Client = Depends(get_supabase),
+    db: Database = Depends(get_db),
+    gemini_pro: "LangChainLLM" = Depends(get_gemini_pro),
+    embedding_model: EmbeddingService = Depends(get_embedding_model),
     settings: Settings = Depends(get_settings),
+    answer_cache: Optional["SemanticAnswerCache"] = Depends(get_answer_cache),
+    clients: ClientRegistry = Depends(get_client_registry),
 ):
-    gemini_pro: ChatGoogleGenerativeAI = create_gemini_pro_client(settings)
-    embedding_model: GoogleGenerativeAIEmbeddings = create_embedding_model_client(settings)
     """
     Queries the enriched ad data and synthesizes an answer based on the user's natural language query.
     """
+    from src.query_engine import synthesize_answer
+
     answer = await synthesize_answer(
         query=request.query,
-        supabase=supabase,
+        db=db,
         gemini_pro=gemini_pro,
         embedding_model=embedding_model,
         filter_criteria=request.filter_criteria,
         k=request.k,
+        answer_cache=answer_cache,
+        response_synthesizers=clients.response_synthesizer,
+        **_retrieval_kwargs(request, settings, gemini_pro),
     )
     return {"query": request.query, "answer": answer}
 
+@app.post("/query-ads/stream")
+async def stream_ad_intelligence(
+    request: QueryRequest,
+    db: Database = Depends(get_db),
+    gemini_pro: "LangChainLLM" = Depends(get_gemini_pro),
+    embedding_model: EmbeddingService = Depends(get_embedding_model),
+    settings: Settings = Depends(get_settings),
+    answer_cache: Optional["SemanticAnswerCache"] = Depends(get_answer_cache),
+    clients: ClientRegistry = Depends(get_client_registry),
+):
+    """
+    Streams the answer to a query as NDJSON events: the retrieved ads and their
+    similarity as soon as retrieval finishes, then the answer tokens as they are
+    generated, then a `done` event with timings. Failures after the response has
+    started are reported as a final `error` event.
+    """
+    from src.query_engine import stream_answer
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            async for event in stream_answer(
+                query=request.query,
+                db=db,
+                gemini_pro=gemini_pro,
+                embedding_model=embedding_model,
+                filter_criteria=request.filter_criteria,
+                k=request.k,
+                answer_cache=answer_cache,
+                response_synthesizers=clients.response_synthesizer,
+                **_retrieval_kwargs(request, settings, gemini_pro),
+            ):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            logger.error(f"Streaming query failed: {e}\n{traceback.format_exc()}")
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        # Keep reverse proxies from buffering the stream.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/ads/{ad_id}/status")
-async def get_ad_status(ad_id: str, supabase: Client = Depends(get_supabase)):
+async def get_ad_status(ad_id: str, db: Database = Depends(get_db)):
     """
     Retrieves the current status of an ad enrichment task.
     """
-    response = supabase.from_("ads").select("status, error_log").eq("id", ad_id).execute()
-    if not response.data:
+    status = await db.get_ad_status(ad_id)
+    if status is None:
         raise HTTPException(status_code=404, detail="Ad not found")
-    return response.data[0]
+    return status
+
+@app.get("/metrics")
+async def get_metrics_snapshot():
+    """
+    Returns operational counters. With `METRICS_BACKEND=redis` they include the
+    counters recorded by the Celery workers.
+    """
+    from src.query_engine import answer_cache_stats
+
+    metrics = get_metrics()
+    return {
+        "counters": metrics.snapshot(),
+        "enrichment_cache": enrichment_cache_stats(metrics),
+        "embeddings": embedding_stats(metrics),
+        "answer_cache": answer_cache_stats(metrics),
+        "leases": lease_stats(metrics),
+        "dedup": dedup_stats(metrics),
+        "dead_letters": dead_letter_stats(metrics),
+        "prompt_packing": prompt_packing_stats(metrics),
+        "structured_output": structured_output_stats(metrics),
+    }
 
 @app.get("/health")
 async def health_check():
@@ -118,11 +458,6 @@ async def health_check():
     """
     return {"status": "ok"}
 
-@app.on_event("shutdown")
-def shutdown_event():
-    logger.info("Shutting down logger.")
-    logger.remove()
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,60 @@
+import threading
+from functools import lru_cache
+from typing import Dict, Optional
+
+import redis
+
+from src.logger import logger
+
+class Metrics:
+    """
+    Named counters for operational metrics (cache hit rates, reclaimed rows, ...).
+
+    Counters live in process memory by default. With a Redis URL they are kept in
+    one Redis hash instead, so the API can report counters incremented by the
+    Celery workers.
+    """
+    REDIS_HASH = "adgenesis:metrics"
+
+    def __init__(self, redis_url: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._redis = redis.Redis.from_url(redis_url, socket_timeout=1) if redis_url else None
+
+    def incr(self, name: str, amount: float = 1) -> None:
+        if self._redis is not None:
+            try:
+                self._redis.hincrbyfloat(self.REDIS_HASH, name, amount)
+                return
+            except redis.RedisError as e:
+                # Metrics must never fail the operation being measured.
+                logger.warning(f"Failed to record metric {name} in Redis: {e}")
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def get(self, name: str) -> float:
+        return self.snapshot().get(name, 0)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            counters = dict(self._counters)
+        if self._redis is not None:
+            try:
+                for name, value in self._redis.hgetall(self.REDIS_HASH).items():
+                    counters[name.decode()] = counters.get(name.decode(), 0) + float(value)
+            except redis.RedisError as e:
+                logger.warning(f"Failed to read metrics from Redis: {e}")
+        return counters
+
+    def ratio(self, numerator: str, *denominator: str) -> Optional[float]:
+        """Returns `numerator / sum(denominator)` from the current counters, or None without data."""
+        counters = self.snapshot()
+        total = sum(counters.get(name, 0) for name in denominator)
+        return counters.get(numerator, 0) / total if total else None
+
+@lru_cache
+def get_metrics() -> Metrics:
+    """Returns the process-wide metrics registry configured by `METRICS_BACKEND`."""
+    from src.dependencies import get_settings
+    settings = get_settings()
+    return Metrics(settings.REDIS_URL if settings.METRICS_BACKEND == "redis" else None)
@@ -31,5 +31,7 @@ class AdKnowledgeObject(BaseModel):
     visual_analysis: Optional[VisualAnalysis] = Field(None, description="A structured object containing the analysis of the ad creative (image/video).")
     audience_persona: Optional[str] = Field(None, description="A concise, generated description of the inferred target audience for the ad.")
     vector_summary: Optional[list[float]] = Field(None, description="A vector embedding of a concise, natural language summary of the ad's core strategy. Used for semantic search.")
+    derived_from: Optional[UUID] = Field(None, description="For a near-duplicate of an earlier ad: that source ad, whose enrichment this ad takes instead of being enriched itself.")
+    stage_status: dict[str, str] = Field(default_factory=dict, description="Checkpoint state per enrichment stage (`DONE` or `FAILED`) of an unfinished enrichment; a retry skips the stages that are `DONE`.")
 
     model_config = ConfigDict(extra='ignore')
@@ -0,0 +1,294 @@
+"""
+Prompt packing: analyzes several ads in one LLM call for the strategic and
+audience persona stages.
+
+The single-ad prompts repeat the same instructions on every call. A
+`PromptPacker` collects the stage calls made concurrently on one event loop,
+for up to `ENRICHMENT_PACK_WINDOW_MS` or `ENRICHMENT_PACK_SIZE` ads, and sends
+them as one prompt that states the instructions once and asks (in JSON-schema
+mode) for a list of results keyed by ad ID. Each item is validated on its own;
+ads whose item is missing or invalid fall back to the single-ad chain, so a
+packed call never fails an ad the single-ad call would have enriched.
+
+Packed results are cached under the single-ad cache keys, so the two modes
+share cache entries.
+"""
+import asyncio
+import json
+import weakref
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+from langchain_core.prompts import BasePromptTemplate
+from pydantic import BaseModel, Field, ValidationError
+
+from src.config import Settings
+from src.enrichment_pipeline import (
+    agenerate_audience_persona,
+    aperform_strategic_analysis,
+    audience_persona_inputs,
+    audience_persona_prompt,
+    strategic_analysis_inputs,
+    strategic_analysis_prompt,
+)
+from src.llm_cache import EnrichmentCache
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+from src.models import StrategicAnalysis, VisualAnalysis
+from src.rate_limiter import is_rate_limit_error
+from src.structured_output import StageOutputParser, json_schema_kwargs, repair_json
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+
+class PackedStrategicAnalysis(StrategicAnalysis):
+    ad_id: str = Field(..., description="The ID of the ad this analysis is for, exactly as given.")
+
+class StrategicAnalysisPack(BaseModel):
+    items: list[PackedStrategicAnalysis] = Field(..., description="One analysis per ad, in any order.")
+
+class PackedAudiencePersona(BaseModel):
+    ad_id: str = Field(..., description="The ID of the ad this persona is for, exactly as given.")
+    audience_persona: str = Field(..., description="A concise description of the inferred target audience persona.")
+
+class AudiencePersonaPack(BaseModel):
+    items: list[PackedAudiencePersona] = Field(..., description="One persona per ad, in any order.")
+
+
+PACKED_STRATEGIC_ANALYSIS_PROMPT_TEMPLATE = """
+You are a highly experienced marketing strategist. Your goal is to perform a deep strategic analysis of each of the advertisements below.
+For each ad, consider its raw ad text, targeting data, and the provided visual analysis.
+Extract the core marketing angle, emotional appeal, call-to-action effectiveness, and key claims.
+Analyze every ad independently of the others.
+
+{ads}
+
+Provide one analysis per ad, with its Ad ID.
+"""
+
+PACKED_AUDIENCE_PERSONA_PROMPT_TEMPLATE = """
+Based on the following data of each ad, generate a concise description of the inferred target audience persona of each ad.
+Describe every ad independently of the others.
+
+{ads}
+
+Provide one persona per ad, with its Ad ID.
+"""
+
+STRATEGIC_ANALYSIS_ITEM_TEMPLATE = """--- Ad ID: {ad_id} ---
+Raw Ad Data: {raw_ad_data}
+Targeting Data: {targeting_data}
+Visual Analysis: {visual_analysis}"""
+
+AUDIENCE_PERSONA_ITEM_TEMPLATE = """--- Ad ID: {ad_id} ---
+Raw Ad Data: {raw_ad_data}
+Strategic Analysis: {strategic_analysis}
+Visual Analysis: {visual_analysis}"""
+
+
+# The single-ad chain call an ad falls back to.
+SingleCall = Callable[[], Awaitable[Any]]
+PendingCall = Tuple[Dict[str, Any], SingleCall, asyncio.Future]
+
+
+class _PackedStage:
+    """How one stage is packed, parsed and, per item, run on its own."""
+
+    def __init__(
+        self,
+        name: str,
+        prompt: BasePromptTemplate,
+        template: str,
+        item_template: str,
+        pack_type: Type[BaseModel],
+        item_type: Type[BaseModel],
+        output_type: Type,
+        result: Callable[[BaseModel], Any],
+    ):
+        self.name = name
+        self.prompt = prompt
+        self.template = template
+        self.item_template = item_template
+        self.schema = json_schema_kwargs(pack_type)
+        self.item_type = item_type
+        self.output_type = output_type
+        self.result = result
+
+    def render(self, batch: Dict[str, Dict[str, Any]]) -> str:
+        ads = "\n\n".join(self.item_template.format(ad_id=ad_id, **inputs) for ad_id, inputs in batch.items())
+        return self.template.format(ads=ads)
+
+
+STRATEGIC_ANALYSIS = _PackedStage(
+    "strategic_analysis", strategic_analysis_prompt, PACKED_STRATEGIC_ANALYSIS_PROMPT_TEMPLATE, STRATEGIC_ANALYSIS_ITEM_TEMPLATE,
+    StrategicAnalysisPack, PackedStrategicAnalysis, StrategicAnalysis,
+    lambda item: StrategicAnalysis(**item.model_dump(exclude={"ad_id"})),
+)
+AUDIENCE_PERSONA = _PackedStage(
+    "audience_persona", audience_persona_prompt, PACKED_AUDIENCE_PERSONA_PROMPT_TEMPLATE, AUDIENCE_PERSONA_ITEM_TEMPLATE,
+    AudiencePersonaPack, PackedAudiencePersona, str,
+    lambda item: item.audience_persona.strip(),
+)
+
+def parse_pack(text: str, item_type: Type[BaseModel]) -> Dict[str, BaseModel]:
+    """
+    Parses a packed answer (`{"items": [...]}` or a bare list, repaired if
+    near-valid) into valid items by ad ID. Invalid items are left out, as is
+    everything when the answer is not JSON.
+    """
+    try:
+        payload = json.loads(text)
+    except json.JSONDecodeError:
+        try:
+            payload = json.loads(repair_json(text))
+        except json.JSONDecodeError:
+            return {}
+    items = payload.get("items") if isinstance(payload, dict) else payload
+    parsed: Dict[str, BaseModel] = {}
+    for item in items if isinstance(items, list) else []:
+        try:
+            item = item_type.model_validate(item)
+        except ValidationError:
+            continue
+        parsed.setdefault(item.ad_id, item)
+    return parsed
+
+
+class PromptPacker:
+    """
+    Coalesces the strategic and persona calls issued on one event loop into
+    packed calls of up to `pack_size` ads, waiting at most `window_ms` for a
+    pack to fill. Concurrent calls for the same ad ID share one result.
+    """
+
+    def __init__(
+        self,
+        llm: "ChatGoogleGenerativeAI",
+        pack_size: int,
+        window_ms: float = 50,
+        cache: Optional[EnrichmentCache] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        self._llm = llm
+        self._pack_size = pack_size
+        self._window_s = window_ms / 1000
+        self._cache = cache
+        self._metrics = metrics or get_metrics()
+        # Per event loop and stage: the pending calls by ad ID, and the flush timer.
+        self._pending: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, Dict[str, PendingCall]]]" = weakref.WeakKeyDictionary()
+        self._timers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.TimerHandle]]" = weakref.WeakKeyDictionary()
+
+    async def strategic_analysis(
+        self, ad_id: str, raw_ad_data: Dict[str, Any], targeting_data: Dict[str, Any], visual_analysis: Optional[VisualAnalysis]
+    ) -> StrategicAnalysis:
+        """Packed counterpart of `aperform_strategic_analysis`."""
+        return await self._submit(
+            STRATEGIC_ANALYSIS, ad_id, strategic_analysis_inputs(raw_ad_data, targeting_data, visual_analysis),
+            lambda: aperform_strategic_analysis(raw_ad_data, targeting_data, visual_analysis, self._llm, cache=self._cache),
+        )
+
+    async def audience_persona(
+        self, ad_id: str, raw_ad_data: Dict[str, Any], strategic_analysis: StrategicAnalysis, visual_analysis: VisualAnalysis
+    ) -> str:
+        """Packed counterpart of `agenerate_audience_persona`."""
+        return await self._submit(
+            AUDIENCE_PERSONA, ad_id, audience_persona_inputs(raw_ad_data, strategic_analysis, visual_analysis),
+            lambda: agenerate_audience_persona(raw_ad_data, strategic_analysis, visual_analysis, self._llm, cache=self._cache),
+        )
+
+    async def _submit(self, stage: _PackedStage, ad_id: str, inputs: Dict[str, Any], single: SingleCall) -> Any:
+        if self._cache is not None:
+            _, cached = self._cache.lookup(stage.name, stage.prompt, self._llm, inputs, stage.output_type)
+            if cached is not None:
+                return cached.strip() if isinstance(cached, str) else cached
+        loop = asyncio.get_running_loop()
+        pending = self._pending.setdefault(loop, {}).setdefault(stage.name, {})
+        if ad_id in pending:
+            future = pending[ad_id][2]
+        else:
+            future = loop.create_future()
+            pending[ad_id] = (inputs, single, future)
+            timers = self._timers.setdefault(loop, {})
+            if len(pending) >= self._pack_size:
+                self._flush(stage)
+            elif stage.name not in timers:
+                timers[stage.name] = loop.call_later(self._window_s, self._flush, stage)
+        # Shielded: the future may be shared with other callers of the same ad.
+        return await asyncio.shield(future)
+
+    def _flush(self, stage: _PackedStage) -> None:
+        loop = asyncio.get_running_loop()
+        timer = self._timers.get(loop, {}).pop(stage.name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.get(loop, {}).pop(stage.name, None)
+        if batch:
+            loop.create_task(self._run(stage, batch))
+
+    async def _run(self, stage: _PackedStage, batch: Dict[str, PendingCall]) -> None:
+        parsed: Dict[str, BaseModel] = {}
+        if len(batch) > 1:
+            self._metrics.incr(f"prompt_packing.{stage.name}.calls")
+            self._metrics.incr(f"prompt_packing.{stage.name}.items", len(batch))
+            try:
+                text = await (self._llm.bind(**stage.schema) | StageOutputParser(stage=f"packed_{stage.name}")).ainvoke(stage.render({ad_id: call[0] for ad_id, call in batch.items()}))
+                parsed = parse_pack(text, stage.item_type)
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    # Falling back would send the same load one ad at a time.
+                    for _, _, future in batch.values():
+                        if not future.done():
+                            future.set_exception(e)
+                    return
+                logger.warning(f"Packed {stage.name} call for {len(batch)} ads failed, falling back to single-ad calls: {e}")
+
+        fallbacks = []
+        for ad_id, (inputs, single, future) in batch.items():
+            item = parsed.get(ad_id)
+            if item is None:
+                fallbacks.append(_resolve(future, single))
+                continue
+            result = stage.result(item)
+            if self._cache is not None:
+                key = self._cache.make_key(stage.name, stage.prompt, self._llm, inputs)
+                self._cache.store(stage.name, key, result)
+            if not future.done():
+                future.set_result(result)
+        if fallbacks:
+            if len(batch) > 1:
+                self._metrics.incr(f"prompt_packing.{stage.name}.fallbacks", len(fallbacks))
+            await asyncio.gather(*fallbacks)
+
+
+async def _resolve(future: asyncio.Future, single: SingleCall) -> None:
+    try:
+        result = await single()
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+        return
+    if not future.done():
+        future.set_result(result)
+
+
+def prompt_packing_stats(metrics: Metrics) -> Dict[str, Dict[str, Optional[float]]]:
+    """Packed calls, ads per call and fallback rate per stage."""
+    counters = metrics.snapshot()
+    stats = {}
+    for stage in (STRATEGIC_ANALYSIS.name, AUDIENCE_PERSONA.name):
+        calls = counters.get(f"prompt_packing.{stage}.calls", 0)
+        items = counters.get(f"prompt_packing.{stage}.items", 0)
+        fallbacks = counters.get(f"prompt_packing.{stage}.fallbacks", 0)
+        stats[stage] = {
+            "calls": calls,
+            "ads_per_call": items / calls if calls else None,
+            "fallback_rate": fallbacks / items if items else None,
+        }
+    return stats
+
+
+def create_prompt_packer(llm: "ChatGoogleGenerativeAI", settings: Settings, cache: Optional[EnrichmentCache] = None) -> Optional[PromptPacker]:
+    """The packer for `llm`, or None when `ENRICHMENT_PACK_SIZE` is 1 (packing disabled)."""
+    if settings.ENRICHMENT_PACK_SIZE <= 1:
+        return None
+    return PromptPacker(llm, settings.ENRICHMENT_PACK_SIZE, settings.ENRICHMENT_PACK_WINDOW_MS, cache=cache)
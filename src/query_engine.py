@@ -1,22 +1,38 @@
+import json
 import os
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
-import google.generativeai as genai
-from langchain_core.prompts import PromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+import numpy as np
+
+from langchain_core.embeddings import Embeddings
+from llama_index.core.base.response.schema import AsyncStreamingResponse
 from llama_index.core import (
     VectorStoreIndex,
     SimpleDirectoryReader,
     get_response_synthesizer,
 )
+from llama_index.core.llms.utils import resolve_llm
+from llama_index.core.postprocessor import LLMRerank
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.prompts import PromptTemplate
 from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.response_synthesizers import BaseSynthesizer
 from llama_index.core.retrievers import BaseRetriever
-from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.core.schema import NodeWithScore, QueryBundle
 from llama_index.vector_stores.supabase import SupabaseVectorStore
-from supabase import Client
+from pydantic import BaseModel, ConfigDict
 
+from src.context_builder import build_context_nodes, select_by_similarity
+from src.db import Database
 from src.logger import logger
-from src.models import AdKnowledgeObject, StrategicAnalysis
+from src.metrics import Metrics, get_metrics
+from src.models import StrategicAnalysis
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
 
 # Configure Google AI (This will be moved into the functions that use it)
 # genai.configure(api_key=settings.GOOGLE_API_KEY)
@@ -35,9 +51,11 @@ Retrieved Ad Data (structured knowledge_objects):
 
 Formulate a comprehensive, data-grounded answer based ONLY on the provided ad data.
 """
+# LlamaIndex prompts: the synthesizer fills in `query_str`/`context_str`,
+# which are mapped onto the template's own variable names.
 query_synthesis_prompt = PromptTemplate(
-    template=QUERY_SYNTHESIS_PROMPT_TEMPLATE,
-    input_variables=["query", "ad_data_context"],
+    QUERY_SYNTHESIS_PROMPT_TEMPLATE,
+    template_var_mappings={"query_str": "query", "context_str": "ad_data_context"},
 )
 
 CRITIQUE_PROMPT_TEMPLATE = """
@@ -62,8 +80,8 @@ Critique:
 Based on your critique, provide a REVISED_ANSWER. If the initial answer is perfect, simply repeat it.
 """
 critique_prompt = PromptTemplate(
-    template=CRITIQUE_PROMPT_TEMPLATE,
-    input_variables=["query", "ad_data_context", "initial_answer"],
+    CRITIQUE_PROMPT_TEMPLATE,
+    template_var_mappings={"query_str": "query", "context_msg": "ad_data_context", "existing_answer": "initial_answer"},
 )
 
 
@@ -71,51 +89,68 @@ critique_prompt = PromptTemplate(
 class SupabaseHybridRetriever(BaseRetriever):
     def __init__(
         self,
-        supabase_client: Client,
-        embedding_model: GoogleGenerativeAIEmbeddings,
+        db: Database,
+        embedding_model: Embeddings,
         k: int = 5,
         filter_criteria: Optional[Dict[str, Any]] = None,
+        ef_search: Optional[int] = None,
+        iterative_scan: Optional[str] = None,
+        context_token_budget: Optional[int] = None,
+        min_similarity: Optional[float] = None,
+        score_gap: Optional[float] = None,
     ):
-        self._supabase_client = supabase_client
+        self._db = db
         self._embedding_model = embedding_model
         self._k = k
         self._filter_criteria = filter_criteria or {}
+        self._ef_search = ef_search
+        self._iterative_scan = iterative_scan
+        self._context_token_budget = context_token_budget
+        self._min_similarity = min_similarity
+        self._score_gap = score_gap
+        # Filled in by each retrieval (the retriever is built per query).
+        self.timings: Dict[str, float] = {}
         super().__init__()
 
     async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """
         Asynchronously retrieves nodes from Supabase using a hybrid approach.
         """
+        started = time.perf_counter()
         query_embedding = await self._embedding_model.aembed_query(
             query_bundle.query_str
         )
+        embedded = time.perf_counter()
 
         params = {
             "query_embedding": query_embedding,
             "match_count": self._k,
             "filter_criteria": self._filter_criteria,
         }
+        # Unset tuning parameters fall back to the RPC's defaults.
+        if self._ef_search is not None:
+            params["ef_search"] = self._ef_search
+        if self._iterative_scan is not None:
+            params["iterative_scan"] = self._iterative_scan
 
-        response = (
-            self._supabase_client.rpc("match_documents_adaptive", params).execute()
-        )
+        matches = await self._db.match_ads_filtered(params)
+        self.timings = {
+            "embedding_ms": (embedded - started) * 1000,
+            "search_ms": (time.perf_counter() - embedded) * 1000,
+        }
 
-        if not response.data:
-            logger.error(
-                f"Failed to retrieve ads from Supabase: {response}"
-            )
+        if not matches:
+            logger.warning(f"No ads matched the query (filters: {self._filter_criteria})")
             return []
 
-        nodes = []
-        for ad_data in response.data:
-            ad_object = AdKnowledgeObject(**ad_data)
-            node = TextNode(
-                text=ad_object.model_dump_json(indent=2),
-                metadata={"source": "Supabase"},
-            )
-            # Note: The RPC function does not currently return a score.
-            nodes.append(NodeWithScore(node=node, score=1.0))
-        return nodes
+        strategy = matches[0].get("search_strategy")
+        if strategy:
+            get_metrics().incr(f"vector_search.{strategy}")
+
+        rows = select_by_similarity(matches, min_similarity=self._min_similarity, score_gap=self._score_gap)
+        if len(rows) < len(matches):
+            get_metrics().incr("retrieval.rows_below_threshold", len(matches) - len(rows))
+        return build_context_nodes(rows, token_budget=self._context_token_budget)
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         """
@@ -127,42 +162,378 @@ class SupabaseHybridRetriever(BaseRetriever):
         return asyncio.run(self._aretrieve(query_bundle))
 
 
+# --- Semantic Answer Cache ---
+class CachedAnswer(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    group: str
+    embedding: np.ndarray # Unit-length query embedding
+    answer: str
+    ads: List[Dict[str, Any]]
+    watermark: Optional[str] # latest_enriched_at for the filters when the answer was computed
+    latency_ms: float
+    created_at: float
+
+class SemanticAnswerCache:
+    """
+    In-process cache of synthesized answers, looked up by query meaning.
+
+    Entries are grouped by (`filter_criteria`, `k`, retrieval options such as
+    score thresholds and re-ranking). Within a group, a query hits
+    when the cosine similarity of its embedding to a cached query's embedding is
+    at least `threshold`. Each entry remembers the newest `enriched_at` among the
+    ads matching its filters (the `latest_enriched_at` RPC); once newer matching
+    ads are enriched the entry is stale and dropped.
+    """
+    def __init__(self, threshold: float = 0.95, max_entries: int = 1000, ttl_seconds: int = 24 * 3600, metrics: Optional[Metrics] = None):
+        self._threshold = threshold
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._metrics = metrics or get_metrics()
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._next_id = 0
+
+    @staticmethod
+    def group_key(filter_criteria: Optional[Dict[str, Any]], k: int, options: Optional[Dict[str, Any]] = None) -> str:
+        return json.dumps({"filter_criteria": filter_criteria or {}, "k": k, **(options or {})}, sort_keys=True, default=str)
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self,
+        query_embedding: List[float],
+        filter_criteria: Optional[Dict[str, Any]],
+        k: int,
+        options: Optional[Dict[str, Any]] = None,
+    ) -> Optional[CachedAnswer]:
+        """Returns the most similar cached answer above the threshold, without checking freshness."""
+        group = self.group_key(filter_criteria, k, options)
+        oldest = time.monotonic() - self._ttl_seconds
+        with self._lock:
+            candidates = [(entry_id, entry) for entry_id, entry in self._entries.items()
+                          if entry.group == group and entry.created_at > oldest]
+            if candidates:
+                similarities = np.stack([entry.embedding for _, entry in candidates]) @ self._unit(query_embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self._threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    return entry
+        self._metrics.incr("answer_cache.misses")
+        return None
+
+    def record_hit(self, entry: CachedAnswer, elapsed_ms: float) -> None:
+        self._metrics.incr("answer_cache.hits")
+        self._metrics.incr("answer_cache.latency_saved_ms", max(entry.latency_ms - elapsed_ms, 0))
+
+    def invalidate(self, entry: CachedAnswer) -> None:
+        """Drops a stale entry."""
+        self._metrics.incr("answer_cache.stale")
+        with self._lock:
+            for entry_id, cached in list(self._entries.items()):
+                if cached is entry:
+                    del self._entries[entry_id]
+
+    def store(
+        self,
+        query_embedding: List[float],
+        filter_criteria: Optional[Dict[str, Any]],
+        k: int,
+        answer: str,
+        ads: List[Dict[str, Any]],
+        watermark: Optional[str],
+        latency_ms: float,
+        options: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        entry = CachedAnswer(
+            group=self.group_key(filter_criteria, k, options),
+            embedding=self._unit(query_embedding),
+            answer=answer,
+            ads=ads,
+            watermark=watermark,
+            latency_ms=latency_ms,
+            created_at=time.monotonic(),
+        )
+        oldest = time.monotonic() - self._ttl_seconds
+        with self._lock:
+            for entry_id, cached in list(self._entries.items()):
+                if cached.created_at <= oldest:
+                    del self._entries[entry_id]
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+def answer_cache_stats(metrics: Metrics) -> Dict[str, Optional[float]]:
+    """Hit/miss/stale counts, hit rate and total latency saved by the answer cache."""
+    counters = metrics.snapshot()
+    hits = counters.get("answer_cache.hits", 0)
+    misses = counters.get("answer_cache.misses", 0)
+    stale = counters.get("answer_cache.stale", 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "stale": stale,
+        "hit_rate": hits / (hits + misses + stale) if hits + misses + stale else None,
+        "latency_saved_ms": counters.get("answer_cache.latency_saved_ms", 0),
+    }
+
+async def _lookup_answer_cache(
+    answer_cache: SemanticAnswerCache,
+    query: str,
+    db: Database,
+    embedding_model: Embeddings,
+    filter_criteria: Optional[Dict[str, Any]],
+    k: int,
+    options: Dict[str, Any],
+    started: float,
+) -> Tuple[Optional[CachedAnswer], List[float], Optional[str]]:
+    """
+    Returns `(fresh cached answer or None, query embedding, current watermark)`.
+    The watermark is read before retrieval, so ads enriched while an answer is
+    being computed make that answer stale rather than being missed.
+    """
+    query_embedding = await embedding_model.aembed_query(query)
+    watermark = await db.latest_enriched_at(filter_criteria)
+    cached = answer_cache.lookup(query_embedding, filter_criteria, k, options)
+    if cached is not None:
+        if cached.watermark == watermark:
+            answer_cache.record_hit(cached, (time.perf_counter() - started) * 1000)
+            return cached, query_embedding, watermark
+        answer_cache.invalidate(cached)
+    return None, query_embedding, watermark
+
+def _retrieval_options(
+    min_similarity: Optional[float],
+    score_gap: Optional[float],
+    node_postprocessors: Optional[List[BaseNodePostprocessor]],
+) -> Dict[str, Any]:
+    """The retrieval settings besides filters and `k` that change which ads an answer is based on."""
+    return {
+        "min_similarity": min_similarity,
+        "score_gap": score_gap,
+        "postprocessors": [
+            [postprocessor.class_name(), getattr(postprocessor, "top_n", None)]
+            for postprocessor in node_postprocessors or []
+        ],
+    }
+
+def _ad_summaries(nodes: List[NodeWithScore]) -> List[Dict[str, Any]]:
+    return [
+        {"ad_id": node.node.metadata.get("ad_id"), "similarity": node.node.metadata.get("similarity")}
+        for node in nodes
+    ]
+
+
 # --- Query Engine Functions ---
+def create_response_synthesizer(gemini_pro: "ChatGoogleGenerativeAI", streaming: bool = False) -> BaseSynthesizer:
+    return get_response_synthesizer(
+        llm=gemini_pro,
+        text_qa_template=query_synthesis_prompt,
+        refine_template=critique_prompt,
+        streaming=streaming,
+    )
+
+def _response_synthesizer(
+    gemini_pro: "ChatGoogleGenerativeAI",
+    response_synthesizers: Optional[Callable[..., BaseSynthesizer]],
+    streaming: bool,
+) -> BaseSynthesizer:
+    if response_synthesizers is not None:
+        return response_synthesizers(streaming=streaming)
+    return create_response_synthesizer(gemini_pro, streaming=streaming)
+
+def build_node_postprocessors(
+    rerank: Optional[str],
+    gemini_pro: "ChatGoogleGenerativeAI",
+    top_n: Optional[int] = None,
+) -> List[BaseNodePostprocessor]:
+    """
+    Node postprocessors for a `QueryRequest.rerank` mode. `"llm"` asks the LLM to
+    pick and order the most relevant of the retrieved ads, keeping at most
+    `top_n` (default 10).
+    """
+    if not rerank:
+        return []
+    if rerank == "llm":
+        return [LLMRerank(llm=resolve_llm(gemini_pro), top_n=top_n or 10)]
+    raise ValueError(f"Unknown rerank mode: {rerank}")
+
 async def synthesize_answer(
     query: str,
-    supabase: Client,
-    gemini_pro: ChatGoogleGenerativeAI,
-    embedding_model: GoogleGenerativeAIEmbeddings,
+    db: Database,
+    gemini_pro: "ChatGoogleGenerativeAI",
+    embedding_model: Embeddings,
     filter_criteria: Optional[Dict[str, Any]] = None,
     k: int = 5,
     max_critique_loops: int = 2,
+    ef_search: Optional[int] = None,
+    iterative_scan: Optional[str] = None,
+    context_token_budget: Optional[int] = None,
+    answer_cache: Optional[SemanticAnswerCache] = None,
+    min_similarity: Optional[float] = None,
+    score_gap: Optional[float] = None,
+    node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
+    response_synthesizers: Optional[Callable[..., BaseSynthesizer]] = None,
 ) -> str:
     """
     Synthesizes a data-grounded answer from retrieved ad data using a LlamaIndex query engine.
+    With an `answer_cache`, equivalent earlier queries whose matching ads are unchanged are answered from it.
+
+    `min_similarity` drops weak matches and `score_gap` stops at the first larger
+    drop in similarity between consecutive matches, so synthesis runs over fewer
+    than `k` ads when only a few are relevant. `node_postprocessors` (e.g.
+    re-rankers) run on the retrieved nodes before synthesis.
+
+    The synthesizer holds no per-query state, so `response_synthesizers(streaming=...)`
+    (e.g. `ClientRegistry.response_synthesizer`) can return a process-wide one
+    over `gemini_pro`; without it one is built per call.
     """
+    started = time.perf_counter()
+    options = _retrieval_options(min_similarity, score_gap, node_postprocessors)
+    if answer_cache is not None:
+        cached, query_embedding, watermark = await _lookup_answer_cache(
+            answer_cache, query, db, embedding_model, filter_criteria, k, options, started
+        )
+        if cached is not None:
+            return cached.answer
+
     # --- LlamaIndex Integration ---
+    # The retriever carries this query's `k` and filters; it is a thin object
+    # over the shared Supabase client and embedding model.
     retriever = SupabaseHybridRetriever(
-        supabase_client=supabase,
+        db=db,
         embedding_model=embedding_model,
         k=k,
         filter_criteria=filter_criteria,
-    )
-
-    response_synthesizer = get_response_synthesizer(
-        llm=gemini_pro,
-        text_qa_template=query_synthesis_prompt,
-        refine_template=critique_prompt,
+        ef_search=ef_search,
+        iterative_scan=iterative_scan,
+        context_token_budget=context_token_budget,
+        min_similarity=min_similarity,
+        score_gap=score_gap,
     )
 
     query_engine = RetrieverQueryEngine(
         retriever=retriever,
-        response_synthesizer=response_synthesizer,
+        response_synthesizer=_response_synthesizer(gemini_pro, response_synthesizers, streaming=False),
+        node_postprocessors=node_postprocessors,
     )
 
     # Synthesize the answer using the query engine
     response = await query_engine.aquery(query)
 
+    if answer_cache is not None:
+        answer_cache.store(
+            query_embedding, filter_criteria, k, response.response, _ad_summaries(response.source_nodes),
+            watermark, latency_ms=(time.perf_counter() - started) * 1000, options=options,
+        )
     return response.response
 
+async def stream_answer(
+    query: str,
+    db: Database,
+    gemini_pro: "ChatGoogleGenerativeAI",
+    embedding_model: Embeddings,
+    filter_criteria: Optional[Dict[str, Any]] = None,
+    k: int = 5,
+    ef_search: Optional[int] = None,
+    iterative_scan: Optional[str] = None,
+    context_token_budget: Optional[int] = None,
+    answer_cache: Optional[SemanticAnswerCache] = None,
+    min_similarity: Optional[float] = None,
+    score_gap: Optional[float] = None,
+    node_postprocessors: Optional[List[BaseNodePostprocessor]] = None,
+    response_synthesizers: Optional[Callable[..., BaseSynthesizer]] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Answers `query` like `synthesize_answer`, yielding events as they become available:
+
+    - `{"type": "retrieval", "ads": [{"ad_id", "similarity"}, ...]}` once retrieval finishes,
+    - `{"type": "token", "text": ...}` for each generated text delta of the final answer,
+    - `{"type": "done", "retrieved_ads_count": ..., "timings": {...}}` with a timing breakdown in ms.
+
+    Intermediate refine passes are not streamed; only the final answer is. An
+    `answer_cache` hit is sent as one token, with `"cached": true` on `done`.
+    """
+    started = time.perf_counter()
+    options = _retrieval_options(min_similarity, score_gap, node_postprocessors)
+    if answer_cache is not None:
+        cached, query_embedding, watermark = await _lookup_answer_cache(
+            answer_cache, query, db, embedding_model, filter_criteria, k, options, started
+        )
+        if cached is not None:
+            yield {"type": "retrieval", "ads": cached.ads}
+            yield {"type": "token", "text": cached.answer}
+            yield {
+                "type": "done",
+                "retrieved_ads_count": len(cached.ads),
+                "cached": True,
+                "timings": {"total_ms": round((time.perf_counter() - started) * 1000, 1)},
+            }
+            return
+
+    retriever = SupabaseHybridRetriever(
+        db=db,
+        embedding_model=embedding_model,
+        k=k,
+        filter_criteria=filter_criteria,
+        ef_search=ef_search,
+        iterative_scan=iterative_scan,
+        context_token_budget=context_token_budget,
+        min_similarity=min_similarity,
+        score_gap=score_gap,
+    )
+    query_engine = RetrieverQueryEngine(
+        retriever=retriever,
+        response_synthesizer=_response_synthesizer(gemini_pro, response_synthesizers, streaming=True),
+        node_postprocessors=node_postprocessors,
+    )
+    query_bundle = QueryBundle(query)
+
+    nodes = await query_engine.aretrieve(query_bundle)
+    retrieved = time.perf_counter()
+    ads = _ad_summaries(nodes)
+    yield {"type": "retrieval", "ads": ads}
+
+    response = await query_engine.asynthesize(query_bundle, nodes)
+    first_token = None
+    tokens = []
+    if isinstance(response, AsyncStreamingResponse):
+        async for token in response.async_response_gen():
+            if first_token is None:
+                first_token = time.perf_counter()
+            tokens.append(token)
+            yield {"type": "token", "text": token}
+    else:
+        first_token = time.perf_counter()
+        tokens.append(str(response))
+        yield {"type": "token", "text": str(response)}
+    finished = time.perf_counter()
+    answer = "".join(tokens)
+
+    # An empty answer is a failed synthesis, not one to serve again.
+    if answer_cache is not None and answer:
+        answer_cache.store(
+            query_embedding, filter_criteria, k, answer, ads, watermark,
+            latency_ms=(finished - started) * 1000, options=options,
+        )
+
+    timings = {**retriever.timings, "retrieval_ms": (retrieved - started) * 1000}
+    if first_token is not None:
+        timings["first_token_ms"] = (first_token - started) * 1000
+    timings["synthesis_ms"] = (finished - retrieved) * 1000
+    timings["total_ms"] = (finished - started) * 1000
+    yield {
+        "type": "done",
+        "retrieved_ads_count": len(nodes),
+        "cached": False,
+        "timings": {name: round(value, 1) for name, value in timings.items()},
+    }
+
 
 # The main function is now removed as it was for testing purposes and will be replaced by a proper test suite.
@@ -0,0 +1,197 @@
+"""
+Queue worker mode: enriches PENDING ads pulled straight from `public.ads`
+instead of from Celery messages.
+
+Each process claims batches of PENDING ads with `FOR UPDATE SKIP LOCKED` (see
+`Database.claim_pending_ads`), so any number of workers can run side by side
+without processing an ad twice, and enriches up to `QUEUE_WORKER_CONCURRENCY`
+of them at a time on one event loop. Claimed ads are leased to the worker,
+which heartbeats the leases of the ads in flight; ads whose lease expired
+(their worker died) are periodically put back to PENDING (see `src.leases`).
+With `ENRICHMENT_PACK_SIZE` > 1 the strategic and persona stages of the ads in
+flight share packed LLM calls (see `src.prompt_packing`).
+
+A backfill or re-enrichment is an `UPDATE public.ads SET status = 'PENDING'
+WHERE ...` rather than millions of published tasks. Ads dispatched through
+Celery at ingestion are safe to process in either mode: whichever claims an
+ad first enriches it, the other skips it.
+
+    python -m src.queue_worker [--concurrency 32] [--batch-size 16]
+"""
+import argparse
+import asyncio
+import signal
+import time
+from typing import TYPE_CHECKING, Any, Dict, Optional, Set
+
+from langchain_core.embeddings import Embeddings
+from src.creatives import CreativeFetcher
+from src.db import Database
+from src.enrichment_pipeline import aenrich_ad
+from src.leases import LeaseHeartbeat, lease_owner_id, sweep_expired_leases
+from src.llm_cache import EnrichmentCache
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+from src.models import AdKnowledgeObject
+from src.prompt_packing import PromptPacker, create_prompt_packer
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+
+class QueueWorker:
+    def __init__(
+        self,
+        db: Database,
+        gemini_flash: "ChatGoogleGenerativeAI",
+        gemini_pro: "ChatGoogleGenerativeAI",
+        embedding_model: Embeddings,
+        cache: Optional[EnrichmentCache] = None,
+        concurrency: int = 16,
+        batch_size: int = 16,
+        lease_seconds: float = 300,
+        heartbeat_interval: float = 60,
+        poll_interval: float = 2,
+        reclaim_interval: float = 60,
+        fast_mode: bool = False,
+        packer: Optional[PromptPacker] = None,
+        fetcher: Optional[CreativeFetcher] = None,
+        metrics: Optional[Metrics] = None,
+    ):
+        self._db = db
+        self._gemini_flash = gemini_flash
+        self._gemini_pro = gemini_pro
+        self._embedding_model = embedding_model
+        self._cache = cache
+        self._concurrency = concurrency
+        self._batch_size = batch_size
+        self._lease_seconds = lease_seconds
+        self._heartbeat_interval = heartbeat_interval
+        self._poll_interval = poll_interval
+        self._reclaim_interval = reclaim_interval
+        self._fast_mode = fast_mode
+        self._packer = packer
+        self._fetcher = fetcher
+        self._metrics = metrics or get_metrics()
+        self.worker_id = lease_owner_id()
+
+    async def _enrich(self, row: Dict[str, Any]) -> None:
+        ad_id = row["id"]
+        try:
+            enriched_ad = await aenrich_ad(
+                ad_data=AdKnowledgeObject(**row),
+                gemini_flash=self._gemini_flash,
+                gemini_pro=self._gemini_pro,
+                embedding_model=self._embedding_model,
+                fast_mode=self._fast_mode,
+                cache=self._cache,
+                packer=self._packer,
+                fetcher=self._fetcher,
+                # Completed stages survive a crash; the next claim resumes after them.
+                checkpoint=lambda stage, result: self._db.save_stage(ad_id, stage, result, owner=self.worker_id),
+            )
+            saved = await self._db.save_enrichment(ad_id, enriched_ad.model_dump(), owner=self.worker_id)
+        except Exception as e:
+            # The lease runs out and the ad is reclaimed for another attempt.
+            logger.error(f"Queue worker {self.worker_id} failed to enrich ad {ad_id}: {e}")
+            self._metrics.incr("queue_worker.errors")
+            return
+        if not saved:
+            logger.warning(f"Queue worker {self.worker_id} lost the lease on ad {ad_id}; result discarded.")
+            self._metrics.incr("leases.stale_writes")
+            return
+        self._metrics.incr("queue_worker.enriched" if enriched_ad.status == "ENRICHED" else "queue_worker.failed")
+
+    async def reclaim(self) -> int:
+        # Reclaimed ads become PENDING, which is all this mode needs to pick them up again.
+        return await sweep_expired_leases(self._db, metrics=self._metrics)
+
+    async def run(self, stop: Optional[asyncio.Event] = None, max_ads: Optional[int] = None) -> int:
+        """
+        Claims and enriches ads until `stop` is set (or `max_ads` have been
+        claimed), then waits for the ads in flight. Returns the number claimed.
+        """
+        stop = stop or asyncio.Event()
+        in_flight: Set[asyncio.Task] = set()
+        claimed_total = 0
+        next_reclaim = time.monotonic()
+        heartbeat = LeaseHeartbeat(self._db, self.worker_id, self._lease_seconds, self._heartbeat_interval, metrics=self._metrics)
+        logger.info(f"Queue worker {self.worker_id} started (concurrency {self._concurrency}, batch {self._batch_size}).")
+        async with heartbeat:
+            try:
+                while not stop.is_set() and (max_ads is None or claimed_total < max_ads):
+                    if time.monotonic() >= next_reclaim:
+                        await self.reclaim()
+                        next_reclaim = time.monotonic() + self._reclaim_interval
+
+                    # Claim only what can start right away, so leases do not run
+                    # down while ads wait for a free slot.
+                    free = self._concurrency - len(in_flight)
+                    limit = min(free, self._batch_size)
+                    if max_ads is not None:
+                        limit = min(limit, max_ads - claimed_total)
+                    rows = []
+                    if limit >= min(self._batch_size, self._concurrency) or not in_flight:
+                        rows = await self._db.claim_pending_ads(limit, self._lease_seconds, self.worker_id)
+                    claimed_total += len(rows)
+                    if rows:
+                        self._metrics.incr("queue_worker.claimed", len(rows))
+                    for row in rows:
+                        task = asyncio.create_task(self._enrich(row))
+                        in_flight.add(task)
+                        heartbeat.ad_ids.add(row["id"])
+                        task.add_done_callback(in_flight.discard)
+                        task.add_done_callback(lambda _, ad_id=row["id"]: heartbeat.ad_ids.discard(ad_id))
+
+                    if in_flight and (not rows or len(in_flight) >= self._concurrency):
+                        await asyncio.wait(in_flight, timeout=self._poll_interval, return_when=asyncio.FIRST_COMPLETED)
+                    elif not rows:
+                        try:
+                            await asyncio.wait_for(stop.wait(), timeout=self._poll_interval)
+                        except asyncio.TimeoutError:
+                            pass
+            finally:
+                if in_flight:
+                    logger.info(f"Queue worker {self.worker_id} waiting for {len(in_flight)} ads in flight.")
+                    await asyncio.gather(*in_flight, return_exceptions=True)
+        return claimed_total
+
+
+async def main(concurrency: Optional[int] = None, batch_size: Optional[int] = None) -> None:
+    from src.dependencies import get_client_registry
+
+    clients = get_client_registry()
+    settings = clients.settings
+    worker = QueueWorker(
+        db=clients.db,
+        # The enrichment chains are LangChain runnables, so they get the raw chat models.
+        gemini_flash=clients.gemini_flash_chat_model,
+        gemini_pro=clients.gemini_pro_chat_model,
+        embedding_model=clients.embedding_model,
+        cache=clients.enrichment_cache,
+        concurrency=concurrency or settings.QUEUE_WORKER_CONCURRENCY,
+        batch_size=batch_size or settings.QUEUE_WORKER_BATCH_SIZE,
+        lease_seconds=settings.ENRICHMENT_LEASE_SECONDS,
+        heartbeat_interval=settings.ENRICHMENT_HEARTBEAT_SECONDS,
+        poll_interval=settings.QUEUE_WORKER_POLL_INTERVAL_SECONDS,
+        reclaim_interval=settings.QUEUE_WORKER_RECLAIM_INTERVAL_SECONDS,
+        fast_mode=settings.ENRICHMENT_FAST_MODE,
+        packer=create_prompt_packer(clients.gemini_pro_chat_model, settings, clients.enrichment_cache),
+        fetcher=clients.creative_fetcher,
+    )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await worker.run(stop)
+    finally:
+        await clients.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enrich PENDING ads claimed directly from Postgres.")
+    parser.add_argument("--concurrency", type=int, help="Ads enriched concurrently (default: QUEUE_WORKER_CONCURRENCY)")
+    parser.add_argument("--batch-size", type=int, help="Ads claimed per statement (default: QUEUE_WORKER_BATCH_SIZE)")
+    args = parser.parse_args()
+    asyncio.run(main(args.concurrency, args.batch_size))
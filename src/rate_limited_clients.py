@@ -0,0 +1,62 @@
+"""
+LangChain Gemini clients whose calls go through a `ModelRateLimiter`.
+
+Kept apart from src/rate_limiter.py because subclassing the LangChain clients
+imports `langchain_google_genai`; `create_rate_limited_chat_model` and
+`create_rate_limited_embeddings` import this module on first use.
+"""
+import math
+from typing import Any, Dict, List, Optional
+
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from pydantic import PrivateAttr
+
+from src.rate_limiter import ModelRateLimiter
+
+
+class RateLimitedChatGoogleGenerativeAI(ChatGoogleGenerativeAI):
+    """`ChatGoogleGenerativeAI` whose generate calls go through a `ModelRateLimiter`."""
+    _limiter: Optional[ModelRateLimiter] = PrivateAttr(default=None)
+
+    def _generate(self, *args: Any, **kwargs: Any):
+        if self._limiter is None:
+            return super()._generate(*args, **kwargs)
+        return self._limiter.run(lambda: super(RateLimitedChatGoogleGenerativeAI, self)._generate(*args, **kwargs))
+
+    async def _agenerate(self, *args: Any, **kwargs: Any):
+        if self._limiter is None:
+            return await super()._agenerate(*args, **kwargs)
+        return await self._limiter.arun(lambda: super(RateLimitedChatGoogleGenerativeAI, self)._agenerate(*args, **kwargs))
+
+
+class RateLimitedGoogleGenerativeAIEmbeddings(GoogleGenerativeAIEmbeddings):
+    """
+    `GoogleGenerativeAIEmbeddings` whose requests go through a
+    `ModelRateLimiter`; a call costs one token per API batch it sends.
+    """
+    _limiter: Optional[ModelRateLimiter] = PrivateAttr(default=None)
+
+    @staticmethod
+    def _cost(texts: List[str], batch_size: int) -> float:
+        return max(1, math.ceil(len(texts) / batch_size))
+
+    def embed_documents(self, texts: List[str], *, batch_size: int = 100, task_type: Optional[str] = None, **kwargs: Any) -> List[List[float]]:
+        call = lambda: super(RateLimitedGoogleGenerativeAIEmbeddings, self).embed_documents(texts, batch_size=batch_size, task_type=task_type, **kwargs)
+        return call() if self._limiter is None else self._limiter.run(call, cost=self._cost(texts, batch_size))
+
+    async def aembed_documents(self, texts: List[str], *, batch_size: int = 100, task_type: Optional[str] = None, **kwargs: Any) -> List[List[float]]:
+        call = lambda: super(RateLimitedGoogleGenerativeAIEmbeddings, self).aembed_documents(texts, batch_size=batch_size, task_type=task_type, **kwargs)
+        return await (call() if self._limiter is None else self._limiter.arun(call, cost=self._cost(texts, batch_size)))
+
+    def embed_query(self, text: str, **kwargs: Any) -> List[float]:
+        call = lambda: super(RateLimitedGoogleGenerativeAIEmbeddings, self).embed_query(text, **kwargs)
+        return call() if self._limiter is None else self._limiter.run(call)
+
+    async def aembed_query(self, text: str, **kwargs: Any) -> List[float]:
+        call = lambda: super(RateLimitedGoogleGenerativeAIEmbeddings, self).aembed_query(text, **kwargs)
+        return await (call() if self._limiter is None else self._limiter.arun(call))
+
+
+def client_kwargs(limiter: Optional[ModelRateLimiter]) -> Dict[str, Any]:
+    # With a limiter, 429s must reach it rather than be retried blindly by the SDK.
+    return {"max_retries": 1} if limiter is not None else {}
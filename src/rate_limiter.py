@@ -0,0 +1,329 @@
+"""
+Per-model rate limiting for the Gemini chat and embedding clients.
+
+Every model name gets one `ModelRateLimiter`, which combines:
+  * a token bucket refilled at the model's quota (requests per minute). With
+    the Redis backend the bucket lives in Redis, so the API and all Celery
+    workers draw from the same quota instead of each assuming all of it;
+  * an AIMD concurrency limit per process: it grows by one slot per window
+    of successful calls and halves on a 429 / RESOURCE_EXHAUSTED response;
+  * retries of rate-limited calls after a jittered exponential backoff, so
+    that callers throttled together do not come back together.
+
+`create_rate_limited_chat_model` and `create_rate_limited_embeddings` build the
+LangChain clients of `src.dependencies` with their calls routed through it.
+"""
+import asyncio
+import math
+import random
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+import redis
+
+from src.config import Settings
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+
+T = TypeVar("T")
+
+RATE_LIMIT_MARKERS = ("RESOURCE_EXHAUSTED", "ResourceExhausted")
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    """
+    True for quota errors of the Google clients: `google.api_core` raises
+    `ResourceExhausted`, `google.genai` a `ClientError` with code 429 (which
+    LangChain re-raises as `GoogleRateLimitError` or wraps in a
+    `GoogleGenerativeAIError`).
+    """
+    while exc is not None:
+        if getattr(exc, "code", None) == 429 or getattr(exc, "status_code", None) == 429:
+            return True
+        if type(exc).__name__ in ("ResourceExhausted", "GoogleRateLimitError"):
+            return True
+        if any(marker in str(exc) for marker in RATE_LIMIT_MARKERS):
+            return True
+        exc = exc.__cause__
+    return False
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# --- Token buckets ---
+
+class LocalTokenBucket:
+    """
+    In-process token bucket. `reserve` always takes the tokens and returns how
+    long the caller must wait for them, so concurrent callers queue up in order
+    instead of polling.
+    """
+    def __init__(self, rate_per_s: float, capacity: float):
+        self.rate_per_s = rate_per_s
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_s)
+            self._updated = now
+            self._tokens -= cost
+            return max(0.0, -self._tokens / self.rate_per_s)
+
+    async def areserve(self, cost: float = 1) -> float:
+        return self.reserve(cost) # Never blocks for longer than the lock.
+
+
+# Same algorithm as `LocalTokenBucket.reserve`, atomically on one Redis hash.
+# Returns the wait as a string: Lua numbers come back from Redis as integers.
+RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate) - cost
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+if tokens >= 0 then return '0' end
+return tostring(-tokens / rate)
+"""
+
+class RedisTokenBucket:
+    """Token bucket shared by every process that uses the same Redis key."""
+    def __init__(self, redis_url: str, key: str, rate_per_s: float, capacity: float):
+        self.rate_per_s = rate_per_s
+        self.capacity = capacity
+        self._key = key
+        self._redis = redis.Redis.from_url(redis_url, socket_timeout=1)
+        self._script = self._redis.register_script(RESERVE_SCRIPT)
+        self._fallback = LocalTokenBucket(rate_per_s, capacity)
+
+    def reserve(self, cost: float = 1) -> float:
+        try:
+            return float(self._script(keys=[self._key], args=[self.rate_per_s, self.capacity, cost]))
+        except redis.RedisError as e:
+            # Rate limiting must not take the pipeline down with Redis; limit locally meanwhile.
+            logger.warning(f"Rate limiter bucket {self._key} unavailable in Redis, limiting locally: {e}")
+            return self._fallback.reserve(cost)
+
+    async def areserve(self, cost: float = 1) -> float:
+        """`reserve` off the event loop: the script is a blocking Redis round trip."""
+        return await asyncio.to_thread(self.reserve, cost)
+
+    def close(self) -> None:
+        self._redis.close()
+
+
+# --- Adaptive concurrency ---
+
+class AdaptiveConcurrency:
+    """
+    AIMD concurrency limit for one event loop: `limit` grows by 1 per `limit`
+    successful calls and halves on a rate-limit error (at most once per
+    `decrease_cooldown_s`, since one burst yields many errors at once).
+    """
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, decrease_cooldown_s: float = 1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self._decrease_cooldown_s = decrease_cooldown_s
+        self._last_decrease = -math.inf
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> None:
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    self._wake() # Pass the slot it was woken for on.
+                raise
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def on_success(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._wake()
+
+    def on_rate_limited(self) -> bool:
+        now = time.monotonic()
+        if now - self._last_decrease < self._decrease_cooldown_s:
+            return False
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+        return True
+
+
+# --- Limiter ---
+
+class ModelRateLimiter:
+    """Rate limit, adaptive concurrency and rate-limit retries for the calls to one model."""
+    def __init__(
+        self,
+        model: str,
+        bucket: Any,
+        concurrency: AdaptiveConcurrency,
+        max_retries: int = 4,
+        backoff_base_s: float = 1.0,
+        backoff_max_s: float = 30.0,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.model = model
+        self.bucket = bucket
+        self.concurrency = concurrency
+        self._max_retries = max_retries
+        self._backoff_base_s = backoff_base_s
+        self._backoff_max_s = backoff_max_s
+        self._metrics = metrics or get_metrics()
+
+    def _wait_for(self, cost: float) -> float:
+        return self._record_wait(self.bucket.reserve(cost))
+
+    async def _await_for(self, cost: float) -> float:
+        return self._record_wait(await self.bucket.areserve(cost))
+
+    def _record_wait(self, wait: float) -> float:
+        if wait > 0:
+            self._metrics.incr(f"rate_limit.{self.model}.waited_s", wait)
+        return wait
+
+    def _on_rate_limited(self, attempt: int, e: BaseException) -> float:
+        self._metrics.incr(f"rate_limit.{self.model}.throttled")
+        if self.concurrency.on_rate_limited():
+            logger.warning(f"{self.model} is rate limited ({e}); concurrency limit now {int(self.concurrency.limit)}.")
+        return backoff_delay(attempt, self._backoff_base_s, self._backoff_max_s)
+
+    async def arun(self, call: Callable[[], Awaitable[T]], cost: float = 1) -> T:
+        """Awaits `call()` within the model's rate and concurrency limits, retrying it when rate limited."""
+        attempt = 0
+        while True:
+            await self.concurrency.acquire()
+            try:
+                wait = await self._await_for(cost)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                result = await call()
+            except Exception as e:
+                if attempt >= self._max_retries or not is_rate_limit_error(e):
+                    raise
+                delay = self._on_rate_limited(attempt, e)
+                attempt += 1
+            else:
+                self.concurrency.on_success()
+                self._metrics.incr(f"rate_limit.{self.model}.calls")
+                return result
+            finally:
+                self.concurrency.release()
+            await asyncio.sleep(delay)
+
+    def run(self, call: Callable[[], T], cost: float = 1) -> T:
+        """
+        Blocking variant of `arun` for the synchronous client methods. It
+        honours the shared rate and retries; the concurrency limit is per event
+        loop, so it only feeds back into it.
+        """
+        attempt = 0
+        while True:
+            wait = self._wait_for(cost)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                result = call()
+            except Exception as e:
+                if attempt >= self._max_retries or not is_rate_limit_error(e):
+                    raise
+                time.sleep(self._on_rate_limited(attempt, e))
+                attempt += 1
+            else:
+                self.concurrency.on_success()
+                self._metrics.incr(f"rate_limit.{self.model}.calls")
+                return result
+
+    def close(self) -> None:
+        if callable(getattr(self.bucket, "close", None)):
+            self.bucket.close()
+
+
+def model_rpm(settings: Settings, model: str) -> float:
+    """The quota of `model`: the lowest RPM configured for any client that uses it."""
+    quotas = [
+        rpm for name, rpm in (
+            (settings.GEMINI_FLASH_MODEL, settings.GEMINI_FLASH_RPM),
+            (settings.GEMINI_PRO_MODEL, settings.GEMINI_PRO_RPM),
+            (settings.EMBEDDING_MODEL, settings.EMBEDDING_RPM),
+        ) if name == model
+    ]
+    if not quotas:
+        raise ValueError(f"No rate limit configured for model {model}")
+    return min(quotas)
+
+def create_rate_limiter(settings: Settings, model: str, metrics: Optional[Metrics] = None) -> Optional[ModelRateLimiter]:
+    """Builds the limiter of `model` for `RATE_LIMIT_BACKEND` (`redis`, `memory` or `none`)."""
+    backend = settings.RATE_LIMIT_BACKEND
+    if backend == "none":
+        return None
+    rate_per_s = model_rpm(settings, model) / 60
+    capacity = max(1.0, rate_per_s * settings.RATE_LIMIT_BURST_SECONDS)
+    if backend == "redis":
+        bucket = RedisTokenBucket(settings.REDIS_URL, f"adgenesis:rate_limit:{model}", rate_per_s, capacity)
+    elif backend == "memory":
+        bucket = LocalTokenBucket(rate_per_s, capacity)
+    else:
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+    return ModelRateLimiter(
+        model,
+        bucket,
+        AdaptiveConcurrency(settings.MODEL_CONCURRENCY_INITIAL, maximum=settings.MODEL_CONCURRENCY_MAX),
+        max_retries=settings.RATE_LIMIT_MAX_RETRIES,
+        backoff_base_s=settings.RATE_LIMIT_BACKOFF_BASE_SECONDS,
+        backoff_max_s=settings.RATE_LIMIT_BACKOFF_MAX_SECONDS,
+        metrics=metrics,
+    )
+
+
+# --- Rate-limited LangChain clients ---
+# The client classes subclass langchain_google_genai's, which is slow to import:
+# they live in src/rate_limited_clients.py, imported on first use.
+
+def create_rate_limited_chat_model(limiter: Optional[ModelRateLimiter], **kwargs: Any) -> "ChatGoogleGenerativeAI":
+    from src.rate_limited_clients import RateLimitedChatGoogleGenerativeAI, client_kwargs
+
+    model = RateLimitedChatGoogleGenerativeAI(**client_kwargs(limiter), **kwargs)
+    model._limiter = limiter
+    return model
+
+def create_rate_limited_embeddings(limiter: Optional[ModelRateLimiter], **kwargs: Any) -> "GoogleGenerativeAIEmbeddings":
+    from src.rate_limited_clients import RateLimitedGoogleGenerativeAIEmbeddings
+
+    embeddings = RateLimitedGoogleGenerativeAIEmbeddings(**kwargs)
+    embeddings._limiter = limiter
+    return embeddings
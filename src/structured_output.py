@@ -0,0 +1,165 @@
+"""
+Structured LLM output for the enrichment stages.
+
+The JSON stages constrain the model with Gemini's native JSON-schema mode
+(`response_mime_type="application/json"` plus `response_json_schema`) instead
+of describing the schema in the prompt, which removes the format instructions
+from every prompt. `StageOutputParser` validates the reply against the Pydantic
+model and, when that fails, tries a local repair of near-valid JSON (code
+fences, surrounding prose, trailing commas, Python literals, truncation) before
+giving up and failing the stage.
+
+Per stage, it records parse outcomes and the token usage reported with each
+reply:
+  structured_output.<stage>.parsed|repaired|failed
+  llm_tokens.<stage>.calls|input|output
+"""
+import json
+import re
+from typing import Any, Dict, List, Optional, Type
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import BaseOutputParser
+from langchain_core.outputs import Generation
+from pydantic import BaseModel, ValidationError
+
+from src.logger import logger
+from src.metrics import Metrics, get_metrics
+
+_CODE_FENCE = re.compile(r"```(?:json)?\s*(.*?)\s*(?:```|$)", re.DOTALL)
+_STRING = re.compile(r'("(?:\\.|[^"\\])*")')
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def json_schema_kwargs(schema: Type[BaseModel]) -> Dict[str, Any]:
+    """Model call arguments that constrain a Gemini reply to `schema` (for `llm.bind` or a batch request)."""
+    return {"response_mime_type": "application/json", "response_json_schema": schema.model_json_schema()}
+
+
+def _close_truncated(text: str) -> str:
+    """Closes the strings, arrays and objects left open by a reply cut off mid-way."""
+    closers: List[str] = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]" and closers:
+            closers.pop()
+    if in_string:
+        text += '"'
+    text = text.rstrip().rstrip(",")
+    return text + "".join(reversed(closers))
+
+
+def _outside_strings(text: str) -> str:
+    """Drops trailing commas and maps Python literals, leaving string contents alone."""
+    parts = _STRING.split(text)
+    for index in range(0, len(parts), 2):
+        part = re.sub(r"\b(True|False|None)\b", lambda match: _PYTHON_LITERALS[match.group(1)], parts[index])
+        parts[index] = _TRAILING_COMMA.sub(r"\1", part)
+    return "".join(parts)
+
+
+def repair_json(text: str) -> str:
+    """
+    Best-effort repair of a near-valid JSON reply: unwraps code fences and
+    surrounding prose, drops trailing commas, maps Python literals and closes a
+    truncated document. Returns the text unchanged when it finds no JSON.
+    """
+    fenced = _CODE_FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return text
+    text = text[min(starts):]
+    cleaned = _outside_strings(text)
+    end = max(cleaned.rfind("}"), cleaned.rfind("]"))
+    try:
+        json.loads(cleaned[:end + 1])
+        return cleaned[:end + 1] # Drops prose after a complete document
+    except json.JSONDecodeError:
+        return _outside_strings(_close_truncated(text))
+
+
+def record_usage(stage: str, generation: Generation, metrics: Optional[Metrics] = None) -> None:
+    """Counts the call and the input/output tokens the model reported for `generation`."""
+    metrics = metrics or get_metrics()
+    metrics.incr(f"llm_tokens.{stage}.calls")
+    usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+    if usage:
+        metrics.incr(f"llm_tokens.{stage}.input", usage.get("input_tokens", 0))
+        metrics.incr(f"llm_tokens.{stage}.output", usage.get("output_tokens", 0))
+
+
+class StageOutputParser(BaseOutputParser[Any]):
+    """
+    Parses the reply of one enrichment stage into `pydantic_object` (repairing
+    near-valid JSON) or, without one, returns the text. Records parse outcomes
+    and token usage under `stage`.
+    """
+
+    stage: str
+    pydantic_object: Optional[Type[BaseModel]] = None
+
+    @property
+    def _type(self) -> str:
+        return "stage_output"
+
+    def parse_result(self, result: List[Generation], *, partial: bool = False) -> Any:
+        record_usage(self.stage, result[0])
+        return self.parse(result[0].text)
+
+    def parse(self, text: str) -> Any:
+        if self.pydantic_object is None:
+            return text
+        metrics = get_metrics()
+        try:
+            parsed = self.pydantic_object.model_validate_json(text)
+        except ValidationError:
+            pass
+        else:
+            metrics.incr(f"structured_output.{self.stage}.parsed")
+            return parsed
+        try:
+            parsed = self.pydantic_object.model_validate_json(repair_json(text))
+        except ValidationError as e:
+            metrics.incr(f"structured_output.{self.stage}.failed")
+            raise OutputParserException(f"Invalid {self.pydantic_object.__name__} output for {self.stage}: {e}", llm_output=text) from e
+        logger.info(f"Repaired malformed JSON output of stage {self.stage}.")
+        metrics.incr(f"structured_output.{self.stage}.repaired")
+        return parsed
+
+
+def structured_output_stats(metrics: Metrics) -> Dict[str, Dict[str, Optional[float]]]:
+    """Parse failure and repair rates and tokens per call for each stage."""
+    counters = metrics.snapshot()
+    stages = {
+        name.split(".")[1] for name in counters
+        if name.startswith("structured_output.") or name.startswith("llm_tokens.")
+    }
+    stats = {}
+    for stage in sorted(stages):
+        parsed = counters.get(f"structured_output.{stage}.parsed", 0)
+        repaired = counters.get(f"structured_output.{stage}.repaired", 0)
+        failed = counters.get(f"structured_output.{stage}.failed", 0)
+        replies = parsed + repaired + failed
+        calls = counters.get(f"llm_tokens.{stage}.calls", 0)
+        stats[stage] = {
+            "calls": calls,
+            "parse_failure_rate": failed / replies if replies else None,
+            "repair_rate": repaired / replies if replies else None,
+            "input_tokens_per_call": counters.get(f"llm_tokens.{stage}.input", 0) / calls if calls else None,
+            "output_tokens_per_call": counters.get(f"llm_tokens.{stage}.output", 0) / calls if calls else None,
+        }
+    return stats
@@ -1,8 +1,15 @@
-from supabase import create_client, Client
-from src.config import Settings
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-settings = Settings()
-supabase_client: Client = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
+from src.config import get_settings
 
-def get_supabase_client() -> Client:
-    return supabase_client
+if TYPE_CHECKING:
+    from supabase import Client
+
+@lru_cache
+def get_supabase_client() -> "Client":
+    """Returns the process-wide Supabase client, created on first use."""
+    from supabase import create_client
+
+    settings = get_settings()
+    return create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
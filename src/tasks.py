@@ -1,97 +1,212 @@
-from celery import Task
+import asyncio
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Coroutine, List, Optional, Sequence, TypeVar
+
+from celery import Task, group
 from celery.exceptions import Reject
-from src.celery_app import celery_app
-from src.enrichment_pipeline import enrich_ad
+from src.celeryconfig import BULK_QUEUE, REALTIME_QUEUE, RETRY_QUEUE
+from src.creatives import CreativeFetcher
+from src.dead_letters import DeadLetterQueue
+from src.embeddings import EmbeddingService
+from src.enrichment_pipeline import aenrich_ad
+from src.lanes import lane_options
+from src.leases import LeaseHeartbeat, lease_owner_id, sweep_expired_leases
+from src.llm_cache import EnrichmentCache
 from src.models import AdKnowledgeObject
 from src.logger import logger
-from src.dependencies import get_supabase, create_gemini_flash_client, create_gemini_pro_client, create_embedding_model_client
+from src.dependencies import get_settings, get_client_registry
 from src.config import Settings
+from src.db import Database
+from src.metrics import get_metrics
+from src.rate_limiter import backoff_delay
+
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+T = TypeVar("T")
+
+# One event loop per worker process, run by its own thread. The async LLM
+# clients bind their connections to the loop they first run on, so every task
+# submits its coroutines to this loop and waits for them. With the `threads`
+# pool (CELERY_WORKER_POOL), many tasks of a process wait on it at once and
+# share one set of clients; enrichment is network wait, so they overlap.
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_loop_pid: Optional[int] = None
+_worker_loop_lock = threading.Lock()
+_in_flight: Optional[asyncio.Semaphore] = None
 
-# Import necessary classes for client types
-from supabase import Client as SupabaseClient
-from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from llama_index.llms.langchain import LangChainLLM
+def _get_worker_loop() -> asyncio.AbstractEventLoop:
+    global _worker_loop, _worker_loop_pid, _in_flight
+    with _worker_loop_lock:
+        # Created lazily, and again in a forked child: its thread does not survive a fork.
+        if _worker_loop is None or _worker_loop.is_closed() or _worker_loop_pid != os.getpid():
+            _worker_loop = asyncio.new_event_loop()
+            _worker_loop_pid = os.getpid()
+            _in_flight = None
+            threading.Thread(target=_worker_loop.run_forever, name="worker-loop", daemon=True).start()
+        return _worker_loop
+
+async def _limit_in_flight(coro: Coroutine[Any, Any, T]) -> T:
+    """Runs `coro` once fewer than `WORKER_MAX_IN_FLIGHT` limited coroutines are running."""
+    global _in_flight
+    if _in_flight is None:
+        _in_flight = asyncio.Semaphore(get_settings().WORKER_MAX_IN_FLIGHT)
+    async with _in_flight:
+        return await coro
+
+def run_in_worker_loop(coro: Coroutine[Any, Any, T], limit_in_flight: bool = False) -> T:
+    """
+    Runs `coro` to completion on the process's shared event loop, starting it
+    on first use, and returns its result. Safe to call from many threads.
+    With `limit_in_flight`, it counts against `WORKER_MAX_IN_FLIGHT`.
+    """
+    future = asyncio.run_coroutine_threadsafe(_limit_in_flight(coro) if limit_in_flight else coro, _get_worker_loop())
+    try:
+        return future.result()
+    except BaseException:
+        # E.g. a time limit interrupted the waiting thread: stop the work too.
+        future.cancel()
+        raise
+
+_registry_lock = threading.Lock()
+
+def _client_registry():
+    # Serializes the first call: pool threads starting together must share one registry.
+    with _registry_lock:
+        return get_client_registry()
 
 class BaseTaskWithClients(Task):
     """
-    Base Celery Task class that initializes clients once per worker process.
+    Base Celery Task class whose clients come from the process's client
+    registry. They are built on first use rather than when the task is
+    registered, so a worker only builds the clients its tasks use, and are
+    shared by every task (and pool thread) of the process.
     """
-    def __init__(self):
-        super().__init__()
-        self._settings = Settings()
-        self._supabase_client = get_supabase()
-        self._gemini_flash_client = create_gemini_flash_client(self._settings)
-        self._gemini_pro_client = create_gemini_pro_client(self._settings)
-        self._embedding_model_instance = create_embedding_model_client(self._settings)
+    _settings: Optional[Settings] = None
+    _db: Optional[Database] = None
+    _gemini_flash_client: Optional["ChatGoogleGenerativeAI"] = None
+    _gemini_pro_client: Optional["ChatGoogleGenerativeAI"] = None
+    _embedding_model_instance: Optional[EmbeddingService] = None
 
     @property
     def settings(self) -> Settings:
+        if self._settings is None:
+            self._settings = get_settings()
         return self._settings
 
     @property
-    def supabase_client(self) -> SupabaseClient:
-        return self._supabase_client
+    def db(self) -> Database:
+        """Pooled Postgres access; its pool lives on the worker loop (see `run_in_worker_loop`)."""
+        if self._db is None:
+            self._db = _client_registry().db
+        return self._db
 
     @property
-    def gemini_flash_client(self) -> LangChainLLM:
+    def gemini_flash_client(self) -> "ChatGoogleGenerativeAI":
+        # The enrichment chains are LangChain runnables, so they get the raw chat models.
+        if self._gemini_flash_client is None:
+            self._gemini_flash_client = _client_registry().gemini_flash_chat_model
         return self._gemini_flash_client
 
     @property
-    def gemini_pro_client(self) -> LangChainLLM:
+    def gemini_pro_client(self) -> "ChatGoogleGenerativeAI":
+        if self._gemini_pro_client is None:
+            self._gemini_pro_client = _client_registry().gemini_pro_chat_model
         return self._gemini_pro_client
 
     @property
-    def embedding_model_instance(self) -> GoogleGenerativeAIEmbeddings:
+    def embedding_model_instance(self) -> EmbeddingService:
+        if self._embedding_model_instance is None:
+            self._embedding_model_instance = _client_registry().embedding_model
         return self._embedding_model_instance
 
-@celery_app.task(bind=True, max_retries=3, default_retry_delay=60, ignore_result=True, base=BaseTaskWithClients)
-def enrichment_task(self, ad_id: str):
+    @property
+    def enrichment_cache(self) -> Optional[EnrichmentCache]:
+        return _client_registry().enrichment_cache
+
+    @property
+    def creative_fetcher(self) -> Optional[CreativeFetcher]:
+        """Its HTTP connections live on the worker loop (see `run_in_worker_loop`)."""
+        return _client_registry().creative_fetcher
+
+# Imported after BaseTaskWithClients is defined: src.celery_app imports it back
+# from this module, so either module can be imported first.
+from src.celery_app import celery_app
+
+@celery_app.task(bind=True, max_retries=3, ignore_result=True, base=BaseTaskWithClients)
+def enrichment_task(self, ad_id: str, force_refresh: bool = False):
     """
     Celery task to enrich an ad, fetching data from the DB.
     Handles retries and dead-lettering.
+    With `force_refresh`, cached LLM outputs are ignored (and replaced).
     """
     try:
         logger.info(f"Starting enrichment for ad ID: {ad_id}")
 
         # Access clients from the task instance
-        supabase = self.supabase_client
+        db = self.db
         gemini_flash = self.gemini_flash_client
         gemini_pro = self.gemini_pro_client
         embedding_model = self.embedding_model_instance
+        cache = self.enrichment_cache
+        if cache is not None and force_refresh:
+            cache = cache.bypass()
+
+        # Lease the ad (PENDING -> ENRICHING) and fetch it in one statement.
+        # The lease is held under the task ID, so a retry or redelivery of this
+        # task takes it back; any other task skips it while the lease is live.
+        owner = lease_owner_id(self.request.id)
+        lease_seconds = self.settings.ENRICHMENT_LEASE_SECONDS
+        claimed, row = run_in_worker_loop(db.claim_ad(ad_id, owner, lease_seconds))
 
-        # Fetch the ad data from Supabase
-        response = supabase.from_("ads").select("*").eq("id", ad_id).single().execute()
-        
-        if not response.data:
+        if row is None:
             logger.error(f"Ad with ID {ad_id} not found in the database. Rejecting task.")
             raise Reject("Ad not found", requeue=False)
 
-        ad_data = AdKnowledgeObject(**response.data)
+        if not claimed:
+            logger.warning(f"Ad {ad_id} is already {row['status']}. Skipping task.")
+            return
 
-        # Atomic Idempotency Check and Status Update
-        # Attempt to set status to ENRICHING only if it's currently PENDING
-        update_response = supabase.from_("ads").update({"status": "ENRICHING"}).eq("id", ad_id).eq("status", "PENDING").execute()
+        ad_data = AdKnowledgeObject(**row)
+        if force_refresh and not self.request.retries:
+            # Stages checkpointed by an earlier run are redone too; retries of
+            # this task still resume from its own checkpoints.
+            ad_data.stage_status = {}
 
-        if update_response.count == 0:
-            # If no rows were updated, it means the ad was not in PENDING status,
-            # or it was already ENRICHED/ENRICHING by another process.
-            response = supabase.from_("ads").select("status").eq("id", ad_id).single().execute()
-            current_status = response.data["status"] if response.data else "UNKNOWN"
-            logger.warning(f"Ad {ad_id} is already {current_status} or not found. Skipping task.")
-            return
+        # Checkpoint every stage as it completes, so that a retry resumes
+        # from the first stage that did not
+        async def checkpoint(stage: str, result: Any) -> None:
+            await db.save_stage(ad_id, stage, result, owner=owner)
+
+        # Run the enrichment pipeline using clients from the task instance,
+        # heartbeating the lease so that a long run is not taken for a dead one
+        async def enrich_under_lease() -> AdKnowledgeObject:
+            async with LeaseHeartbeat(db, owner, lease_seconds, self.settings.ENRICHMENT_HEARTBEAT_SECONDS, [ad_id]):
+                return await aenrich_ad(
+                    ad_data=ad_data,
+                    gemini_flash=gemini_flash,
+                    gemini_pro=gemini_pro,
+                    embedding_model=embedding_model,
+                    fast_mode=self.settings.ENRICHMENT_FAST_MODE,
+                    cache=cache,
+                    checkpoint=checkpoint,
+                    fetcher=self.creative_fetcher,
+                )
 
-        # Run the enrichment pipeline using clients from the task instance
-        enriched_ad = enrich_ad(
-            ad_data=ad_data,
-            gemini_flash=gemini_flash,
-            gemini_pro=gemini_pro,
-            embedding_model=embedding_model,
-            supabase=supabase
-        )
+        enriched_ad = run_in_worker_loop(enrich_under_lease(), limit_in_flight=True)
 
-        # Update the database with the result
-        update_data = enriched_ad.model_dump(exclude_unset=True)
-        supabase.from_("ads").update(update_data).eq("id", ad_id).execute()
+        # A failed stage call is retried while retries remain; the last
+        # attempt saves the ad as FAILED below.
+        if "FAILED" in enriched_ad.stage_status.values() and self.request.retries < self.max_retries:
+            raise RuntimeError(f"Enrichment stage failed: {enriched_ad.error_log}")
+
+        # Write the result with the prepared enrichment statement, unless the
+        # lease expired and the ad went to another task meanwhile
+        if not run_in_worker_loop(db.save_enrichment(ad_id, enriched_ad.model_dump(), owner=owner)):
+            logger.warning(f"Lost the lease on ad {ad_id}; discarding this result.")
+            get_metrics().incr("leases.stale_writes")
+            return
 
         logger.info(f"Successfully enriched ad {ad_id}")
         return enriched_ad.model_dump_json()
@@ -99,14 +214,75 @@ def enrichment_task(self, ad_id: str):
     except Exception as e:
         logger.error(f"Enrichment task failed for ad {ad_id}: {e}")
         try:
-            # Retry for transient errors
-            raise self.retry(exc=e)
+            # Retry for transient errors, after a jittered exponential backoff
+            # so that tasks throttled together do not return together, and
+            countdown = backoff_delay(
+                self.request.retries,
+                self.settings.TASK_RETRY_BACKOFF_BASE_SECONDS,
+                self.settings.TASK_RETRY_BACKOFF_MAX_SECONDS,
+            )
+            # on the retry lane, so that failing ads do not hold up first attempts
+            raise self.retry(exc=e, countdown=countdown, **lane_options(RETRY_QUEUE, self.app.conf.broker_url or ""))
         except self.MaxRetriesExceededError:
             # Move to dead-letter queue for persistent errors
             logger.error(f"Max retries exceeded for ad {ad_id}. Moving to DLQ.")
             # Update status to FAILED in DB
-            supabase.from_("ads").update({
+            run_in_worker_loop(self.db.update_ad(ad_id, {
                 "status": "FAILED",
-                "error_log": f"Max retries exceeded: {e}"
-            }).eq("id", ad_id).execute()
+                "error_log": f"Max retries exceeded: {e}",
+                "lease_owner": None,
+                "lease_expires_at": None,
+            }))
+            _dead_letter(self.name, {"ad_id": ad_id, "force_refresh": force_refresh}, e)
             raise Reject(e, requeue=False)
+
+
+def _dead_letter(task_name: str, kwargs: dict, error: Exception) -> None:
+    """Publishes a task that exhausted its retries to the dead-letter queue (see src/dead_letters.py)."""
+    dead_letters = DeadLetterQueue(celery_app.connection_for_write())
+    try:
+        dead_letters.publish(task_name, kwargs, str(error))
+    except Exception as e:
+        logger.error(f"Could not dead-letter {task_name} {kwargs}: {e}")
+    finally:
+        dead_letters.close()
+
+
+def dispatch_enrichment(ad_id: str, force_refresh: bool = False, lane: str = REALTIME_QUEUE) -> str:
+    """Dispatches enrichment for one ad on `lane` (see src/lanes.py); returns the task ID."""
+    options = lane_options(lane, celery_app.conf.broker_url or "")
+    return enrichment_task.apply_async(kwargs={"ad_id": ad_id, "force_refresh": force_refresh}, **options).id
+
+
+def dispatch_enrichment_batch(ad_ids: List[str], force_refresh: Sequence[bool] = (), lanes: Sequence[str] = ()) -> List[str]:
+    """
+    Dispatches enrichment for many ads as a single Celery group.
+    All messages are published over one producer connection instead of one
+    `delay` round trip per ad. `force_refresh` and `lanes` optionally hold one
+    flag and one priority lane (default `bulk`, see src/lanes.py) per ad.
+    Returns the task IDs in the same order as `ad_ids`.
+    """
+    if not ad_ids:
+        return []
+    flags = list(force_refresh) or [False] * len(ad_ids)
+    broker_url = celery_app.conf.broker_url or ""
+    options = [lane_options(lane, broker_url) for lane in (list(lanes) or [BULK_QUEUE] * len(ad_ids))]
+    group_result = group(
+        enrichment_task.s(ad_id=ad_id, force_refresh=flag).set(**option)
+        for ad_id, flag, option in zip(ad_ids, flags, options)
+    ).apply_async()
+    return [result.id for result in group_result.results]
+
+
+@celery_app.task(bind=True, ignore_result=True, base=BaseTaskWithClients)
+def sweep_expired_leases_task(self):
+    """
+    Celery beat task: puts ads whose enrichment lease expired (their worker
+    died mid-run) back to PENDING and re-queues them, in batches of
+    `LEASE_SWEEP_BATCH_SIZE`.
+    """
+    return run_in_worker_loop(sweep_expired_leases(
+        self.db,
+        requeue=lambda ad_ids: dispatch_enrichment_batch(ad_ids, lanes=[RETRY_QUEUE] * len(ad_ids)),
+        batch_size=self.settings.LEASE_SWEEP_BATCH_SIZE,
+    ))
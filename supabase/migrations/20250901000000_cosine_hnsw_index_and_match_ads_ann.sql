@@ -0,0 +1,120 @@
+-- The original HNSW index was built with vector_l2_ops, while every search ranks
+-- by cosine distance (<=>). An index only serves ORDER BY on its own operator,
+-- so those searches fell back to a sequential scan over every ad. Rebuild the
+-- index with cosine ops, restricted to the rows that are ever searched.
+--
+-- Requires pgvector >= 0.8 for iterative index scans (`iterative_scan` other
+-- than 'off'). On older versions call match_ads_ann with iterative_scan =>
+-- 'off' (VECTOR_SEARCH_ITERATIVE_SCAN=off): the hnsw.iterative_scan and
+-- hnsw.max_scan_tuples settings are then left untouched, since setting an
+-- unknown hnsw.* parameter fails once the extension is loaded.
+DROP INDEX IF EXISTS public.idx_ads_vector_summary_hnsw;
+CREATE INDEX IF NOT EXISTS idx_ads_vector_summary_hnsw ON public.ads
+USING hnsw (vector_summary vector_cosine_ops) WITH (m = 16, ef_construction = 64)
+WHERE status = 'ENRICHED';
+
+-- Approximate nearest-neighbour search over enriched ads.
+--
+-- The inner query orders by the raw `vector_summary <=> query_embedding`
+-- expression so the planner can walk the HNSW index; similarity is derived
+-- from the distance of the `match_count` returned rows only.
+--
+--   ef_search        hnsw.ef_search: candidate list size, trading latency for recall.
+--   iterative_scan   hnsw.iterative_scan (pgvector >= 0.8): 'off', 'strict_order'
+--                    or 'relaxed_order'. With filters, iterative scans keep
+--                    walking the index until `match_count` rows pass them.
+--   max_scan_tuples  hnsw.max_scan_tuples: upper bound for iterative scans.
+--
+-- The settings are transaction-local and do not leak into other requests.
+CREATE OR REPLACE FUNCTION match_ads_ann (
+  query_embedding VECTOR(768),
+  match_count INT,
+  filter_criteria JSONB DEFAULT '{}'::jsonb,
+  ef_search INT DEFAULT 100,
+  iterative_scan TEXT DEFAULT 'relaxed_order',
+  max_scan_tuples INT DEFAULT 20000
+) RETURNS TABLE (
+  id UUID,
+  ad_id BIGINT,
+  raw_data_snapshot JSONB,
+  status TEXT,
+  enriched_at TIMESTAMPTZ,
+  error_log TEXT,
+  strategic_analysis JSONB,
+  visual_analysis JSONB,
+  audience_persona TEXT,
+  vector_summary VECTOR(768),
+  created_at TIMESTAMPTZ,
+  similarity FLOAT
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  sql_query TEXT;
+  where_clauses TEXT[] := ARRAY['status = ''ENRICHED'''];
+  json_key TEXT;
+  json_value JSONB;
+  nested_key TEXT;
+BEGIN
+  IF iterative_scan NOT IN ('off', 'strict_order', 'relaxed_order') THEN
+    RAISE EXCEPTION 'iterative_scan must be off, strict_order or relaxed_order, got %', iterative_scan;
+  END IF;
+
+  PERFORM set_config('hnsw.ef_search', greatest(ef_search, match_count)::text, true);
+  IF iterative_scan <> 'off' THEN
+    PERFORM set_config('hnsw.iterative_scan', iterative_scan, true);
+    PERFORM set_config('hnsw.max_scan_tuples', max_scan_tuples::text, true);
+  END IF;
+
+  -- Build WHERE clauses from filter_criteria JSONB
+  FOR json_key, json_value IN SELECT * FROM jsonb_each(filter_criteria)
+  LOOP
+    IF json_key LIKE 'strategic_analysis.%' THEN
+      nested_key := split_part(json_key, '.', 2);
+      where_clauses := array_append(where_clauses, format('a.strategic_analysis->>%L = %L', nested_key, json_value #>> '{}'));
+    ELSE
+      -- Assumes other keys are for the raw_data_snapshot JSONB field
+      where_clauses := array_append(where_clauses, format('a.raw_data_snapshot->>%L = %L', json_key, json_value #>> '{}'));
+    END IF;
+  END LOOP;
+
+  -- relaxed_order may return candidates slightly out of order, so the
+  -- materialized candidates are re-sorted by their exact distance.
+  sql_query :=
+    'WITH candidates AS MATERIALIZED ('
+    || ' SELECT a.*, a.vector_summary <=> $1 AS distance FROM public.ads a'
+    || ' WHERE ' || array_to_string(where_clauses, ' AND ')
+    || ' ORDER BY a.vector_summary <=> $1 LIMIT $2'
+    || ')'
+    || ' SELECT c.id, c.ad_id, c.raw_data_snapshot, c.status, c.enriched_at, c.error_log,'
+    || ' c.strategic_analysis, c.visual_analysis, c.audience_persona, c.vector_summary, c.created_at,'
+    || ' 1 - c.distance AS similarity'
+    || ' FROM candidates c ORDER BY c.distance';
+
+  RETURN QUERY EXECUTE sql_query USING query_embedding, match_count;
+END;
+$$;
+
+-- Keep the original RPC for existing callers, backed by the indexed search.
+CREATE OR REPLACE FUNCTION match_documents_adaptive (
+  query_embedding VECTOR(768),
+  match_count INT,
+  filter_criteria JSONB DEFAULT '{}'::jsonb
+) RETURNS TABLE (
+  id UUID,
+  ad_id BIGINT,
+  raw_data_snapshot JSONB,
+  status TEXT,
+  enriched_at TIMESTAMPTZ,
+  error_log TEXT,
+  strategic_analysis JSONB,
+  visual_analysis JSONB,
+  audience_persona TEXT,
+  vector_summary VECTOR(768),
+  created_at TIMESTAMPTZ,
+  similarity FLOAT
+)
+LANGUAGE sql
+AS $$
+  SELECT * FROM match_ads_ann(query_embedding, match_count, filter_criteria);
+$$;
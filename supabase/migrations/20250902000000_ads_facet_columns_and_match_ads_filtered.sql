@@ -0,0 +1,217 @@
+-- Hot filter facets as stored generated columns, so filtered searches use
+-- B-tree/GIN indexes instead of evaluating JSONB predicates on every row.
+-- Adding stored generated columns rewrites the table once.
+
+-- Lenient casts for the generated columns below. The snapshots are raw scraper
+-- output, and a STORED column that fails to compute fails the INSERT, and with
+-- it the whole multi-row ingest chunk: a malformed value becomes NULL instead.
+CREATE OR REPLACE FUNCTION public.try_boolean(value TEXT) RETURNS BOOLEAN
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE
+AS $$
+BEGIN
+  RETURN value::boolean;
+EXCEPTION WHEN others THEN
+  RETURN NULL;
+END
+$$;
+
+-- Casts from text to timestamptz are only stable (they depend on the session
+-- TimeZone and DateStyle), which generated columns do not accept. Only ISO 8601
+-- values are parsed: with an explicit offset as given, without one as UTC, so
+-- the result is the same in every session.
+CREATE OR REPLACE FUNCTION public.iso_timestamptz(value TEXT) RETURNS TIMESTAMPTZ
+LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE
+AS $$
+BEGIN
+  IF value !~ '^\d{4}-\d{2}-\d{2}' THEN
+    RETURN NULL;
+  ELSIF value ~ '[T ]\d{2}:\d{2}' AND value ~ '([Zz]|[+-]\d{2}(:?\d{2})?)$' THEN
+    RETURN value::timestamptz;
+  END IF;
+  RETURN value::timestamp AT TIME ZONE 'UTC';
+EXCEPTION WHEN others THEN
+  RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION public.jsonb_text_array(value JSONB) RETURNS TEXT[]
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+AS $$
+  SELECT coalesce(array_agg(element), '{}')
+  FROM jsonb_array_elements_text(CASE WHEN jsonb_typeof(value) = 'array' THEN value ELSE '[]'::jsonb END) AS element
+$$;
+
+ALTER TABLE public.ads
+  ADD COLUMN IF NOT EXISTS marketing_angle TEXT GENERATED ALWAYS AS (strategic_analysis->>'marketing_angle') STORED,
+  ADD COLUMN IF NOT EXISTS emotional_appeal TEXT GENERATED ALWAYS AS (strategic_analysis->>'emotional_appeal') STORED,
+  ADD COLUMN IF NOT EXISTS page_name TEXT GENERATED ALWAYS AS (raw_data_snapshot->>'page_name') STORED,
+  ADD COLUMN IF NOT EXISTS ad_display_format TEXT GENERATED ALWAYS AS (raw_data_snapshot->>'ad_display_format') STORED,
+  ADD COLUMN IF NOT EXISTS publisher_platforms TEXT[] GENERATED ALWAYS AS (public.jsonb_text_array(raw_data_snapshot->'publisher_platform')) STORED,
+  ADD COLUMN IF NOT EXISTS is_active BOOLEAN GENERATED ALWAYS AS (public.try_boolean(raw_data_snapshot->>'is_active')) STORED,
+  ADD COLUMN IF NOT EXISTS start_date TIMESTAMPTZ GENERATED ALWAYS AS (public.iso_timestamptz(raw_data_snapshot->>'start_date')) STORED,
+  ADD COLUMN IF NOT EXISTS end_date TIMESTAMPTZ GENERATED ALWAYS AS (public.iso_timestamptz(raw_data_snapshot->>'end_date')) STORED;
+
+-- Searches only ever read ENRICHED rows, so the facet indexes are partial too.
+CREATE INDEX IF NOT EXISTS idx_ads_marketing_angle ON public.ads (marketing_angle) WHERE status = 'ENRICHED';
+CREATE INDEX IF NOT EXISTS idx_ads_emotional_appeal ON public.ads (emotional_appeal) WHERE status = 'ENRICHED';
+CREATE INDEX IF NOT EXISTS idx_ads_page_name ON public.ads (page_name) WHERE status = 'ENRICHED';
+CREATE INDEX IF NOT EXISTS idx_ads_ad_display_format ON public.ads (ad_display_format) WHERE status = 'ENRICHED';
+CREATE INDEX IF NOT EXISTS idx_ads_publisher_platforms ON public.ads USING gin (publisher_platforms) WHERE status = 'ENRICHED';
+CREATE INDEX IF NOT EXISTS idx_ads_is_active ON public.ads (is_active) WHERE status = 'ENRICHED';
+CREATE INDEX IF NOT EXISTS idx_ads_run_dates ON public.ads (start_date, end_date) WHERE status = 'ENRICHED';
+
+-- Facets are correlated (a page sticks to a few angles and formats); multivariate
+-- statistics keep the combined selectivity estimates below honest.
+CREATE STATISTICS IF NOT EXISTS ads_facet_stats (dependencies, mcv)
+  ON marketing_angle, emotional_appeal, page_name, ad_display_format FROM public.ads;
+ANALYZE public.ads;
+
+-- Filter-aware nearest-neighbour search over enriched ads.
+--
+-- filter_criteria keys:
+--   marketing_angle, emotional_appeal, page_name, ad_display_format, is_active
+--       equality on the facet column (`strategic_analysis.<facet>` is accepted too)
+--   publisher_platform   a platform or an array of platforms the ad must run on
+--   date_from, date_to   the ad ran at some point within [date_from, date_to]
+--   any other key        equality on raw_data_snapshot->>key (unindexed)
+--
+-- Strategy, from the planner's row estimate for the filters:
+--   prefilter   estimated matches <= prefilter_max_rows or selectivity <=
+--               prefilter_selectivity: the facet indexes find the candidates and
+--               they are ranked exactly (full recall, never fewer than k hits).
+--   postfilter  otherwise: HNSW walk with an iterative scan that keeps going until
+--               match_count rows pass the filters (see match_ads_ann).
+-- The chosen strategy is returned with every row.
+CREATE OR REPLACE FUNCTION match_ads_filtered (
+  query_embedding VECTOR(768),
+  match_count INT,
+  filter_criteria JSONB DEFAULT '{}'::jsonb,
+  ef_search INT DEFAULT 100,
+  iterative_scan TEXT DEFAULT 'relaxed_order',
+  max_scan_tuples INT DEFAULT 20000,
+  prefilter_selectivity FLOAT DEFAULT 0.02,
+  prefilter_max_rows INT DEFAULT 20000
+) RETURNS TABLE (
+  id UUID,
+  ad_id BIGINT,
+  raw_data_snapshot JSONB,
+  status TEXT,
+  enriched_at TIMESTAMPTZ,
+  error_log TEXT,
+  strategic_analysis JSONB,
+  visual_analysis JSONB,
+  audience_persona TEXT,
+  vector_summary VECTOR(768),
+  created_at TIMESTAMPTZ,
+  similarity FLOAT,
+  search_strategy TEXT
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  sql_query TEXT;
+  where_clauses TEXT[] := ARRAY['a.status = ''ENRICHED'''];
+  json_key TEXT;
+  json_value JSONB;
+  facet TEXT;
+  plan JSONB;
+  total_rows FLOAT;
+  matching_rows FLOAT;
+  strategy TEXT := 'postfilter';
+  previous_enable_indexscan TEXT := current_setting('enable_indexscan');
+BEGIN
+  IF iterative_scan NOT IN ('off', 'strict_order', 'relaxed_order') THEN
+    RAISE EXCEPTION 'iterative_scan must be off, strict_order or relaxed_order, got %', iterative_scan;
+  END IF;
+
+  FOR json_key, json_value IN SELECT * FROM jsonb_each(filter_criteria)
+  LOOP
+    facet := CASE WHEN json_key LIKE 'strategic_analysis.%' THEN split_part(json_key, '.', 2) ELSE json_key END;
+    IF facet IN ('marketing_angle', 'emotional_appeal', 'page_name', 'ad_display_format') THEN
+      where_clauses := array_append(where_clauses, format('a.%I = %L', facet, json_value #>> '{}'));
+    ELSIF facet = 'is_active' THEN
+      where_clauses := array_append(where_clauses, format('a.is_active = %L::boolean', json_value #>> '{}'));
+    ELSIF facet = 'publisher_platform' THEN
+      where_clauses := array_append(where_clauses, format('a.publisher_platforms @> %L::text[]',
+        public.jsonb_text_array(CASE WHEN jsonb_typeof(json_value) = 'array' THEN json_value ELSE jsonb_build_array(json_value) END)));
+    ELSIF facet = 'date_from' THEN
+      where_clauses := array_append(where_clauses, format('(a.end_date IS NULL OR a.end_date >= %L::timestamptz)', json_value #>> '{}'));
+    ELSIF facet = 'date_to' THEN
+      where_clauses := array_append(where_clauses, format('a.start_date <= %L::timestamptz', json_value #>> '{}'));
+    ELSIF json_key LIKE 'strategic_analysis.%' THEN
+      where_clauses := array_append(where_clauses, format('a.strategic_analysis->>%L = %L', facet, json_value #>> '{}'));
+    ELSE
+      where_clauses := array_append(where_clauses, format('a.raw_data_snapshot->>%L = %L', json_key, json_value #>> '{}'));
+    END IF;
+  END LOOP;
+
+  IF array_length(where_clauses, 1) > 1 THEN
+    -- Planner estimates only; nothing is executed.
+    EXECUTE 'EXPLAIN (FORMAT JSON) SELECT 1 FROM public.ads a WHERE a.status = ''ENRICHED''' INTO plan;
+    total_rows := greatest((plan->0->'Plan'->>'Plan Rows')::float, 1);
+    EXECUTE 'EXPLAIN (FORMAT JSON) SELECT 1 FROM public.ads a WHERE ' || array_to_string(where_clauses, ' AND ') INTO plan;
+    matching_rows := (plan->0->'Plan'->>'Plan Rows')::float;
+    IF matching_rows <= prefilter_max_rows OR matching_rows / total_rows <= prefilter_selectivity THEN
+      strategy := 'prefilter';
+    END IF;
+  END IF;
+
+  IF strategy = 'prefilter' THEN
+    -- Keep the planner off the HNSW index: bitmap scans over the facet indexes
+    -- collect the candidates, which are then sorted by exact distance.
+    PERFORM set_config('enable_indexscan', 'off', true);
+  ELSE
+    PERFORM set_config('hnsw.ef_search', greatest(ef_search, match_count)::text, true);
+    IF iterative_scan <> 'off' THEN -- hnsw.iterative_scan needs pgvector >= 0.8
+      PERFORM set_config('hnsw.iterative_scan', iterative_scan, true);
+      PERFORM set_config('hnsw.max_scan_tuples', max_scan_tuples::text, true);
+    END IF;
+  END IF;
+
+  sql_query :=
+    'WITH candidates AS MATERIALIZED ('
+    || ' SELECT a.*, a.vector_summary <=> $1 AS distance FROM public.ads a'
+    || ' WHERE ' || array_to_string(where_clauses, ' AND ')
+    || ' ORDER BY a.vector_summary <=> $1 LIMIT $2'
+    || ')'
+    || ' SELECT c.id, c.ad_id, c.raw_data_snapshot, c.status, c.enriched_at, c.error_log,'
+    || ' c.strategic_analysis, c.visual_analysis, c.audience_persona, c.vector_summary, c.created_at,'
+    || ' 1 - c.distance AS similarity, $3'
+    || ' FROM candidates c ORDER BY c.distance';
+
+  RETURN QUERY EXECUTE sql_query USING query_embedding, match_count, strategy;
+
+  IF strategy = 'prefilter' THEN
+    PERFORM set_config('enable_indexscan', previous_enable_indexscan, true);
+  END IF;
+END;
+$$;
+
+-- match_ads_ann keeps its signature and now shares the filter handling above.
+CREATE OR REPLACE FUNCTION match_ads_ann (
+  query_embedding VECTOR(768),
+  match_count INT,
+  filter_criteria JSONB DEFAULT '{}'::jsonb,
+  ef_search INT DEFAULT 100,
+  iterative_scan TEXT DEFAULT 'relaxed_order',
+  max_scan_tuples INT DEFAULT 20000
+) RETURNS TABLE (
+  id UUID,
+  ad_id BIGINT,
+  raw_data_snapshot JSONB,
+  status TEXT,
+  enriched_at TIMESTAMPTZ,
+  error_log TEXT,
+  strategic_analysis JSONB,
+  visual_analysis JSONB,
+  audience_persona TEXT,
+  vector_summary VECTOR(768),
+  created_at TIMESTAMPTZ,
+  similarity FLOAT
+)
+LANGUAGE sql
+AS $$
+  SELECT m.id, m.ad_id, m.raw_data_snapshot, m.status, m.enriched_at, m.error_log,
+         m.strategic_analysis, m.visual_analysis, m.audience_persona, m.vector_summary, m.created_at, m.similarity
+  FROM match_ads_filtered(query_embedding, match_count, filter_criteria, ef_search, iterative_scan, max_scan_tuples) m;
+$$;
@@ -0,0 +1,139 @@
+-- The filter_criteria -> SQL predicate mapping is shared by the search RPC and
+-- the answer cache's freshness check, so it moves into its own function.
+
+-- WHERE clause (over `public.ads a`) selecting the ENRICHED ads that match
+-- filter_criteria; see match_ads_filtered for the supported keys. Values are
+-- quoted with format(%L), so the result is safe to EXECUTE.
+CREATE OR REPLACE FUNCTION public.ads_filter_predicate(filter_criteria JSONB) RETURNS TEXT
+LANGUAGE plpgsql IMMUTABLE
+AS $$
+DECLARE
+  where_clauses TEXT[] := ARRAY['a.status = ''ENRICHED'''];
+  json_key TEXT;
+  json_value JSONB;
+  facet TEXT;
+BEGIN
+  FOR json_key, json_value IN SELECT * FROM jsonb_each(filter_criteria)
+  LOOP
+    facet := CASE WHEN json_key LIKE 'strategic_analysis.%' THEN split_part(json_key, '.', 2) ELSE json_key END;
+    IF facet IN ('marketing_angle', 'emotional_appeal', 'page_name', 'ad_display_format') THEN
+      where_clauses := array_append(where_clauses, format('a.%I = %L', facet, json_value #>> '{}'));
+    ELSIF facet = 'is_active' THEN
+      where_clauses := array_append(where_clauses, format('a.is_active = %L::boolean', json_value #>> '{}'));
+    ELSIF facet = 'publisher_platform' THEN
+      where_clauses := array_append(where_clauses, format('a.publisher_platforms @> %L::text[]',
+        public.jsonb_text_array(CASE WHEN jsonb_typeof(json_value) = 'array' THEN json_value ELSE jsonb_build_array(json_value) END)));
+    ELSIF facet = 'date_from' THEN
+      where_clauses := array_append(where_clauses, format('(a.end_date IS NULL OR a.end_date >= %L::timestamptz)', json_value #>> '{}'));
+    ELSIF facet = 'date_to' THEN
+      where_clauses := array_append(where_clauses, format('a.start_date <= %L::timestamptz', json_value #>> '{}'));
+    ELSIF json_key LIKE 'strategic_analysis.%' THEN
+      where_clauses := array_append(where_clauses, format('a.strategic_analysis->>%L = %L', facet, json_value #>> '{}'));
+    ELSE
+      where_clauses := array_append(where_clauses, format('a.raw_data_snapshot->>%L = %L', json_key, json_value #>> '{}'));
+    END IF;
+  END LOOP;
+
+  RETURN array_to_string(where_clauses, ' AND ');
+END;
+$$;
+
+-- Latest enriched_at among the ads matching filter_criteria. The semantic
+-- answer cache records it when an answer is computed; a later value means
+-- newly enriched ads match and the cached answer is stale.
+CREATE INDEX IF NOT EXISTS idx_ads_enriched_at ON public.ads (enriched_at) WHERE status = 'ENRICHED';
+
+CREATE OR REPLACE FUNCTION latest_enriched_at(filter_criteria JSONB DEFAULT '{}'::jsonb) RETURNS TIMESTAMPTZ
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+  result TIMESTAMPTZ;
+BEGIN
+  EXECUTE 'SELECT max(a.enriched_at) FROM public.ads a WHERE ' || public.ads_filter_predicate(filter_criteria) INTO result;
+  RETURN result;
+END;
+$$;
+
+-- Unchanged apart from building its WHERE clause with ads_filter_predicate.
+CREATE OR REPLACE FUNCTION match_ads_filtered (
+  query_embedding VECTOR(768),
+  match_count INT,
+  filter_criteria JSONB DEFAULT '{}'::jsonb,
+  ef_search INT DEFAULT 100,
+  iterative_scan TEXT DEFAULT 'relaxed_order',
+  max_scan_tuples INT DEFAULT 20000,
+  prefilter_selectivity FLOAT DEFAULT 0.02,
+  prefilter_max_rows INT DEFAULT 20000
+) RETURNS TABLE (
+  id UUID,
+  ad_id BIGINT,
+  raw_data_snapshot JSONB,
+  status TEXT,
+  enriched_at TIMESTAMPTZ,
+  error_log TEXT,
+  strategic_analysis JSONB,
+  visual_analysis JSONB,
+  audience_persona TEXT,
+  vector_summary VECTOR(768),
+  created_at TIMESTAMPTZ,
+  similarity FLOAT,
+  search_strategy TEXT
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  sql_query TEXT;
+  where_clause TEXT;
+  plan JSONB;
+  total_rows FLOAT;
+  matching_rows FLOAT;
+  strategy TEXT := 'postfilter';
+  previous_enable_indexscan TEXT := current_setting('enable_indexscan');
+BEGIN
+  IF iterative_scan NOT IN ('off', 'strict_order', 'relaxed_order') THEN
+    RAISE EXCEPTION 'iterative_scan must be off, strict_order or relaxed_order, got %', iterative_scan;
+  END IF;
+
+  where_clause := public.ads_filter_predicate(filter_criteria);
+
+  IF filter_criteria <> '{}'::jsonb THEN
+    -- Planner estimates only; nothing is executed.
+    EXECUTE 'EXPLAIN (FORMAT JSON) SELECT 1 FROM public.ads a WHERE a.status = ''ENRICHED''' INTO plan;
+    total_rows := greatest((plan->0->'Plan'->>'Plan Rows')::float, 1);
+    EXECUTE 'EXPLAIN (FORMAT JSON) SELECT 1 FROM public.ads a WHERE ' || where_clause INTO plan;
+    matching_rows := (plan->0->'Plan'->>'Plan Rows')::float;
+    IF matching_rows <= prefilter_max_rows OR matching_rows / total_rows <= prefilter_selectivity THEN
+      strategy := 'prefilter';
+    END IF;
+  END IF;
+
+  IF strategy = 'prefilter' THEN
+    -- Keep the planner off the HNSW index: bitmap scans over the facet indexes
+    -- collect the candidates, which are then sorted by exact distance.
+    PERFORM set_config('enable_indexscan', 'off', true);
+  ELSE
+    PERFORM set_config('hnsw.ef_search', greatest(ef_search, match_count)::text, true);
+    IF iterative_scan <> 'off' THEN -- hnsw.iterative_scan needs pgvector >= 0.8
+      PERFORM set_config('hnsw.iterative_scan', iterative_scan, true);
+      PERFORM set_config('hnsw.max_scan_tuples', max_scan_tuples::text, true);
+    END IF;
+  END IF;
+
+  sql_query :=
+    'WITH candidates AS MATERIALIZED ('
+    || ' SELECT a.*, a.vector_summary <=> $1 AS distance FROM public.ads a'
+    || ' WHERE ' || where_clause
+    || ' ORDER BY a.vector_summary <=> $1 LIMIT $2'
+    || ')'
+    || ' SELECT c.id, c.ad_id, c.raw_data_snapshot, c.status, c.enriched_at, c.error_log,'
+    || ' c.strategic_analysis, c.visual_analysis, c.audience_persona, c.vector_summary, c.created_at,'
+    || ' 1 - c.distance AS similarity, $3'
+    || ' FROM candidates c ORDER BY c.distance';
+
+  RETURN QUERY EXECUTE sql_query USING query_embedding, match_count, strategy;
+
+  IF strategy = 'prefilter' THEN
+    PERFORM set_config('enable_indexscan', previous_enable_indexscan, true);
+  END IF;
+END;
+$$;
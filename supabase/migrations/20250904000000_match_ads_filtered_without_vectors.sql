@@ -0,0 +1,92 @@
+-- Search results feed the synthesis context, which never uses the 768-float
+-- embedding; returning it made every PostgREST response several KB per row.
+-- match_ads_filtered now returns vector_summary only with include_vector.
+
+-- Adding a parameter would create an overload, so the old signature goes first.
+-- match_ads_ann calls it by position and resolves to the new one.
+DROP FUNCTION IF EXISTS match_ads_filtered(VECTOR(768), INT, JSONB, INT, TEXT, INT, FLOAT, INT);
+
+CREATE OR REPLACE FUNCTION match_ads_filtered (
+  query_embedding VECTOR(768),
+  match_count INT,
+  filter_criteria JSONB DEFAULT '{}'::jsonb,
+  ef_search INT DEFAULT 100,
+  iterative_scan TEXT DEFAULT 'relaxed_order',
+  max_scan_tuples INT DEFAULT 20000,
+  prefilter_selectivity FLOAT DEFAULT 0.02,
+  prefilter_max_rows INT DEFAULT 20000,
+  include_vector BOOLEAN DEFAULT false
+) RETURNS TABLE (
+  id UUID,
+  ad_id BIGINT,
+  raw_data_snapshot JSONB,
+  status TEXT,
+  enriched_at TIMESTAMPTZ,
+  error_log TEXT,
+  strategic_analysis JSONB,
+  visual_analysis JSONB,
+  audience_persona TEXT,
+  vector_summary VECTOR(768),
+  created_at TIMESTAMPTZ,
+  similarity FLOAT,
+  search_strategy TEXT
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  sql_query TEXT;
+  where_clause TEXT;
+  plan JSONB;
+  total_rows FLOAT;
+  matching_rows FLOAT;
+  strategy TEXT := 'postfilter';
+  previous_enable_indexscan TEXT := current_setting('enable_indexscan');
+BEGIN
+  IF iterative_scan NOT IN ('off', 'strict_order', 'relaxed_order') THEN
+    RAISE EXCEPTION 'iterative_scan must be off, strict_order or relaxed_order, got %', iterative_scan;
+  END IF;
+
+  where_clause := public.ads_filter_predicate(filter_criteria);
+
+  IF filter_criteria <> '{}'::jsonb THEN
+    -- Planner estimates only; nothing is executed.
+    EXECUTE 'EXPLAIN (FORMAT JSON) SELECT 1 FROM public.ads a WHERE a.status = ''ENRICHED''' INTO plan;
+    total_rows := greatest((plan->0->'Plan'->>'Plan Rows')::float, 1);
+    EXECUTE 'EXPLAIN (FORMAT JSON) SELECT 1 FROM public.ads a WHERE ' || where_clause INTO plan;
+    matching_rows := (plan->0->'Plan'->>'Plan Rows')::float;
+    IF matching_rows <= prefilter_max_rows OR matching_rows / total_rows <= prefilter_selectivity THEN
+      strategy := 'prefilter';
+    END IF;
+  END IF;
+
+  IF strategy = 'prefilter' THEN
+    -- Keep the planner off the HNSW index: bitmap scans over the facet indexes
+    -- collect the candidates, which are then sorted by exact distance.
+    PERFORM set_config('enable_indexscan', 'off', true);
+  ELSE
+    PERFORM set_config('hnsw.ef_search', greatest(ef_search, match_count)::text, true);
+    IF iterative_scan <> 'off' THEN -- hnsw.iterative_scan needs pgvector >= 0.8
+      PERFORM set_config('hnsw.iterative_scan', iterative_scan, true);
+      PERFORM set_config('hnsw.max_scan_tuples', max_scan_tuples::text, true);
+    END IF;
+  END IF;
+
+  sql_query :=
+    'WITH candidates AS MATERIALIZED ('
+    || ' SELECT a.*, a.vector_summary <=> $1 AS distance FROM public.ads a'
+    || ' WHERE ' || where_clause
+    || ' ORDER BY a.vector_summary <=> $1 LIMIT $2'
+    || ')'
+    || ' SELECT c.id, c.ad_id, c.raw_data_snapshot, c.status, c.enriched_at, c.error_log,'
+    || ' c.strategic_analysis, c.visual_analysis, c.audience_persona,'
+    || ' CASE WHEN $4 THEN c.vector_summary END, c.created_at,'
+    || ' 1 - c.distance AS similarity, $3'
+    || ' FROM candidates c ORDER BY c.distance';
+
+  RETURN QUERY EXECUTE sql_query USING query_embedding, match_count, strategy, include_vector;
+
+  IF strategy = 'prefilter' THEN
+    PERFORM set_config('enable_indexscan', previous_enable_indexscan, true);
+  END IF;
+END;
+$$;
@@ -0,0 +1,15 @@
+-- Lets workers pull PENDING ads straight from public.ads (src/queue_worker.py)
+-- instead of receiving one broker message per ad. A worker claims a batch with
+-- FOR UPDATE SKIP LOCKED, so concurrent workers never claim the same row, and
+-- holds each claimed row under a lease. Rows still ENRICHING after their lease
+-- expired belong to a worker that died; they are put back to PENDING.
+--
+-- Re-enrichment and backfills become a single UPDATE ... SET status = 'PENDING'.
+
+ALTER TABLE public.ads ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+
+-- Claim order (oldest first) over the PENDING rows only.
+CREATE INDEX IF NOT EXISTS idx_ads_pending_queue ON public.ads (created_at) WHERE status = 'PENDING';
+
+-- Expired-lease scan over the (few) ENRICHING rows.
+CREATE INDEX IF NOT EXISTS idx_ads_enriching_lease ON public.ads (lease_expires_at) WHERE status = 'ENRICHING';
@@ -0,0 +1,21 @@
+-- Crash-safe enrichment leases for both worker modes.
+--
+-- A claim records who holds the ad (lease_owner: the Celery task id, which a
+-- retry keeps, or the queue worker's host:pid) and until when. The holder
+-- extends the lease with heartbeats while it works. Once a lease has expired,
+-- the periodic sweeper (Celery beat) puts the ad back to PENDING and re-queues
+-- it; a retry of the owning task may pick its own ad up again at any time.
+
+ALTER TABLE public.ads
+  ADD COLUMN IF NOT EXISTS lease_owner TEXT,
+  ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+
+-- Ads claimed before leases existed have none; give them one hour to finish
+-- before the sweeper treats them as orphaned.
+UPDATE public.ads SET lease_expires_at = now() + interval '1 hour'
+WHERE status = 'ENRICHING' AND lease_expires_at IS NULL;
+
+-- Serves the sweeper's (status = 'ENRICHING' AND lease_expires_at < now()) scan
+-- and supersedes the partial lease index.
+CREATE INDEX IF NOT EXISTS idx_ads_status_lease ON public.ads (status, lease_expires_at);
+DROP INDEX IF EXISTS idx_ads_enriching_lease;
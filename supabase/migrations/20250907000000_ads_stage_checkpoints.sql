@@ -0,0 +1,13 @@
+-- Stage checkpoints for enrichment.
+--
+-- Each enrichment stage (visual_analysis, strategic_analysis, audience_persona,
+-- vector_summary) writes its result column as soon as it completes and marks
+-- itself DONE in stage_status, e.g. {"visual_analysis": "DONE",
+-- "strategic_analysis": "FAILED"}. A retry of the ad resumes from the first
+-- stage that is not DONE instead of repeating every LLM call.
+--
+-- A successful enrichment resets stage_status to '{}', so setting an enriched
+-- ad back to PENDING re-runs every stage. To re-run a partially enriched ad
+-- from scratch, reset stage_status along with its status.
+
+ALTER TABLE public.ads ADD COLUMN IF NOT EXISTS stage_status JSONB NOT NULL DEFAULT '{}'::jsonb;
@@ -0,0 +1,58 @@
+-- Near-duplicate detection at ingestion (src/dedup.py).
+--
+-- Every ingested ad gets two fingerprints: copy_simhash, a 64-bit SimHash of
+-- its normalized copy, and creative_fingerprint, a SHA-256 of its normalized
+-- creative URL. An ad whose creative fingerprint matches an existing source ad
+-- and whose SimHash is within DEDUP_MAX_HAMMING_DISTANCE bits of the source's
+-- is stored with derived_from pointing at the source and is never enqueued
+-- for LLM enrichment:
+--   * if the source is already ENRICHED, its results are copied at ingestion;
+--   * otherwise the trigger below copies them when the source becomes ENRICHED
+--     (or fails the derived ad when the source FAILS).
+--
+-- Only source ads (derived_from IS NULL) are matched against, so chains of
+-- derived ads never form.
+
+ALTER TABLE public.ads ADD COLUMN IF NOT EXISTS copy_simhash BIGINT;
+ALTER TABLE public.ads ADD COLUMN IF NOT EXISTS creative_fingerprint TEXT;
+ALTER TABLE public.ads ADD COLUMN IF NOT EXISTS derived_from UUID REFERENCES public.ads (id) ON DELETE SET NULL;
+
+-- Fingerprint index of the ads that can serve as a source.
+CREATE INDEX IF NOT EXISTS idx_ads_dedup_sources ON public.ads (creative_fingerprint)
+    WHERE derived_from IS NULL AND status <> 'FAILED';
+
+CREATE INDEX IF NOT EXISTS idx_ads_derived_from ON public.ads (derived_from) WHERE derived_from IS NOT NULL;
+
+-- Derived ads wait for their source instead of being claimed by queue workers.
+DROP INDEX IF EXISTS public.idx_ads_pending_queue;
+CREATE INDEX IF NOT EXISTS idx_ads_pending_queue ON public.ads (created_at) WHERE status = 'PENDING' AND derived_from IS NULL;
+
+CREATE OR REPLACE FUNCTION public.propagate_enrichment_to_derived_ads()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.status = 'ENRICHED' THEN
+        -- FAILED derived ads are included, so a source that succeeds on a retry heals them.
+        UPDATE public.ads SET
+            status = 'ENRICHED', enriched_at = NEW.enriched_at, error_log = NULL,
+            visual_analysis = NEW.visual_analysis, strategic_analysis = NEW.strategic_analysis,
+            audience_persona = NEW.audience_persona, vector_summary = NEW.vector_summary,
+            stage_status = '{}'::jsonb
+        WHERE derived_from = NEW.id AND status IN ('PENDING', 'FAILED');
+    ELSIF NEW.status = 'FAILED' THEN
+        UPDATE public.ads SET
+            status = 'FAILED',
+            error_log = 'Source ad ' || NEW.id || ' failed: ' || coalesce(NEW.error_log, 'unknown error')
+        WHERE derived_from = NEW.id AND status = 'PENDING';
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS ads_propagate_to_derived ON public.ads;
+CREATE TRIGGER ads_propagate_to_derived
+    AFTER UPDATE OF status ON public.ads
+    FOR EACH ROW
+    WHEN (NEW.status IN ('ENRICHED', 'FAILED') AND OLD.status IS DISTINCT FROM NEW.status AND NEW.derived_from IS NULL)
+    EXECUTE FUNCTION public.propagate_enrichment_to_derived_ads();
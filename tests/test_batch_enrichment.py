@@ -0,0 +1,174 @@
+import json
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+from src.batch_enrichment import BatchEnrichmentRunner, GeminiBatchClient
+from src.metrics import Metrics
+from src.models import StrategicAnalysis, VisualAnalysis
+
+VISUAL = VisualAnalysis(visual_style="bold", key_visual_elements=["sneaker"], color_palette="neon", overall_impression="energetic")
+STRATEGIC = StrategicAnalysis(
+    marketing_angle="Social Proof", emotional_appeal="Belonging", cta_analysis="Clear", key_claims=["Loved by runners"], confidence_score=0.8,
+)
+
+
+class LocalBatchEndpoint:
+    """
+    Stand-in for the `aio.files` and `aio.batches` APIs of `google.genai.Client`:
+    reads the uploaded JSONL, answers each request with `respond(model, prompt)`
+    and serves the answers as a JSONL result file. Jobs report RUNNING on the
+    first poll and `final_state` afterwards.
+    """
+
+    def __init__(self, respond, final_state="JOB_STATE_SUCCEEDED"):
+        self._respond = respond
+        self._final_state = final_state
+        self._files = {}
+        self._jobs = {}
+        self.submitted = []
+        self.aio = SimpleNamespace(
+            files=SimpleNamespace(upload=self._upload, download=self._download),
+            batches=SimpleNamespace(create=self._create, get=self._get),
+        )
+
+    async def _upload(self, file, config):
+        name = f"files/{len(self._files)}"
+        with open(file) as handle:
+            self._files[name] = [json.loads(line) for line in handle]
+        return SimpleNamespace(name=name)
+
+    async def _download(self, file):
+        return self._files[file].encode()
+
+    async def _create(self, model, src, config):
+        requests = self._files[src]
+        self.submitted.append((model, requests))
+        lines = []
+        for line in requests:
+            prompt = line["request"]["contents"][0]["parts"][0]["text"]
+            answer = self._respond(model, prompt)
+            if isinstance(answer, Exception):
+                lines.append({"key": line["key"], "error": {"code": 400, "message": str(answer)}})
+            elif answer is not None:
+                lines.append({"key": line["key"], "response": {"candidates": [{"content": {"parts": [{"text": answer}]}}]}})
+        name = f"batches/{len(self._jobs)}"
+        self._files[f"{name}/results"] = "".join(json.dumps(line) + "\n" for line in lines)
+        self._jobs[name] = 0
+        return SimpleNamespace(name=name)
+
+    async def _get(self, name):
+        self._jobs[name] += 1
+        state = "JOB_STATE_RUNNING" if self._jobs[name] == 1 else self._final_state
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=state), error=None, dest=SimpleNamespace(file_name=f"{name}/results"))
+
+
+class InMemoryAds:
+    """Stand-in for the batch methods of `Database`."""
+
+    def __init__(self, rows):
+        self.rows = {str(row["id"]): dict(row, status="PENDING") for row in rows}
+        self.stages = {}
+
+    async def claim_pending_ads(self, limit, lease_seconds, owner):
+        batch = [ad_id for ad_id, row in self.rows.items() if row["status"] == "PENDING"][:limit]
+        for ad_id in batch:
+            self.rows[ad_id]["status"] = "ENRICHING"
+        return [dict(self.rows[ad_id]) for ad_id in batch]
+
+    async def heartbeat(self, ad_ids, owner, lease_seconds):
+        return len(ad_ids)
+
+    async def save_stages(self, stage, results, owner=None):
+        for ad_id, value in results.items():
+            self.stages.setdefault(stage, {})[ad_id] = value
+        return len(results)
+
+    async def finish_enrichments(self, outcomes, owner=None):
+        for outcome in outcomes:
+            self.rows[outcome["id"]].update(status=outcome["status"], error_log=outcome.get("error_log"))
+        return len(outcomes)
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    async def aembed_documents(self, texts):
+        self.calls.append(texts)
+        return [[0.1, 0.2] for _ in texts]
+
+
+def _ad(creative_url="https://cdn.example.com/ad.jpg"):
+    return {"id": uuid4(), "ad_id": 1, "raw_data_snapshot": {"ad_creative_url": creative_url, "ad_copy": "Run further"}}
+
+
+def _runner(db, endpoint, embeddings, **kwargs):
+    return BatchEnrichmentRunner(
+        db,
+        GeminiBatchClient(endpoint),
+        gemini_flash=SimpleNamespace(model="gemini-flash", temperature=0.2),
+        gemini_pro=SimpleNamespace(model="gemini-pro", temperature=0.7),
+        embedding_model=embeddings,
+        poll_interval=0,
+        metrics=Metrics(),
+        **kwargs,
+    )
+
+
+def _respond(model, prompt):
+    if model == "gemini-flash":
+        return VISUAL.model_dump_json()
+    if "Audience Persona:" in prompt:
+        return "  Urban runners in their thirties.\n"
+    return STRATEGIC.model_dump_json()
+
+
+@pytest.mark.asyncio
+async def test_batch_run_chains_stages_through_jobs_and_writes_outcomes_in_bulk():
+    rows = [_ad(), _ad(), _ad(creative_url=None)]
+    db = InMemoryAds(rows)
+    endpoint = LocalBatchEndpoint(_respond)
+    embeddings = FakeEmbeddings()
+
+    counts = await _runner(db, endpoint, embeddings).run(max_ads=10)
+
+    assert counts == {"ENRICHED": 2, "FAILED": 1}
+    # One job per LLM stage, each carrying only the ads with a creative.
+    assert [(model, len(requests)) for model, requests in endpoint.submitted] == [("gemini-flash", 2), ("gemini-pro", 2), ("gemini-pro", 2)]
+    generation_config = endpoint.submitted[0][1][0]["request"]["generation_config"]
+    assert generation_config["temperature"] == 0.2 and generation_config["response_mime_type"] == "application/json"
+    # The strategic prompts carry the visual analysis the first job returned.
+    assert all("neon" in line["request"]["contents"][0]["parts"][0]["text"] for line in endpoint.submitted[1][1])
+    assert set(db.stages["audience_persona"].values()) == {"Urban runners in their thirties."}
+    assert len(embeddings.calls) == 1 and len(embeddings.calls[0]) == 2
+    assert db.rows[str(rows[2]["id"])]["error_log"] == "Ad creative URL not found in raw_data_snapshot."
+
+
+@pytest.mark.asyncio
+async def test_batch_run_fails_bad_answers_and_releases_ads_of_failed_jobs():
+    rows = [_ad(creative_url="https://cdn.example.com/broken.jpg"), _ad()]
+    db = InMemoryAds(rows)
+
+    def respond(model, prompt):
+        return "not json" if "broken.jpg" in prompt else _respond(model, prompt)
+
+    counts = await _runner(db, LocalBatchEndpoint(respond), FakeEmbeddings()).run(max_ads=10)
+    assert counts == {"FAILED": 1, "ENRICHED": 1}
+    assert db.rows[str(rows[0]["id"])]["error_log"].startswith("visual_analysis:")
+
+    expired = InMemoryAds([_ad()])
+    counts = await _runner(expired, LocalBatchEndpoint(_respond, final_state="JOB_STATE_EXPIRED"), FakeEmbeddings()).run(max_ads=10)
+    assert counts == {"PENDING": 1}
+    assert "visual_analysis" not in expired.stages
+
+
+@pytest.mark.asyncio
+async def test_batch_run_skips_checkpointed_stages():
+    row = dict(_ad(), visual_analysis=VISUAL.model_dump(), stage_status={"visual_analysis": "DONE"})
+    db = InMemoryAds([row])
+    endpoint = LocalBatchEndpoint(_respond)
+
+    assert await _runner(db, endpoint, FakeEmbeddings()).run(max_ads=10) == {"ENRICHED": 1}
+    assert [model for model, _ in endpoint.submitted] == ["gemini-pro", "gemini-pro"]
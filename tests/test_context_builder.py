@@ -0,0 +1,66 @@
+from src.context_builder import build_context_nodes, compact_ad_context, count_tokens
+
+
+def _row(ad_id, url="https://scontent.fbcdn.net/v/t39/123_n.jpg?stp=dst-jpg&oh=abc&oe=1", body="Walk on clouds all day.", similarity=0.9):
+    return {
+        "ad_id": ad_id,
+        "similarity": similarity,
+        "vector_summary": [0.123456789] * 768,
+        "raw_data_snapshot": {
+            "ad_id": ad_id,
+            "page_name": "Cloud Shoes",
+            "ad_body_text": body,
+            "cta_text": "Shop now",
+            "landing_page_url": "https://www.cloudshoes.com/products/runner?utm_source=fb",
+            "creatives": [{"original_url": url}],
+        },
+        "strategic_analysis": {"marketing_angle": "Social Proof", "emotional_appeal": "Comfort", "key_claims": ["soft"]},
+        "visual_analysis": {"visual_style": "UGC"},
+        "audience_persona": "Commuters who stand all day.",
+    }
+
+
+def test_compact_context_omits_vectors_and_urls():
+    text = compact_ad_context(_row(1))
+
+    assert "0.123456789" not in text
+    assert "fbcdn" not in text and "utm_source" not in text
+    assert "Shop now (cloudshoes.com)" in text
+    assert "angle=Social Proof" in text
+    assert "Audience: Commuters who stand all day." in text
+
+
+def test_reruns_of_the_same_creative_are_merged():
+    rows = [
+        _row(1, similarity=0.9),
+        _row(2, url="https://scontent.fbcdn.net/v/t39/123_n.jpg?stp=dst-jpg&oh=def&oe=2", similarity=0.8),
+        _row(3, url="https://scontent.fbcdn.net/v/t39/456_n.jpg", body="Something else.", similarity=0.7),
+    ]
+
+    nodes = build_context_nodes(rows)
+
+    assert [node.node.metadata["ad_id"] for node in nodes] == [1, 3]
+    assert nodes[0].node.metadata["duplicate_ad_ids"] == [2]
+    assert "Also ran as: 2" in nodes[0].node.get_content()
+    # Client-facing identifiers stay out of the prompt text.
+    assert "similarity" not in nodes[0].node.get_content(metadata_mode="llm")
+
+
+def test_token_budget_keeps_best_node():
+    rows = [_row(ad_id, body=f"Distinct copy number {ad_id}. " * 20) for ad_id in range(5)]
+    first = count_tokens(compact_ad_context(rows[0]))
+
+    assert len(build_context_nodes(rows, token_budget=1)) == 1
+    assert len(build_context_nodes(rows, token_budget=first * 2 + 5)) == 2
+    assert len(build_context_nodes(rows)) == 5
+
+
+def test_select_by_similarity_applies_threshold_and_score_gap():
+    from src.context_builder import select_by_similarity
+
+    rows = [{"ad_id": i, "similarity": s} for i, s in enumerate([0.82, 0.80, 0.78, 0.55, 0.53])]
+
+    assert [row["ad_id"] for row in select_by_similarity(rows)] == [0, 1, 2, 3, 4]
+    assert [row["ad_id"] for row in select_by_similarity(rows, min_similarity=0.6)] == [0, 1, 2]
+    assert [row["ad_id"] for row in select_by_similarity(rows, score_gap=0.1)] == [0, 1, 2]
+    assert select_by_similarity(rows, min_similarity=0.9) == []
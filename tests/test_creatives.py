@@ -0,0 +1,115 @@
+import asyncio
+import stat
+from unittest.mock import patch
+
+import httpx
+import pytest
+from langchain_core.language_models import FakeListChatModel
+
+from src.creatives import Creative, CreativeFetcher, CreativeTooLarge
+from src.enrichment_pipeline import aperform_visual_analysis
+from src.metrics import Metrics
+from src.models import VisualAnalysis
+
+JPEG = b"\xff\xd8\xff\xe0" + b"creative" * 1000
+VIDEO = b"\x00\x00\x00\x18ftypmp42" + b"frames" * 1000
+
+
+class LocalCDN:
+    """Stand-in for the creative CDN behind an `httpx.MockTransport`; counts requests per path."""
+
+    def __init__(self, files, chunked=False):
+        self.files = files
+        self.requests = []
+        self._chunked = chunked
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request.url.path)
+        await asyncio.sleep(0.01)
+        if request.url.path not in self.files:
+            return httpx.Response(404)
+        content_type, body = self.files[request.url.path]
+        if self._chunked: # No Content-Length: the cap must hold while streaming
+            async def stream():
+                for start in range(0, len(body), 1024):
+                    yield body[start:start + 1024]
+            return httpx.Response(200, headers={"content-type": content_type}, content=stream())
+        return httpx.Response(200, headers={"content-type": content_type}, content=body)
+
+
+def _fetcher(tmp_path, cdn, **kwargs):
+    kwargs.setdefault("ffmpeg", "/nonexistent/ffmpeg")
+    return CreativeFetcher(tmp_path / "creatives", transport=httpx.MockTransport(cdn.handle), metrics=Metrics(), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_identical_creatives_are_downloaded_and_processed_once(tmp_path):
+    cdn = LocalCDN({"/a.jpg": ("image/jpeg", JPEG), "/mirror/a.jpg": ("image/jpeg", JPEG)})
+    fetcher = _fetcher(tmp_path, cdn, spool_bytes=1024)
+
+    first, second = await asyncio.gather(
+        fetcher.fetch("https://cdn.example.com/a.jpg?_nc_ohc=1"), fetcher.fetch("https://cdn.example.com/a.jpg?_nc_ohc=1"),
+    )
+    again = await fetcher.fetch("https://cdn.example.com/a.jpg?_nc_ohc=1")
+    mirrored = await fetcher.fetch("https://cdn.example.com/mirror/a.jpg")
+
+    assert cdn.requests == ["/a.jpg", "/mirror/a.jpg"] # Concurrent and repeated fetches share one download
+    assert first.content_hash == second.content_hash == again.content_hash == mirrored.content_hash
+    assert mirrored.images == first.images and first.images[0].read_bytes() == JPEG
+    block = first.content_blocks()[0]
+    assert block["type"] == "image_url" and block["image_url"]["url"].startswith("data:image/jpeg;base64,")
+    await fetcher.aclose()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunked", [False, True])
+async def test_downloads_over_the_size_cap_are_aborted(tmp_path, chunked):
+    cdn = LocalCDN({"/big.mp4": ("video/mp4", VIDEO)}, chunked=chunked)
+    fetcher = _fetcher(tmp_path, cdn, max_bytes=len(VIDEO) - 1)
+
+    with pytest.raises(CreativeTooLarge):
+        await fetcher.fetch("https://cdn.example.com/big.mp4")
+    assert not (tmp_path / "creatives" / "blobs").exists()
+    await fetcher.aclose()
+
+
+@pytest.mark.asyncio
+async def test_videos_are_reduced_to_keyframes(tmp_path):
+    # Fake ffmpeg: writes two frames to the output pattern (its last argument).
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text('#!/bin/sh\nfor last; do :; done\necho "$@" > "$(dirname "$last")/args"\nfor i in 01 02; do printf frame > "$(dirname "$last")/frame_$i.jpg"; done\n')
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    cdn = LocalCDN({"/ad.mp4": ("video/mp4", VIDEO)})
+    fetcher = _fetcher(tmp_path, cdn, ffmpeg=str(ffmpeg), max_frames=2)
+
+    creative = await fetcher.fetch("https://cdn.example.com/ad.mp4")
+
+    assert [image.name for image in creative.images] == ["frame_01.jpg", "frame_02.jpg"]
+    args = (creative.images[0].parent / "args").read_text()
+    assert "eq(pict_type,I)" in args and "-frames:v 2" in args
+    assert not list(creative.images[0].parent.glob("*.video")) # The downloaded video is not kept
+    await fetcher.aclose()
+
+
+@pytest.mark.asyncio
+async def test_visual_analysis_shows_the_fetched_creative_to_the_model(tmp_path):
+    image = tmp_path / "image.jpg"
+    image.write_bytes(JPEG)
+    visual = VisualAnalysis(visual_style="bold", key_visual_elements=["sneaker"], color_palette="neon", overall_impression="loud")
+
+    class FixedFetcher:
+        async def fetch(self, url):
+            return Creative(url, "ab" * 32, "image/jpeg", [image])
+
+    class UnreachableFetcher:
+        async def fetch(self, url):
+            raise httpx.ConnectError("connection refused")
+
+    llm = FakeListChatModel(responses=[visual.model_dump_json()] * 2)
+    with patch.object(FakeListChatModel, "_call", autospec=True, side_effect=FakeListChatModel._call) as call:
+        assert await aperform_visual_analysis("https://cdn.example.com/a.jpg", llm, fetcher=FixedFetcher()) == visual
+        content = call.call_args.args[1][0].content
+        assert content[0]["type"] == "text" and content[1]["type"] == "image_url"
+
+        assert await aperform_visual_analysis("https://cdn.example.com/a.jpg", llm, fetcher=UnreachableFetcher()) == visual
+        assert isinstance(call.call_args.args[1][0].content, str) # Fell back to the URL-only prompt
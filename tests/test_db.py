@@ -0,0 +1,257 @@
+import datetime
+from contextlib import asynccontextmanager
+from unittest.mock import AsyncMock, MagicMock
+from uuid import uuid4
+
+import pytest
+
+from src.db import Database, decode_vector, encode_vector
+
+
+def _database(conn) -> Database:
+    db = Database("postgresql://unused")
+
+    @asynccontextmanager
+    async def connection():
+        yield conn
+
+    db.connection = connection
+    return db
+
+
+def _transactions(conn) -> list:
+    """Makes `conn.transaction()` record how each transaction ended."""
+    outcomes = []
+
+    @asynccontextmanager
+    async def transaction():
+        try:
+            yield
+        except BaseException:
+            outcomes.append("rollback")
+            raise
+        outcomes.append("commit")
+
+    conn.transaction = transaction
+    return outcomes
+
+
+def test_vector_codec_round_trips():
+    assert decode_vector(encode_vector([0.5, -1.0, 2.25])) == [0.5, -1.0, 2.25]
+
+
+@pytest.mark.asyncio
+async def test_insert_ads_uses_one_unnest_statement():
+    conn = MagicMock()
+    conn.fetch = AsyncMock(return_value=[{"id": uuid4(), "ad_id": 1}, {"id": uuid4(), "ad_id": 2}])
+    rows = [
+        {"ad_id": 1, "raw_data_snapshot": {"a": 1}, "status": "PENDING"},
+        {"ad_id": 2, "raw_data_snapshot": {"a": 2}, "status": "PENDING"},
+    ]
+
+    inserted = await _database(conn).insert_ads(rows)
+
+    query, *arrays = conn.fetch.call_args.args
+    assert query == (
+        "INSERT INTO public.ads (ad_id, raw_data_snapshot, status)"
+        " SELECT * FROM unnest($1::bigint[], $2::jsonb[], $3::text[]) RETURNING *"
+    )
+    assert arrays == [[1, 2], [{"a": 1}, {"a": 2}], ["PENDING", "PENDING"]]
+    assert [row["ad_id"] for row in inserted] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_insert_ads_rejects_unknown_or_mixed_columns():
+    db = _database(MagicMock())
+    with pytest.raises(ValueError):
+        await db.insert_ads([{"ad_id": 1, "owner": "x"}])
+    with pytest.raises(ValueError):
+        await db.insert_ads([{"ad_id": 1}, {"ad_id": 2, "status": "PENDING"}])
+
+
+@pytest.mark.asyncio
+async def test_match_ads_filtered_passes_named_arguments():
+    conn = MagicMock()
+    conn.fetch = AsyncMock(return_value=[{"ad_id": 7, "similarity": 0.9}])
+
+    rows = await _database(conn).match_ads_filtered({"match_count": 5, "query_embedding": [0.1], "ef_search": 80})
+
+    query, *values = conn.fetch.call_args.args
+    assert query == "SELECT * FROM public.match_ads_filtered(query_embedding => $1, match_count => $2, ef_search => $3)"
+    assert values == [[0.1], 5, 80]
+    assert rows == [{"ad_id": 7, "similarity": 0.9}]
+
+
+@pytest.mark.asyncio
+async def test_status_lookups_treat_malformed_ids_as_missing():
+    conn = MagicMock()
+    conn.fetchrow = AsyncMock()
+    assert await _database(conn).get_ad_status("not-a-uuid") is None
+    conn.fetchrow.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_latest_enriched_at_is_an_iso_string():
+    conn = MagicMock()
+    conn.fetchval = AsyncMock(return_value=datetime.datetime(2025, 9, 1, 10, tzinfo=datetime.timezone.utc))
+    assert await _database(conn).latest_enriched_at(None) == "2025-09-01T10:00:00+00:00"
+    assert conn.fetchval.call_args.args[1] == {}
+
+
+@pytest.mark.asyncio
+async def test_claim_ad_distinguishes_claimed_taken_and_missing():
+    conn = MagicMock()
+    ad_id = uuid4()
+    conn.fetchrow = AsyncMock(side_effect=[
+        {"claimed": True, "id": ad_id, "status": "ENRICHING"},
+        {"claimed": False, "id": ad_id, "status": "ENRICHED"},
+        None,
+    ])
+    db = _database(conn)
+
+    assert await db.claim_ad(ad_id, "task:1", 300) == (True, {"id": ad_id, "status": "ENRICHING"})
+    assert await db.claim_ad(str(ad_id), "task:1", 300) == (False, {"id": ad_id, "status": "ENRICHED"})
+    assert await db.claim_ad(ad_id, "task:1", 300) == (False, None)
+    assert conn.fetchrow.call_args.args[1:] == (ad_id, "task:1", 300.0)
+
+
+@pytest.mark.asyncio
+async def test_claim_ad_takes_back_its_own_or_an_expired_lease():
+    from src.db import CLAIM_AD_SQL
+
+    assert "lease_owner = $2 OR lease_expires_at < now()" in CLAIM_AD_SQL
+
+
+@pytest.mark.asyncio
+async def test_save_enrichment_uses_one_fixed_statement():
+    from src.db import SAVE_ENRICHMENT_SQL
+
+    conn = MagicMock()
+    conn.execute = AsyncMock(side_effect=["UPDATE 1", "UPDATE 0"])
+    ad_id = uuid4()
+    db = _database(conn)
+
+    assert await db.save_enrichment(ad_id, {"status": "ENRICHED", "audience_persona": "Runners", "vector_summary": [0.1]})
+
+    query, *values = conn.execute.call_args.args
+    assert query == SAVE_ENRICHMENT_SQL
+    assert values == [ad_id, "ENRICHED", None, None, None, None, "Runners", [0.1], None]
+    # Fenced by the lease owner: nothing is written once the lease moved on
+    assert not await db.save_enrichment(ad_id, {"status": "ENRICHED"}, owner="task:1")
+    assert conn.execute.call_args.args[-1] == "task:1"
+
+
+@pytest.mark.asyncio
+async def test_claim_pending_ads_skips_locked_rows_under_a_lease():
+    conn = MagicMock()
+    conn.fetch = AsyncMock(return_value=[])
+    db = _database(conn)
+
+    assert await db.claim_pending_ads(0, 600, "host:1") == []
+    conn.fetch.assert_not_called()
+    await db.claim_pending_ads(16, 600, "host:1")
+    query, limit, lease_seconds, owner = conn.fetch.call_args.args
+    assert "FOR UPDATE SKIP LOCKED" in query and (limit, lease_seconds, owner) == (16, 600.0, "host:1")
+    assert "derived_from IS NULL" in query # Near-duplicates wait for their source ad
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_reports_the_leases_still_held():
+    conn = MagicMock()
+    conn.execute = AsyncMock(return_value="UPDATE 1")
+    db = _database(conn)
+    ad_ids = [uuid4(), uuid4()]
+
+    assert await db.heartbeat([], "host:1", 300) == 0
+    conn.execute.assert_not_called()
+    assert await db.heartbeat([str(ad_id) for ad_id in ad_ids], "host:1", 300) == 1
+    assert conn.execute.call_args.args[1:] == (ad_ids, "host:1", 300.0)
+
+
+@pytest.mark.asyncio
+async def test_save_stage_checkpoints_one_column_with_a_fixed_statement():
+    from src.db import SAVE_STAGE_SQL
+    from src.models import VisualAnalysis
+
+    conn = MagicMock()
+    conn.execute = AsyncMock(return_value="UPDATE 1")
+    db = _database(conn)
+    ad_id = uuid4()
+    visual = VisualAnalysis(visual_style="bold", key_visual_elements=[], color_palette="warm", overall_impression="loud")
+
+    assert await db.save_stage(ad_id, "visual_analysis", visual, owner="task:1")
+    query, *values = conn.execute.call_args.args
+    assert query == SAVE_STAGE_SQL["visual_analysis"]
+    assert values == [ad_id, visual.model_dump(mode="json"), "task:1"]
+    with pytest.raises(ValueError):
+        await db.save_stage(ad_id, "status", "ENRICHED")
+
+
+@pytest.mark.asyncio
+async def test_batch_writes_use_one_unnest_statement_per_stage_and_outcome():
+    from src.db import FINISH_ENRICHMENTS_SQL, SAVE_STAGES_SQL
+
+    conn = MagicMock()
+    conn.execute = AsyncMock(return_value="UPDATE 2")
+    db = _database(conn)
+    ad_ids = [uuid4(), uuid4()]
+
+    assert await db.save_stages("audience_persona", {}, owner="host:1") == 0
+    conn.execute.assert_not_called()
+    assert await db.save_stages("audience_persona", {str(ad_ids[0]): "Parents", str(ad_ids[1]): "Runners"}, owner="host:1") == 2
+    assert conn.execute.call_args.args == (SAVE_STAGES_SQL["audience_persona"], ad_ids, ["Parents", "Runners"], "host:1")
+
+    enriched_at = datetime.datetime(2025, 9, 8)
+    assert await db.finish_enrichments(
+        [
+            {"id": ad_ids[0], "status": "ENRICHED", "enriched_at": enriched_at},
+            {"id": ad_ids[1], "status": "FAILED", "error_log": "visual_analysis: bad JSON"},
+        ],
+        owner="host:1",
+    ) == 2
+    assert conn.execute.call_args.args == (
+        FINISH_ENRICHMENTS_SQL, ad_ids, ["ENRICHED", "FAILED"], [enriched_at, None], [None, "visual_analysis: bad JSON"], "host:1",
+    )
+    with pytest.raises(ValueError):
+        await db.save_stages("status", {ad_ids[0]: "ENRICHED"})
+
+
+@pytest.mark.asyncio
+async def test_reclaim_expired_leases_commits_only_after_before_commit_returns():
+    conn = MagicMock()
+    ad_id = uuid4()
+    conn.fetch = AsyncMock(return_value=[{"id": ad_id}])
+    outcomes = _transactions(conn)
+    db = _database(conn)
+
+    def broker_down(ad_ids):
+        raise ConnectionError("broker unavailable")
+
+    with pytest.raises(ConnectionError):
+        await db.reclaim_expired_leases(10, before_commit=broker_down)
+    requeued = []
+    assert await db.reclaim_expired_leases(10, before_commit=requeued.append) == [str(ad_id)]
+
+    assert outcomes == ["rollback", "commit"]
+    assert requeued == [[str(ad_id)]]
+
+
+
+@pytest.mark.asyncio
+async def test_requeue_failed_ads_dispatches_before_committing():
+    conn = MagicMock()
+    failed, enriched = uuid4(), uuid4()
+    conn.fetch = AsyncMock(return_value=[{"id": failed}])
+    outcomes = _transactions(conn)
+    db = _database(conn)
+
+    def broker_down(ad_ids):
+        raise ConnectionError("broker unavailable")
+
+    with pytest.raises(ConnectionError):
+        await db.requeue_failed_ads([enriched, failed], before_commit=broker_down)
+    dispatched = []
+    assert await db.requeue_failed_ads([enriched, failed], before_commit=dispatched.append) == [str(failed)]
+
+    assert outcomes == ["rollback", "commit"]
+    assert dispatched == [[str(failed)]]
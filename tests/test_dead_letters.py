@@ -0,0 +1,94 @@
+from unittest.mock import AsyncMock
+from uuid import uuid4
+
+import pytest
+from kombu import Connection
+
+from src.dead_letters import DeadLetterQueue, replay_dead_letters
+from src.metrics import Metrics
+
+
+class FailedAds:
+    """`Database.requeue_failed_ads` over in-memory statuses; nothing commits if `before_commit` raises."""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    async def requeue_failed_ads(self, ad_ids, before_commit=None):
+        requeued = [ad_id for ad_id in ad_ids if self.statuses.get(ad_id) == "FAILED"]
+        if requeued and before_commit is not None:
+            before_commit(requeued)
+        self.statuses.update(dict.fromkeys(requeued, "PENDING"))
+        return requeued
+
+
+@pytest.fixture
+def dead_letters():
+    queue = DeadLetterQueue(Connection("memory://"))
+    yield queue
+    for message in queue.take(1000):
+        message.ack()
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_replay_redrives_failed_ads_in_rate_limited_batches(dead_letters):
+    ad_ids = [str(uuid4()) for _ in range(5)]
+    for ad_id in ad_ids:
+        dead_letters.publish("src.tasks.enrichment_task", {"ad_id": ad_id, "force_refresh": ad_id == ad_ids[0]}, "429 quota exceeded")
+    # The last ad was re-enriched since it was dead-lettered: it is dropped.
+    db = FailedAds({**dict.fromkeys(ad_ids, "FAILED"), ad_ids[-1]: "ENRICHED"})
+    dispatched, pauses = [], []
+
+    async def sleep(seconds):
+        pauses.append(seconds)
+
+    counts = await replay_dead_letters(
+        dead_letters, db, lambda ids, force_refresh: dispatched.append((ids, force_refresh)),
+        batch_size=2, rate_per_second=4, sleep=sleep, metrics=Metrics(),
+    )
+
+    assert counts == {"replayed": 4, "dropped": 1}
+    assert [ids for ids, _ in dispatched] == [ad_ids[0:2], ad_ids[2:4]]
+    assert dispatched[0][1] == [True, False]
+    assert len(pauses) == 3 and all(0.2 < pause <= 0.5 for pause in pauses[:2]) # 2 entries at 4/s
+    assert dead_letters.take(10) == []
+
+
+@pytest.mark.asyncio
+async def test_a_failed_dispatch_leaves_the_batch_in_the_dead_letter_queue(dead_letters):
+    ad_id = str(uuid4())
+    dead_letters.publish("src.tasks.enrichment_task", {"ad_id": ad_id}, "boom")
+    db = FailedAds({ad_id: "FAILED"})
+
+    def dispatch(ids, force_refresh):
+        raise ConnectionError("broker unavailable")
+
+    with pytest.raises(ConnectionError):
+        await replay_dead_letters(dead_letters, db, dispatch, sleep=AsyncMock(), metrics=Metrics())
+
+    [message] = dead_letters.take(10)
+    assert message.payload["kwargs"] == {"ad_id": ad_id} and message.payload["error"] == "boom"
+    message.requeue()
+    assert db.statuses == {ad_id: "FAILED"}
+
+
+@pytest.mark.asyncio
+async def test_a_batch_whose_dispatch_failed_replays_on_the_next_run(dead_letters):
+    ad_id = str(uuid4())
+    dead_letters.publish("src.tasks.enrichment_task", {"ad_id": ad_id}, "boom")
+    db = FailedAds({ad_id: "FAILED"})
+    dispatched = []
+
+    def broker_down(ids, force_refresh):
+        raise ConnectionError("broker unavailable")
+
+    with pytest.raises(ConnectionError):
+        await replay_dead_letters(dead_letters, db, broker_down, sleep=AsyncMock(), metrics=Metrics())
+    counts = await replay_dead_letters(
+        dead_letters, db, lambda ids, force_refresh: dispatched.append(ids), sleep=AsyncMock(), metrics=Metrics(),
+    )
+
+    assert counts == {"replayed": 1, "dropped": 0}
+    assert dispatched == [[ad_id]] and db.statuses == {ad_id: "PENDING"}
+
@@ -0,0 +1,57 @@
+from unittest.mock import AsyncMock, MagicMock
+from uuid import uuid4
+
+import pytest
+
+from src.dedup import creative_fingerprint, dedup_stats, hamming_distance, link_duplicates, simhash
+from src.metrics import Metrics
+
+COPY = "Our lightest running shoe yet. Engineered mesh keeps you cool for every mile. Free returns on all orders."
+
+
+def _row(ad_id, body, url="https://scontent.xx.fbcdn.net/v/t39/shoe.jpg?_nc_ohc=1"):
+    return {"ad_id": ad_id, "raw_data_snapshot": {"ad_body_text": body, "cta_text": "Shop Now", "ad_creative_url": url}, "status": "PENDING"}
+
+
+def test_simhash_keeps_edited_copy_close_and_other_copy_far():
+    edited = COPY.replace("Free returns", "FREE returns!!").replace("every mile", "every single mile")
+    other = "Learn Spanish in 15 minutes a day with lessons built by native speakers."
+
+    assert simhash(COPY) == simhash(COPY.upper() + "  https://example.com/shoe")
+    assert hamming_distance(simhash(COPY), simhash(edited)) <= 8
+    assert hamming_distance(simhash(COPY), simhash(other)) > 20
+    assert -(1 << 63) <= simhash(COPY) < 1 << 63 # Fits a BIGINT
+
+
+def test_creative_fingerprint_ignores_signed_fbcdn_parameters():
+    first = creative_fingerprint({"ad_creative_url": "https://scontent-a.xx.fbcdn.net/v/t39/shoe.jpg?_nc_ohc=1&oe=2"})
+    mirror = creative_fingerprint({"ad_creative_url": "https://scontent-b.xx.fbcdn.net/v/t39/shoe.jpg?_nc_ohc=9"})
+    assert first == mirror != creative_fingerprint({"ad_creative_url": "https://scontent-a.xx.fbcdn.net/v/t39/bag.jpg"})
+    assert creative_fingerprint({}) is None
+
+
+@pytest.mark.asyncio
+async def test_duplicates_link_to_an_enriched_source_or_the_first_ad_of_the_chunk():
+    enriched = _row(0, COPY)
+    enriched_id = uuid4()
+    db = MagicMock()
+    db.find_dedup_sources = AsyncMock(return_value=[{
+        "id": enriched_id, "status": "ENRICHED",
+        "creative_fingerprint": creative_fingerprint(enriched["raw_data_snapshot"]),
+        "copy_simhash": simhash(COPY + " Shop Now"),
+    }])
+    metrics = Metrics()
+    rows = [
+        _row(1, COPY), # Same creative and copy as the enriched ad
+        _row(2, "Something else entirely", url="https://cdn.example.com/new.jpg"),
+        _row(3, "Something else, entirely!", url="https://cdn.example.com/new.jpg"), # Duplicate of ad 2
+        _row(4, COPY, url="https://cdn.example.com/other.jpg"), # Same copy, different creative
+        _row(5, COPY), # Forced refresh
+    ]
+
+    await link_duplicates(rows, db, max_distance=6, skip=[False, False, False, False, True], metrics=metrics)
+
+    assert [row["derived_from"] for row in rows] == [enriched_id, None, rows[1]["id"], None, None]
+    assert all(row["id"] and row["creative_fingerprint"] for row in rows)
+    assert len(db.find_dedup_sources.call_args.args[0]) == 3 # One lookup for the chunk's distinct creatives
+    assert dedup_stats(metrics) == {"checked": 4, "duplicates": 2, "copied_at_ingestion": 0, "dedup_ratio": 0.5}
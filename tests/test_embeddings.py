@@ -0,0 +1,118 @@
+import asyncio
+from typing import List, Optional
+
+import pytest
+from langchain_core.embeddings import Embeddings
+
+from src.embeddings import (
+    DOCUMENT_TASK_TYPE,
+    QUERY_TASK_TYPE,
+    EmbeddingService,
+    decode_vector,
+    embedding_stats,
+    encode_vector,
+)
+from src.llm_cache import SQLiteCacheStore
+from src.metrics import Metrics
+
+class RecordingEmbeddings(Embeddings):
+    """Embedding model that records every batched call and its task type."""
+    model = "recording-embedding"
+
+    def __init__(self):
+        self.calls: List[tuple] = []
+
+    def _vector(self, text: str) -> List[float]:
+        return [float(len(text)), 0.1, 0.2]
+
+    def embed_documents(self, texts: List[str], task_type: Optional[str] = None) -> List[List[float]]:
+        self.calls.append((task_type, list(texts)))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str], task_type: Optional[str] = None) -> List[List[float]]:
+        await asyncio.sleep(0.01)
+        return self.embed_documents(texts, task_type=task_type)
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteCacheStore(tmp_path / "embeddings.sqlite3", max_entries=100, table="embedding_cache")
+    yield store
+    store.close()
+
+def test_vectors_round_trip_as_float32_blobs():
+    blob = encode_vector([0.5, -1.25, 3.0])
+    assert len(blob) == 12
+    assert decode_vector(blob) == [0.5, -1.25, 3.0]
+
+def test_embed_query_is_served_from_lru_then_persistent_store(store):
+    model = RecordingEmbeddings()
+    service = EmbeddingService(model, store=store, metrics=Metrics())
+
+    first = service.embed_query("comfy sneakers")
+    assert service.embed_query("comfy sneakers") == first
+    assert len(model.calls) == 1
+    assert model.calls[0][0] == QUERY_TASK_TYPE
+
+    # A fresh process shares only the persistent store.
+    restarted = EmbeddingService(model, store=store, metrics=Metrics())
+    assert restarted.embed_query("comfy sneakers") == first
+    assert len(model.calls) == 1
+    assert embedding_stats(restarted._metrics)["store_hits"] == 1
+
+class UnavailableStore:
+    """Cache store whose backend (Redis, SQLite) is down."""
+
+    def get(self, key):
+        raise ConnectionError("cache unavailable")
+
+    def set(self, key, value, ttl_seconds):
+        raise ConnectionError("cache unavailable")
+
+@pytest.mark.asyncio
+async def test_store_outage_falls_through_to_the_model():
+    model = RecordingEmbeddings()
+    service = EmbeddingService(model, store=UnavailableStore(), metrics=Metrics())
+
+    assert service.embed_query("comfy sneakers") == [14.0, pytest.approx(0.1), pytest.approx(0.2)]
+    assert len(await service.aembed_documents(["lightweight trainers", "trail shoes"])) == 2
+    assert len(model.calls) == 2
+    assert service._metrics.snapshot()["embedding.misses"] == 3
+
+@pytest.mark.asyncio
+async def test_concurrent_embeds_are_coalesced_into_one_call():
+    model = RecordingEmbeddings()
+    service = EmbeddingService(model, batch_window_ms=20, metrics=Metrics())
+
+    vectors = await asyncio.gather(
+        service.aembed_query("a"), service.aembed_query("bb"), service.aembed_query("a"),
+        service.aembed_documents(["ccc"]),
+    )
+
+    assert vectors[0] == vectors[2] == [1.0, pytest.approx(0.1), pytest.approx(0.2)]
+    assert vectors[3][0][0] == 3.0
+    # One call per task type; the duplicate query text is sent once.
+    assert sorted(model.calls) == [(DOCUMENT_TASK_TYPE, ["ccc"]), (QUERY_TASK_TYPE, ["a", "bb"])]
+    stats = embedding_stats(service._metrics)
+    assert stats["api_calls"] == 2 and stats["coalesced"] == 1
+
+@pytest.mark.asyncio
+async def test_batches_are_split_at_max_batch_size():
+    model = RecordingEmbeddings()
+    service = EmbeddingService(model, batch_window_ms=20, max_batch_size=2, metrics=Metrics())
+
+    await service.aembed_documents(["a", "bb", "ccc"])
+
+    assert [len(texts) for _, texts in model.calls] == [2, 1]
+
+@pytest.mark.asyncio
+async def test_model_errors_reach_every_waiting_caller():
+    class FailingEmbeddings(RecordingEmbeddings):
+        async def aembed_documents(self, texts, task_type=None):
+            raise RuntimeError("quota exceeded")
+
+    service = EmbeddingService(FailingEmbeddings(), metrics=Metrics())
+    results = await asyncio.gather(service.aembed_query("a"), service.aembed_query("b"), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
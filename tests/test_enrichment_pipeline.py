@@ -1,5 +1,6 @@
+import asyncio
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 from datetime import datetime
 from uuid import uuid4
 from langchain_core.messages import AIMessage
@@ -11,6 +12,7 @@ from src.enrichment_pipeline import (
     generate_audience_persona,
     generate_vector_summary,
     enrich_ad,
+    aenrich_ad,
 )
 from src.models import AdKnowledgeObject, StrategicAnalysis, VisualAnalysis
 from src.logger import logger
@@ -57,6 +59,7 @@ def mock_embedding_model():
     """Fixture for a mocked GoogleGenerativeAIEmbeddings model."""
     mock = MagicMock()
     mock.embed_query.return_value = [0.1, 0.2, 0.3, 0.4]
+    mock.aembed_query = AsyncMock(return_value=[0.1, 0.2, 0.3, 0.4])
     return mock
 
 @pytest.fixture
@@ -188,10 +191,10 @@ def test_enrich_ad_success(
 
     # Verify that all sub-functions were called
     mock_perform_visual_analysis.assert_called_once_with(
-        MOCK_AD_CREATIVE_URL, mock_gemini_flash
+        MOCK_AD_CREATIVE_URL, mock_gemini_flash, cache=None
     )
     mock_perform_strategic_analysis.assert_called_once_with(
-        MOCK_RAW_AD_DATA, MOCK_TARGETING_DATA, mock_visual_analysis, mock_gemini_pro
+        MOCK_RAW_AD_DATA, MOCK_TARGETING_DATA, mock_visual_analysis, mock_gemini_pro, cache=None
     )
     mock_generate_audience_persona.assert_called_once()
     mock_generate_vector_summary.assert_called_once()
@@ -290,3 +293,163 @@ def test_enrich_ad_missing_ad_creative_url(
     # Ensure no LLM calls were made
     # FakeListChatModel does not have an 'invoke' method to check if called
     assert not mock_embedding_model.embed_query.called
+
+
+# --- Unit Tests for the async enrichment engine ---
+
+@pytest.mark.asyncio
+async def test_aenrich_ad_success(
+    sample_ad_knowledge_object,
+    mock_gemini_flash,
+    mock_gemini_pro,
+    mock_embedding_model,
+    mock_supabase_client,
+):
+    """Tests that the async engine runs all four stages with the fake models."""
+    enriched_ad = await aenrich_ad(
+        sample_ad_knowledge_object,
+        mock_gemini_flash,
+        mock_gemini_pro,
+        mock_embedding_model,
+        mock_supabase_client,
+    )
+
+    assert enriched_ad.status == "ENRICHED"
+    assert enriched_ad.visual_analysis.visual_style == "minimalist"
+    assert enriched_ad.strategic_analysis.marketing_angle == "Feature-Benefit"
+    assert enriched_ad.audience_persona == "Young professionals interested in tech gadgets."
+    assert enriched_ad.vector_summary == [0.1, 0.2, 0.3, 0.4]
+    summary_text = mock_embedding_model.aembed_query.call_args.args[0]
+    assert "Audience: Young professionals interested in tech gadgets." in summary_text
+
+def _recorded(name, result, events):
+    """A stage that records when it starts and ends, yielding to the loop in between."""
+    async def stage(*args, **kwargs):
+        events.append(("start", name))
+        await asyncio.sleep(0)
+        events.append(("end", name))
+        return result
+    return AsyncMock(side_effect=stage)
+
+@pytest.mark.asyncio
+async def test_aenrich_ad_fast_mode_overlaps_independent_stages(
+    sample_ad_knowledge_object,
+    mock_gemini_flash,
+    mock_gemini_pro,
+    mock_embedding_model,
+    mock_supabase_client,
+):
+    """Tests that fast mode runs the stages as two overlapping pairs instead of one after another."""
+    visual = VisualAnalysis(visual_style="bold", key_visual_elements=[], color_palette="warm", overall_impression="loud")
+    strategic = StrategicAnalysis(
+        marketing_angle="Scarcity", emotional_appeal="Urgency", cta_analysis="Clear", key_claims=[], confidence_score=0.8
+    )
+    events = []
+    with patch("src.enrichment_pipeline.aperform_visual_analysis", _recorded("visual", visual, events)), \
+         patch("src.enrichment_pipeline.aperform_strategic_analysis", _recorded("strategic", strategic, events)) as mock_strategic, \
+         patch("src.enrichment_pipeline.agenerate_audience_persona", _recorded("persona", "Bargain hunters", events)), \
+         patch("src.enrichment_pipeline.agenerate_vector_summary", _recorded("vector", [0.1], events)) as mock_vector:
+        enriched_ad = await aenrich_ad(
+            sample_ad_knowledge_object,
+            mock_gemini_flash,
+            mock_gemini_pro,
+            mock_embedding_model,
+            mock_supabase_client,
+            fast_mode=True,
+        )
+
+    assert enriched_ad.status == "ENRICHED"
+    assert enriched_ad.audience_persona == "Bargain hunters"
+    # Each pair starts together, and the second starts once the first has ended.
+    first, second = events[:4], events[4:]
+    assert first[:2] == [("start", "visual"), ("start", "strategic")] and {event for event, _ in first[2:]} == {"end"}
+    assert second[:2] == [("start", "persona"), ("start", "vector")] and {event for event, _ in second[2:]} == {"end"}
+    # The strategic pass is text-only and the summary is embedded without the persona.
+    assert mock_strategic.call_args.args[2] is None
+    assert "Audience" not in mock_vector.call_args.args[0]
+
+@pytest.mark.asyncio
+@patch("src.enrichment_pipeline.aperform_visual_analysis", new_callable=AsyncMock)
+async def test_aenrich_ad_visual_analysis_failure(
+    mock_aperform_visual_analysis,
+    sample_ad_knowledge_object,
+    mock_gemini_flash,
+    mock_gemini_pro,
+    mock_embedding_model,
+    mock_supabase_client,
+):
+    """Tests that the async engine marks the ad FAILED when a stage raises."""
+    mock_aperform_visual_analysis.side_effect = Exception("Visual analysis failed")
+
+    enriched_ad = await aenrich_ad(
+        sample_ad_knowledge_object,
+        mock_gemini_flash,
+        mock_gemini_pro,
+        mock_embedding_model,
+        mock_supabase_client,
+    )
+
+    assert enriched_ad.status == "FAILED"
+    assert "Visual analysis failed" in enriched_ad.error_log
+    assert not mock_embedding_model.aembed_query.called
+
+@pytest.mark.asyncio
+@patch("src.enrichment_pipeline.aperform_visual_analysis", new_callable=AsyncMock)
+async def test_aenrich_ad_raises_rate_limit_errors_for_a_later_retry(
+    mock_aperform_visual_analysis,
+    sample_ad_knowledge_object,
+    mock_gemini_flash,
+    mock_gemini_pro,
+    mock_embedding_model,
+    mock_supabase_client,
+):
+    """Tests that a quota error is not recorded as a failed enrichment."""
+    mock_aperform_visual_analysis.side_effect = Exception("429 RESOURCE_EXHAUSTED: quota exceeded")
+
+    with pytest.raises(Exception, match="RESOURCE_EXHAUSTED"):
+        await aenrich_ad(
+            sample_ad_knowledge_object,
+            mock_gemini_flash,
+            mock_gemini_pro,
+            mock_embedding_model,
+            mock_supabase_client,
+        )
+
+    assert sample_ad_knowledge_object.status != "FAILED"
+
+@pytest.mark.asyncio
+async def test_aenrich_ad_checkpoints_stages_and_resumes_after_the_failed_one(
+    sample_ad_knowledge_object,
+    mock_gemini_flash,
+    mock_gemini_pro,
+    mock_embedding_model,
+):
+    """Tests that a retry repeats only the stages that did not complete."""
+    checkpoints = []
+
+    async def checkpoint(stage, result):
+        checkpoints.append(stage)
+
+    mock_embedding_model.aembed_query = AsyncMock(side_effect=[ConnectionError("embedding timeout"), [0.5]])
+    failed = await aenrich_ad(
+        sample_ad_knowledge_object, mock_gemini_flash, mock_gemini_pro, mock_embedding_model, checkpoint=checkpoint
+    )
+    assert failed.status == "FAILED"
+    assert checkpoints == ["visual_analysis", "strategic_analysis", "audience_persona"]
+    assert failed.stage_status["vector_summary"] == "FAILED"
+
+    # The retry starts from the persisted row: completed stages are not run again.
+    resumed_ad = AdKnowledgeObject(**failed.model_dump())
+    with patch("src.enrichment_pipeline.aperform_visual_analysis", new_callable=AsyncMock) as mock_visual, \
+         patch("src.enrichment_pipeline.aperform_strategic_analysis", new_callable=AsyncMock) as mock_strategic, \
+         patch("src.enrichment_pipeline.agenerate_audience_persona", new_callable=AsyncMock) as mock_persona:
+        enriched_ad = await aenrich_ad(
+            resumed_ad, mock_gemini_flash, mock_gemini_pro, mock_embedding_model, checkpoint=checkpoint
+        )
+
+    assert enriched_ad.status == "ENRICHED"
+    assert enriched_ad.vector_summary == [0.5]
+    mock_visual.assert_not_called()
+    mock_strategic.assert_not_called()
+    mock_persona.assert_not_called()
+    assert checkpoints[-1] == "vector_summary"
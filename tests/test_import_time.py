@@ -0,0 +1,38 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+
+# Cumulative import time budgets, in seconds. Both were ~5-6 s while the
+# client libraries were imported eagerly, and are ~1.5 s without them.
+IMPORT_BUDGET_S = {"src.main": 3.0, "src.celery_app": 3.0}
+
+# Client libraries that must only be imported on first use.
+LAZY_PACKAGES = ("llama_index", "langchain_google_genai", "google.generativeai", "google.genai", "supabase")
+
+
+def _import_times(module: str) -> dict:
+    """Cumulative import time (µs) of every module imported by `import module`, from `python -X importtime`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize("module", sorted(IMPORT_BUDGET_S))
+def test_startup_imports_stay_within_budget(module):
+    times = _import_times(module)
+
+    eager = sorted(name for name in times for package in LAZY_PACKAGES if name == package or name.startswith(package + "."))
+    assert eager == []
+    assert times[module] / 1e6 < IMPORT_BUDGET_S[module]
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+from celery import Celery
+
+from src.celeryconfig import BULK_QUEUE, REALTIME_QUEUE
+from src.config import Settings
+from src.lanes import broker_priority, lane_options, worker_argv
+
+TASK_SECONDS = 0.005
+
+
+def test_lane_options_route_and_prioritize_per_broker():
+    assert lane_options(REALTIME_QUEUE, "amqp://localhost") == {"queue": "realtime", "priority": 9}
+    assert lane_options(REALTIME_QUEUE, "redis://localhost:6379/0") == {"queue": "realtime", "priority": 0} # Redis serves 0 first
+    assert broker_priority(0, "redis://localhost") > broker_priority(5, "redis://localhost")
+    with pytest.raises(ValueError):
+        lane_options("urgent", "amqp://localhost")
+
+
+def test_each_lane_gets_its_own_worker_pool_settings():
+    settings = Settings(SUPABASE_URL="x", SUPABASE_KEY="x", SUPABASE_CONNECTION_STRING="x", GOOGLE_API_KEY="x",
+                        CELERY_BULK_CONCURRENCY=12, CELERY_BULK_PREFETCH=8)
+    argv = worker_argv(BULK_QUEUE, settings, ["--loglevel", "INFO"])
+    assert argv[argv.index("--queues") + 1] == "bulk"
+    assert argv[argv.index("--concurrency") + 1] == "12" and argv[argv.index("--prefetch-multiplier") + 1] == "8"
+    assert argv[-2:] == ["--loglevel", "INFO"]
+
+
+def _run_lanes(app: Celery, pools: dict, backfill: int, realtime: int, realtime_lane: str) -> list:
+    """
+    Runs worker threads over the memory broker (`pools`: lane -> workers), each
+    "executing" a task in TASK_SECONDS, while a backfill of `backfill` tasks
+    goes to `bulk` and `realtime` single ads go to `realtime_lane`, 20 ms
+    apart. Returns the queueing latencies of the realtime ads.
+    """
+    sent_at, latencies, stop = {}, [], threading.Event()
+
+    def worker(lane):
+        with app.connection_for_read() as conn:
+            queue = conn.SimpleQueue(app.amqp.queues[lane])
+            while not stop.is_set():
+                try:
+                    message = queue.get(block=False)
+                except queue.Empty:
+                    time.sleep(0.001)
+                    continue
+                if message.headers["id"] in sent_at:
+                    latencies.append(time.monotonic() - sent_at[message.headers["id"]])
+                time.sleep(TASK_SECONDS)
+                message.ack()
+
+    threads = [threading.Thread(target=worker, args=(lane,)) for lane, workers in pools.items() for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(backfill):
+            app.send_task("src.tasks.enrichment_task", kwargs={"ad_id": f"backfill-{i}"}, **lane_options(BULK_QUEUE, "memory://"))
+        for i in range(realtime):
+            result = app.send_task("src.tasks.enrichment_task", kwargs={"ad_id": f"analyst-{i}"}, **lane_options(realtime_lane, "memory://"))
+            sent_at[result.id] = time.monotonic()
+            time.sleep(0.02)
+        deadline = time.monotonic() + 10
+        while len(latencies) < realtime and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        with app.connection_for_write() as conn:
+            for lane in pools:
+                conn.SimpleQueue(app.amqp.queues[lane]).clear()
+    return latencies
+
+
+def test_realtime_latency_stays_bounded_while_a_backfill_runs():
+    app = Celery("lanes-test", broker="memory://")
+    app.config_from_object("src.celeryconfig")
+
+    laned = _run_lanes(app, {REALTIME_QUEUE: 1, BULK_QUEUE: 2}, backfill=600, realtime=10, realtime_lane=REALTIME_QUEUE)
+    # The old topology: one queue, so single ads wait behind the backfill.
+    shared = _run_lanes(app, {BULK_QUEUE: 3}, backfill=600, realtime=10, realtime_lane=BULK_QUEUE)
+
+    assert len(laned) == len(shared) == 10
+    assert max(laned) < 0.1
+    assert min(shared) > 0.3 # 600 tasks x 5 ms over 3 workers ahead of the first single ad
@@ -0,0 +1,79 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from src.leases import LeaseHeartbeat, lease_owner_id, sweep_expired_leases
+from src.metrics import Metrics
+
+
+def test_task_leases_are_owned_by_the_task_id():
+    assert lease_owner_id("abc") == lease_owner_id("abc") == "task:abc"
+    assert lease_owner_id() != lease_owner_id("abc")
+
+
+@pytest.mark.asyncio
+async def test_sweeper_reclaims_in_batches_and_requeues_them():
+    batches = iter([["a", "b"], ["c", "d"], ["e"]])
+
+    async def reclaim(limit, before_commit=None):
+        ad_ids = next(batches)
+        before_commit(ad_ids)
+        return ad_ids
+
+    db = MagicMock()
+    db.reclaim_expired_leases = AsyncMock(side_effect=reclaim)
+    requeued = []
+    metrics = Metrics()
+
+    assert await sweep_expired_leases(db, requeue=requeued.append, batch_size=2, metrics=metrics) == 5
+
+    assert requeued == [["a", "b"], ["c", "d"], ["e"]]
+    assert [call.args for call in db.reclaim_expired_leases.call_args_list] == [(2,), (2,), (2,)]
+    assert metrics.snapshot() == {"leases.reclaimed": 5, "leases.requeued": 5}
+
+
+class ExpiredLeases:
+    """`Database.reclaim_expired_leases` over in-memory statuses; nothing commits if `before_commit` raises."""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    async def reclaim_expired_leases(self, limit, before_commit=None):
+        ad_ids = [ad_id for ad_id, status in self.statuses.items() if status == "ENRICHING"][:limit]
+        if ad_ids and before_commit is not None:
+            before_commit(ad_ids)
+        self.statuses.update(dict.fromkeys(ad_ids, "PENDING"))
+        return ad_ids
+
+
+@pytest.mark.asyncio
+async def test_a_failed_requeue_leaves_the_ads_to_the_next_sweep():
+    db = ExpiredLeases({"a": "ENRICHING", "b": "ENRICHING"})
+    requeued = []
+
+    def broker_down(ad_ids):
+        raise ConnectionError("broker unavailable")
+
+    with pytest.raises(ConnectionError):
+        await sweep_expired_leases(db, requeue=broker_down, metrics=Metrics())
+    assert await sweep_expired_leases(db, requeue=requeued.append, metrics=Metrics()) == 2
+
+    assert requeued == [["a", "b"]]
+    assert db.statuses == {"a": "PENDING", "b": "PENDING"}
+
+
+@pytest.mark.asyncio
+async def test_heartbeat_extends_held_leases_and_counts_lost_ones():
+    db = MagicMock()
+    db.heartbeat = AsyncMock(return_value=1)
+    metrics = Metrics()
+
+    async with LeaseHeartbeat(db, "host:1", 300, 0.01, ["a", "b"], metrics=metrics) as heartbeat:
+        await asyncio.sleep(0.015)
+        heartbeat.ad_ids.clear()
+        await asyncio.sleep(0.02)
+
+    db.heartbeat.assert_awaited_once()
+    assert sorted(db.heartbeat.call_args.args[0]) == ["a", "b"]
+    assert metrics.snapshot()["leases.lost"] == 1
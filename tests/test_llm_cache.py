@@ -0,0 +1,88 @@
+import time
+import pytest
+from langchain_core.language_models import FakeListChatModel
+
+from src.enrichment_pipeline import perform_visual_analysis, aperform_visual_analysis
+from src.llm_cache import (
+    EnrichmentCache,
+    SQLiteCacheStore,
+    enrichment_cache_stats,
+    normalize_creative_url,
+)
+from src.metrics import Metrics
+from src.models import VisualAnalysis
+
+FBCDN_URL = "https://video.fcaw3-1.fna.fbcdn.net/o1/v/t2/f2/m366/AQPpRu0st.mp4?_nc_cat=109&_nc_sid=5e9851&oh=00_abc&oe=68B2"
+FBCDN_URL_OTHER_EDGE = "https://scontent-ams2-1.xx.fbcdn.net/o1/v/t2/f2/m366/AQPpRu0st.mp4?_nc_cat=110&oh=00_def&oe=68C9"
+
+VISUAL_RESPONSE = VisualAnalysis(
+    visual_style="minimalist",
+    key_visual_elements=["product image"],
+    color_palette="cool tones",
+    overall_impression="clean",
+).model_dump_json()
+
+@pytest.fixture
+def cache(tmp_path):
+    """An EnrichmentCache over a temporary SQLite store with its own metrics."""
+    store = SQLiteCacheStore(tmp_path / "cache.sqlite3", max_entries=100)
+    yield EnrichmentCache(store, ttl_seconds=60, metrics=Metrics())
+    store.close()
+
+def test_normalize_creative_url_strips_volatile_fbcdn_parameters():
+    assert normalize_creative_url(FBCDN_URL) == normalize_creative_url(FBCDN_URL_OTHER_EDGE)
+    assert normalize_creative_url("https://example.com/a.jpg?v=2#top") == "https://example.com/a.jpg?v=2"
+
+def test_cache_key_ignores_ad_id_and_volatile_url_parameters(cache):
+    from src.enrichment_pipeline import strategic_analysis_prompt
+    llm = FakeListChatModel(responses=[""])
+    first = {"raw_ad_data": {"ad_id": 1, "ad_body_text": "Buy  now", "ad_creative_url": FBCDN_URL}}
+    second = {"raw_ad_data": {"ad_id": 2, "ad_body_text": "Buy now", "ad_creative_url": FBCDN_URL_OTHER_EDGE}}
+    different_copy = {"raw_ad_data": {"ad_id": 3, "ad_body_text": "Sale ends today", "ad_creative_url": FBCDN_URL}}
+
+    assert cache.make_key("strategic_analysis", strategic_analysis_prompt, llm, first) == \
+        cache.make_key("strategic_analysis", strategic_analysis_prompt, llm, second)
+    assert cache.make_key("strategic_analysis", strategic_analysis_prompt, llm, first) != \
+        cache.make_key("strategic_analysis", strategic_analysis_prompt, llm, different_copy)
+
+def test_perform_visual_analysis_serves_repeats_from_cache(cache):
+    """The second equivalent request must not reach the model."""
+    model = FakeListChatModel(responses=[VISUAL_RESPONSE, "not json"])
+
+    first = perform_visual_analysis(FBCDN_URL, model, cache=cache)
+    second = perform_visual_analysis(FBCDN_URL_OTHER_EDGE, model, cache=cache)
+
+    assert first == second
+    assert model.i == 1 # Only one response consumed
+    stats = enrichment_cache_stats(cache._metrics)["visual_analysis"]
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["hit_rate"] == 0.5
+
+@pytest.mark.asyncio
+async def test_bypass_skips_lookup_but_refreshes_entry(cache):
+    model = FakeListChatModel(responses=[VISUAL_RESPONSE])
+    await aperform_visual_analysis(FBCDN_URL, model, cache=cache)
+
+    refreshed = VisualAnalysis.model_validate_json(VISUAL_RESPONSE).model_copy(update={"visual_style": "bold"})
+    model = FakeListChatModel(responses=[refreshed.model_dump_json()])
+    result = await aperform_visual_analysis(FBCDN_URL, model, cache=cache.bypass())
+
+    assert result.visual_style == "bold"
+    assert (await aperform_visual_analysis(FBCDN_URL, model, cache=cache)).visual_style == "bold"
+    assert enrichment_cache_stats(cache._metrics)["visual_analysis"]["bypassed"] == 1
+
+def test_sqlite_store_expires_and_evicts_least_recently_used(tmp_path):
+    store = SQLiteCacheStore(tmp_path / "cache.sqlite3", max_entries=2)
+    store.set("expired", "x", ttl_seconds=-1)
+    assert store.get("expired") is None
+
+    store.set("a", "1", ttl_seconds=60)
+    time.sleep(0.01)
+    store.set("b", "2", ttl_seconds=60)
+    time.sleep(0.01)
+    assert store.get("a") == "1" # Touch "a" so that "b" is least recently used
+    time.sleep(0.01)
+    store.set("c", "3", ttl_seconds=60)
+
+    assert store.get("b") is None
+    assert store.get("a") == "1" and store.get("c") == "3"
+    store.close()
@@ -1,9 +1,14 @@
+import asyncio
+import json
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import AsyncMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
 
-from src.main import app
-from src.dependencies import get_supabase, get_gemini_pro, get_embedding_model
+from src.main import app, ingest_and_enrich_ads_stream
+from src.config import Settings
+from src.dedup import ad_copy, creative_fingerprint, simhash
+from src.dependencies import ClientRegistry, get_client_registry, get_db, get_settings
 
 # Create a TestClient instance
 client = TestClient(app)
@@ -20,7 +25,7 @@ def test_health_check():
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
 
-@patch("src.main.synthesize_answer", new_callable=AsyncMock)
+@patch("src.query_engine.synthesize_answer", new_callable=AsyncMock)
 def test_query_ad_intelligence_success(mock_synthesize_answer):
     """
     Tests the /query-ads endpoint, ensuring it returns a successful response
@@ -53,7 +58,63 @@ def test_query_ad_intelligence_success(mock_synthesize_answer):
     assert call_kwargs["query"] == "What are the best performing ads?"
     assert call_kwargs["k"] == 5
 
-@patch("src.main.synthesize_answer", new_callable=AsyncMock)
+@patch("src.query_engine.build_node_postprocessors")
+@patch("src.query_engine.synthesize_answer", new_callable=AsyncMock)
+def test_query_ad_intelligence_passes_score_cutoffs_and_rerank(mock_synthesize_answer, mock_build_node_postprocessors):
+    mock_synthesize_answer.return_value = "answer"
+    reranker = MagicMock()
+    mock_build_node_postprocessors.return_value = [reranker]
+
+    response = client.post("/query-ads", json={
+        "query": "q", "k": 8, "min_similarity": 0.7, "score_gap": 0.15, "rerank": "llm", "rerank_top_n": 3,
+    })
+
+    assert response.status_code == 200
+    call_kwargs = mock_synthesize_answer.call_args.kwargs
+    assert (call_kwargs["min_similarity"], call_kwargs["score_gap"]) == (0.7, 0.15)
+    assert call_kwargs["node_postprocessors"] == [reranker]
+    assert mock_build_node_postprocessors.call_args.args[0] == "llm"
+    assert mock_build_node_postprocessors.call_args.kwargs["top_n"] == 3
+
+@patch("src.query_engine.synthesize_answer", new_callable=AsyncMock)
+def test_query_ad_intelligence_reuses_clients_across_requests(mock_synthesize_answer):
+    """
+    Tests that the Supabase client, LLM and embedding model come from the
+    process-wide registry instead of being rebuilt for every request.
+    """
+    mock_synthesize_answer.return_value = "answer"
+
+    with TestClient(app) as lifespan_client:
+        lifespan_client.post("/query-ads", json={"query": "first"})
+        lifespan_client.post("/query-ads", json={"query": "second"})
+
+    first, second = (call.kwargs for call in mock_synthesize_answer.call_args_list)
+    for name in ("db", "gemini_pro", "embedding_model"):
+        assert first[name] is second[name]
+    assert first["response_synthesizers"] == second["response_synthesizers"] == get_client_registry().response_synthesizer
+    assert get_settings() is get_settings()
+
+def test_shutdown_closes_clients_when_the_query_engine_failed_to_load():
+    registry = MagicMock(aclose=AsyncMock())
+    with patch("src.main.get_client_registry", return_value=registry), \
+         patch("src.main.importlib.import_module", side_effect=ImportError("llama_index is broken")):
+        with TestClient(app):
+            pass
+
+    registry.aclose.assert_awaited_once()
+
+def test_response_synthesizers_live_and_go_with_the_registry():
+    """The shared synthesizers are registry clients: one per mode, rebuilt with the LLM after `aclose`."""
+    registry = ClientRegistry(get_settings())
+    with patch("src.query_engine.create_response_synthesizer", side_effect=lambda llm, streaming=False: MagicMock(llm=llm)):
+        synthesizer = registry.response_synthesizer()
+
+        assert registry.response_synthesizer() is synthesizer and synthesizer.llm is registry.gemini_pro
+        assert registry.response_synthesizer(streaming=True) is not synthesizer
+        asyncio.run(registry.aclose())
+        assert registry.response_synthesizer() is not synthesizer
+
+@patch("src.query_engine.synthesize_answer", new_callable=AsyncMock)
 def test_query_ad_intelligence_api_error(mock_synthesize_answer):
     """
     Tests how the /query-ads endpoint handles an exception from the query engine.
@@ -63,6 +124,190 @@ def test_query_ad_intelligence_api_error(mock_synthesize_answer):
 
     payload = {"query": "This will fail"}
 
-    # The TestClient will raise the exception, so we use pytest.raises
-    with pytest.raises(Exception, match="LLM provider is down"):
-        client.post("/query-ads", json=payload)
+    response = client.post("/query-ads", json=payload)
+
+    # The global exception handler turns it into a 500 with the error as detail.
+    assert response.status_code == 500
+    assert response.json() == {"message": "Internal server error", "detail": "LLM provider is down"}
+
+
+def test_stream_ad_intelligence_streams_ndjson_events():
+    """Events from the query engine are forwarded one NDJSON line each, in order."""
+    async def fake_stream_answer(**kwargs):
+        yield {"type": "retrieval", "ads": [{"ad_id": 1, "similarity": 0.9}]}
+        yield {"type": "token", "text": "Social "}
+        yield {"type": "token", "text": "proof."}
+        yield {"type": "done", "retrieved_ads_count": 1, "timings": {"total_ms": 12.0}}
+
+    with patch("src.query_engine.stream_answer", side_effect=fake_stream_answer) as mock_stream_answer:
+        response = client.post("/query-ads/stream", json={"query": "What works?", "k": 3})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert [event["type"] for event in events] == ["retrieval", "token", "token", "done"]
+    assert mock_stream_answer.call_args.kwargs["k"] == 3
+
+def test_stream_ad_intelligence_reports_failures_as_error_event():
+    async def failing_stream_answer(**kwargs):
+        yield {"type": "retrieval", "ads": []}
+        raise RuntimeError("LLM provider is down")
+
+    with patch("src.query_engine.stream_answer", side_effect=failing_stream_answer):
+        response = client.post("/query-ads/stream", json={"query": "This will fail"})
+
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[-1] == {"type": "error", "detail": "LLM provider is down"}
+
+
+def test_get_ad_status_reads_through_the_database():
+    db = MagicMock()
+    db.get_ad_status = AsyncMock(side_effect=[{"status": "FAILED", "error_log": "boom"}, None])
+    app.dependency_overrides[get_db] = lambda: db
+    try:
+        assert client.get(f"/ads/{uuid4()}/status").json() == {"status": "FAILED", "error_log": "boom"}
+        assert client.get("/ads/unknown/status").status_code == 404
+    finally:
+        app.dependency_overrides.clear()
+
+
+# --- Bulk ingestion ---
+
+def _ingest_item(ad_id: int) -> dict:
+    return {
+        "ad_id": ad_id,
+        "raw_data_snapshot": {"ad_body_text": f"Ad {ad_id}"},
+        "ad_creative_url": f"http://example.com/{ad_id}.jpg",
+    }
+
+@pytest.fixture
+def mock_bulk_db():
+    """Database mock whose bulk insert echoes the rows back with generated UUIDs."""
+    mock = MagicMock()
+    inserted_batches = []
+
+    async def insert_ads(rows):
+        inserted_batches.append(rows)
+        return [{"id": uuid4(), **row} for row in rows]
+
+    mock.insert_ads = AsyncMock(side_effect=insert_ads)
+    mock.find_dedup_sources = AsyncMock(return_value=[])
+    mock.copy_enrichment_from_sources = AsyncMock(return_value=[])
+    mock.inserted_batches = inserted_batches
+    app.dependency_overrides[get_db] = lambda: mock
+    app.dependency_overrides[get_settings] = lambda: Settings(INGEST_INSERT_CHUNK_SIZE=2, INGEST_BATCH_MAX_ITEMS=10)
+    yield mock
+    app.dependency_overrides.clear()
+
+@patch("src.main.dispatch_enrichment_batch")
+def test_ingest_ads_batch_chunks_inserts_and_reports_per_item(mock_dispatch, mock_bulk_db):
+    """
+    Tests that /ingest-ads:batch inserts valid items in chunks, dispatches one
+    group per chunk and returns one result per item in request order.
+    """
+    mock_dispatch.side_effect = lambda ad_ids, force_refresh=(), lanes=(): [f"task-{ad_id}" for ad_id in ad_ids]
+    payload = [_ingest_item(1), {"ad_id": "not-a-number"}, _ingest_item(2), _ingest_item(3)]
+
+    response = client.post("/ingest-ads:batch", json=payload)
+
+    assert response.status_code == 202
+    body = response.json()
+    assert body["accepted"] == 3
+    assert body["rejected"] == 1
+    assert [result["index"] for result in body["results"]] == [0, 1, 2, 3]
+    assert body["results"][1]["status"] == "invalid"
+    for result in (body["results"][0], body["results"][2], body["results"][3]):
+        assert result["status"] == "accepted"
+        assert result["task_id"] == f"task-{result['ad_id']}"
+    assert body["results"][3]["source_ad_id"] == 3
+
+    # Chunk size is 2, so three valid ads become two multi-row inserts.
+    assert [len(rows) for rows in mock_bulk_db.inserted_batches] == [2, 1]
+    assert mock_bulk_db.inserted_batches[0][0]["raw_data_snapshot"]["ad_creative_url"] == "http://example.com/1.jpg"
+    assert mock_dispatch.call_count == 2
+
+@patch("src.main.dispatch_enrichment_batch")
+def test_ingest_ads_batch_marks_chunk_failed_on_insert_error(mock_dispatch, mock_bulk_db):
+    """Tests that a failed multi-row insert fails only the items in that chunk."""
+    mock_bulk_db.insert_ads.side_effect = Exception("connection reset")
+
+    response = client.post("/ingest-ads:batch", json=[_ingest_item(1), _ingest_item(2)])
+
+    assert response.status_code == 202
+    body = response.json()
+    assert body["accepted"] == 0
+    assert all(result["status"] == "failed" for result in body["results"])
+    assert "connection reset" in body["results"][0]["error"]
+    mock_dispatch.assert_not_called()
+
+def test_ingest_ads_batch_rejects_oversized_batch(mock_bulk_db):
+    response = client.post("/ingest-ads:batch", json=[_ingest_item(i) for i in range(11)])
+    assert response.status_code == 413
+
+@patch("src.main.dispatch_enrichment_batch")
+def test_ingest_ads_stream_ndjson(mock_dispatch, mock_bulk_db):
+    """Tests that /ingest-ads:stream returns one NDJSON result per input line."""
+    mock_dispatch.side_effect = lambda ad_ids, force_refresh=(), lanes=(): [f"task-{ad_id}" for ad_id in ad_ids]
+    body = "\n".join([json.dumps(_ingest_item(1)), "{broken", json.dumps(_ingest_item(2)), json.dumps(_ingest_item(3))])
+
+    response = client.post("/ingest-ads:stream", content=body, headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.status_code == 200
+    results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda result: result["index"])
+    assert [result["status"] for result in results] == ["accepted", "invalid", "accepted", "accepted"]
+    assert [len(rows) for rows in mock_bulk_db.inserted_batches] == [2, 1]
+
+@pytest.mark.asyncio
+@patch("src.main.dispatch_enrichment_batch")
+async def test_ingest_ads_stream_sends_each_chunk_before_reading_the_rest(mock_dispatch, mock_bulk_db):
+    """A chunk's results are streamed back while later lines are still unread."""
+    mock_dispatch.side_effect = lambda ad_ids, force_refresh=(), lanes=(): [f"task-{ad_id}" for ad_id in ad_ids]
+    sent = []
+
+    class NDJSONRequest:
+        async def stream(self):
+            for ad_id in (1, 2, 3):
+                sent.append(ad_id)
+                yield (json.dumps(_ingest_item(ad_id)) + "\n").encode()
+
+    response = await ingest_and_enrich_ads_stream(NDJSONRequest(), db=mock_bulk_db, settings=Settings(INGEST_INSERT_CHUNK_SIZE=2))
+    first_chunk = await anext(response.body_iterator)
+
+    assert [json.loads(line)["index"] for line in first_chunk.splitlines()] == [0, 1]
+    assert sent == [1, 2]
+    assert [json.loads(line)["index"] for line in "".join([chunk async for chunk in response.body_iterator]).splitlines()] == [2]
+
+@patch("src.main.dispatch_enrichment_batch")
+def test_ingest_ads_batch_links_near_duplicates_instead_of_dispatching_them(mock_dispatch, mock_bulk_db):
+    """Tests that a near-duplicate in the chunk is stored with `derived_from` and not enqueued."""
+    mock_dispatch.side_effect = lambda ad_ids, force_refresh=(), lanes=(): [f"task-{ad_id}" for ad_id in ad_ids]
+    original = _ingest_item(1)
+    original["raw_data_snapshot"]["ad_body_text"] = "Run further in the lightest trainer we have ever made"
+    duplicate = {**original, "ad_id": 2, "raw_data_snapshot": {"ad_body_text": "Run further in the lightest trainer we have ever made!"}}
+
+    response = client.post("/ingest-ads:batch", json=[original, duplicate])
+
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["accepted", "accepted"]
+    rows = mock_bulk_db.inserted_batches[0]
+    assert rows[1]["derived_from"] == rows[0]["id"] and rows[0]["derived_from"] is None
+    assert results[1]["derived_from"] == str(rows[0]["id"]) and results[1].get("task_id") is None
+    assert mock_dispatch.call_args.args[0] == [results[0]["ad_id"]]
+    mock_bulk_db.copy_enrichment_from_sources.assert_awaited_once_with([rows[1]["id"]])
+
+@patch("src.main.dispatch_enrichment", return_value="task-1")
+def test_ingest_ad_enriches_near_duplicate_when_copying_fails(mock_dispatch, mock_bulk_db):
+    """A near-duplicate whose copy from the source fails is dispatched for its own enrichment."""
+    item = _ingest_item(1)
+    snapshot = {**item["raw_data_snapshot"], "ad_creative_url": item["ad_creative_url"]}
+    source = {"id": uuid4(), "status": "ENRICHED", "creative_fingerprint": creative_fingerprint(snapshot), "copy_simhash": simhash(ad_copy(snapshot))}
+    mock_bulk_db.find_dedup_sources.return_value = [source]
+    mock_bulk_db.insert_ad = AsyncMock(side_effect=lambda row: {"id": uuid4(), **row})
+    mock_bulk_db.copy_enrichment_from_sources.side_effect = Exception("connection reset")
+
+    response = client.post("/ingest-ad", json=item)
+
+    assert response.status_code == 202
+    assert response.json()["task_id"] == "task-1"
+    assert mock_bulk_db.insert_ad.call_args.args[0]["derived_from"] == source["id"]
+    mock_dispatch.assert_called_once()
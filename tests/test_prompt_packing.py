@@ -0,0 +1,93 @@
+import asyncio
+import json
+import re
+from typing import Any, List, Optional
+
+import pytest
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from src.metrics import Metrics
+from src.models import StrategicAnalysis, VisualAnalysis
+from src.prompt_packing import PackedStrategicAnalysis, PromptPacker, parse_pack
+
+VISUAL = VisualAnalysis(visual_style="bold", key_visual_elements=["sneaker"], color_palette="neon", overall_impression="energetic")
+ANALYSIS = {"marketing_angle": "Social Proof", "emotional_appeal": "Belonging", "cta_analysis": "Clear", "key_claims": ["Loved by runners"], "confidence_score": 0.8}
+
+
+class AnsweringChatModel(BaseChatModel):
+    """Answers single-ad and packed strategic/persona prompts; drops the packed items of `omit` ad IDs."""
+
+    omit: List[str] = []
+    prompts: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "answering-fake"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        prompt = messages[-1].content
+        self.prompts.append(prompt)
+        ad_ids = re.findall(r"--- Ad ID: (\S+) ---", prompt)
+        persona = "persona" in prompt.lower().split("\n", 2)[1]
+        if ad_ids:
+            items = [
+                {"ad_id": ad_id, "audience_persona": f"Persona {ad_id}"} if persona else {"ad_id": ad_id, **ANALYSIS}
+                for ad_id in ad_ids if ad_id not in self.omit
+            ]
+            text = f"```json\n{json.dumps({'items': items})}\n```"
+        else:
+            text = "Single persona" if persona else json.dumps(ANALYSIS)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+
+def test_parse_pack_keeps_valid_items_only():
+    text = json.dumps({"items": [{"ad_id": "a", **ANALYSIS}, {"ad_id": "b", "marketing_angle": "Scarcity"}, "junk"]})
+    assert list(parse_pack(f"```json\n{text}\n```", PackedStrategicAnalysis)) == ["a"]
+    assert list(parse_pack(json.dumps([{"ad_id": "c", **ANALYSIS}]), PackedStrategicAnalysis)) == ["c"]
+    assert parse_pack("Sorry, I cannot help with that.", PackedStrategicAnalysis) == {}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_packed_call():
+    llm = AnsweringChatModel(prompts=[])
+    metrics = Metrics()
+    packer = PromptPacker(llm, pack_size=4, window_ms=1000, metrics=metrics)
+
+    results = await asyncio.gather(*(
+        packer.strategic_analysis(f"ad-{i}", {"ad_copy": f"copy {i}"}, {}, VISUAL) for i in range(4)
+    ))
+
+    assert results == [StrategicAnalysis(**ANALYSIS)] * 4
+    assert len(llm.prompts) == 1 # The pack filled up without waiting for the window
+    assert all(f"--- Ad ID: ad-{i} ---" in llm.prompts[0] for i in range(4))
+    assert metrics.snapshot()["prompt_packing.strategic_analysis.items"] == 4
+
+
+@pytest.mark.asyncio
+async def test_calls_for_the_same_ad_in_one_window_share_its_result():
+    llm = AnsweringChatModel(prompts=[])
+    packer = PromptPacker(llm, pack_size=4, window_ms=10, metrics=Metrics())
+
+    results = await asyncio.gather(
+        packer.strategic_analysis("ad-0", {"ad_copy": "copy"}, {}, VISUAL),
+        packer.strategic_analysis("ad-0", {"ad_copy": "copy"}, {}, VISUAL),
+    )
+
+    assert results == [StrategicAnalysis(**ANALYSIS)] * 2
+    assert len(llm.prompts) == 1
+
+@pytest.mark.asyncio
+async def test_items_missing_from_the_pack_fall_back_to_single_ad_calls():
+    llm = AnsweringChatModel(prompts=[], omit=["ad-2"])
+    metrics = Metrics()
+    packer = PromptPacker(llm, pack_size=8, window_ms=10, metrics=metrics)
+
+    personas = await asyncio.gather(*(
+        packer.audience_persona(f"ad-{i}", {"ad_copy": f"copy {i}"}, StrategicAnalysis(**ANALYSIS), VISUAL) for i in range(3)
+    ))
+
+    assert personas == ["Persona ad-0", "Persona ad-1", "Single persona"]
+    assert len(llm.prompts) == 2
+    assert metrics.snapshot()["prompt_packing.audience_persona.fallbacks"] == 1
@@ -0,0 +1,163 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from llama_index.core.schema import QueryBundle
+
+from src.query_engine import SupabaseHybridRetriever
+
+@pytest.mark.asyncio
+async def test_retriever_calls_filtered_ann_rpc_with_tuning_parameters():
+    db = MagicMock()
+    db.match_ads_filtered = AsyncMock(return_value=[])
+    embedding_model = MagicMock()
+    embedding_model.aembed_query = AsyncMock(return_value=[0.1, 0.2])
+    retriever = SupabaseHybridRetriever(
+        db, embedding_model, k=3, filter_criteria={"page_name": "Acme"},
+        ef_search=200, iterative_scan="strict_order",
+    )
+
+    await retriever._aretrieve(QueryBundle("comfy shoes"))
+
+    db.match_ads_filtered.assert_awaited_once_with({
+        "query_embedding": [0.1, 0.2],
+        "match_count": 3,
+        "filter_criteria": {"page_name": "Acme"},
+        "ef_search": 200,
+        "iterative_scan": "strict_order",
+    })
+
+@pytest.mark.asyncio
+async def test_retriever_leaves_unset_tuning_parameters_to_rpc_defaults():
+    db = MagicMock()
+    db.match_ads_filtered = AsyncMock(return_value=[])
+    embedding_model = MagicMock()
+    embedding_model.aembed_query = AsyncMock(return_value=[0.1])
+
+    await SupabaseHybridRetriever(db, embedding_model)._aretrieve(QueryBundle("q"))
+
+    params = db.match_ads_filtered.call_args.args[0]
+    assert "ef_search" not in params and "iterative_scan" not in params
+
+@pytest.mark.asyncio
+async def test_retriever_scores_nodes_by_similarity_and_drops_weak_matches():
+    db = MagicMock()
+    db.match_ads_filtered = AsyncMock(return_value=[
+        {"ad_id": ad_id, "raw_data_snapshot": {"ad_body_text": f"copy {ad_id}"}, "similarity": similarity}
+        for ad_id, similarity in [(1, 0.86), (2, 0.84), (3, 0.61), (4, 0.40)]
+    ])
+    embedding_model = MagicMock()
+    embedding_model.aembed_query = AsyncMock(return_value=[0.1])
+
+    nodes = await SupabaseHybridRetriever(db, embedding_model, k=4, min_similarity=0.5)._aretrieve(QueryBundle("q"))
+    assert [(node.node.metadata["ad_id"], node.score) for node in nodes] == [(1, 0.86), (2, 0.84), (3, 0.61)]
+
+    nodes = await SupabaseHybridRetriever(db, embedding_model, k=4, score_gap=0.1)._aretrieve(QueryBundle("q"))
+    assert [node.node.metadata["ad_id"] for node in nodes] == [1, 2]
+
+@pytest.mark.asyncio
+async def test_stream_answer_emits_retrieval_then_tokens_then_timings():
+    from llama_index.core.llms import MockLLM
+    from src.query_engine import stream_answer
+
+    db = MagicMock()
+    db.match_ads_filtered = AsyncMock(return_value=[
+        {"ad_id": 7, "raw_data_snapshot": {}, "similarity": 0.91, "search_strategy": "prefilter"},
+    ])
+    embedding_model = MagicMock()
+    embedding_model.aembed_query = AsyncMock(return_value=[0.1])
+
+    events = [event async for event in stream_answer("comfy shoes", db, MockLLM(max_tokens=3), embedding_model)]
+
+    assert events[0] == {"type": "retrieval", "ads": [{"ad_id": 7, "similarity": 0.91}]}
+    tokens = [event["text"] for event in events[1:-1]]
+    assert len(tokens) == 3 and all(event["type"] == "token" for event in events[1:-1])
+    done = events[-1]
+    assert done["type"] == "done" and done["retrieved_ads_count"] == 1
+    assert {"embedding_ms", "search_ms", "retrieval_ms", "first_token_ms", "total_ms"} <= done["timings"].keys()
+
+@pytest.mark.asyncio
+async def test_stream_answer_without_tokens_neither_times_nor_caches_them():
+    from llama_index.core.base.response.schema import AsyncStreamingResponse
+    from llama_index.core.llms import MockLLM
+    from src.metrics import Metrics
+    from src.query_engine import SemanticAnswerCache, stream_answer
+
+    async def no_tokens():
+        return
+        yield
+
+    synthesizer = MagicMock()
+    synthesizer.asynthesize = AsyncMock(side_effect=lambda *args, **kwargs: AsyncStreamingResponse(no_tokens()))
+    cache = SemanticAnswerCache(threshold=0.95, metrics=Metrics())
+    db = _answer_cache_db(["2025-09-01T10:00:00+00:00"] * 2)
+    embedding_model = MagicMock()
+    embedding_model.aembed_query = AsyncMock(return_value=[0.1])
+    ask = lambda: stream_answer(
+        "comfy shoes", db, MockLLM(), embedding_model, answer_cache=cache,
+        response_synthesizers=lambda streaming: synthesizer,
+    )
+
+    events = [event async for event in ask()]
+    assert [event["type"] for event in events] == ["retrieval", "done"]
+    assert "first_token_ms" not in events[-1]["timings"]
+
+    await ask().__anext__() # Searches again instead of serving the empty answer
+    assert _searches(db) == 2
+
+def _answer_cache_db(watermarks):
+    """Database mock serving one enriched ad and the given sequence of latest_enriched_at values."""
+    db = MagicMock()
+    db.latest_enriched_at = AsyncMock(side_effect=watermarks)
+    db.match_ads_filtered = AsyncMock(return_value=[{"ad_id": 7, "raw_data_snapshot": {}, "similarity": 0.9}])
+    return db
+
+def _searches(db) -> int:
+    return db.match_ads_filtered.await_count
+
+@pytest.mark.asyncio
+async def test_answer_cache_serves_near_duplicate_queries_until_new_ads_are_enriched():
+    from llama_index.core.llms import MockLLM
+    from src.metrics import Metrics
+    from src.query_engine import SemanticAnswerCache, answer_cache_stats, synthesize_answer
+
+    cache = SemanticAnswerCache(threshold=0.95, metrics=Metrics())
+    db = _answer_cache_db(["2025-09-01T10:00:00+00:00"] * 3 + ["2025-09-02T08:00:00+00:00"])
+    embedding_model = MagicMock()
+    embedding_model.aembed_query = AsyncMock(side_effect=lambda text: [1.0, 0.0] if "angles" in text else [0.0, 1.0])
+    llm = MockLLM(max_tokens=3)
+    ask = lambda query, **kwargs: synthesize_answer(query, db, llm, embedding_model, answer_cache=cache, **kwargs)
+
+    first = await ask("What angles is brand X using?")
+    assert _searches(db) == 1
+    assert await ask("Which angles is brand X using?") == first # Same embedding, same watermark
+    assert _searches(db) == 1
+
+    await ask("What angles is brand X using?", k=3) # Different k: separate entry
+    assert _searches(db) == 2
+
+    await ask("What angles is brand X using?") # A newer enriched ad matches: recompute
+    assert _searches(db) == 3
+    stats = answer_cache_stats(cache._metrics)
+    assert (stats["hits"], stats["misses"], stats["stale"]) == (1, 2, 1)
+    assert stats["latency_saved_ms"] >= 0
+
+def test_answer_cache_respects_similarity_threshold():
+    from src.metrics import Metrics
+    from src.query_engine import SemanticAnswerCache
+
+    cache = SemanticAnswerCache(threshold=0.95, metrics=Metrics())
+    cache.store([1.0, 0.0], {"page_name": "Acme"}, 5, "answer", [], None, latency_ms=900)
+
+    assert cache.lookup([0.99, 0.05], {"page_name": "Acme"}, 5).answer == "answer"
+    assert cache.lookup([0.7, 0.7], {"page_name": "Acme"}, 5) is None
+    assert cache.lookup([1.0, 0.0], {"page_name": "Other"}, 5) is None
+
+def test_build_node_postprocessors_for_rerank_modes():
+    from llama_index.core.llms import MockLLM
+    from src.query_engine import build_node_postprocessors
+
+    assert build_node_postprocessors(None, MockLLM()) == []
+    [reranker] = build_node_postprocessors("llm", MockLLM(), top_n=3)
+    assert reranker.class_name() == "LLMRerank" and reranker.top_n == 3
+    with pytest.raises(ValueError):
+        build_node_postprocessors("cross-encoder", MockLLM())
@@ -0,0 +1,102 @@
+import asyncio
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+
+from src.metrics import Metrics
+from src.models import AdKnowledgeObject
+from src.queue_worker import QueueWorker
+
+
+class InMemoryQueue:
+    """Stand-in for the queue methods of `Database`: claims are atomic like SKIP LOCKED ones."""
+
+    def __init__(self, ads: int):
+        self.rows = {uuid4(): {"ad_id": i, "raw_data_snapshot": {}, "status": "PENDING"} for i in range(ads)}
+        self.saved = []
+        self.claim_sizes = []
+
+    async def claim_pending_ads(self, limit, lease_seconds, owner):
+        await asyncio.sleep(0)
+        batch = [ad_id for ad_id, row in self.rows.items() if row["status"] == "PENDING"][:limit]
+        for ad_id in batch:
+            self.rows[ad_id]["status"] = "ENRICHING"
+        self.claim_sizes.append(len(batch))
+        return [{"id": ad_id, **self.rows[ad_id]} for ad_id in batch]
+
+    async def reclaim_expired_leases(self, limit=1000, before_commit=None):
+        return []
+
+    async def heartbeat(self, ad_ids, owner, lease_seconds):
+        return len(ad_ids)
+
+    async def save_enrichment(self, ad_id, fields, owner=None):
+        self.saved.append(ad_id)
+        self.rows[ad_id]["status"] = fields["status"]
+        return True
+
+
+def _worker(db, metrics, **kwargs):
+    return QueueWorker(db, None, None, None, poll_interval=0.01, metrics=metrics, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_workers_enrich_every_pending_ad_once_within_concurrency():
+    db = InMemoryQueue(ads=50)
+    metrics = Metrics()
+    active, peak = 0, 0
+
+    async def fake_enrich(ad_data: AdKnowledgeObject, **kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.005)
+        active -= 1
+        return ad_data.model_copy(update={"status": "ENRICHED"})
+
+    stop = asyncio.Event()
+    with patch("src.queue_worker.aenrich_ad", side_effect=fake_enrich):
+        workers = [_worker(db, metrics, concurrency=4, batch_size=3) for _ in range(3)]
+        runs = [asyncio.create_task(worker.run(stop)) for worker in workers]
+        while any(row["status"] != "ENRICHED" for row in db.rows.values()):
+            await asyncio.sleep(0.01)
+        stop.set()
+        claimed = await asyncio.gather(*runs)
+
+    assert sum(claimed) == 50
+    assert sorted(db.saved) == sorted(db.rows) # Each ad saved exactly once
+    assert peak <= 12 and max(db.claim_sizes) <= 3
+    assert metrics.snapshot()["queue_worker.enriched"] == 50
+
+
+@pytest.mark.asyncio
+async def test_failed_save_leaves_the_ad_to_lease_expiry():
+    db = InMemoryQueue(ads=1)
+    metrics = Metrics()
+
+    async def failing_save(ad_id, fields, owner=None):
+        raise ConnectionError("connection reset")
+
+    async def fake_enrich(ad_data, **kwargs):
+        return ad_data
+
+    db.save_enrichment = failing_save
+    with patch("src.queue_worker.aenrich_ad", side_effect=fake_enrich):
+        assert await _worker(db, metrics).run(max_ads=1) == 1
+
+    assert list(db.rows.values())[0]["status"] == "ENRICHING"
+    assert metrics.snapshot()["queue_worker.errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_reclaim_counts_expired_leases():
+    db = InMemoryQueue(ads=0)
+    metrics = Metrics()
+
+    async def reclaim(limit=1000, before_commit=None):
+        return [uuid4() for _ in range(7)]
+
+    db.reclaim_expired_leases = reclaim
+    assert await _worker(db, metrics).reclaim() == 7
+    assert metrics.snapshot()["leases.reclaimed"] == 7
@@ -0,0 +1,166 @@
+import asyncio
+import time
+
+import pytest
+
+from src.metrics import Metrics
+from src.rate_limiter import (
+    AdaptiveConcurrency,
+    LocalTokenBucket,
+    ModelRateLimiter,
+    RedisTokenBucket,
+    is_rate_limit_error,
+)
+
+
+class ResourceExhausted(Exception):
+    code = 429
+
+
+class ClientError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} error")
+        self.code = code
+
+
+def _limiter(bucket=None, concurrency=None, metrics=None, **kwargs):
+    return ModelRateLimiter(
+        "test-model",
+        bucket or LocalTokenBucket(1000, 1000),
+        concurrency or AdaptiveConcurrency(8),
+        backoff_base_s=0,
+        metrics=metrics or Metrics(),
+        **kwargs,
+    )
+
+
+def test_rate_limit_errors_are_recognized_through_wrappers():
+    try:
+        try:
+            raise ClientError(429)
+        except ClientError as e:
+            raise RuntimeError("Error embedding content") from e
+    except RuntimeError as wrapped:
+        assert is_rate_limit_error(wrapped)
+    assert is_rate_limit_error(ResourceExhausted())
+    assert not is_rate_limit_error(ClientError(400))
+
+
+def test_token_bucket_queues_reservations_beyond_its_capacity():
+    bucket = LocalTokenBucket(rate_per_s=10, capacity=2)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(0.1, abs=0.01)
+    assert waits[3] == pytest.approx(0.2, abs=0.01)
+
+
+def test_concurrency_halves_on_rate_limits_and_grows_additively():
+    concurrency = AdaptiveConcurrency(8, minimum=1, maximum=10, decrease_cooldown_s=60)
+    assert concurrency.on_rate_limited()
+    assert not concurrency.on_rate_limited() # Same burst
+    assert concurrency.limit == 4
+    for _ in range(5): # About one window of `limit` calls
+        concurrency.on_success()
+    assert int(concurrency.limit) == 5
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_calls_are_retried_and_other_errors_are_not():
+    metrics = Metrics()
+    limiter = _limiter(metrics=metrics, max_retries=3)
+    attempts = []
+
+    async def flaky():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise ResourceExhausted("RESOURCE_EXHAUSTED")
+        return "ok"
+
+    async def broken():
+        raise ValueError("bad request")
+
+    assert await limiter.arun(flaky) == "ok"
+    assert len(attempts) == 3
+    assert metrics.snapshot()["rate_limit.test-model.throttled"] == 2
+    with pytest.raises(ValueError):
+        await limiter.arun(broken)
+    assert limiter.concurrency.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_redis_reservations_do_not_block_the_event_loop():
+    bucket = RedisTokenBucket("redis://localhost:6379/0", "test-model", rate_per_s=1000, capacity=1000)
+
+    def slow_script(keys, args):
+        time.sleep(0.2) # A slow Redis round trip
+        return "0"
+
+    bucket._script = slow_script
+    limiter = _limiter(bucket=bucket)
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    async def call():
+        return "ok"
+
+    ticking = asyncio.create_task(ticker())
+    try:
+        assert await limiter.arun(call) == "ok"
+    finally:
+        ticking.cancel()
+    assert ticks >= 5
+
+
+@pytest.mark.asyncio
+async def test_calls_stay_within_the_concurrency_limit():
+    limiter = _limiter(concurrency=AdaptiveConcurrency(2, maximum=2))
+    active, peak = 0, 0
+
+    async def call():
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+
+    await asyncio.gather(*(limiter.arun(call) for _ in range(10)))
+    assert peak == 2
+
+
+@pytest.mark.asyncio
+async def test_shared_bucket_sustains_the_quota_without_429s():
+    """Simulated quota: three worker processes sharing one bucket, as with the Redis backend."""
+    quota_rps = 40
+    server = {"tokens": quota_rps * 0.5, "updated": time.monotonic(), "rejected": 0, "succeeded": 0}
+
+    async def api_call():
+        now = time.monotonic()
+        server["tokens"] = min(quota_rps * 0.5, server["tokens"] + (now - server["updated"]) * quota_rps)
+        server["updated"] = now
+        if server["tokens"] < 1:
+            server["rejected"] += 1
+            raise ResourceExhausted("RESOURCE_EXHAUSTED")
+        server["tokens"] -= 1
+        await asyncio.sleep(0.02)
+        server["succeeded"] += 1
+
+    shared = LocalTokenBucket(quota_rps, quota_rps * 0.2)
+    limiters = [_limiter(bucket=shared) for _ in range(3)]
+    duration_s = 1.5
+    deadline = time.monotonic() + duration_s
+
+    async def caller(limiter):
+        while time.monotonic() < deadline:
+            await limiter.arun(api_call)
+
+    start = time.monotonic()
+    await asyncio.gather(*(caller(limiter) for limiter in limiters for _ in range(16)))
+    elapsed = time.monotonic() - start
+
+    assert server["rejected"] == 0
+    assert 0.85 * quota_rps <= server["succeeded"] / elapsed <= 1.2 * quota_rps
@@ -0,0 +1,58 @@
+import json
+from unittest.mock import patch
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration
+
+from src.enrichment_pipeline import perform_visual_analysis, visual_analysis_prompt
+from src.metrics import Metrics
+from src.models import VisualAnalysis
+from src.structured_output import StageOutputParser, repair_json, structured_output_stats
+
+VISUAL = VisualAnalysis(visual_style="bold", key_visual_elements=["sneaker"], color_palette="neon", overall_impression="None of the above")
+
+
+@pytest.mark.parametrize("text", [
+    "Here is the analysis:\n```json\n" + VISUAL.model_dump_json() + "\n```",
+    "Sure! " + VISUAL.model_dump_json() + " Let me know if you need more.",
+    VISUAL.model_dump_json()[:-1] + ",}",
+    VISUAL.model_dump_json()[:-5], # Truncated mid-string
+])
+def test_repair_json_recovers_near_valid_replies(text):
+    repaired = json.loads(repair_json(text))
+    assert repaired["visual_style"] == "bold"
+    assert repaired["overall_impression"].startswith("None of the") # Strings are left alone
+
+
+def test_repair_json_maps_python_literals():
+    assert json.loads(repair_json('{"ok": True, "missing": None,}')) == {"ok": True, "missing": None}
+
+
+def test_stage_parser_counts_parsed_repaired_and_failed_replies_and_tokens():
+    metrics = Metrics()
+    parser = StageOutputParser(stage="visual_analysis", pydantic_object=VisualAnalysis)
+    reply = AIMessage(content=VISUAL.model_dump_json(), usage_metadata={"input_tokens": 120, "output_tokens": 40, "total_tokens": 160})
+
+    with patch("src.structured_output.get_metrics", return_value=metrics):
+        assert parser.parse_result([ChatGeneration(message=reply)]) == VISUAL
+        assert parser.parse("```json\n" + VISUAL.model_dump_json() + "\n```") == VISUAL
+        with pytest.raises(OutputParserException):
+            parser.parse("I cannot analyze this image.")
+
+    stats = structured_output_stats(metrics)["visual_analysis"]
+    assert stats["parse_failure_rate"] == pytest.approx(1 / 3) and stats["repair_rate"] == pytest.approx(1 / 3)
+    assert stats["calls"] == 1 and stats["input_tokens_per_call"] == 120 and stats["output_tokens_per_call"] == 40
+
+
+def test_json_stages_use_schema_mode_without_format_instructions():
+    assert "format_instructions" not in visual_analysis_prompt.input_variables + list(visual_analysis_prompt.partial_variables)
+    llm = FakeListChatModel(responses=["```json\n" + VISUAL.model_dump_json() + ",\n```"])
+
+    with patch.object(FakeListChatModel, "_call", autospec=True, side_effect=FakeListChatModel._call) as call:
+        assert perform_visual_analysis("https://cdn.example.com/ad.jpg", llm) == VISUAL
+
+    assert call.call_args.kwargs["response_mime_type"] == "application/json"
+    assert call.call_args.kwargs["response_json_schema"] == VisualAnalysis.model_json_schema()
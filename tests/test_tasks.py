@@ -0,0 +1,134 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from celery.exceptions import Retry
+from unittest.mock import AsyncMock, MagicMock, patch
+from uuid import uuid4
+
+from src.dependencies import get_settings
+from src.models import AdKnowledgeObject
+from src.tasks import enrichment_task
+
+
+@pytest.fixture
+def mock_task_db():
+    db = MagicMock()
+    with patch.object(enrichment_task, "_db", db):
+        yield db
+
+
+def test_enrichment_task_claims_and_saves_in_two_round_trips(mock_task_db):
+    ad_id = uuid4()
+    row = {"id": ad_id, "ad_id": 1, "raw_data_snapshot": {"ad_creative_url": "http://example.com/a.jpg"}, "status": "ENRICHING"}
+    mock_task_db.claim_ad = AsyncMock(return_value=(True, row))
+    mock_task_db.save_enrichment = AsyncMock(return_value=True)
+    enriched = AdKnowledgeObject(**{**row, "status": "ENRICHED", "audience_persona": "Runners"})
+
+    with patch("src.tasks.aenrich_ad", new=AsyncMock(return_value=enriched)):
+        enrichment_task.run(ad_id=str(ad_id))
+
+    claimed_id, owner, _ = mock_task_db.claim_ad.call_args.args
+    assert claimed_id == str(ad_id)
+    saved_id, fields = mock_task_db.save_enrichment.call_args.args
+    assert saved_id == str(ad_id) and mock_task_db.save_enrichment.call_args.kwargs == {"owner": owner}
+    assert fields["status"] == "ENRICHED" and fields["audience_persona"] == "Runners"
+    assert [name for name, *_ in mock_task_db.mock_calls] == ["claim_ad", "save_enrichment"]
+
+
+def test_enrichment_task_skips_ads_that_are_not_pending(mock_task_db):
+    mock_task_db.claim_ad = AsyncMock(return_value=(False, {"id": uuid4(), "status": "ENRICHED"}))
+    mock_task_db.save_enrichment = AsyncMock()
+
+    with patch("src.tasks.aenrich_ad", new=AsyncMock()) as mock_enrich:
+        enrichment_task.run(ad_id=str(uuid4()))
+
+    mock_enrich.assert_not_called()
+    mock_task_db.save_enrichment.assert_not_called()
+
+
+def test_enrichment_task_retries_under_the_same_lease_owner(mock_task_db):
+    ad_id = uuid4()
+    row = {"id": ad_id, "ad_id": 1, "raw_data_snapshot": {}, "status": "ENRICHING"}
+    mock_task_db.claim_ad = AsyncMock(return_value=(True, row))
+    mock_task_db.save_enrichment = AsyncMock(return_value=True)
+    enriched = AdKnowledgeObject(**{**row, "status": "ENRICHED"})
+
+    with patch("src.tasks.aenrich_ad", new=AsyncMock(return_value=enriched)):
+        for _ in range(2):
+            enrichment_task.apply(kwargs={"ad_id": str(ad_id)}, task_id="retried-task")
+
+    owners = {call.args[1] for call in mock_task_db.claim_ad.call_args_list}
+    assert owners == {"task:retried-task"}
+
+
+def test_enrichment_task_retries_a_failed_stage_from_its_checkpoints(mock_task_db):
+    ad_id = uuid4()
+    row = {"id": ad_id, "ad_id": 1, "raw_data_snapshot": {}, "status": "ENRICHING"}
+    mock_task_db.claim_ad = AsyncMock(return_value=(True, row))
+    mock_task_db.save_enrichment = AsyncMock(return_value=True)
+    failed = AdKnowledgeObject(**{**row, "status": "FAILED", "stage_status": {"visual_analysis": "DONE", "strategic_analysis": "FAILED"}})
+
+    with patch("src.tasks.aenrich_ad", new=AsyncMock(return_value=failed)) as mock_enrich, \
+         patch.object(enrichment_task, "retry", side_effect=Retry()) as mock_retry:
+        with pytest.raises(Retry):
+            enrichment_task.run(ad_id=str(ad_id))
+
+    mock_retry.assert_called_once()
+    mock_task_db.save_enrichment.assert_not_called()
+    # Completed stages are written through the checkpoint callback as they finish.
+    checkpoint = mock_enrich.call_args.kwargs["checkpoint"]
+    mock_task_db.save_stage = AsyncMock(return_value=True)
+    asyncio.run(checkpoint("visual_analysis", {"visual_style": "bold"}))
+    mock_task_db.save_stage.assert_awaited_once()
+    assert mock_task_db.save_stage.call_args.args[:2] == (str(ad_id), "visual_analysis")
+
+
+def test_dispatch_routes_each_ad_to_its_lane():
+    from src.tasks import dispatch_enrichment_batch
+
+    with patch("src.tasks.group") as mock_group:
+        mock_group.return_value.apply_async.return_value.results = [MagicMock(id="t1"), MagicMock(id="t2")]
+        assert dispatch_enrichment_batch(["a", "b"], lanes=["realtime", "bulk"]) == ["t1", "t2"]
+
+    signatures = list(mock_group.call_args.args[0])
+    assert [signature.options["queue"] for signature in signatures] == ["realtime", "bulk"]
+    assert signatures[0].options["priority"] != signatures[1].options["priority"]
+
+
+def test_task_clients_are_built_on_first_use():
+    from src.tasks import BaseTaskWithClients
+
+    with patch("src.tasks.get_client_registry") as mock_registry:
+        task = BaseTaskWithClients()
+        mock_registry.assert_not_called()
+        assert task.db is task.db is mock_registry.return_value.db
+
+    mock_registry.assert_called_once()
+
+
+def test_pool_threads_share_the_worker_loop_up_to_the_in_flight_limit(mock_task_db):
+    running = peak = 0
+
+    async def slow_enrich(ad_data, **kwargs):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return ad_data.model_copy(update={"status": "ENRICHED"})
+
+    mock_task_db.claim_ad = AsyncMock(side_effect=lambda ad_id, owner, lease: (True, {"id": ad_id, "ad_id": 1, "raw_data_snapshot": {}, "status": "ENRICHING"}))
+    mock_task_db.save_enrichment = AsyncMock(return_value=True)
+    settings = get_settings().model_copy(update={"WORKER_MAX_IN_FLIGHT": 3})
+
+    with patch("src.tasks.aenrich_ad", side_effect=slow_enrich), \
+         patch("src.tasks.get_settings", return_value=settings), patch("src.tasks._in_flight", None):
+        started = time.monotonic()
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda _: enrichment_task.run(ad_id=str(uuid4())), range(9)))
+        elapsed = time.monotonic() - started
+
+    assert peak == 3 # Concurrent, but never beyond WORKER_MAX_IN_FLIGHT
+    assert elapsed < 9 * 0.05 and mock_task_db.save_enrichment.await_count == 9